@@ -0,0 +1,169 @@
+#! /usr/bin/env python
+##########################################################################
+# NSAp - Copyright (C) CEA, 2016
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+"""
+Benchmark the registration presets on a stand-in registration.
+
+Connectomist is not needed: a synthetic phantom is registered on a
+translated copy of itself with a mutual information, coordinate descent,
+multi-resolution stand-in driven by the preset parameters. The stand-in
+uses the 'levelCount' histogram bins, the 'subSamplingMaximumSizes'
+levels, the 'stepSize' and 'stoppingCriterionError' relative to the
+translation search range and the 'maximumIterationCount'. The runtimes
+are relative costs of the presets, not Connectomist runtimes.
+
+The results are reported in 'doc/source/registration_presets.rst'.
+"""
+
+# System import
+from __future__ import print_function
+import argparse
+import time
+import numpy
+
+# pyConnectomist import
+from pyconnectomist.utils.regtools import REGISTRATION_PRESETS
+from pyconnectomist.utils.regtools import apply_registration_preset
+
+# The Connectomist DW to T1 registration parameters used by the stand-in,
+# the subsampling levels being scaled to the phantom size
+BASE_PARAMETERS = {
+    "levelCount": 32,
+    "maximumIterationCount": 1000,
+    "stepSize": 0.1,
+    "stoppingCriterionError": 0.01,
+    "maximumTolerance": 0.01,
+    "optimizerParametersTranslationX": 30,
+    "subSamplingMaximumSizes": "32 64"}
+
+# The phantom translation in voxels
+TRANSLATION = numpy.array([2.3, -1.7, 3.1])
+
+
+def phantom(size, seed=0):
+    """ Create a phantom: an ellipsoid with Gaussian blobs.
+    """
+    rng = numpy.random.RandomState(seed)
+    grid = numpy.indices((size, ) * 3).astype(float) / size - 0.5
+    radii = numpy.array([0.4, 0.35, 0.3]).reshape(3, 1, 1, 1)
+    volume = 100. * (((grid / radii) ** 2).sum(axis=0) < 1)
+    for _ in range(12):
+        center = rng.uniform(-0.25, 0.25, 3)
+        width = rng.uniform(0.03, 0.1)
+        volume += rng.uniform(50, 200) * numpy.exp(-(
+            (grid - center.reshape(3, 1, 1, 1)) ** 2).sum(axis=0) /
+            (2 * width ** 2))
+    return volume
+
+
+def resample(volume, coords):
+    """ Trilinear interpolation of a volume at (3, N) voxel coordinates.
+    """
+    shape = numpy.array(volume.shape).reshape(3, 1)
+    coords = numpy.clip(coords, 0, shape - 1.001)
+    lower = numpy.floor(coords).astype(int)
+    weights = coords - lower
+    values = 0.
+    for corner in numpy.ndindex(2, 2, 2):
+        corner = numpy.array(corner).reshape(3, 1)
+        weight = numpy.prod(numpy.where(corner, weights, 1 - weights), axis=0)
+        values = values + weight * volume[tuple(lower + corner)]
+    return values
+
+
+def mutual_information(reference, floating, level_count):
+    """ Mutual information of two intensity samples.
+    """
+    joint, _, _ = numpy.histogram2d(reference, floating, bins=level_count)
+    joint /= joint.sum()
+    marginals = numpy.outer(joint.sum(axis=1), joint.sum(axis=0))
+    nonzero = joint > 0
+    return (joint[nonzero] * numpy.log(
+        joint[nonzero] / marginals[nonzero])).sum()
+
+
+def register(reference, floating, parameters):
+    """ Estimate the translation of the floating volume.
+    """
+    search_range = parameters["optimizerParametersTranslationX"]
+    translation = numpy.zeros(3)
+    evaluations = 0
+    for size in str(parameters["subSamplingMaximumSizes"]).split():
+        factor = int(numpy.ceil(max(reference.shape) / float(size)))
+        coords = numpy.indices(reference.shape)[
+            :, ::factor, ::factor, ::factor].reshape(3, -1).astype(float)
+        samples = resample(reference, coords)
+
+        def similarity(translation):
+            return mutual_information(
+                samples, resample(floating, coords + translation.reshape(
+                    3, 1)), parameters["levelCount"])
+
+        best = similarity(translation)
+        evaluations += 1
+        step = parameters["stepSize"] * search_range
+        for _ in range(parameters["maximumIterationCount"]):
+            if step < parameters["stoppingCriterionError"] * search_range:
+                break
+            improved = False
+            for axis in range(3):
+                for sign in (-1, 1):
+                    candidate = translation.copy()
+                    candidate[axis] += sign * step
+                    value = similarity(candidate)
+                    evaluations += 1
+                    if value > best:
+                        best, translation, improved = value, candidate, True
+            if not improved:
+                step /= 2.
+    return translation, evaluations
+
+
+def benchmark(size=64, repeat=3):
+    """ Time each preset on the stand-in registration.
+    """
+    reference = phantom(size)
+    coords = numpy.indices(reference.shape).reshape(3, -1).astype(float)
+    floating = resample(reference, coords - TRANSLATION.reshape(3, 1))
+    floating = floating.reshape(reference.shape)
+    results = []
+    presets = sorted(REGISTRATION_PRESETS, key=lambda name: (
+        REGISTRATION_PRESETS[name]["maximumIterationCount"]))
+    for preset in [None] + presets:
+        parameters = apply_registration_preset(BASE_PARAMETERS, preset)
+        runtimes = []
+        for _ in range(repeat):
+            start = time.time()
+            translation, evaluations = register(
+                reference, floating, parameters)
+            runtimes.append(time.time() - start)
+        results.append((preset or "none", min(runtimes), evaluations,
+                        numpy.linalg.norm(translation - TRANSLATION)))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("-s", "--size", type=int, default=64,
+                        help="the phantom size in voxels.")
+    parser.add_argument("-r", "--repeat", type=int, default=3,
+                        help="the number of timed runs, the best is kept.")
+    args = parser.parse_args()
+    print("========  ===========  ===========  ===============")
+    print("Preset    Runtime (s)  Evaluations  Error (voxels)")
+    print("========  ===========  ===========  ===============")
+    for preset, runtime, evaluations, error in benchmark(
+            args.size, args.repeat):
+        print("{0:<8}  {1:<11.2f}  {2:<11d}  {3:.2f}".format(
+            preset, runtime, evaluations, error))
+    print("========  ===========  ===========  ===============")
+
+
+if __name__ == "__main__":
+    main()
@@ -12,13 +12,28 @@ Wrapper to Connectomist's 'Fast bundle labeling' tab.
 # System import
 import os
 import glob
+import json
+import logging
+import numpy
 
 # Clindmri import
 from pyconnectomist import DEFAULT_CONNECTOMIST_PATH
 from pyconnectomist.exceptions import ConnectomistBadFileError
 from pyconnectomist.exceptions import ConnectomistError
 from pyconnectomist.wrappers import ConnectomistWrapper
-from pyconnectomist.utils.filetools import ptk_bundle_to_trk
+from pyconnectomist.utils.bundletools import bundle_to_trk
+from pyconnectomist.utils.bundletools import bundles_to_trx
+from pyconnectomist.utils.bundletools import compress_bundles
+from pyconnectomist.utils.bundletools import merge_bundles_to_trk
+from pyconnectomist.utils.bundletools import read_bundles_header
+from pyconnectomist.utils.bundletools import iter_bundles
+from pyconnectomist.utils.bundletools import save_bundles_header
+from pyconnectomist.utils.bundletools import trk_buffer
+from pyconnectomist.utils.bundletools import merge_bundle_maps
+from pyconnectomist.utils.paralleltools import parallel_map
+
+# Module logger
+logger = logging.getLogger(__name__)
 
 # Set for checking bundle names that can take values in a finite set
 BUNDLE_NAMES = frozenset([
@@ -73,6 +88,9 @@ BOOL_MAP = {
     True: 2
 }
 
+# Number of points of the fibers resampled by the fast bundle labeling
+LABELING_RESAMPLED_POINTS = 21
+
 
 def fast_bundle_labeling(
         outdir,
@@ -86,6 +104,10 @@ def fast_bundle_labeling(
         nb_fibers_to_process_at_once=50000,
         resample_fibers=True,
         remove_temporary_files=True,
+        memory_budget=None,
+        memory_model=None,
+        record_memory=False,
+        morphologist_index=None,
         path_connectomist=DEFAULT_CONNECTOMIST_PATH):
     """ Wrapper to Connectomist's 'Fast Bundle Labeling' tab.
 
@@ -115,6 +137,20 @@ def fast_bundle_labeling(
         resampled.
     remove_temporary_files: bool, optional
         If True remove temporary files.
+    memory_budget: int, optional
+        The memory in MB available for the labeling. If specified, the
+        'nb_fibers_to_process_at_once' is ignored and set to the largest
+        value allowed by the 'memory_model'.
+    memory_model: 3-uplet, optional
+        The labeling memory model fitted on recorded runs with
+        'fit_labeling_memory_model', mandatory with a 'memory_budget'.
+    record_memory: bool, optional
+        If True record the fiber counts, the chunk size and the peak memory
+        of the Connectomist call in the 'fiber_chunking.json' output file.
+        Always True when a 'memory_budget' is specified.
+    morphologist_index: MorphologistIndex, optional
+        An index of the Morphologist files used instead of listing the
+        Morphologist directory.
     path_connectomist: str, optional
         Path to the Connectomist executable.
 
@@ -144,12 +180,20 @@ def fast_bundle_labeling(
                         bundle_name, BUNDLE_NAMES))
     else:
         bundle_names = BUNDLE_NAMES
+    if memory_budget is not None and memory_model is None:
+        raise ConnectomistError(
+            "A 'memory_model' fitted on recorded runs is required to size "
+            "the fiber chunks from a memory budget.")
 
     # Get Connectomist transformations
     dwtot1file = os.path.join(registered_dwi_dir, "dw_to_t1.trm")
     morphologist_regpattern = os.path.join(
         morphologist_dir, subject_id, "t1mri", "*", "registration")
-    morphologist_regdirs = glob.glob(morphologist_regpattern)
+    if morphologist_index is not None:
+        morphologist_regdirs = morphologist_index.find(subject_id,
+                                                       "registration")
+    else:
+        morphologist_regdirs = glob.glob(morphologist_regpattern)
     if len(morphologist_regdirs) != 1:
         raise ConnectomistBadFileError(morphologist_regpattern)
     morphologist_regdir = morphologist_regdirs[0]
@@ -164,6 +208,14 @@ def fast_bundle_labeling(
         if not os.path.isfile(path):
             raise ConnectomistBadFileError(path)
 
+    # Size the fiber chunks from the memory budget
+    if memory_budget is not None:
+        nb_fibers_to_process_at_once = fiber_chunk_size(
+            paths_bundle_map, memory_budget, memory_model,
+            resample_fibers=resample_fibers)
+    logger.info("Labeling the fibers by chunks of %d fibers.",
+                nb_fibers_to_process_at_once)
+
     # Dict with all parameters for connectomist
     algorithm = "DWI-Fast-Bundle-Labelling"
     parameters_dict = {
@@ -195,17 +247,292 @@ def fast_bundle_labeling(
     }
 
     # Call with Connectomist
+    record_memory = record_memory or memory_budget is not None
     connprocess = ConnectomistWrapper(path_connectomist)
     parameter_file = ConnectomistWrapper.create_parameter_file(
         algorithm, parameters_dict, outdir)
-    connprocess(algorithm, parameter_file, outdir)
+    connprocess(algorithm, parameter_file, outdir,
+                track_memory=record_memory)
+
+    # Record the chunk size and the peak memory of this Connectomist call
+    # (in KB) so that the memory model can be fitted
+    if record_memory:
+        nb_fibers, nb_points = fiber_point_counts(paths_bundle_map)
+        with open(os.path.join(outdir, "fiber_chunking.json"), "wt") as \
+                open_file:
+            json.dump({
+                "memory_budget": memory_budget,
+                "nb_fibers_to_process_at_once": nb_fibers_to_process_at_once,
+                "nb_fibers": nb_fibers,
+                "nb_points": nb_points,
+                "resample_fibers": resample_fibers,
+                "peak_memory": connprocess.peak_memory}, open_file, indent=4)
 
     return outdir
 
 
+def fiber_point_counts(paths_bundle_map):
+    """ Count the fibers and the fiber points of bundle maps.
+
+    The counts are read from the bundle map headers and data sizes, without
+    loading the fibers: each fiber is stored as an int32 number of points
+    followed by the float32 (x, y, z) coordinates.
+
+    Parameters
+    ----------
+    paths_bundle_map: list of str
+        Paths to the bundle maps.
+
+    Returns
+    -------
+    nb_fibers: int
+        the number of fibers.
+    nb_points: int
+        the number of fiber points.
+    """
+    nb_fibers = 0
+    nb_points = 0
+    for path in paths_bundle_map:
+        header, datafile = read_bundles_header(path)
+        nb_map_fibers = int(header["curves_count"])
+        nb_fibers += nb_map_fibers
+        nb_points += (os.path.getsize(datafile) // 4 - nb_map_fibers) // 3
+
+    return nb_fibers, nb_points
+
+
+def fit_labeling_memory_model(records):
+    """ Fit the fast bundle labeling memory model on recorded runs.
+
+    The peak memory of a labeling is modeled as a fixed cost (atlas and
+    process), plus a cost per fiber and a cost per fiber point of a chunk,
+    the points added by the resampling being included. To measure the model
+    on a given installation, label real bundle maps with 'record_memory'
+    set, using at least three different 'nb_fibers_to_process_at_once'
+    values and bundle maps with different fiber lengths (for instance the
+    tractographies of two subjects with two storing increments), then fit
+    the model on the produced 'fiber_chunking.json' files.
+
+    Parameters
+    ----------
+    records: list of str
+        Paths to the 'fiber_chunking.json' files of the recorded runs.
+
+    Returns
+    -------
+    memory_model: 3-uplet
+        the fixed cost, the cost per fiber and the cost per fiber point in
+        bytes.
+    """
+    # Build the linear system: the peak memory is recorded in KB
+    system = []
+    peaks = []
+    for path in records:
+        with open(path, "rt") as open_file:
+            record = json.load(open_file)
+        if record["nb_fibers"] == 0 or record["peak_memory"] is None:
+            continue
+        chunk_size = min(record["nb_fibers_to_process_at_once"],
+                         record["nb_fibers"])
+        points_per_fiber = float(record["nb_points"]) / record["nb_fibers"]
+        if record["resample_fibers"]:
+            points_per_fiber += LABELING_RESAMPLED_POINTS
+        system.append((1., chunk_size, chunk_size * points_per_fiber))
+        peaks.append(record["peak_memory"] * 1024.)
+    system = numpy.asarray(system, dtype=numpy.float64).reshape(-1, 3)
+    if numpy.linalg.matrix_rank(system) < 3:
+        raise ValueError(
+            "The recorded runs do not constrain the memory model: use at "
+            "least three chunk sizes and two fiber lengths.")
+
+    # Least squares fit, the costs being positive
+    model = numpy.linalg.lstsq(system, numpy.asarray(peaks), rcond=None)[0]
+
+    return tuple(float(max(value, 0.)) for value in model)
+
+
+def fiber_chunk_size(paths_bundle_map, memory_budget, memory_model,
+                     resample_fibers=True):
+    """ Compute the largest number of fibers that can be labeled at once
+    within a memory budget.
+
+    The fiber and point counts are read from the bundle map headers and
+    data sizes, without loading the fibers.
+
+    Parameters
+    ----------
+    paths_bundle_map: list of str
+        Paths to the bundle maps.
+    memory_budget: int
+        The memory in MB available for the labeling.
+    memory_model: 3-uplet
+        The fixed cost, the cost per fiber and the cost per fiber point in
+        bytes, as returned by 'fit_labeling_memory_model'.
+    resample_fibers: bool, optional
+        If True the fibers are resampled during the labeling.
+
+    Returns
+    -------
+    nb_fibers_to_process_at_once: int
+        the fiber chunk size.
+
+    Raises
+    ------
+    ConnectomistError: if the memory budget is below the fixed cost of the
+        memory model.
+    """
+    # Get the fiber and point counts
+    nb_fibers, nb_points = fiber_point_counts(paths_bundle_map)
+    if nb_fibers == 0:
+        return 1
+
+    # Apply the memory model
+    base_memory, fiber_memory, point_memory = memory_model
+    points_per_fiber = float(nb_points) / nb_fibers
+    if resample_fibers:
+        points_per_fiber += LABELING_RESAMPLED_POINTS
+    fiber_memory += point_memory * points_per_fiber
+    available = memory_budget * 1024 ** 2 - base_memory
+    if available <= 0:
+        raise ConnectomistError(
+            "The {0} MB memory budget is below the {1:.0f} MB base cost of "
+            "the labeling.".format(memory_budget, base_memory / 1024. ** 2))
+    if fiber_memory <= 0:
+        return nb_fibers
+    chunk_size = int(available // fiber_memory)
+
+    return max(1, min(chunk_size, nb_fibers))
+
+
+def sharded_fast_bundle_labeling(
+        outdir,
+        registered_dwi_dir,
+        morphologist_dir,
+        subject_id,
+        paths_bundle_map,
+        nb_shards=2,
+        chunk_size=100000,
+        **kwargs):
+    """ Fast bundle labeling split in independent shards.
+
+    The fibers of the input bundle maps are streamed chunk by chunk in
+    shards with balanced fiber counts. Each shard is labeled in parallel in a
+    'shard_<i>' sub-directory and the
+    'bundleMapsReferential/<region>/*.bundles' outputs are merged in the
+    output directory following the shard order.
+
+    Parameters
+    ----------
+    outdir: str
+        Path to the Connectomist output working directory.
+    registered_dwi_dir: str
+        path to Connectomist register DWI directory.
+    morphologist_dir: str
+        path to Morphologist directory.
+    subject_id: str
+        the subject identifier.
+    paths_bundle_map: list of str
+        Paths to the bundle maps.
+    nb_shards: int (optional, default 2)
+        the number of shards, limited by the number of fibers.
+    chunk_size: int (optional, default 100000)
+        the number of input fibers loaded at once to write the shards.
+    kwargs: dict
+        the other 'fast_bundle_labeling' parameters: a 'memory_budget' is
+        shared between the shards.
+
+    Returns
+    -------
+    outdir: str
+        path to Connectomist's output directory.
+    """
+    # Check input parameter files existence
+    for path in paths_bundle_map:
+        if not os.path.isfile(path):
+            raise ConnectomistBadFileError(path)
+    if not os.path.isdir(outdir):
+        os.mkdir(outdir)
+
+    # Split the fibers in balanced shards
+    nb_fibers, _ = fiber_point_counts(paths_bundle_map)
+    header = None
+    if len(paths_bundle_map) > 0:
+        header, _ = read_bundles_header(paths_bundle_map[0])
+    nb_shards = max(1, min(nb_shards, nb_fibers))
+    bounds = [(nb_fibers * index) // nb_shards
+              for index in range(nb_shards + 1)]
+    if kwargs.get("memory_budget") is not None:
+        kwargs = dict(kwargs)
+        kwargs["memory_budget"] = kwargs["memory_budget"] // nb_shards
+    shards = []
+    for index, (start, stop) in enumerate(zip(bounds[:-1], bounds[1:])):
+        shard_dir = os.path.join(outdir, "shard_{0}".format(index))
+        if not os.path.isdir(shard_dir):
+            os.mkdir(shard_dir)
+        shard_bundle = save_bundles_header(
+            os.path.join(shard_dir, "fibers.bundles"), stop - start,
+            header=header)
+        shards.append(((shard_dir, registered_dwi_dir, morphologist_dir,
+                        subject_id, [shard_bundle]), kwargs))
+
+    # Stream the input fibers in the shard binary files, so that only one
+    # chunk of fibers is loaded at once
+    shard_files = [
+        open(os.path.splitext(args[4][0])[0] + ".bundlesdata", "wb")
+        for args, _ in shards]
+    try:
+        index = 0
+        position = 0
+        for path in paths_bundle_map:
+            for points, offsets in iter_bundles(path, chunk_size):
+                first = 0
+                while first < len(offsets) - 1:
+                    while position >= bounds[index + 1]:
+                        index += 1
+                    last = min(len(offsets) - 1,
+                               first + bounds[index + 1] - position)
+                    buffer = trk_buffer(
+                        points[offsets[first]: offsets[last]],
+                        offsets[first: last + 1] - offsets[first])
+                    buffer.tofile(shard_files[index])
+                    position += last - first
+                    first = last
+    finally:
+        for open_file in shard_files:
+            open_file.close()
+
+    # Label each shard in its own Connectomist call
+    shard_dirs = parallel_map(_fast_bundle_labeling, shards,
+                              nb_workers=nb_shards)
+
+    # Merge the shard labeled bundle maps
+    labeled = {}
+    for shard_dir in shard_dirs:
+        for path in glob.glob(os.path.join(
+                shard_dir, "bundleMapsReferential", "*", "*.bundles")):
+            region = os.path.basename(os.path.dirname(path))
+            key = (region, os.path.basename(path))
+            labeled.setdefault(key, []).append(path)
+    for (region, basename), paths in sorted(labeled.items()):
+        region_dir = os.path.join(outdir, "bundleMapsReferential", region)
+        if not os.path.isdir(region_dir):
+            os.makedirs(region_dir)
+        merge_bundle_maps(paths, os.path.join(region_dir, basename))
+
+    return outdir
+
+
+def _fast_bundle_labeling(shard):
+    """ Run the fast bundle labeling of a shard.
+    """
+    args, kwargs = shard
+    return fast_bundle_labeling(*args, **kwargs)
+
+
 def export_bundles_to_trk(
         labeling_dir,
-        outdir=None):
+        outdir=None,
+        nb_threads=1):
     """ After Connectomist has done the fibers labeling, convert the result
     to Trackvis format.
 
@@ -216,6 +543,8 @@ def export_bundles_to_trk(
     outdir: str (optional)
         path to directory where to output.
         By default <outdir> is <labeling_dir>.
+    nb_threads: int (optional, default 1)
+        the number of bundles converted in parallel.
 
     Returns
     -------
@@ -229,12 +558,13 @@ def export_bundles_to_trk(
         if not os.path.isdir(outdir):  # If outdir does not exist, create it
             os.mkdir(outdir)
 
-    # Step 2 - Convert to Trackvis
+    # Step 2 - Define the Trackvis outputs
     bundles = []
     bundles = glob.glob(os.path.join(labeling_dir, "bundleMapsReferential",
                                      "*", "*.bundlesdata"))
     bundles = [item.replace(".bundlesdata", ".bundles") for item in bundles]
-    for index, path in enumerate(bundles):
+    conversions = []
+    for path in bundles:
         basename = os.path.basename(path)
         basename = basename.split(".")[0]
         dirname = os.path.dirname(path)
@@ -243,6 +573,173 @@ def export_bundles_to_trk(
         if not os.path.isdir(outbasedir):
             os.makedirs(outbasedir)
         trk = os.path.join(outbasedir, basename + ".trk")
-        bundles[index] = ptk_bundle_to_trk(path, trk)
+        conversions.append((path, trk))
+
+    # Step 3 - Convert to Trackvis
+    bundles = parallel_map(_bundle_to_trk, conversions, nb_workers=nb_threads)
 
     return bundles
+
+
+def export_merged_bundles_to_trk(labeling_dir, outdir=None):
+    """ After Connectomist has done the fibers labeling, gather all the
+    labeled bundles in a single Trackvis file.
+
+    The 'bundle_label' fiber property gives the index of each fiber bundle
+    in the 'bundles' list of a '.json' sidecar file.
+
+    Parameters
+    ----------
+    labeling_dir: str
+        path to the Connectomist 'Labeling' directory.
+    outdir: str (optional)
+        path to directory where to output.
+        By default <outdir> is <labeling_dir>.
+
+    Returns
+    -------
+    trk: str
+        path to the labeled fiber bundles Trackvis file.
+    sidecar: str
+        path to the bundle labels '.json' file.
+    """
+    # Step 1 - Set outdir path and check directory existence
+    if outdir is None:
+        outdir = labeling_dir
+    elif not os.path.isdir(outdir):
+        os.mkdir(outdir)
+
+    # Step 2 - Detect the labeled bundles
+    bundles = sorted(glob.glob(os.path.join(
+        labeling_dir, "bundleMapsReferential", "*", "*.bundlesdata")))
+    if len(bundles) == 0:
+        raise ConnectomistError(
+            "No labeled bundle found in '{0}'.".format(labeling_dir))
+    bundles = [item.replace(".bundlesdata", ".bundles") for item in bundles]
+
+    # Step 3 - Merge the bundles and describe the labels
+    trk = merge_bundles_to_trk(bundles, os.path.join(outdir, "bundles.trk"))
+    sidecar = os.path.join(outdir, "bundles.json")
+    with open(sidecar, "wt") as open_file:
+        json.dump({
+            "property": "bundle_label",
+            "bundles": [os.path.basename(path).split(".")[0]
+                        for path in bundles],
+            "regions": [os.path.basename(os.path.dirname(path))
+                        for path in bundles]}, open_file, indent=4)
+
+    return trk, sidecar
+
+
+def export_bundles_to_trx(labeling_dir, outdir=None, reference=None,
+                          float16=False):
+    """ After Connectomist has done the fibers labeling, gather the labeled
+    bundles in a TRX tractogram where each bundle is a group.
+
+    Parameters
+    ----------
+    labeling_dir: str
+        path to the Connectomist 'Labeling' directory.
+    outdir: str (optional)
+        path to directory where to output.
+        By default <outdir> is <labeling_dir>.
+    reference: str (optional, default None)
+        path to a Nifti image defined on the Connectomist diffusion grid
+        giving the TRX RAS+ world space, see 'bundles_to_trx'.
+    float16: bool (optional, default False)
+        if True store the fiber positions in half precision.
+
+    Returns
+    -------
+    trx: str
+        path to the labeled fiber bundles TRX directory.
+    """
+    # Step 1 - Set outdir path and check directory existence
+    if outdir is None:
+        outdir = labeling_dir
+    elif not os.path.isdir(outdir):
+        os.mkdir(outdir)
+
+    # Step 2 - Detect the labeled bundles
+    bundles = sorted(glob.glob(os.path.join(
+        labeling_dir, "bundleMapsReferential", "*", "*.bundlesdata")))
+    if len(bundles) == 0:
+        raise ConnectomistError(
+            "No labeled bundle found in '{0}'.".format(labeling_dir))
+    bundles = [item.replace(".bundlesdata", ".bundles") for item in bundles]
+    group_names = [os.path.basename(path).split(".")[0] for path in bundles]
+
+    # Step 3 - Convert to TRX
+    trx = bundles_to_trx(bundles, os.path.join(outdir, "bundles.trx"),
+                         reference=reference, group_names=group_names,
+                         float16=float16)
+
+    return trx
+
+
+def export_quicklook_bundles(labeling_dir, outdir=None, tolerance=0.5,
+                             max_fibers=None, nb_threads=1):
+    """ After Connectomist has done the fibers labeling, export compressed
+    and optionally subsampled labeled bundles in Trackvis format for quick
+    looks.
+
+    Parameters
+    ----------
+    labeling_dir: str
+        path to the Connectomist 'Labeling' directory.
+    outdir: str (optional)
+        path to directory where to output.
+        By default <outdir> is <labeling_dir>.
+    tolerance: float (optional, default 0.5)
+        the maximum distance in mm between a removed point and the
+        compressed fibers.
+    max_fibers: int (optional, default None)
+        if specified, the maximum number of fibers randomly kept in each
+        bundle.
+    nb_threads: int (optional, default 1)
+        the number of bundles converted in parallel.
+
+    Returns
+    -------
+    bundles: list of str
+        path to the quick look labeled fiber bundles Trackvis files.
+    """
+    # Step 1 - Set outdir path and check directory existence
+    if outdir is None:
+        outdir = labeling_dir
+    elif not os.path.isdir(outdir):
+        os.mkdir(outdir)
+
+    # Step 2 - Define the Trackvis outputs
+    bundles = sorted(glob.glob(os.path.join(
+        labeling_dir, "bundleMapsReferential", "*", "*.bundlesdata")))
+    conversions = []
+    for path in bundles:
+        basename = os.path.basename(path).split(".")[0]
+        region = os.path.basename(os.path.dirname(path))
+        outbasedir = os.path.join(outdir, "quicklook", region)
+        if not os.path.isdir(outbasedir):
+            os.makedirs(outbasedir)
+        conversions.append((
+            [path.replace(".bundlesdata", ".bundles")],
+            os.path.join(outbasedir, basename + ".trk"), tolerance,
+            max_fibers))
+
+    # Step 3 - Compress and convert to Trackvis
+    bundles = parallel_map(_compress_bundles, conversions,
+                           nb_workers=nb_threads)
+
+    return bundles
+
+
+def _compress_bundles(conversion):
+    """ Compress bundle maps described by a (bundlefiles, trk, tolerance,
+    max_fibers) 4-uplet.
+    """
+    return compress_bundles(*conversion)
+
+
+def _bundle_to_trk(conversion):
+    """ Convert a bundle map described by a (bundle, trk) 2-uplet.
+    """
+    return bundle_to_trk(*conversion)
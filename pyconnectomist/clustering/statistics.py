@@ -0,0 +1,149 @@
+##########################################################################
+# NSAp - Copyright (C) CEA, 2016
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html for details.
+##########################################################################
+
+"""
+Compute the statistics of the bundles labeled by Connectomist's
+'Fast bundle labeling' tab.
+"""
+
+# System import
+import os
+import glob
+import numpy
+
+# pyConnectomist import
+from pyconnectomist.exceptions import ConnectomistError
+from pyconnectomist.utils.bundletools import load_bundles
+from pyconnectomist.utils.bundletools import fiber_lengths
+from pyconnectomist.utils.paralleltools import parallel_map
+
+# The default fiber length histogram bins in mm: the last bin gathers the
+# fibers longer than 300 mm
+LENGTH_BINS = tuple(range(0, 310, 10)) + (numpy.inf, )
+
+# The bundle statistics table columns
+STATISTICS = [
+    "region", "bundle", "nb_fibers", "nb_points", "mean_length",
+    "std_length", "min_length", "median_length", "max_length", "xmin",
+    "ymin", "zmin", "xmax", "ymax", "zmax"]
+
+
+def bundle_statistics(bundlefile, bins=LENGTH_BINS):
+    """ Compute the statistics of a bundle map.
+
+    Parameters
+    ----------
+    bundlefile: str
+        path to the '.bundles' header file.
+    bins: sequence of float (optional)
+        the fiber length histogram bin edges in mm: an infinite edge is
+        appended if needed so that the fibers longer than the last edge are
+        counted.
+
+    Returns
+    -------
+    statistics: dict
+        the fiber and point counts, the fiber length distribution and the
+        bounding box of the bundle map: the length histogram is stored in the
+        'histogram' item.
+    """
+    # Load the fibers
+    points, offsets, _ = load_bundles(bundlefile)
+    lengths = fiber_lengths(points, offsets)
+
+    # Compute the statistics
+    statistics = {
+        "region": os.path.basename(os.path.dirname(bundlefile)),
+        "bundle": os.path.basename(bundlefile).split(".")[0],
+        "nb_fibers": len(lengths),
+        "nb_points": len(points),
+        "histogram": numpy.histogram(
+            lengths, bins=_overflow_bins(bins))[0].tolist()}
+    if len(lengths) > 0:
+        statistics.update({
+            "mean_length": lengths.mean(),
+            "std_length": lengths.std(),
+            "min_length": lengths.min(),
+            "median_length": numpy.median(lengths),
+            "max_length": lengths.max()})
+    if len(points) > 0:
+        bbox_min = points.min(axis=0)
+        bbox_max = points.max(axis=0)
+        for index, axis in enumerate("xyz"):
+            statistics[axis + "min"] = bbox_min[index]
+            statistics[axis + "max"] = bbox_max[index]
+
+    return statistics
+
+
+def labeling_statistics(labeling_dir, outfile=None, bins=LENGTH_BINS,
+                        nb_threads=1):
+    """ Compute the statistics of each bundle labeled by Connectomist and
+    write them in a tab separated table, one row per bundle.
+
+    Parameters
+    ----------
+    labeling_dir: str
+        path to the Connectomist 'Labeling' directory.
+    outfile: str (optional, default None)
+        path to the output table. By default the table is written in
+        '<labeling_dir>/bundle_statistics.tsv'.
+    bins: sequence of float (optional)
+        the fiber length histogram bin edges in mm: an infinite edge is
+        appended if needed so that the fibers longer than the last edge are
+        counted.
+    nb_threads: int (optional, default 1)
+        the number of bundles processed in parallel.
+
+    Returns
+    -------
+    outfile: str
+        path to the bundle statistics table.
+    """
+    # Get the labeled bundles
+    bundlefiles = sorted(glob.glob(os.path.join(
+        labeling_dir, "bundleMapsReferential", "*", "*.bundles")))
+    if len(bundlefiles) == 0:
+        raise ConnectomistError(
+            "No labeled bundle found in '{0}'.".format(labeling_dir))
+
+    # Compute the statistics
+    all_statistics = parallel_map(
+        _bundle_statistics, [(path, bins) for path in bundlefiles],
+        nb_workers=nb_threads)
+
+    # Write the table
+    if outfile is None:
+        outfile = os.path.join(labeling_dir, "bundle_statistics.tsv")
+    bins = _overflow_bins(bins)
+    histogram_columns = [
+        "length_{0}_{1}".format(low, high)
+        for low, high in zip(bins[:-1], bins[1:])]
+    with open(outfile, "wt") as open_file:
+        open_file.write("\t".join(STATISTICS + histogram_columns) + "\n")
+        for statistics in all_statistics:
+            row = [statistics.get(name, "") for name in STATISTICS]
+            row += statistics["histogram"]
+            open_file.write("\t".join([str(item) for item in row]) + "\n")
+
+    return outfile
+
+
+def _overflow_bins(bins):
+    """ Append an infinite edge to histogram bins if needed.
+    """
+    bins = tuple(bins)
+    if bins[-1] != numpy.inf:
+        bins += (numpy.inf, )
+    return bins
+
+
+def _bundle_statistics(args):
+    """ Compute the statistics of a bundle map described by a
+    (bundlefile, bins) 2-uplet.
+    """
+    return bundle_statistics(*args)
@@ -15,11 +15,15 @@ import shutil
 
 # Wrappers of Connectomist's tabs
 from pyconnectomist import DEFAULT_CONNECTOMIST_PATH
+from pyconnectomist.utils.regtools import WARM_START_SEARCH_SCALE
+from pyconnectomist.utils.regtools import WARM_START_ITERATION_COUNT
 from .qspace import data_import_and_qspace_sampling
 from .mask import rough_mask_extraction
 from .outliers import outlying_slice_detection
+from .outliers import prescreen_outliers
 from .susceptibility import susceptibility_correction
 from .eddy import eddy_and_motion_correction
+from .eddy import sharded_eddy_and_motion_correction
 from .eddy import export_eddy_motion_results_to_nifti
 from .registration import dwi_to_anatomy
 from .qc import qc_reporting
@@ -65,7 +69,7 @@ def complete_preprocessing(
         b0_field=3.0,
         water_fat_shift=4.68,
         t1_foot_zcropping=0,
-        level_count=32,
+        level_count=None,
         lower_theshold=0.0,
         apply_smoothing=True,
         init_center_gravity=False,
@@ -74,6 +78,16 @@ def complete_preprocessing(
         delete_steps=False,
         morphologist_dir=None,
         already_corrected=False,
+        outlier_prescreen=False,
+        max_discarded_ratio=None,
+        motion_qc=False,
+        morphologist_index=None,
+        header_cache=None,
+        prior_preproc_dir=None,
+        warm_start_search_scale=WARM_START_SEARCH_SCALE,
+        warm_start_iteration_count=WARM_START_ITERATION_COUNT,
+        registration_preset=None,
+        nb_eddy_shards=1,
         path_connectomist=DEFAULT_CONNECTOMIST_PATH):
     """ Function that runs all preprocessing tabs from Connectomist.
 
@@ -95,7 +109,8 @@ def complete_preprocessing(
 
     8- QC reporting.
 
-    9- Export result as a Nifti with a .bval and a .bvec.
+    9- Export result as a Nifti with a .bval and a .bvec, and optionally the
+    motion quality control metrics.
 
     10- Export outliers.
 
@@ -156,8 +171,9 @@ def complete_preprocessing(
         Philips only, default 4.68 pixels.
     t1_foot_zcropping: int (optional, default 0)
         crop the t1 image in the z direction in order to remove the neck.
-    level_count: int (optional, default 32)
-        the number of bins in the histogram.
+    level_count: int (optional, default None)
+        the number of bins in the histogram, by default the registration
+        preset value or 32. It takes precedence over the preset.
     lower_theshold: float (optional, default 0)
         remove noise in the image by applying this lower theshold.
     apply_smoothing: bool (optional, default True)
@@ -178,6 +194,44 @@ def complete_preprocessing(
     already_corrected: bool (optional, default False)
         if True, only the first three step are computed in order to facilitate
         the modeling, tractography, bundeling steps.
+    outlier_prescreen: bool (optional, default False)
+        if True, screen the outlying diffusion slices in-process before the
+        Connectomist outliers detection, and discard the corrupted
+        diffusion weighted volumes.
+    max_discarded_ratio: float (optional, default None)
+        if specified with the prescreen, the ratio of discarded volumes
+        above which the acquisition is rejected before the eddy current and
+        motion correction.
+    motion_qc: bool (optional, default False)
+        if True, export the motion quality control metrics computed from the
+        eddy current and motion correction transformations:
+        '<outdir>/dwi_motion.tsv' and '<outdir>/dwi_motion.json'.
+    morphologist_index: MorphologistIndex (optional, default None)
+        an index of the Morphologist files shared by the steps, used instead
+        of listing the Morphologist directory.
+    header_cache: NiftiHeaderCache (optional, default None)
+        a cache of the Nifti header metadata shared by the steps: backed by
+        a '.json' file, reruns skip the Nifti header parsing. By default the
+        headers are not cached.
+    prior_preproc_dir: str (optional, default None)
+        a previous preprocessing directory of the same subject (a prior run
+        or an earlier timepoint): its 'dw_to_t1.trm' transformation, if any,
+        seeds the DW to T1 registrations, and its 'dw_to_b0.trm'
+        transformation, if any, seeds the susceptibility DW to B0
+        registration.
+    warm_start_search_scale: float (optional, default 0.2)
+        the factor applied to the optimizer search ranges of the seeded
+        registrations, 1 to keep them.
+    warm_start_iteration_count: int (optional, default 200)
+        the maximum number of iterations of the seeded registrations, None
+        to keep it.
+    registration_preset: str (optional, default None)
+        the speed/accuracy preset applied to all the registrations: 'fast',
+        'balanced' or 'accurate'. By default the Connectomist parameters are
+        kept.
+    nb_eddy_shards: int (optional, default 1)
+        if greater than 1, split the DW volumes of the eddy current and motion
+        correction in shards run in parallel (experimental).
     path_connectomist: str (optional)
         path to the Connectomist executable.
 
@@ -192,6 +246,19 @@ def complete_preprocessing(
     if not os.path.isdir(outdir):
         os.mkdir(outdir)
 
+    # Get the prior transformations used to seed the registrations
+    dwtot1_transform = None
+    dwtob0_transform = None
+    if prior_preproc_dir is not None:
+        dwtot1_transform = os.path.join(
+            prior_preproc_dir, STEPS[1], "dw_to_t1.trm")
+        if not os.path.isfile(dwtot1_transform):
+            dwtot1_transform = None
+        dwtob0_transform = os.path.join(
+            prior_preproc_dir, STEPS[4], "dw_to_b0.trm")
+        if not os.path.isfile(dwtob0_transform):
+            dwtob0_transform = None
+
     # Step 2 - Import files to Connectomist and choose q-space model
     raw_dwi_dir = os.path.join(outdir, STEPS[0])
     data_import_and_qspace_sampling(
@@ -211,6 +278,8 @@ def complete_preprocessing(
         b0_phase,
         phase_axis,
         slice_axis,
+        header_cache=header_cache,
+        gradient_cachedir=outdir,
         path_connectomist=path_connectomist)
 
     # Step 3 - Registration t1 - dwi
@@ -226,6 +295,12 @@ def complete_preprocessing(
         apply_smoothing=apply_smoothing,
         init_center_gravity=init_center_gravity,
         transform_type=transform_type,
+        morphologist_index=morphologist_index,
+        header_cache=header_cache,
+        initial_transform=dwtot1_transform,
+        warm_start_search_scale=warm_start_search_scale,
+        warm_start_iteration_count=warm_start_iteration_count,
+        registration_preset=registration_preset,
         path_connectomist=path_connectomist)
 
     # Step 4 - Create a brain mask
@@ -239,6 +314,12 @@ def complete_preprocessing(
         level_count=level_count,
         lower_theshold=lower_theshold,
         apply_smoothing=apply_smoothing,
+        morphologist_index=morphologist_index,
+        header_cache=header_cache,
+        initial_transform=dwtot1_transform,
+        warm_start_search_scale=warm_start_search_scale,
+        warm_start_iteration_count=warm_start_iteration_count,
+        registration_preset=registration_preset,
         path_connectomist=path_connectomist)
 
     # Quit if requested: preproc already performed
@@ -247,11 +328,20 @@ def complete_preprocessing(
 
     # Step 5 - Detect and correct outlying diffusion slices
     outliers_dir = os.path.join(outdir, STEPS[3])
+    discarded_orientations = None
+    if outlier_prescreen:
+        _, discarded_orientations = prescreen_outliers(
+            outliers_dir,
+            raw_dwi_dir,
+            rough_mask_dir,
+            max_discarded_ratio=max_discarded_ratio,
+            gradient_cachedir=outdir)
     outlying_slice_detection(
         outliers_dir,
         raw_dwi_dir,
         rough_mask_dir,
         subject_id,
+        discarded_orientations=discarded_orientations,
         path_connectomist=path_connectomist)
 
     # Step 6 - Susceptibility correction
@@ -275,18 +365,29 @@ def complete_preprocessing(
             EPI_factor,
             b0_field,
             water_fat_shift,
+            initial_transform=dwtob0_transform,
+            warm_start_search_scale=warm_start_search_scale,
+            warm_start_iteration_count=warm_start_iteration_count,
+            registration_preset=registration_preset,
             path_connectomist=path_connectomist)
 
     # Step 7 - Eddy current and motion correction
     eddy_motion_dir = os.path.join(outdir, STEPS[5])
-    eddy_and_motion_correction(
+    eddy_kwargs = {}
+    eddy_func = eddy_and_motion_correction
+    if nb_eddy_shards > 1:
+        eddy_kwargs["nb_shards"] = nb_eddy_shards
+        eddy_func = sharded_eddy_and_motion_correction
+    eddy_func(
         eddy_motion_dir,
         raw_dwi_dir,
         rough_mask_dir,
         corrected_dir,
         subject_id,
-        similarity_measure,
-        path_connectomist=path_connectomist)
+        similarity_measure=similarity_measure,
+        registration_preset=registration_preset,
+        path_connectomist=path_connectomist,
+        **eddy_kwargs)
 
     # Step 8 - QC reporting
     qc_dir = os.path.join(outdir, STEPS[6])
@@ -307,7 +408,9 @@ def complete_preprocessing(
     preproc_files = export_eddy_motion_results_to_nifti(
         eddy_motion_dir,
         outdir=outdir,
-        filename="dwi")
+        filename="dwi",
+        motion_qc=motion_qc,
+        gradient_cachedir=outdir)
     preproc_dwi, preproc_bval, preproc_bvec = preproc_files
 
     # Step 10 - Export outliers.py
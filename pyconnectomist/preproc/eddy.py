@@ -11,15 +11,30 @@ Wrapper to Connectomist's 'Eddy current & motion' tab.
 
 # System import
 import os
+import re
+import copy
+import shutil
+import filecmp
+import warnings
 import numpy as np
 
 # pyConnectomist import
 from pyconnectomist import DEFAULT_CONNECTOMIST_PATH
 from pyconnectomist.exceptions import ConnectomistBadFileError
+from pyconnectomist.exceptions import ConnectomistError
 from pyconnectomist.wrappers import ConnectomistWrapper
 from pyconnectomist.utils.filetools import ptk_gis_to_nifti
 from pyconnectomist.utils.filetools import ptk_concatenate_volumes
-from pyconnectomist.utils.filetools import exec_file
+from pyconnectomist.utils.filetools import parse_dict_file
+from pyconnectomist.utils.filetools import save_dict_file
+from pyconnectomist.utils.filetools import load_gis
+from pyconnectomist.utils.filetools import save_gis
+from pyconnectomist.utils.paralleltools import parallel_map
+from pyconnectomist.utils.dwitools import GradientTable
+from pyconnectomist.utils.regtools import read_trms
+from pyconnectomist.utils.regtools import motion_metrics
+from pyconnectomist.utils.regtools import save_motion_metrics
+from pyconnectomist.utils.regtools import apply_registration_preset
 
 # Global map
 SIMILARITY = {
@@ -27,6 +42,13 @@ SIMILARITY = {
     "norm_mi": 2
 }
 
+# The Connectomist 'Eddy current & motion' algorithm
+EDDY_ALGORITHM = "DWI-Eddy-Current-And-Motion-Correction"
+
+# The per-volume motion transformations of the 'Eddy current & motion'
+# directory, numbered by diffusion weighted volume
+MOTION_TRM_PATTERN = re.compile(r"^dw_to_t2_(\d+)\.trm$")
+
 
 def eddy_and_motion_correction(
         outdir,
@@ -35,6 +57,7 @@ def eddy_and_motion_correction(
         corrected_dir,
         subject_id,
         similarity_measure="mi",
+        registration_preset=None,
         path_connectomist=DEFAULT_CONNECTOMIST_PATH):
     """ Wrapper to Connectomist's 'Eddy current & motion' tab.
 
@@ -54,6 +77,9 @@ def eddy_and_motion_correction(
         the subject code in study.
     similarity_measure: str (option, default 'mi')
         the registration similarity measure.
+    registration_preset: str (optional, default None)
+        the registration speed/accuracy preset: 'fast', 'balanced' or
+        'accurate'. By default the Connectomist parameters are kept.
     path_connectomist: str (optional)
         path to the Connectomist executable.
 
@@ -68,7 +94,7 @@ def eddy_and_motion_correction(
                          "'{0}'.".format(similarity_measure))
 
     # Dict with all parameters for connectomist
-    algorithm = "DWI-Eddy-Current-And-Motion-Correction"
+    algorithm = EDDY_ALGORITHM
     parameters_dict = {
         # ---------------------------------------------------------------------
         # Used parameters
@@ -151,6 +177,9 @@ def eddy_and_motion_correction(
             "optimizerParametersRotationY":     2
         }
     }
+    for name in ("eddyCurrentCorrectionOptions", "motionCorrectionOptions"):
+        parameters_dict[name] = apply_registration_preset(
+            parameters_dict[name], registration_preset)
 
     # Call with Connectomist
     connprocess = ConnectomistWrapper(path_connectomist)
@@ -161,13 +190,275 @@ def eddy_and_motion_correction(
     return outdir
 
 
+def sharded_eddy_and_motion_correction(
+        outdir,
+        raw_dwi_dir,
+        rough_mask_dir,
+        corrected_dir,
+        subject_id,
+        nb_shards=2,
+        keep_shards=False,
+        **kwargs):
+    """ Eddy current and motion correction split in independent shards.
+
+    Experimental: the reassembled outputs have not been validated against a
+    complete Connectomist run.
+
+    Each diffusion weighted volume is registered on the T2 volume
+    independently, so the DW series can be split in contiguous volume
+    subsets. Each shard gets a 'shard_<i>' sub-directory with copies of the
+    raw DWI and corrected directories where the DW series and the gradients
+    of their '.minf' files are restricted to the shard volumes, the other
+    files being linked. The shards are run in parallel, then the corrected
+    volumes, the rotated gradients and the per-volume 'dw_to_t2_<index>.trm'
+    transformations are reassembled in the output directory following the
+    original volume order. The other outputs are copied if they are
+    identical in all the shards, otherwise they are skipped with a warning.
+
+    Parameters
+    ----------
+    outdir: str
+        path to Connectomist output work directory.
+    raw_dwi_dir: str
+        path to Connectomist Raw DWI directory.
+    rough_mask_dir: str
+        path to Connectomist Rough Mask directory.
+    corrected_dir: str
+        path to Connectomist Susceptibility or Outlier directory.
+    subject_id: str
+        the subject code in study.
+    nb_shards: int (optional, default 2)
+        the number of shards, limited by the number of DW volumes.
+    keep_shards: bool (optional, default False)
+        if True, keep the 'shard_<i>' sub-directories.
+    kwargs: dict
+        the other 'eddy_and_motion_correction' parameters.
+
+    Returns
+    -------
+    outdir: str
+        path to Connectomist's output directory.
+    """
+    warnings.warn("The sharded eddy current and motion correction is "
+                  "experimental.")
+
+    # Split the volumes of the raw and corrected DW series
+    nb_volumes = _volume_count(corrected_dir)
+    if _volume_count(raw_dwi_dir) != nb_volumes:
+        raise ConnectomistError(
+            "Expect DW series with the same number of volumes in '{0}' and "
+            "'{1}'.".format(raw_dwi_dir, corrected_dir))
+    nb_shards = max(1, min(nb_shards, nb_volumes))
+    volumes = np.array_split(np.arange(nb_volumes), nb_shards)
+    if not os.path.isdir(outdir):
+        os.mkdir(outdir)
+    shards = []
+    for index, indices in enumerate(volumes):
+        shard_dir = os.path.join(outdir, "shard_{0}".format(index))
+        shard_raw_dwi_dir = os.path.join(shard_dir, "raw_dwi")
+        shard_corrected_dir = os.path.join(shard_dir, "corrected_dwi")
+        shard_eddy_motion_dir = os.path.join(shard_dir, "eddy_motion")
+        for dirpath in (shard_dir, shard_eddy_motion_dir):
+            if not os.path.isdir(dirpath):
+                os.mkdir(dirpath)
+        _subset_directory(raw_dwi_dir, shard_raw_dwi_dir, indices)
+        _subset_directory(corrected_dir, shard_corrected_dir, indices)
+        shards.append(((shard_eddy_motion_dir, shard_raw_dwi_dir,
+                        rough_mask_dir, shard_corrected_dir, subject_id),
+                       kwargs))
+
+    # Correct each shard in its own Connectomist call
+    shard_dirs = parallel_map(_eddy_and_motion_correction, shards,
+                              nb_workers=nb_shards)
+
+    # Reassemble the corrected DW series and the rotated gradients
+    dw = os.path.join(outdir, "dw_wo_eddy_current_and_motion.ima")
+    _concatenate_diffusion_series(
+        [os.path.join(shard_dir, os.path.basename(dw))
+         for shard_dir in shard_dirs], dw)
+
+    # Renumber the per-volume transformations: the shard volumes are
+    # contiguous, so the shard numbering is offset by the first volume index
+    for shard_dir, indices in zip(shard_dirs, volumes):
+        trms = _motion_transformations(shard_dir)
+        if len(trms) != len(indices):
+            raise ConnectomistError(
+                "Expect one transformation per diffusion weighted volume in "
+                "'{0}', found {1}.".format(shard_dir, len(trms)))
+        for volume_index, path in trms:
+            shutil.copy(path, os.path.join(outdir, "dw_to_t2_{0}.trm".format(
+                volume_index + indices[0])))
+
+    # Copy the other outputs, like the T2 volume which is the common
+    # registration reference, if they do not depend on the shard volumes
+    t2 = os.path.join(shard_dirs[0], "t2_wo_eddy_current_and_motion.ima")
+    if not os.path.isfile(t2):
+        raise ConnectomistBadFileError(t2)
+    reassembled = (os.path.basename(dw), os.path.basename(dw)[:-4] + ".dim",
+                   os.path.basename(dw) + ".minf",
+                   "{0}.json".format(EDDY_ALGORITHM))
+    skipped = []
+    for name in sorted(os.listdir(shard_dirs[0])):
+        path = os.path.join(shard_dirs[0], name)
+        if (name in reassembled or MOTION_TRM_PATTERN.match(name) or
+                not os.path.isfile(path)):
+            continue
+        shard_paths = [os.path.join(shard_dir, name)
+                       for shard_dir in shard_dirs[1:]]
+        if all(os.path.isfile(shard_path) and
+               filecmp.cmp(path, shard_path, shallow=False)
+               for shard_path in shard_paths):
+            shutil.copy(path, outdir)
+        else:
+            skipped.append(name)
+    if len(skipped) > 0:
+        warnings.warn("The shard outputs {0} depend on the shard volumes and "
+                      "are not reassembled.".format(skipped))
+
+    # Remove the shards
+    if not keep_shards:
+        for index in range(len(volumes)):
+            shutil.rmtree(os.path.join(outdir, "shard_{0}".format(index)))
+
+    return outdir
+
+
+def _motion_transformations(dirpath):
+    """ Find the per-volume motion transformations of a directory. Return
+    the (volume index, path) pairs sorted by volume index.
+    """
+    trms = []
+    for name in os.listdir(dirpath):
+        match = MOTION_TRM_PATTERN.match(name)
+        if match is not None:
+            trms.append((int(match.group(1)), os.path.join(dirpath, name)))
+    return sorted(trms)
+
+
+def _eddy_and_motion_correction(shard):
+    """ Run the eddy current and motion correction of a shard.
+    """
+    args, kwargs = shard
+    return eddy_and_motion_correction(*args, **kwargs)
+
+
+def _volume_count(dirpath):
+    """ The number of volumes of the DW series of a directory.
+    """
+    nb_volumes = set(
+        len(bvalues) for bvalues in _diffusion_series(dirpath).values())
+    if len(nb_volumes) != 1:
+        raise ConnectomistError(
+            "Expect DW series with the same number of volumes in "
+            "'{0}'.".format(dirpath))
+    return nb_volumes.pop()
+
+
+def _subset_directory(dirpath, subset_dirpath, indices):
+    """ Copy a directory where the DW series are restricted to a subset of
+    their volumes, the other files being linked.
+    """
+    series = _diffusion_series(dirpath)
+    headers = set(sum([[name[:-4] + ".dim", name + ".minf"]
+                       for name in series], []))
+    if not os.path.isdir(subset_dirpath):
+        os.mkdir(subset_dirpath)
+    for name in os.listdir(dirpath):
+        path = os.path.join(dirpath, name)
+        if name in series:
+            _subset_diffusion_series(
+                path, os.path.join(subset_dirpath, name), indices)
+        elif name not in headers:
+            link = os.path.join(subset_dirpath, name)
+            if not os.path.lexists(link):
+                os.symlink(os.path.abspath(path), link)
+
+
+def _diffusion_series(dirpath):
+    """ Find the DW series of a directory: the '.ima' files with diffusion
+    gradients in their '.minf' file. Map each file name to its b-values.
+    """
+    series = {}
+    for name in sorted(os.listdir(dirpath)):
+        path = os.path.join(dirpath, name)
+        if not name.endswith(".ima") or not os.path.isfile(path + ".minf"):
+            continue
+        attributes = parse_dict_file(path + ".minf").get("attributes", {})
+        if "diffusion_gradient_orientations" in attributes:
+            series[name] = attributes.get("bvalues", [])
+    if len(series) == 0:
+        raise ConnectomistError(
+            "No DW series found in '{0}'.".format(dirpath))
+    return series
+
+
+def _subset_diffusion_series(dw, subset_dw, indices):
+    """ Write the subset of the DW volumes and gradients of a DW series.
+    """
+    data, voxel_sizes = load_gis(dw)
+    if data.ndim == 3:
+        data = data[..., np.newaxis]
+    parsed_dict = copy.deepcopy(parse_dict_file(dw + ".minf"))
+    attributes = parsed_dict["attributes"]
+    if data.shape[3] != len(attributes["bvalues"]):
+        raise ConnectomistBadFileError(dw + ".minf")
+    for key in ("bvalues", "diffusion_gradient_orientations"):
+        attributes[key] = attributes[key][indices]
+    _set_volume_count(attributes, len(indices))
+    save_gis(subset_dw, data[..., indices], voxel_sizes)
+    save_dict_file(subset_dw + ".minf", parsed_dict)
+
+
+def _concatenate_diffusion_series(dws, concatenated_dw):
+    """ Concatenate the volumes and the gradients of DW series.
+    """
+    volumes = []
+    parsed_dicts = []
+    for path in dws:
+        for fpath in (path, path + ".minf"):
+            if not os.path.isfile(fpath):
+                raise ConnectomistBadFileError(fpath)
+        data, voxel_sizes = load_gis(path)
+        if data.ndim == 3:
+            data = data[..., np.newaxis]
+        volumes.append(data)
+        parsed_dicts.append(parse_dict_file(path + ".minf"))
+    parsed_dict = copy.deepcopy(parsed_dicts[0])
+    attributes = parsed_dict.get("attributes", {})
+    for key in ("bvalues", "diffusion_gradient_orientations"):
+        if key not in attributes:
+            raise ConnectomistBadFileError(dws[0] + ".minf")
+        attributes[key] = np.concatenate(
+            [item["attributes"][key] for item in parsed_dicts])
+    data = np.concatenate(volumes, axis=3)
+    _set_volume_count(attributes, data.shape[3])
+    save_gis(concatenated_dw, data, voxel_sizes)
+    save_dict_file(concatenated_dw + ".minf", parsed_dict)
+
+
+def _set_volume_count(attributes, nb_volumes):
+    """ Update the number of volumes of the '.minf' attributes.
+    """
+    dimension = attributes.get("volume_dimension")
+    if dimension is not None and len(dimension) == 4:
+        attributes["volume_dimension"] = list(dimension[:3]) + [nb_volumes]
+
+
 def export_eddy_motion_results_to_nifti(
         eddy_motion_dir,
         outdir=None,
-        filename="dwi"):
+        filename="dwi",
+        motion_qc=False,
+        gradient_cachedir=None):
     """ After Connectomist has done Eddy current and motion correction, convert
     the result to Nifti with bval/bvec files (bvec with corrrected directions).
 
+    Optionally the per-volume 'dw_to_t2_<index>.trm' transformations of the
+    eddy motion directory are used to compute motion quality control
+    metrics: a '<filename>_motion.tsv' table with one row per diffusion
+    weighted volume and '<filename>_motion.json' summary scalars. The
+    transformations are checked before any file is exported.
+
     Parameters
     ----------
     eddy_motion_dir: str
@@ -180,6 +471,11 @@ def export_eddy_motion_results_to_nifti(
         By default <outdir> is <eddy_motion_dir>.
     filename: str (optional)
         to change output filenames, by default "dwi".
+    motion_qc: bool (optional, default False)
+        if True, export the motion quality control metrics.
+    gradient_cachedir: str (optional, default None)
+        a subject level folder where the corrected gradient table is cached,
+        by default the table is not cached.
 
     Returns
     -------
@@ -193,8 +489,7 @@ def export_eddy_motion_results_to_nifti(
         if not os.path.isdir(outdir):  # If outdir does not exist, create it
             os.mkdir(outdir)
 
-    # Step 1 - Concatenate preprocessed T2 and preprocessed DW volumes
-    # Set input and output paths (Gis files) without extension (.ima)
+    # Step 1 - Set input and output paths (Gis files)
     t2 = os.path.join(eddy_motion_dir, "t2_wo_eddy_current_and_motion.ima")
     dw = os.path.join(eddy_motion_dir, "dw_wo_eddy_current_and_motion.ima")
     t2_dw = os.path.join(
@@ -205,53 +500,38 @@ def export_eddy_motion_results_to_nifti(
         if not os.path.isfile(path):
             raise ConnectomistBadFileError(path)
 
-    # Apply concatenation: result is a Gis file
-    ptk_concatenate_volumes([t2, dw], t2_dw)
-
-    # Step 2 - Convert to Nifti
-    dwi = ptk_gis_to_nifti(t2_dw, os.path.join(outdir, "%s.nii.gz" % filename))
-
-    # Step 3 - Create .bval and .bvec (with corrected directions)
+    # Step 2 - Get the corrected gradients
     # The new directions of gradients (modified by the Eddy current and motion
     # correction) are found in the .ima.minf (Gis format) file associated to
-    # diffusion weighted data.
-    try:
-        # The .ima.minf is a text file that defines a python dict
-        path_minf = dw + ".minf"
-        exec_dict = exec_file(path_minf)
-
-        # Verify dict structure by checking 2 keys.
-        if "bvalues" not in exec_dict["attributes"]:
-            raise Exception
-        if "diffusion_gradient_orientations" not in exec_dict["attributes"]:
-            raise Exception
-    except:
-        raise ConnectomistBadFileError(path_minf)
-
-    # Get bvalues and create .bval file
-    bvalues = np.array(exec_dict["attributes"]["bvalues"], dtype=np.int)
-
-    # Add 0 in bvalues for b=0 associated to T2
-    bvalues = np.concatenate(([0], bvalues))
-
-    # Create "dwi.bval"
-    bval = os.path.join(outdir, "%s.bval" % filename)
-    np.savetxt(bval, bvalues, newline=" ", fmt="%d")
-
-    # Get gradient directions to create .bvec file
-    directions = np.array(
-        exec_dict["attributes"]["diffusion_gradient_orientations"])
+    # diffusion weighted data: a b=0 volume is inserted first for the T2
+    gtab = GradientTable.from_minf(dw + ".minf", nodiff_first=True,
+                                   cachedir=gradient_cachedir)
+    directions = gtab.bvecs
 
-    # Normalize vectors
-    magnitudes = np.linalg.norm(directions, axis=1)
-    for i, vector in enumerate(directions):
-        directions[i, :] = directions[i, :] / magnitudes[i]
+    # Step 3 - Check the volume transformations
+    if motion_qc:
+        trms = [path for _, path in _motion_transformations(eddy_motion_dir)]
+        if len(trms) != len(directions) - 1:
+            raise ConnectomistError(
+                "Expect one transformation per diffusion weighted volume in "
+                "'{0}', found {1}.".format(eddy_motion_dir, len(trms)))
+        affines = read_trms(trms)
 
-    # Add null vector for direction corresponding to bvalue=0 volume
-    directions = np.concatenate(([[0, 0, 0]], directions))
+    # Step 4 - Concatenate preprocessed T2 and preprocessed DW volumes and
+    # convert to Nifti: the concatenation result is a Gis file
+    ptk_concatenate_volumes([t2, dw], t2_dw)
+    dwi = ptk_gis_to_nifti(t2_dw, os.path.join(outdir, "%s.nii.gz" % filename))
 
-    # Create "dwi.bvec"
+    # Step 5 - Create "dwi.bval" and "dwi.bvec"
+    bval = os.path.join(outdir, "%s.bval" % filename)
     bvec = os.path.join(outdir, "%s.bvec" % filename)
-    np.savetxt(bvec, directions.T, fmt="%.10f")
+    gtab.to_files(bval, bvec)
+
+    # Step 6 - Compute the motion metrics from the volume transformations
+    if motion_qc:
+        metrics = motion_metrics(affines, directions[1:])
+        save_motion_metrics(
+            metrics, os.path.join(outdir, "%s_motion.tsv" % filename),
+            os.path.join(outdir, "%s_motion.json" % filename))
 
     return dwi, bval, bvec
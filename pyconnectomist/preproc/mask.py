@@ -18,6 +18,10 @@ import nibabel
 from pyconnectomist import DEFAULT_CONNECTOMIST_PATH
 from pyconnectomist.exceptions import ConnectomistBadFileError
 from pyconnectomist.wrappers import ConnectomistWrapper
+from pyconnectomist.utils.regtools import apply_registration_preset
+from pyconnectomist.utils.regtools import warm_start_registration
+from pyconnectomist.utils.regtools import WARM_START_SEARCH_SCALE
+from pyconnectomist.utils.regtools import WARM_START_ITERATION_COUNT
 
 
 def rough_mask_extraction(
@@ -26,9 +30,15 @@ def rough_mask_extraction(
         registration_dir,
         morphologist_dir,
         subject_id,
-        level_count=32,
+        level_count=None,
         lower_theshold=0.0,
         apply_smoothing=True,
+        morphologist_index=None,
+        header_cache=None,
+        initial_transform=None,
+        warm_start_search_scale=WARM_START_SEARCH_SCALE,
+        warm_start_iteration_count=WARM_START_ITERATION_COUNT,
+        registration_preset=None,
         path_connectomist=DEFAULT_CONNECTOMIST_PATH):
     """ Wrapper to Connectomist's 'Rough mask' tab.
 
@@ -44,12 +54,32 @@ def rough_mask_extraction(
         path to Morphologist directory.
     subject_id: str
         the subject code in study.
-    level_count: int (optional, default 32)
-        the number of bins in the histogram.
+    level_count: int (optional, default None)
+        the number of bins in the histogram, by default the registration
+        preset value or 32. It takes precedence over the preset.
     lower_theshold: float (optional, default 0)
         remove noise in the image by applying this lower theshold.
     apply_smoothing: bool (optional, default True)
         smooth the image before performing the histogram analysis.
+    morphologist_index: MorphologistIndex (optional, default None)
+        an index of the Morphologist files used instead of listing the
+        Morphologist directory.
+    header_cache: NiftiHeaderCache (optional, default None)
+        a cache of the Nifti header metadata used instead of parsing the
+        T1 image header.
+    initial_transform: str (optional, default None)
+        a prior '.trm' DW to T1 transformation, computed on a previous
+        run or an earlier timepoint, used to seed the registration with
+        reduced optimizer search ranges and iterations.
+    warm_start_search_scale: float (optional, default 0.2)
+        the factor applied to the optimizer search ranges of a seeded
+        registration, 1 to keep them.
+    warm_start_iteration_count: int (optional, default 200)
+        the maximum number of iterations of a seeded registration, None to
+        keep it.
+    registration_preset: str (optional, default None)
+        the registration speed/accuracy preset: 'fast', 'balanced' or
+        'accurate'. By default the Connectomist parameters are kept.
     path_connectomist: str (optional)
         path to the Connectomist executable.
 
@@ -68,17 +98,23 @@ def rough_mask_extraction(
     subject_morphologist_dir = os.path.join(morphologist_dir, subject_id)
     t1pattern = os.path.join(subject_morphologist_dir, "t1mri", "*", "{0}{1}")
     t1patterns = [t1pattern.format(subject_id, ext) for ext in extensions]
-    files = []
-    for fpattern in t1patterns:
-        files.extend(glob.glob(fpattern))
+    if morphologist_index is not None:
+        files = morphologist_index.find(subject_id, "t1")
+    else:
+        files = []
+        for fpattern in t1patterns:
+            files.extend(glob.glob(fpattern))
     print(files)
     if len(files) != 1 or not os.path.isfile(files[0]):
         raise ConnectomistBadFileError(str(t1patterns))
     niit1file = files[0]
 
     # Get the min image dimension
-    im = nibabel.load(niit1file)
-    mindim = min(im.shape)
+    if header_cache is not None:
+        mindim = min(header_cache.get(niit1file)["shape"])
+    else:
+        im = nibabel.load(niit1file)
+        mindim = min(im.shape)
 
     # Dict with all parameters for connectomist
     algorithm = "DWI-Rough-Mask-Extraction"
@@ -107,7 +143,7 @@ def rough_mask_extraction(
             "initialParametersTranslationY":                 0,
             "initialParametersTranslationZ":                 0,
             "initializeCoefficientsUsingCenterOfGravity": False,
-            "levelCount":                          level_count,
+            "levelCount":                                  32,
             "maximumIterationCount":                      1000,
             "maximumTestGradient":                      1000.0,
             "maximumTolerance":                           0.01,
@@ -139,6 +175,17 @@ def rough_mask_extraction(
         "strategyRoughMaskFromT1":    1,
         "strategyRoughMaskFromT2":    0
     }
+    parameters_dict["dwToT1RegistrationParameter"] = apply_registration_preset(
+        parameters_dict["dwToT1RegistrationParameter"], registration_preset)
+    if level_count is not None:
+        parameters_dict["dwToT1RegistrationParameter"]["levelCount"] = (
+            level_count)
+    if initial_transform is not None:
+        parameters_dict["dwToT1RegistrationParameter"] = (
+            warm_start_registration(
+                parameters_dict["dwToT1RegistrationParameter"],
+                initial_transform, search_scale=warm_start_search_scale,
+                iteration_count=warm_start_iteration_count))
 
     # Call with Connectomist
     connprocess = ConnectomistWrapper(path_connectomist)
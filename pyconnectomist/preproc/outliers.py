@@ -9,9 +9,27 @@
 Wrapper to Connectomist's 'Outliers' tab.
 """
 
+# System import
+import os
+import pprint
+import warnings
+import numpy
+
 # pyConnectomist import
 from pyconnectomist import DEFAULT_CONNECTOMIST_PATH
+from pyconnectomist.exceptions import ConnectomistBadFileError
+from pyconnectomist.exceptions import ConnectomistError
 from pyconnectomist.wrappers import ConnectomistWrapper
+from pyconnectomist.utils.filetools import load_gis
+from pyconnectomist.utils.filetools import parse_dict_file
+from pyconnectomist.utils.dwitools import GradientTable
+
+# The smallest robust scale of the slice intensity deviations
+MIN_DEVIATION_SCALE = 1e-6
+
+# The slice axes of the Connectomist 'outliers.py' report: each axis maps
+# the diffusion weighted volume indices to their outlying slice indices
+OUTLIER_AXES = ("axial", "coronal", "sagittal")
 
 
 def outlying_slice_detection(
@@ -19,6 +37,8 @@ def outlying_slice_detection(
         raw_dwi_dir,
         rough_mask_dir,
         subject_id,
+        discarded_orientations=None,
+        outlier_factor=3.0,
         path_connectomist=DEFAULT_CONNECTOMIST_PATH):
     """ Wrapper to Connectomist's 'Outliers' tab.
 
@@ -32,6 +52,11 @@ def outlying_slice_detection(
         path to Connectomist Rough Mask folder.
     subject_id: str
         the subject code in study.
+    discarded_orientations: list of int (optional, default None)
+        the indices of the diffusion weighted volumes to be discarded, for
+        instance as detected by 'prescreen_outliers'.
+    outlier_factor: float (optional, default 3.0)
+        the Connectomist outlier detection factor.
     path_connectomist: str (optional)
         path to the Connectomist executable.
 
@@ -46,8 +71,9 @@ def outlying_slice_detection(
         "rawDwiDirectory": raw_dwi_dir,
         "roughMaskDirectory": rough_mask_dir,
         "outputWorkDirectory": outdir,
-        "discardedOrientationList": "",
-        "outlierFactor": 3.0,
+        "discardedOrientationList": " ".join(
+            str(index) for index in discarded_orientations or []),
+        "outlierFactor": outlier_factor,
         "_subjectName": subject_id
     }
 
@@ -58,3 +84,170 @@ def outlying_slice_detection(
     connprocess(algorithm, parameter_file, outdir)
 
     return outdir
+
+
+def prescreen_outliers(
+        outdir,
+        raw_dwi_dir,
+        rough_mask_dir,
+        outlier_factor=3.0,
+        nb_neighbors=6,
+        discard_slice_ratio=0.1,
+        max_discarded_ratio=None,
+        min_slice_voxels=100,
+        gradient_cachedir=None):
+    """ Detect the outlying diffusion slices before running the Connectomist
+    'Outliers' tab.
+
+    The mean masked intensity of each slice of each diffusion weighted
+    volume is compared to the median of the same slice in the volumes
+    acquired with the closest gradient orientations of the same shell. The
+    relative deviations are converted to robust z-scores using their median
+    absolute deviation over the volumes of each slice. A volume with more
+    than 'discard_slice_ratio' outlying slices is discarded.
+
+    The report is written in '<outdir>/outliers_prescreen.py' with the
+    structure of the Connectomist 'outliers.py' report, so that it can be
+    read with 'read_outliers': only the axial slices are checked, the other
+    axes are left empty.
+
+    Parameters
+    ----------
+    outdir: str
+        path to the output directory.
+    raw_dwi_dir: str
+        path to Connectomist Raw DWI folder.
+    rough_mask_dir: str
+        path to Connectomist Rough Mask folder.
+    outlier_factor: float (optional, default 3.0)
+        the robust z-score above which a slice is an outlier.
+    nb_neighbors: int (optional, default 6)
+        the number of neighbouring gradient orientations.
+    discard_slice_ratio: float (optional, default 0.1)
+        the ratio of outlying slices above which a volume is discarded.
+    max_discarded_ratio: float (optional, default None)
+        if specified, the ratio of discarded volumes above which the
+        acquisition is rejected.
+    min_slice_voxels: int (optional, default 100)
+        the number of masked voxels under which a slice is not checked.
+    gradient_cachedir: str (optional, default None)
+        a subject level folder where the gradient table is cached, by
+        default the table is not cached.
+
+    Returns
+    -------
+    report: str
+        path to the outliers report.
+    discarded_orientations: list of int
+        the indices of the discarded diffusion weighted volumes.
+    """
+    # Get Connectomist import result files and check existance
+    dwfile = os.path.join(raw_dwi_dir, "dw.ima")
+    maskfile = os.path.join(rough_mask_dir, "mask.ima")
+    for fpath in (dwfile, dwfile + ".minf", maskfile):
+        if not os.path.isfile(fpath):
+            raise ConnectomistBadFileError(fpath)
+    gtab = GradientTable.from_minf(dwfile + ".minf",
+                                   cachedir=gradient_cachedir)
+
+    # Compute the mean masked intensity of each slice, volume by volume
+    dw, _ = load_gis(dwfile)
+    mask, _ = load_gis(maskfile)
+    if dw.ndim == 3:
+        dw = dw[..., numpy.newaxis]
+    mask = (mask > 0)
+    if dw.shape[:3] != mask.shape or dw.shape[3] != len(gtab.bvals):
+        raise ConnectomistError(
+            "The imported diffusion data do not match the rough mask or the "
+            "diffusion gradients.")
+    counts = mask.sum(axis=(0, 1))
+    valid_slices = counts >= min_slice_voxels
+    means = numpy.empty((mask.shape[2], dw.shape[3]), dtype=numpy.float64)
+    means.fill(numpy.nan)
+    for index in range(dw.shape[3]):
+        sums = numpy.sum(dw[..., index] * mask, axis=(0, 1),
+                         dtype=numpy.float64)
+        means[valid_slices, index] = (
+            sums[valid_slices] / counts[valid_slices])
+
+    # Get the closest orientations of the same shell: antipodal orientations
+    # are equivalent
+    norms = numpy.linalg.norm(gtab.bvecs, axis=1)
+    bvecs = gtab.bvecs / numpy.where(norms > 0, norms, 1)[:, numpy.newaxis]
+    similarity = numpy.abs(numpy.dot(bvecs, bvecs.T))
+    same_shell = (gtab.shell_index[:, numpy.newaxis] == gtab.shell_index)
+    same_shell &= ~numpy.eye(len(bvecs), dtype=bool)
+    similarity[~same_shell] = -1
+    neighbors = numpy.argsort(-similarity, axis=1)[:, :nb_neighbors]
+    valid_neighbors = numpy.take_along_axis(
+        same_shell, neighbors, axis=1)
+
+    # Compute the robust z-scores of the relative deviations
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        references = means[:, neighbors]
+        references[:, ~valid_neighbors] = numpy.nan
+        references = numpy.nanmedian(references, axis=2)
+        deviations = (means - references) / references
+        deviations[:, gtab.b0_mask] = numpy.nan
+        centered = deviations - numpy.nanmedian(
+            deviations, axis=1)[:, numpy.newaxis]
+        scales = 1.4826 * numpy.nanmedian(numpy.abs(centered), axis=1)
+        scales = numpy.maximum(scales, MIN_DEVIATION_SCALE)
+        scores = centered / scales[:, numpy.newaxis]
+        is_outlier = numpy.abs(scores) > outlier_factor
+
+    # Discard the volumes with too many outlying slices
+    nb_valid_slices = max(int(valid_slices.sum()), 1)
+    outliers = dict(
+        (int(index), numpy.flatnonzero(is_outlier[:, index]).tolist())
+        for index in numpy.flatnonzero(is_outlier.any(axis=0)))
+    discarded_orientations = [
+        index for index, slices in sorted(outliers.items())
+        if len(slices) > discard_slice_ratio * nb_valid_slices]
+
+    # Write the report
+    if not os.path.isdir(outdir):
+        os.mkdir(outdir)
+    report = os.path.join(outdir, "outliers_prescreen.py")
+    report_outliers = dict((axis, {}) for axis in OUTLIER_AXES)
+    report_outliers["axial"] = outliers
+    with open(report, "wt") as open_file:
+        open_file.write("outliers = {0}\n".format(
+            pprint.pformat(report_outliers)))
+
+    # Reject the acquisition if requested
+    if (max_discarded_ratio is not None and len(discarded_orientations) >
+            max_discarded_ratio * dw.shape[3]):
+        raise ConnectomistError(
+            "{0} out of {1} diffusion weighted volumes are corrupted, see "
+            "'{2}'.".format(len(discarded_orientations), dw.shape[3],
+                            report))
+
+    return report, discarded_orientations
+
+
+def read_outliers(report, axis="axial"):
+    """ Read a Connectomist 'outliers.py' report or a pre-screen report.
+
+    Parameters
+    ----------
+    report: str
+        path to the outliers report.
+    axis: str (optional, default 'axial')
+        the slice axis: 'axial', 'coronal' or 'sagittal'.
+
+    Returns
+    -------
+    outliers: dict
+        the outlying slice indices of each diffusion weighted volume.
+    """
+    if axis not in OUTLIER_AXES:
+        raise ValueError("'{0}' is not a valid slice axis (must be in "
+                         "{1}).".format(axis, OUTLIER_AXES))
+    content = parse_dict_file(report).get("outliers")
+    if not isinstance(content, dict) or axis not in content:
+        raise ConnectomistBadFileError(report)
+
+    return dict((int(index), [int(item) for item in slices])
+                for index, slices in content[axis].items())
@@ -23,7 +23,7 @@ from pyconnectomist.exceptions import ConnectomistError
 from pyconnectomist.exceptions import ConnectomistBadManufacturerNameError
 from pyconnectomist.exceptions import ConnectomistBadFileError
 from pyconnectomist.wrappers import ConnectomistWrapper
-from pyconnectomist.utils.dwitools import read_bvals_bvecs
+from pyconnectomist.utils.dwitools import GradientTable
 from pyconnectomist.utils.filetools import ptk_nifti_to_gis
 
 # Define axis mapping
@@ -40,7 +40,8 @@ def gather_and_format_input_files(
         bvals,
         bvecs,
         b0_magnitude=None,
-        b0_phase=None):
+        b0_phase=None,
+        header_cache=None):
     """ Gather all files needed to start the preprocessing in the right format
     (Gis format for images and B0 maps).
 
@@ -62,6 +63,9 @@ def gather_and_format_input_files(
         not required if phase is already contained in
         b0_magnitude or if you don't want to make fieldmap-based
         correction of susceptibility distortions.
+    header_cache: NiftiHeaderCache (optional, default None)
+        a cache of the Nifti header metadata used to check the number of
+        B0 maps without parsing the image header.
 
     Returns
     -------
@@ -84,19 +88,32 @@ def gather_and_format_input_files(
 
     # If there is only one b0 map file and if this file contains 2 volumes,
     # split it in 2 files: magnitude and phase, assuming the first one is
-    # magnitude
+    # magnitude. Each channel is sliced lazily, written in an uncompressed
+    # Nifti file with the original affine, header and data type, and then
+    # converted as the other inputs so that Connectomist gets the same
+    # orientation and transformation.
+    split_b0_maps = False
     if b0_magnitude and not b0_phase:
-        b0_maps = nibabel.load(b0_magnitude)
-        if b0_maps.shape[-1] == 2:
-            voxels = b0_maps.get_data()
-            header = b0_maps.get_header()
-            affine = b0_maps.get_affine()
-            magnitude = nibabel.Nifti1Image(voxels[..., 0], affine, header)
-            phase = nibabel.Nifti1Image(voxels[..., 1], affine, header)
-            b0_magnitude = os.path.join(outdir, "b0_magnitude.nii.gz")
-            b0_phase = os.path.join(outdir, "b0_phase.nii.gz")
-            magnitude.to_filename(b0_magnitude)
-            phase.to_filename(b0_phase)
+        b0_maps = None
+        if header_cache is not None:
+            nb_maps = header_cache.get(b0_magnitude)["shape"][-1]
+        else:
+            b0_maps = nibabel.load(b0_magnitude)
+            nb_maps = b0_maps.shape[-1]
+        if nb_maps == 2:
+            if b0_maps is None:
+                b0_maps = nibabel.load(b0_magnitude)
+            channels = []
+            for index, name in enumerate(("b0_magnitude", "b0_phase")):
+                channel = os.path.join(outdir, name + ".nii")
+                nibabel.Nifti1Image(
+                    np.asanyarray(b0_maps.dataobj[..., index]),
+                    b0_maps.affine, b0_maps.header).to_filename(channel)
+                channels.append(ptk_nifti_to_gis(
+                    channel, os.path.join(outdir, name + ".ima")))
+                os.remove(channel)
+            b0_magnitude, b0_phase = channels
+            split_b0_maps = True
 
     # Go through all DWI data that must be converted
     copied_dwis = []
@@ -121,12 +138,12 @@ def gather_and_format_input_files(
         copied_bvals.append(bval_copy)
         copied_bvecs.append(bvec_copy)
 
-    # Convert and rename B0 map(s) if they are given
-    if b0_magnitude is not None:
+    # Convert and rename B0 map(s) if they are given and not already split
+    if b0_magnitude is not None and not split_b0_maps:
         b0_magnitude = ptk_nifti_to_gis(
             b0_magnitude, os.path.join(outdir, "b0_magnitude.ima"))
 
-    if b0_phase is not None:
+    if b0_phase is not None and not split_b0_maps:
         b0_phase = ptk_nifti_to_gis(
             b0_phase, os.path.join(outdir, "b0_phase.ima"))
 
@@ -150,6 +167,8 @@ def data_import_and_qspace_sampling(
         b0_phase=None,
         phase_axis="y",
         slice_axis="z",
+        header_cache=None,
+        gradient_cachedir=None,
         path_connectomist=DEFAULT_CONNECTOMIST_PATH):
     """ Wrapper to Connectomist's 'DWI & Q-space' tab.
 
@@ -183,6 +202,11 @@ def data_import_and_qspace_sampling(
         the acquistion phase axis 'x', 'y' or 'z'.
     slice_axis: str (optional, default 'z')
         the acquistion slice axis 'x', 'y' or 'z'.
+    header_cache: NiftiHeaderCache (optional, default None)
+        a cache of the Nifti header metadata.
+    gradient_cachedir: str (optional, default None)
+        a subject level folder where the gradient table is cached and shared
+        with the other steps, by default the table is not cached.
     path_connectomist: str (optional)
         path to the Connectomist executable.
 
@@ -206,7 +230,8 @@ def data_import_and_qspace_sampling(
         bvals,
         bvecs,
         b0_magnitude,
-        b0_phase)
+        b0_phase,
+        header_cache=header_cache)
 
     # Dict with all parameters for connectomist
     algorithm = "DWI-Data-Import-And-QSpace-Sampling"
@@ -288,7 +313,10 @@ def data_import_and_qspace_sampling(
     parameters_dict["manufacturer"] = MANUFACTURERS[manufacturer]
 
     # Read bvals and bvecs
-    bvalues, bvectors, nb_shells, nb_nodiff = read_bvals_bvecs(bvals, bvecs)
+    gtab = GradientTable.from_files(bvals, bvecs, cachedir=gradient_cachedir)
+    gtab.check(min_bval=200.)
+    nb_shells = gtab.nb_shells
+    nb_nodiff = gtab.nb_nodiff
 
     # Update Connectomist step description
     parameters_dict["numberOfT2"] = nb_nodiff
@@ -315,12 +343,12 @@ def data_import_and_qspace_sampling(
     # rewrite bvec, bval file accordingly (remove extra T2 values)
     if nb_nodiff > 1:
         bval = os.path.join(outdir, "dwi.bval")
-        dw_indexes = np.where(bvalues >= 100)[0]
-        new_bvals = np.concatenate(([0], bvalues[dw_indexes]))
+        dw_indexes = np.where(gtab.dw_mask)[0]
+        new_bvals = np.concatenate(([0], gtab.bvals[dw_indexes]))
         np.savetxt(bval, new_bvals)
         bvec = os.path.join(outdir, "dwi.bvec")
         new_bvecs = np.concatenate(
-            ([[0], [0], [0]], bvectors.T[:, dw_indexes]), axis=1)
+            ([[0], [0], [0]], gtab.bvecs.T[:, dw_indexes]), axis=1)
         np.savetxt(bvec, new_bvecs)
 
     return outdir
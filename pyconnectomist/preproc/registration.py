@@ -19,6 +19,10 @@ from pyconnectomist import DEFAULT_CONNECTOMIST_PATH
 from pyconnectomist.exceptions import ConnectomistBadFileError
 from pyconnectomist.wrappers import ConnectomistWrapper
 from pyconnectomist.utils.filetools import ptk_nifti_to_gis
+from pyconnectomist.utils.regtools import apply_registration_preset
+from pyconnectomist.utils.regtools import warm_start_registration
+from pyconnectomist.utils.regtools import WARM_START_SEARCH_SCALE
+from pyconnectomist.utils.regtools import WARM_START_ITERATION_COUNT
 
 
 def dwi_to_anatomy(
@@ -27,11 +31,17 @@ def dwi_to_anatomy(
         morphologist_dir,
         subject_id,
         t1_foot_zcropping=0,
-        level_count=32,
+        level_count=None,
         lower_theshold=0.0,
         apply_smoothing=True,
         init_center_gravity=False,
         transform_type=0,
+        morphologist_index=None,
+        header_cache=None,
+        initial_transform=None,
+        warm_start_search_scale=WARM_START_SEARCH_SCALE,
+        warm_start_iteration_count=WARM_START_ITERATION_COUNT,
+        registration_preset=None,
         path_connectomist=DEFAULT_CONNECTOMIST_PATH):
     """ Wrapper to Connectomist's 'Anatomy & Talairach' tab.
 
@@ -47,8 +57,9 @@ def dwi_to_anatomy(
         the subject code in study.
     t1_foot_zcropping: int (optional, default 0)
         crop the t1 image in the z direction in order to remove the neck.
-    level_count: int (optional, default 32)
-        the number of bins in the histogram.
+    level_count: int (optional, default None)
+        the number of bins in the histogram, by default the registration
+        preset value or 32. It takes precedence over the preset.
     lower_theshold: float (optional, default 0)
         remove noise in the image by applying this lower theshold.
     apply_smoothing: bool (optional, default True)
@@ -57,6 +68,25 @@ def dwi_to_anatomy(
         initialize coefficients using the center of gravity.
     transform_type: int (optional, default 0)
         type of registration (rigid=0, affine_wo_shearing=1, affine=2).
+    morphologist_index: MorphologistIndex (optional, default None)
+        an index of the Morphologist files used instead of listing the
+        Morphologist directory.
+    header_cache: NiftiHeaderCache (optional, default None)
+        a cache of the Nifti header metadata used instead of parsing the
+        T1 image header.
+    initial_transform: str (optional, default None)
+        a prior '.trm' DW to T1 transformation, computed on a previous
+        run or an earlier timepoint, used to seed the registration with
+        reduced optimizer search ranges and iterations.
+    warm_start_search_scale: float (optional, default 0.2)
+        the factor applied to the optimizer search ranges of a seeded
+        registration, 1 to keep them.
+    warm_start_iteration_count: int (optional, default 200)
+        the maximum number of iterations of a seeded registration, None to
+        keep it.
+    registration_preset: str (optional, default None)
+        the registration speed/accuracy preset: 'fast', 'balanced' or
+        'accurate'. By default the Connectomist parameters are kept.
     path_connectomist: str (optional)
         path to the Connectomist executable.
 
@@ -73,18 +103,24 @@ def dwi_to_anatomy(
     t1pattern = os.path.join(subject_morphologist_dir, "t1mri", "*", "{0}{1}")
     t1patterns = [t1pattern.format(subject_id, ext) for ext in extensions]
     files = []
-    for fpatterns in ((apcpattern, ), t1patterns):
-        fpath = []
-        for fpattern in fpatterns:
-            fpath.extend(glob.glob(fpattern))
+    for item, fpatterns in (("apc", (apcpattern, )), ("t1", t1patterns)):
+        if morphologist_index is not None:
+            fpath = morphologist_index.find(subject_id, item)
+        else:
+            fpath = []
+            for fpattern in fpatterns:
+                fpath.extend(glob.glob(fpattern))
         if len(fpath) != 1 or not os.path.isfile(fpath[0]):
             raise ConnectomistBadFileError(str(t1patterns))
         files.append(fpath[0])
     acpcfile, t1file = files
 
     # Get the min image dimension
-    im = nibabel.load(t1file)
-    mindim = min(im.shape)
+    if header_cache is not None:
+        mindim = min(header_cache.get(t1file)["shape"])
+    else:
+        im = nibabel.load(t1file)
+        mindim = min(im.shape)
 
     # Create the directory if not existing
     if not os.path.isdir(outdir):
@@ -120,7 +156,7 @@ def dwi_to_anatomy(
             "initialParametersTranslationY": 0,
             "initialParametersTranslationZ": 0,
             "initializeCoefficientsUsingCenterOfGravity": init_center_gravity,
-            "levelCount": level_count,
+            "levelCount": 32,
             "maximumIterationCount": 1000,
             "maximumTestGradient": 1000.0,
             "maximumTolerance": 0.01,
@@ -161,6 +197,17 @@ def dwi_to_anatomy(
         "t1LeftXCropping": 0,
         "t1PosteriorYCropping": 0,
         "t1RightXCropping": 0}
+    parameters_dict["dwToT1RegistrationParameter"] = apply_registration_preset(
+        parameters_dict["dwToT1RegistrationParameter"], registration_preset)
+    if level_count is not None:
+        parameters_dict["dwToT1RegistrationParameter"]["levelCount"] = (
+            level_count)
+    if initial_transform is not None:
+        parameters_dict["dwToT1RegistrationParameter"] = (
+            warm_start_registration(
+                parameters_dict["dwToT1RegistrationParameter"],
+                initial_transform, search_scale=warm_start_search_scale,
+                iteration_count=warm_start_iteration_count))
 
     # Call with Connectomist
     connprocess = ConnectomistWrapper(path_connectomist)
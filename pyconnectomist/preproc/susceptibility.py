@@ -20,7 +20,17 @@ from pyconnectomist.exceptions import ConnectomistMissingParametersError
 from pyconnectomist.exceptions import ConnectomistBadManufacturerNameError
 from pyconnectomist.exceptions import ConnectomistBadFileError
 from pyconnectomist.wrappers import ConnectomistWrapper
-from pyconnectomist.utils.filetools import exec_file
+from pyconnectomist.utils.filetools import parse_dict_file
+from pyconnectomist.utils.regtools import apply_registration_preset
+from pyconnectomist.utils.regtools import warm_start_registration
+from pyconnectomist.utils.regtools import WARM_START_SEARCH_SCALE
+from pyconnectomist.utils.regtools import WARM_START_ITERATION_COUNT
+from pyconnectomist.utils.paralleltools import parallel_map
+from pyconnectomist.utils.paralleltools import available_cpu_count
+
+# The executable search paths where the BrainSuite installation has been
+# checked in the current process
+_BRAINSUITE_CHECKS = set()
 
 
 def susceptibility_correction(
@@ -37,6 +47,10 @@ def susceptibility_correction(
         EPI_factor=None,
         b0_field=3.0,
         water_fat_shift=4.68,
+        initial_transform=None,
+        warm_start_search_scale=WARM_START_SEARCH_SCALE,
+        warm_start_iteration_count=WARM_START_ITERATION_COUNT,
+        registration_preset=None,
         path_connectomist=DEFAULT_CONNECTOMIST_PATH):
     """ Wrapper to Connectomist's 'Susceptibility' tab.
 
@@ -72,6 +86,19 @@ def susceptibility_correction(
         Philips only, B0 field intensity, by default 3.0.
     water_fat_shift: float
         Philips only, default 4.68 pixels.
+    initial_transform: str (optional, default None)
+        a prior '.trm' DW to B0 transformation, computed on a previous
+        run or an earlier timepoint, used to seed the registration with
+        reduced optimizer search ranges and iterations.
+    warm_start_search_scale: float (optional, default 0.2)
+        the factor applied to the optimizer search ranges of a seeded
+        registration, 1 to keep them.
+    warm_start_iteration_count: int (optional, default 200)
+        the maximum number of iterations of a seeded registration, None to
+        keep it.
+    registration_preset: str (optional, default None)
+        the registration speed/accuracy preset: 'fast', 'balanced' or
+        'accurate'. By default the Connectomist parameters are kept.
 
     Returns
     -------
@@ -85,8 +112,8 @@ def susceptibility_correction(
     # Get the manufacturer from Connectomist's parameter file
     try:
         parameter_file = os.path.join(raw_dwi_dir, "acquisition_parameters.py")
-        exec_dict = exec_file(parameter_file)
-        manufacturer = exec_dict["acquisitionParameters"][
+        parsed_dict = parse_dict_file(parameter_file)
+        manufacturer = parsed_dict["acquisitionParameters"][
             "manufacturer"].split(" ")[0]
     except:
         raise ConnectomistBadFileError(parameter_file)
@@ -197,6 +224,14 @@ def susceptibility_correction(
             "transform3DType":                               0
         },
     }
+    parameters_dict["DwToB0RegistrationParameter"] = apply_registration_preset(
+        parameters_dict["DwToB0RegistrationParameter"], registration_preset)
+    if initial_transform is not None:
+        parameters_dict["DwToB0RegistrationParameter"] = (
+            warm_start_registration(
+                parameters_dict["DwToB0RegistrationParameter"],
+                initial_transform, search_scale=warm_start_search_scale,
+                iteration_count=warm_start_iteration_count))
 
     # Maps required parameters in Connectomist, for each manufacturer, to the
     # arguments of the function.
@@ -273,7 +308,7 @@ def susceptibility_correction_wo_fieldmap(
         t1_mask=None,
         nodif_mask=None,
         fsl_sh=None,
-        nthread=4):
+        nthread=None):
     """ Assuming the beginning of the preprocessing was done with Connectomist
     up to Eddy current and motion correction, we now want to make susceptbility
     distortion correction without fieldmap using registration based
@@ -301,8 +336,9 @@ def susceptibility_correction_wo_fieldmap(
         path to the nodif brain mask image.
     fsl_sh: str, default None
         path to the FSL configuration file.
-    nthread: int, default 4
-        number of threads to be used (see bdp.sh --thread flag).
+    nthread: int, default None
+        number of threads to be used (see bdp.sh --thread flag), by default
+        the CPUs available to the process.
 
     Returns
     -------
@@ -320,7 +356,6 @@ def susceptibility_correction_wo_fieldmap(
         the T1 brain image.
     """
     # Local import
-    from pyconnectome.utils.segtools import bet2
     from pyconnectome.utils.filetools import apply_mask
     from pyconnectome import DEFAULT_FSL_PATH
 
@@ -340,16 +375,11 @@ def susceptibility_correction_wo_fieldmap(
         os.mkdir(outdir)
 
     # The input of the bias field correction step is a skull-stripped MRI
-    # volume, use FSL bet2
+    # volume and BrainSuite needs a nodif brain mask: the two independent
+    # brain extractions with FSL bet2 are run concurrently
+    extractions = {}
     if t1_mask is None:
-        fsl_sh = fsl_sh or DEFAULT_FSL_PATH
-        (t1_brain, t1_mask, _, _, _, _, _, _, _, _, _) = bet2(
-            input_file=t1,
-            output_fileroot=outdir,
-            mask=True,
-            skull=False,
-            f=0.5,
-            shfile=fsl_sh)
+        extractions["t1"] = {"input_file": t1, "f": 0.5}
     else:
         t1_brain = apply_mask(
             input_file=t1,
@@ -357,6 +387,20 @@ def susceptibility_correction_wo_fieldmap(
                 outdir, os.path.basename(t1).split(".")[0] + "_brain"),
             mask_file=t1_mask,
             fslconfig=fsl_sh)
+    if nodif_mask is None:
+        extractions["nodif"] = {"input_file": dwi, "f": 0.25}
+    names = sorted(extractions)
+    for name in names:
+        extractions[name].update({
+            "output_fileroot": outdir, "mask": True, "skull": False,
+            "shfile": fsl_sh or DEFAULT_FSL_PATH})
+    results = dict(zip(names, parallel_map(
+        _bet2, [extractions[name] for name in names],
+        nb_workers=len(names))))
+    if "t1" in results:
+        t1_brain, t1_mask = results["t1"][:2]
+    if "nodif" in results:
+        nodif_mask = results["nodif"][1]
 
     # Run bfc (bias field correction: required by BrainSuite)
     bfc_file = os.path.join(outdir, "{0}.bfc.nii.gz".format(subject_id))
@@ -365,17 +409,9 @@ def susceptibility_correction_wo_fieldmap(
     cmd = ["bfc", "-i", t1_brain, "-o", bfc_file, "--bias", bfc_biasfield_file]
     subprocess.check_call(cmd)
 
-    # Extract brain from the nodif volume with FSL bet2
-    if nodif_mask is None:
-        (nodif_brain, nodif_mask, _, _, _, _, _, _, _, _, _) = bet2(
-            input_file=dwi,
-            output_fileroot=outdir,
-            mask=True,
-            skull=False,
-            f=0.25,
-            shfile=fsl_sh)
-
     # Run bdp.sh: registration + diffusion model
+    if nthread is None:
+        nthread = available_cpu_count()
     cmd = ["bdp.sh", bfc_file, "--nii", dwi, "--bval", bval, "--bvec", bvec,
            "--t1-mask", t1_mask, "--dwi-mask", nodif_mask,
            "--dir={0}".format(phase_enc_dir), "--threads={0}".format(nthread)]
@@ -398,10 +434,27 @@ def susceptibility_correction_wo_fieldmap(
             t1_brain)
 
 
+def _bet2(kwargs):
+    """ Run a FSL bet2 brain extraction.
+    """
+    # Local import
+    from pyconnectome.utils.segtools import bet2
+
+    return bet2(**kwargs)
+
+
 def check_brainsuite_installation():
     """ Check that Brainsuite commands, 'bfc' and 'bdp.sh', are executable.
     If not raise an Exception.
+
+    A successful check is cached for the current process and executable
+    search path, so that the commands are not probed at each call.
     """
+    # Check the cache
+    search_path = os.environ.get("PATH")
+    if search_path in _BRAINSUITE_CHECKS:
+        return
+
     # Define stout: not print in the console
     devnull = open(os.devnull, "w")
 
@@ -418,3 +471,6 @@ def check_brainsuite_installation():
     except:
         raise Exception("Brainsuite is not installed or 'bdp.sh' is not in "
                         "$PATH.")
+
+    # Update the cache
+    _BRAINSUITE_CHECKS.add(search_path)
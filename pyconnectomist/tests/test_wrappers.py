@@ -10,6 +10,8 @@
 import unittest
 import sys
 import os
+import shutil
+import tempfile
 # COMPATIBILITY: since python 3.3 mock is included in unittest module
 python_version = sys.version_info
 if python_version[:2] <= (3, 3):
@@ -85,6 +87,37 @@ class ConnectomistWrappers(unittest.TestCase):
         ConnectomistWrapper._connectomist_version_check("/my/path/mock_conf")
         self.assertEqual(len(mock_warn.call_args_list), 1)
 
+    @mock.patch("pyconnectomist.wrappers.ConnectomistWrapper."
+                "_connectomist_version_check")
+    def test_peak_memory(self, mock_version):
+        """ Test the per call peak memory tracking.
+        """
+        # Create a fake Connectomist that allocates as many MB as specified
+        # by the parameter file name
+        tmpdir = tempfile.mkdtemp()
+        try:
+            script = os.path.join(tmpdir, "connectomist")
+            with open(script, "wt") as open_file:
+                open_file.write(
+                    "#!/bin/sh\n"
+                    "exec {0} -c \"import os, sys; sys.argv[-1] == '--help' "
+                    "or len(b'a' * int(os.path.basename(sys.argv[-1])) * "
+                    "1024 ** 2)\" \"$@\"\n".format(sys.executable))
+            os.chmod(script, 0o755)
+
+            # Test execution
+            process = ConnectomistWrapper(script)
+            process("mock_algorithm", os.path.join(tmpdir, "200"), tmpdir,
+                    track_memory=True)
+            self.assertEqual(process.exitcode, 0)
+            self.assertTrue(process.peak_memory > 200 * 1024)
+            process("mock_algorithm", os.path.join(tmpdir, "20"), tmpdir,
+                    track_memory=True)
+            self.assertEqual(process.exitcode, 0)
+            self.assertTrue(process.peak_memory < 200 * 1024)
+        finally:
+            shutil.rmtree(tmpdir)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -17,7 +17,11 @@ fake return string.
 import unittest
 import sys
 import copy
+import json
 import os
+import shutil
+import tempfile
+import numpy
 # COMPATIBILITY: since python 3.3 mock is included in unittest module
 python_version = sys.version_info
 if python_version[:2] <= (3, 3):
@@ -30,6 +34,14 @@ else:
 # pyConnectomist import
 from pyconnectomist.clustering.labeling import fast_bundle_labeling
 from pyconnectomist.clustering.labeling import export_bundles_to_trk
+from pyconnectomist.clustering.labeling import export_bundles_to_trx
+from pyconnectomist.clustering.labeling import export_quicklook_bundles
+from pyconnectomist.clustering.labeling import export_merged_bundles_to_trk
+from pyconnectomist.clustering.labeling import sharded_fast_bundle_labeling
+from pyconnectomist.clustering.labeling import fiber_chunk_size
+from pyconnectomist.clustering.labeling import fit_labeling_memory_model
+from pyconnectomist.utils.bundletools import save_bundles
+from pyconnectomist.utils.bundletools import load_bundles
 from pyconnectomist.exceptions import ConnectomistBadFileError
 from pyconnectomist.exceptions import ConnectomistError
 
@@ -156,6 +168,178 @@ class ConnectomistFastLabeling(unittest.TestCase):
             mock.call(dwtot1file), mock.call(t1total)],
             mock_path.isfile.call_args_list)
 
+    def test_nomemorymodel_raise(self):
+        """ A memory budget without memory model -> raise ConnectomistError.
+        """
+        # Test execution
+        wrong_kwargs = copy.copy(self.kwargs)
+        wrong_kwargs["memory_budget"] = 1024
+        self.assertRaises(ConnectomistError, fast_bundle_labeling,
+                          **wrong_kwargs)
+
+    @mock.patch("pyconnectomist.clustering.labeling.logger")
+    @mock.patch("pyconnectomist.wrappers._wait_with_usage")
+    @mock.patch("pyconnectomist.clustering.labeling.fiber_point_counts")
+    @mock.patch("pyconnectomist.clustering.labeling.ConnectomistWrapper."
+                "_connectomist_version_check")
+    @mock.patch("pyconnectomist.clustering.labeling.ConnectomistWrapper."
+                "create_parameter_file")
+    @mock.patch("pyconnectomist.clustering.labeling.os.path.isfile")
+    @mock.patch("pyconnectomist.clustering.labeling.glob.glob")
+    def test_memory_record(self, mock_glob, mock_isfile, mock_params,
+                           mock_version, mock_counts, mock_wait,
+                           mock_logger):
+        """ Test the record of the peak memory of the labeling call.
+        """
+        # Set the mocked functions returned values
+        tmpdir = tempfile.mkdtemp()
+        mock_glob.return_value = [self.kwargs["morphologist_dir"]]
+        mock_params.return_value = "/my/path/mock_parameters"
+        mock_isfile.return_value = True
+        mock_counts.return_value = (70000, 1400000)
+        mock_wait.return_value = ("mock_OK", "mock_NONE", 2048)
+        self.mock_popen.return_value.returncode = 0
+
+        # Test execution
+        try:
+            kwargs = copy.copy(self.kwargs)
+            kwargs["outdir"] = tmpdir
+            fast_bundle_labeling(
+                memory_budget=1024, memory_model=(512 * 1024 ** 2, 0, 1024),
+                **kwargs)
+            with open(os.path.join(tmpdir, "fiber_chunking.json")) as \
+                    open_file:
+                record = json.load(open_file)
+        finally:
+            shutil.rmtree(tmpdir)
+        self.assertEqual(len(mock_wait.call_args_list), 1)
+        self.assertEqual(mock_logger.info.call_args[0][1], 12787)
+        self.assertEqual(record, {
+            "memory_budget": 1024,
+            "nb_fibers_to_process_at_once": 12787,
+            "nb_fibers": 70000,
+            "nb_points": 1400000,
+            "resample_fibers": True,
+            "peak_memory": 2048})
+
+
+class ConnectomistShardedLabeling(unittest.TestCase):
+    """ Test the Connectomist sharded fast bundle labeling:
+    'pyconnectomist.clustering.labeling.sharded_fast_bundle_labeling'
+    """
+    def setUp(self):
+        """ Create two bundle maps with 3 and 4 fibers.
+        """
+        self.tmpdir = tempfile.mkdtemp()
+        self.paths_bundle_map = []
+        for index, nb_fibers in enumerate((3, 4)):
+            points = numpy.zeros((2 * nb_fibers, 3), dtype=numpy.float32)
+            points[:, 0] = numpy.repeat(
+                numpy.arange(nb_fibers) + 10 * index, 2)
+            self.paths_bundle_map.append(save_bundles(
+                os.path.join(self.tmpdir, "map{0}".format(index)), points,
+                numpy.arange(0, 2 * nb_fibers + 1, 2)))
+        self.outdir = os.path.join(self.tmpdir, "labeling")
+
+    def tearDown(self):
+        """ Run after each test.
+        """
+        shutil.rmtree(self.tmpdir)
+
+    @mock.patch("pyconnectomist.clustering.labeling.fast_bundle_labeling")
+    def test_normal_execution(self, mock_labeling):
+        """ Test the normal behaviour of the function.
+        """
+        # Set the mocked functions returned values: the first fiber of each
+        # shard is labeled in the 'Fornix_Left' bundle
+        def label(outdir, registered_dwi_dir, morphologist_dir, subject_id,
+                  paths_bundle_map, **kwargs):
+            points, offsets, _ = load_bundles(paths_bundle_map[0])
+            region_dir = os.path.join(outdir, "bundleMapsReferential",
+                                      "Fornix")
+            os.makedirs(region_dir)
+            save_bundles(os.path.join(region_dir, "Fornix_Left"),
+                         points[offsets[0]: offsets[1]], offsets[:2])
+            return outdir
+        mock_labeling.side_effect = label
+
+        # Test execution
+        outdir = sharded_fast_bundle_labeling(
+            self.outdir, "/my/path/mock_registered", "/my/path/mock_morpho",
+            "Lola", self.paths_bundle_map, nb_shards=3, chunk_size=2,
+            atlas="custom", memory_budget=3000)
+        self.assertEqual(outdir, self.outdir)
+        self.assertEqual(len(mock_labeling.call_args_list), 3)
+        self.assertEqual(mock_labeling.call_args_list[0][1],
+                         {"atlas": "custom", "memory_budget": 1000})
+        nb_fibers = []
+        fibers = []
+        for index in range(3):
+            shard_bundle = os.path.join(
+                self.outdir, "shard_{0}".format(index), "fibers.bundles")
+            points, offsets, header = load_bundles(shard_bundle)
+            nb_fibers.append(header["curves_count"])
+            fibers.extend(points[offsets[:-1], 0].tolist())
+            self.assertEqual(offsets.tolist(),
+                             list(range(0, 2 * nb_fibers[-1] + 1, 2)))
+        self.assertEqual(nb_fibers, [2, 2, 3])
+        self.assertEqual(fibers, [0, 1, 2, 10, 11, 12, 13])
+        points, offsets, header = load_bundles(os.path.join(
+            self.outdir, "bundleMapsReferential", "Fornix",
+            "Fornix_Left.bundles"))
+        self.assertEqual(header["curves_count"], 3)
+        self.assertEqual(points[offsets[:-1], 0].tolist(), [0, 2, 11])
+
+    def test_chunk_size(self):
+        """ Test the fiber chunk size computation.
+        """
+        # Test execution: 7 fibers of 2 points
+        memory_model = (512 * 1024 ** 2, 1024, 96)
+        fiber_memory = memory_model[1] + 2 * memory_model[2]
+        memory_budget = 1024
+        chunk_size = fiber_chunk_size(self.paths_bundle_map, memory_budget,
+                                      memory_model, resample_fibers=False)
+        self.assertEqual(chunk_size, 7)
+        memory_budget = (memory_model[0] + 5 * fiber_memory) / 1024. ** 2
+        chunk_size = fiber_chunk_size(self.paths_bundle_map, memory_budget,
+                                      memory_model, resample_fibers=False)
+        self.assertEqual(chunk_size, 5)
+        memory_budget = (memory_model[0] + fiber_memory / 2) / 1024. ** 2
+        chunk_size = fiber_chunk_size(self.paths_bundle_map, memory_budget,
+                                      memory_model, resample_fibers=False)
+        self.assertEqual(chunk_size, 1)
+        self.assertRaises(ConnectomistError, fiber_chunk_size,
+                          self.paths_bundle_map, 512, memory_model)
+
+    def test_fit_memory_model(self):
+        """ Test the memory model fit on recorded runs.
+        """
+        # Record runs that follow an exact memory model
+        memory_model = (300 * 1024 ** 2, 2048, 64)
+        records = []
+        for index, (chunk_size, nb_fibers, nb_points) in enumerate((
+                (1000, 5000, 50000), (20000, 50000, 500000),
+                (5000, 5000, 200000), (10000, 80000, 400000))):
+            points_per_fiber = float(nb_points) / nb_fibers + 21
+            peak = (memory_model[0] + memory_model[1] * chunk_size +
+                    memory_model[2] * points_per_fiber * chunk_size)
+            records.append(os.path.join(self.tmpdir, "{0}.json".format(
+                index)))
+            with open(records[-1], "wt") as open_file:
+                json.dump({
+                    "memory_budget": None,
+                    "nb_fibers_to_process_at_once": chunk_size,
+                    "nb_fibers": nb_fibers,
+                    "nb_points": nb_points,
+                    "resample_fibers": True,
+                    "peak_memory": peak / 1024.}, open_file)
+
+        # Test execution
+        numpy.testing.assert_allclose(
+            fit_labeling_memory_model(records), memory_model, rtol=1e-6)
+        self.assertRaises(ValueError, fit_labeling_memory_model,
+                          records[:2])
+
 
 class ConnectomistLabelingExport(unittest.TestCase):
     """ Test the Connectomist 'Fast bundle labeling' tab Nifti export:
@@ -169,7 +353,7 @@ class ConnectomistLabelingExport(unittest.TestCase):
             "outdir": "/my/path/mock_outdir"
         }
 
-    @mock.patch("pyconnectomist.clustering.labeling.ptk_bundle_to_trk")
+    @mock.patch("pyconnectomist.clustering.labeling.bundle_to_trk")
     @mock.patch("pyconnectomist.clustering.labeling.os.path.isdir")
     @mock.patch("pyconnectomist.clustering.labeling.glob.glob")
     @mock.patch("pyconnectomist.clustering.labeling.os.mkdir")
@@ -209,6 +393,107 @@ class ConnectomistLabelingExport(unittest.TestCase):
             mock.call(bundlesdata[1], expected_bundles[1])],
             mock_conversion.call_args_list)
 
+    @mock.patch("pyconnectomist.clustering.labeling.bundles_to_trx")
+    @mock.patch("pyconnectomist.clustering.labeling.os.path.isdir")
+    @mock.patch("pyconnectomist.clustering.labeling.glob.glob")
+    @mock.patch("pyconnectomist.clustering.labeling.os.mkdir")
+    def test_trx_execution(self, mock_mkdir, mock_glob, mock_isdir,
+                           mock_conversion):
+        """ Test the TRX export: one group per labeled bundle.
+        """
+        # Set the mocked functions returned values
+        mock_isdir.return_value = True
+        mock_conversion.side_effect = lambda *x, **kwargs: x[1]
+        mock_glob.return_value = [
+            os.path.join(self.kwargs["labeling_dir"], "bundleMapsReferential",
+                         "region2", "bundle2.bundlesdata"),
+            os.path.join(self.kwargs["labeling_dir"], "bundleMapsReferential",
+                         "region1", "bundle1.bundlesdata")]
+
+        # Test execution
+        trx = export_bundles_to_trx(float16=True, **self.kwargs)
+        self.assertEqual(trx, os.path.join(self.kwargs["outdir"],
+                                           "bundles.trx"))
+        self.assertEqual(len(mock_mkdir.call_args_list), 0)
+        self.assertEqual([mock.call(
+            [item.replace("bundlesdata", "bundles")
+             for item in sorted(mock_glob.return_value)], trx,
+            reference=None, group_names=["bundle1", "bundle2"],
+            float16=True)],
+            mock_conversion.call_args_list)
+
+    @mock.patch("pyconnectomist.clustering.labeling.glob.glob")
+    def test_trx_nobundle_raise(self, mock_glob):
+        """ No labeled bundle -> raise ConnectomistError.
+        """
+        # Set the mocked functions returned values
+        mock_glob.return_value = []
+
+        # Test execution
+        self.assertRaises(ConnectomistError, export_bundles_to_trx,
+                          self.kwargs["labeling_dir"])
+
+    @mock.patch("pyconnectomist.clustering.labeling.compress_bundles")
+    @mock.patch("pyconnectomist.clustering.labeling.os.path.isdir")
+    @mock.patch("pyconnectomist.clustering.labeling.glob.glob")
+    @mock.patch("pyconnectomist.clustering.labeling.os.makedirs")
+    def test_quicklook_execution(self, mock_mkdirs, mock_glob, mock_isdir,
+                                 mock_conversion):
+        """ Test the quick look export.
+        """
+        # Set the mocked functions returned values
+        mock_isdir.return_value = True
+        mock_conversion.side_effect = lambda *x: x[1]
+        mock_glob.return_value = [
+            os.path.join(self.kwargs["labeling_dir"], "bundleMapsReferential",
+                         "region1", "bundle1.bundlesdata")]
+
+        # Test execution
+        bundles = export_quicklook_bundles(tolerance=0.2, max_fibers=100,
+                                           **self.kwargs)
+        expected_bundle = os.path.join(self.kwargs["outdir"], "quicklook",
+                                       "region1", "bundle1.trk")
+        self.assertEqual(bundles, [expected_bundle])
+        self.assertEqual(len(mock_mkdirs.call_args_list), 0)
+        self.assertEqual([mock.call(
+            [mock_glob.return_value[0].replace("bundlesdata", "bundles")],
+            expected_bundle, 0.2, 100)], mock_conversion.call_args_list)
+
+
+class ConnectomistMergedBundlesExport(unittest.TestCase):
+    """ Test the Connectomist 'Fast bundle labeling' tab single Trackvis
+    file export:
+    'pyconnectomist.clustering.labeling.export_merged_bundles_to_trk'
+    """
+    def setUp(self):
+        """ Create a labeling directory with two labeled bundles.
+        """
+        self.tmpdir = tempfile.mkdtemp()
+        for region, name in (("region2", "bundle2"), ("region1", "bundle1")):
+            region_dir = os.path.join(self.tmpdir, "bundleMapsReferential",
+                                      region)
+            os.makedirs(region_dir)
+            save_bundles(os.path.join(region_dir, name),
+                         numpy.zeros((2, 3), dtype=numpy.float32),
+                         numpy.array([0, 2]))
+
+    def tearDown(self):
+        """ Run after each test.
+        """
+        shutil.rmtree(self.tmpdir)
+
+    def test_normal_execution(self):
+        """ Test the single Trackvis file export and its sidecar.
+        """
+        # Test execution
+        trk, sidecar = export_merged_bundles_to_trk(self.tmpdir)
+        self.assertEqual(trk, os.path.join(self.tmpdir, "bundles.trk"))
+        self.assertTrue(os.path.isfile(trk))
+        with open(sidecar, "rt") as open_file:
+            labels = json.load(open_file)
+        self.assertEqual(labels["bundles"], ["bundle1", "bundle2"])
+        self.assertEqual(labels["regions"], ["region1", "region2"])
+
 
 if __name__ == "__main__":
     unittest.main()
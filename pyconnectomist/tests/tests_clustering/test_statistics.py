@@ -0,0 +1,104 @@
+##########################################################################
+# NSAp - Copyright (C) CEA, 2016
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+"""
+Test the bundle statistics on small bundle maps written in a temporary
+directory.
+"""
+
+# System import
+import unittest
+import os
+import shutil
+import tempfile
+import numpy
+
+# pyConnectomist import
+from pyconnectomist.clustering.statistics import labeling_statistics
+from pyconnectomist.clustering.statistics import bundle_statistics
+from pyconnectomist.clustering.statistics import LENGTH_BINS
+from pyconnectomist.clustering.statistics import STATISTICS
+from pyconnectomist.exceptions import ConnectomistError
+from pyconnectomist.utils.bundletools import save_bundles
+
+
+class ConnectomistBundleStatistics(unittest.TestCase):
+    """ Test the labeled bundle statistics:
+    'pyconnectomist.clustering.statistics.labeling_statistics'
+    """
+    def setUp(self):
+        """ Create a labeling directory with two bundles.
+        """
+        self.tmpdir = tempfile.mkdtemp()
+        region_dir = os.path.join(self.tmpdir, "bundleMapsReferential",
+                                  "Fornix")
+        os.makedirs(region_dir)
+        points = numpy.array([
+            [0, 0, 0], [10, 0, 0], [20, 0, 0],
+            [5, 5, 5], [5, 5, 10],
+            [0, 0, 0], [0, 400, 0]], dtype=numpy.float32)
+        save_bundles(os.path.join(region_dir, "Fornix_Left"), points,
+                     numpy.array([0, 3, 5, 7]))
+        save_bundles(os.path.join(region_dir, "Fornix_Right"),
+                     numpy.zeros((0, 3)), numpy.array([0]))
+
+    def tearDown(self):
+        """ Run after each test.
+        """
+        shutil.rmtree(self.tmpdir)
+
+    def test_nobundle_raise(self):
+        """ No labeled bundle -> raise ConnectomistError.
+        """
+        # Test execution
+        self.assertRaises(ConnectomistError, labeling_statistics,
+                          os.path.join(self.tmpdir, "WRONG"))
+
+    def test_normal_execution(self):
+        """ Test the normal behaviour of the function.
+        """
+        # Test execution
+        outfile = labeling_statistics(self.tmpdir, bins=[0, 10, 30],
+                                      nb_threads=2)
+        self.assertEqual(outfile,
+                         os.path.join(self.tmpdir, "bundle_statistics.tsv"))
+        with open(outfile, "rt") as open_file:
+            rows = [line.rstrip("\n").split("\t") for line in open_file]
+        self.assertEqual(rows[0], STATISTICS + [
+            "length_0_10", "length_10_30", "length_30_inf"])
+        self.assertEqual(len(rows), 3)
+        left = dict(zip(rows[0], rows[1]))
+        self.assertEqual(left["bundle"], "Fornix_Left")
+        self.assertEqual(left["region"], "Fornix")
+        self.assertEqual(int(left["nb_fibers"]), 3)
+        self.assertEqual(int(left["nb_points"]), 7)
+        self.assertAlmostEqual(float(left["mean_length"]), 425. / 3)
+        self.assertAlmostEqual(float(left["max_length"]), 400)
+        self.assertAlmostEqual(float(left["zmax"]), 10)
+        self.assertEqual((left["length_0_10"], left["length_10_30"],
+                          left["length_30_inf"]), ("1", "1", "1"))
+        right = dict(zip(rows[0], rows[2]))
+        self.assertEqual(int(right["nb_fibers"]), 0)
+        self.assertEqual(right["mean_length"], "")
+
+    def test_histogram_total(self):
+        """ Test the default histogram counts all the fibers, including the
+        fibers longer than 300 mm.
+        """
+        # Test execution
+        statistics = bundle_statistics(os.path.join(
+            self.tmpdir, "bundleMapsReferential", "Fornix",
+            "Fornix_Left.bundles"))
+        self.assertEqual(len(statistics["histogram"]), len(LENGTH_BINS) - 1)
+        self.assertEqual(sum(statistics["histogram"]),
+                         statistics["nb_fibers"])
+        self.assertEqual(statistics["histogram"][-1], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -107,6 +107,49 @@ class ConnectomistPreproc(unittest.TestCase):
         self.assertEqual(expected_rmtree_calls, mock_rmtree.call_args_list)
         self.assertEqual(output_files, mock_expeddy.return_value +
                          (mock_outliers, ))
+        self.assertEqual(
+            mock_qspace.call_args_list[0][1]["header_cache"], None)
+
+    @mock.patch("pyconnectomist.preproc.all_steps."
+                "data_import_and_qspace_sampling")
+    @mock.patch("pyconnectomist.preproc.all_steps.dwi_to_anatomy")
+    @mock.patch("pyconnectomist.preproc.all_steps.rough_mask_extraction")
+    @mock.patch("pyconnectomist.preproc.all_steps.outlying_slice_detection")
+    @mock.patch("pyconnectomist.preproc.all_steps.susceptibility_correction")
+    @mock.patch("pyconnectomist.preproc.all_steps.eddy_and_motion_correction")
+    @mock.patch("pyconnectomist.preproc.all_steps.qc_reporting")
+    @mock.patch("pyconnectomist.preproc.all_steps."
+                "export_eddy_motion_results_to_nifti")
+    @mock.patch("os.path.isfile")
+    @mock.patch("shutil.rmtree")
+    @mock.patch("shutil.copy")
+    @mock.patch("os.mkdir")
+    def test_prior_transforms(self, mock_mkdir, mock_copy, mock_rmtree,
+                              mock_isfile, mock_expeddy, mock_qc, mock_eddy,
+                              mock_susceptibility, mock_outliers, mock_mask,
+                              mock_registration, mock_qspace):
+        """ Test only the existing prior transformations seed the
+        registrations.
+        """
+        # Set the mocked functions returned values
+        mock_expeddy.return_value = ("mock_dwi", "mock_bval", "mock_bvec")
+        mock_isfile.side_effect = lambda path: path.endswith("dw_to_b0.trm")
+
+        # Test execution
+        prior_preproc_dir = "/my/path/mock_prior"
+        complete_preprocessing(prior_preproc_dir=prior_preproc_dir,
+                               **self.kwargs)
+        self.assertEqual(
+            mock_registration.call_args_list[0][1]["initial_transform"], None)
+        self.assertEqual(
+            mock_mask.call_args_list[0][1]["initial_transform"], None)
+        self.assertEqual(
+            mock_susceptibility.call_args_list[0][1]["initial_transform"],
+            os.path.join(prior_preproc_dir, STEPS[4], "dw_to_b0.trm"))
+        for mock_step in (mock_registration, mock_mask, mock_susceptibility):
+            kwargs = mock_step.call_args_list[0][1]
+            self.assertEqual(kwargs["warm_start_search_scale"], 0.2)
+            self.assertEqual(kwargs["warm_start_iteration_count"], 200)
 
 
 if __name__ == "__main__":
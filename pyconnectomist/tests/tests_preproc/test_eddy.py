@@ -18,6 +18,9 @@ import unittest
 import sys
 import os
 import copy
+import shutil
+import tempfile
+import warnings
 import numpy
 # COMPATIBILITY: since python 3.3 mock is included in unittest module
 python_version = sys.version_info
@@ -30,8 +33,14 @@ else:
 
 # pyConnectomist import
 from pyconnectomist.exceptions import ConnectomistBadFileError
+from pyconnectomist.exceptions import ConnectomistError
 from pyconnectomist.preproc.eddy import eddy_and_motion_correction
 from pyconnectomist.preproc.eddy import export_eddy_motion_results_to_nifti
+from pyconnectomist.preproc.eddy import sharded_eddy_and_motion_correction
+from pyconnectomist.utils.filetools import load_gis
+from pyconnectomist.utils.filetools import save_gis
+from pyconnectomist.utils.filetools import parse_dict_file
+from pyconnectomist.utils.filetools import save_dict_file
 
 
 class ConnectomistEddy(unittest.TestCase):
@@ -114,7 +123,7 @@ class ConnectomistEddyExport(unittest.TestCase):
         self.assertRaises(ConnectomistBadFileError,
                           export_eddy_motion_results_to_nifti, **self.kwargs)
 
-    @mock.patch("pyconnectomist.preproc.eddy.exec_file")
+    @mock.patch("pyconnectomist.utils.dwitools.parse_dict_file")
     @mock.patch("pyconnectomist.preproc.eddy.ptk_gis_to_nifti")
     @mock.patch("pyconnectomist.preproc.eddy.ptk_concatenate_volumes")
     @mock.patch("os.path")
@@ -137,7 +146,7 @@ class ConnectomistEddyExport(unittest.TestCase):
         self.assertRaises(ConnectomistBadFileError,
                           export_eddy_motion_results_to_nifti, **self.kwargs)
 
-    @mock.patch("pyconnectomist.preproc.eddy.exec_file")
+    @mock.patch("pyconnectomist.utils.dwitools.parse_dict_file")
     @mock.patch("pyconnectomist.preproc.eddy.ptk_gis_to_nifti")
     @mock.patch("pyconnectomist.preproc.eddy.ptk_concatenate_volumes")
     @mock.patch("os.path")
@@ -161,7 +170,7 @@ class ConnectomistEddyExport(unittest.TestCase):
                           export_eddy_motion_results_to_nifti, **self.kwargs)
 
     @mock.patch("numpy.savetxt")
-    @mock.patch("pyconnectomist.preproc.eddy.exec_file")
+    @mock.patch("pyconnectomist.utils.dwitools.parse_dict_file")
     @mock.patch("pyconnectomist.preproc.eddy.ptk_gis_to_nifti")
     @mock.patch("pyconnectomist.preproc.eddy.ptk_concatenate_volumes")
     @mock.patch("os.path")
@@ -210,6 +219,199 @@ class ConnectomistEddyExport(unittest.TestCase):
                          mock_exec.call_args_list)
         self.assertTrue(len(mock_savetxt.call_args_list) == 2)
 
+    @mock.patch("pyconnectomist.preproc.eddy.save_motion_metrics")
+    @mock.patch("pyconnectomist.preproc.eddy.read_trms")
+    @mock.patch("os.listdir")
+    @mock.patch("numpy.savetxt")
+    @mock.patch("pyconnectomist.utils.dwitools.parse_dict_file")
+    @mock.patch("pyconnectomist.preproc.eddy.ptk_gis_to_nifti")
+    @mock.patch("pyconnectomist.preproc.eddy.ptk_concatenate_volumes")
+    @mock.patch("os.path")
+    @mock.patch("os.mkdir")
+    def test_motion_execution(self, mock_mkdir, mock_path, mock_concat,
+                              mock_conversion, mock_exec, mock_savetxt,
+                              mock_listdir, mock_read, mock_save):
+        """ Test the motion quality control export.
+        """
+        # Set the mocked functions returned values
+        mock_path.join.side_effect = lambda *x: x[0] + "/" + x[1]
+        mock_path.isfile.side_effect = [True] * 2 + [False]
+        mock_conversion.side_effect = lambda *x: x[-1]
+        mock_exec.return_value = {
+            "attributes": {
+                "bvalues": self.bvals,
+                "diffusion_gradient_orientations": self.bvecs
+            }
+        }
+        mock_listdir.return_value = [
+            "dw_to_t2_10.trm", "t1_to_t2.trm", "dw_to_t2_9.trm",
+            "dw_to_t2_9.trm.minf"]
+        mock_read.return_value = numpy.array([numpy.eye(4)] * 2)
+
+        # Test execution
+        export_eddy_motion_results_to_nifti(motion_qc=True, **self.kwargs)
+        eddy_motion_dir = self.kwargs["eddy_motion_dir"]
+        self.assertEqual([mock.call([eddy_motion_dir + "/dw_to_t2_9.trm",
+                                     eddy_motion_dir + "/dw_to_t2_10.trm"])],
+                         mock_read.call_args_list)
+        self.assertEqual(len(mock_save.call_args_list), 1)
+        self.assertEqual(mock_save.call_args_list[0][0][1:], (
+            os.path.join(self.kwargs["outdir"], "mock_dwi_motion.tsv"),
+            os.path.join(self.kwargs["outdir"], "mock_dwi_motion.json")))
+        self.assertTrue(numpy.allclose(
+            mock_save.call_args_list[0][0][0]["framewise_displacement"], 0))
+
+        # Missing transformations: raise before any export
+        mock_path.isfile.side_effect = [True] * 2 + [False]
+        mock_listdir.return_value = mock_listdir.return_value[:2]
+        mock_concat.reset_mock()
+        mock_conversion.reset_mock()
+        self.assertRaises(ConnectomistError,
+                          export_eddy_motion_results_to_nifti,
+                          motion_qc=True, **self.kwargs)
+        self.assertEqual(len(mock_concat.call_args_list), 0)
+        self.assertEqual(len(mock_conversion.call_args_list), 0)
+
+
+class ConnectomistShardedEddy(unittest.TestCase):
+    """ Test the sharded eddy current and motion correction:
+    'pyconnectomist.preproc.eddy.sharded_eddy_and_motion_correction'
+    """
+    def setUp(self):
+        """ Create raw and corrected directories with a T2 volume and a DW
+        series where each volume is filled with its index.
+        """
+        self.tmpdir = tempfile.mkdtemp()
+        self.raw_dwi_dir = os.path.join(self.tmpdir, "raw")
+        self.corrected_dir = os.path.join(self.tmpdir, "corrected")
+        self.outdir = os.path.join(self.tmpdir, "eddy")
+        self.bvalues = [1000, 1000, 2000, 2000, 3000]
+        self.orientations = numpy.eye(3)[[0, 1, 2, 0, 1]]
+        for dirpath, suffix in ((self.raw_dwi_dir, ""),
+                                (self.corrected_dir, "_wo_outlier")):
+            os.mkdir(dirpath)
+            save_gis(os.path.join(dirpath, "t2{0}.ima".format(suffix)),
+                     numpy.ones((4, 4, 3), dtype=numpy.int16))
+            data = numpy.ones((4, 4, 3, 5), dtype=numpy.int16)
+            data *= numpy.arange(5, dtype=numpy.int16)
+            dw = os.path.join(dirpath, "dw{0}.ima".format(suffix))
+            save_gis(dw, data)
+            save_dict_file(dw + ".minf", {"attributes": {
+                "bvalues": self.bvalues,
+                "diffusion_gradient_orientations": self.orientations,
+                "volume_dimension": [4, 4, 3, 5]}})
+
+    def tearDown(self):
+        """ Run after each test.
+        """
+        shutil.rmtree(self.tmpdir)
+
+    def correction(self, outdir, raw_dwi_dir, rough_mask_dir, corrected_dir,
+                   subject_id, **kwargs):
+        """ Fake the Connectomist correction: the volumes are copied, the
+        gradients are flipped and one transformation per volume is written,
+        with a report of the shard volume count.
+        """
+        dw = os.path.join(corrected_dir, "dw_wo_outlier.ima")
+        data, _ = load_gis(dw)
+        raw_data, _ = load_gis(os.path.join(raw_dwi_dir, "dw.ima"))
+        self.assertEqual(raw_data.shape, data.shape)
+        with open(os.path.join(outdir, "report.txt"), "wt") as open_file:
+            open_file.write("{0}\n".format(data.shape[3]))
+        parsed_dict = copy.deepcopy(parse_dict_file(dw + ".minf"))
+        attributes = parsed_dict["attributes"]
+        attributes["diffusion_gradient_orientations"] *= -1
+        dw = os.path.join(outdir, "dw_wo_eddy_current_and_motion.ima")
+        save_gis(dw, data)
+        save_dict_file(dw + ".minf", parsed_dict)
+        save_gis(os.path.join(outdir, "t2_wo_eddy_current_and_motion.ima"),
+                 numpy.ones((4, 4, 3), dtype=numpy.int16))
+        for index in range(data.shape[3]):
+            with open(os.path.join(outdir, "dw_to_t2_{0}.trm".format(index)),
+                      "wt") as open_file:
+                open_file.write("{0}\n".format(data[0, 0, 0, index]))
+        return outdir
+
+    def test_nodwiseries_raise(self):
+        """ No DW series -> raise ConnectomistError.
+        """
+        # Test execution
+        os.remove(os.path.join(self.corrected_dir, "dw_wo_outlier.ima.minf"))
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            self.assertRaises(ConnectomistError,
+                              sharded_eddy_and_motion_correction, self.outdir,
+                              self.raw_dwi_dir, "mask", self.corrected_dir,
+                              "Lola")
+
+    @mock.patch("pyconnectomist.preproc.eddy.eddy_and_motion_correction")
+    def test_normal_execution(self, mock_eddy):
+        """ Test the shards are reassembled in the original order.
+        """
+        # Set the mocked functions returned values
+        mock_eddy.side_effect = self.correction
+
+        # Test execution
+        with warnings.catch_warnings(record=True) as records:
+            warnings.simplefilter("always")
+            outdir = sharded_eddy_and_motion_correction(
+                self.outdir, self.raw_dwi_dir, "mask", self.corrected_dir,
+                "Lola", nb_shards=2, keep_shards=True,
+                similarity_measure="mi")
+        self.assertEqual(len(records), 2)
+        self.assertTrue("report.txt" in str(records[1].message))
+        self.assertEqual(outdir, self.outdir)
+        self.assertEqual(len(mock_eddy.call_args_list), 2)
+        self.assertEqual(mock_eddy.call_args_list[0][1],
+                         {"similarity_measure": "mi"})
+        self.assertEqual(mock_eddy.call_args_list[1][0][1], os.path.join(
+            self.outdir, "shard_1", "raw_dwi"))
+        shard_dir = os.path.join(self.outdir, "shard_1", "corrected_dwi")
+        self.assertTrue(os.path.islink(
+            os.path.join(shard_dir, "t2_wo_outlier.ima")))
+        self.assertEqual(load_gis(os.path.join(
+            shard_dir, "dw_wo_outlier.ima"))[0].shape, (4, 4, 3, 2))
+        self.assertFalse(os.path.isfile(
+            os.path.join(self.outdir, "report.txt")))
+        dw = os.path.join(self.outdir, "dw_wo_eddy_current_and_motion.ima")
+        data, _ = load_gis(dw)
+        self.assertEqual(data[0, 0, 0].tolist(), list(range(5)))
+        attributes = parse_dict_file(dw + ".minf")["attributes"]
+        self.assertEqual(attributes["bvalues"].tolist(), self.bvalues)
+        numpy.testing.assert_array_equal(
+            attributes["diffusion_gradient_orientations"], -self.orientations)
+        self.assertEqual(attributes["volume_dimension"], [4, 4, 3, 5])
+        self.assertTrue(os.path.isfile(
+            os.path.join(self.outdir, "t2_wo_eddy_current_and_motion.ima")))
+        for index in range(5):
+            with open(os.path.join(self.outdir, "dw_to_t2_{0}.trm".format(
+                    index)), "rt") as open_file:
+                self.assertEqual(open_file.read(), "{0}\n".format(index))
+
+        # The shards are removed by default
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            sharded_eddy_and_motion_correction(
+                self.outdir, self.raw_dwi_dir, "mask", self.corrected_dir,
+                "Lola", nb_shards=2)
+        self.assertFalse(os.path.isdir(os.path.join(self.outdir, "shard_0")))
+
+    def test_volumecount_raise(self):
+        """ Raw and corrected DW series with different volume counts -> raise
+        ConnectomistError.
+        """
+        # Test execution
+        dw = os.path.join(self.raw_dwi_dir, "dw.ima")
+        parsed_dict = parse_dict_file(dw + ".minf")
+        parsed_dict["attributes"]["bvalues"] = self.bvalues[:4]
+        save_dict_file(dw + ".minf", parsed_dict)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            self.assertRaises(ConnectomistError,
+                              sharded_eddy_and_motion_correction, self.outdir,
+                              self.raw_dwi_dir, "mask", self.corrected_dir,
+                              "Lola")
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -100,6 +100,46 @@ class ConnectomistMask(unittest.TestCase):
         self.assertEqual(outdir, self.kwargs["outdir"])
         self.assertTrue(len(mock_params.call_args_list) == 1)
 
+        # The explicit level count takes precedence over the preset
+        for level_count, expected in ((None, 16), (48, 48)):
+            mock_params.reset_mock()
+            mock_glob.side_effect = [
+                [self.kwargs["morphologist_dir"] + os.sep +
+                 "{0}.nii.gz".format(self.kwargs["subject_id"])],
+                []]
+            mock_path.isfile.side_effect = [True, True, True, False]
+            kwargs = dict(self.kwargs, level_count=level_count,
+                          registration_preset="fast")
+            rough_mask_extraction(**kwargs)
+            parameters = mock_params.call_args_list[0][0][1][
+                "dwToT1RegistrationParameter"]
+            self.assertEqual(parameters["levelCount"], expected)
+            self.assertEqual(parameters["maximumIterationCount"], 250)
+
+        # A warm-started run reduces the search ranges and iterations
+        mock_params.reset_mock()
+        mock_glob.side_effect = [
+            [self.kwargs["morphologist_dir"] + os.sep +
+             "{0}.nii.gz".format(self.kwargs["subject_id"])],
+            []]
+        mock_path.isfile.side_effect = [True, True, True, False]
+        with mock.patch(
+                "pyconnectomist.utils.regtools.read_trms") as mock_read:
+            mock_read.return_value = numpy.array([numpy.eye(4)])
+            rough_mask_extraction(initial_transform="/my/path/dw_to_t1.trm",
+                                  **self.kwargs)
+        self.assertEqual([mock.call(["/my/path/dw_to_t1.trm"])],
+                         mock_read.call_args_list)
+        parameters = mock_params.call_args_list[0][0][1][
+            "dwToT1RegistrationParameter"]
+        self.assertAlmostEqual(parameters["optimizerParametersTranslationX"],
+                               6)
+        self.assertAlmostEqual(parameters["optimizerParametersRotationZ"], 1)
+        self.assertEqual(parameters["maximumIterationCount"], 200)
+        self.assertEqual(parameters["initialParametersScalingX"], 1)
+        self.assertFalse(
+            parameters["initializeCoefficientsUsingCenterOfGravity"])
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -16,6 +16,10 @@ fake return string.
 # System import
 import unittest
 import sys
+import numpy
+import tempfile
+import shutil
+import os
 # COMPATIBILITY: since python 3.3 mock is included in unittest module
 python_version = sys.version_info
 if python_version[:2] <= (3, 3):
@@ -27,6 +31,12 @@ else:
 
 # pyConnectomist import
 from pyconnectomist.preproc.outliers import outlying_slice_detection
+from pyconnectomist.preproc.outliers import prescreen_outliers
+from pyconnectomist.preproc.outliers import read_outliers
+from pyconnectomist.exceptions import ConnectomistBadFileError
+from pyconnectomist.exceptions import ConnectomistError
+from pyconnectomist.utils.filetools import parse_dict_file
+from pyconnectomist.utils.filetools import save_gis
 
 
 class ConnectomistOutliers(unittest.TestCase):
@@ -73,6 +83,105 @@ class ConnectomistOutliers(unittest.TestCase):
         outdir = outlying_slice_detection(**self.kwargs)
         self.assertEqual(outdir, self.kwargs["outdir"])
         self.assertTrue(len(mock_params.call_args_list) == 1)
+        parameters = mock_params.call_args_list[0][0][1]
+        self.assertEqual(parameters["discardedOrientationList"], "")
+        self.assertEqual(parameters["outlierFactor"], 3.0)
+
+        # Discard some orientations
+        outlying_slice_detection(discarded_orientations=[3, 7],
+                                 **self.kwargs)
+        parameters = mock_params.call_args_list[1][0][1]
+        self.assertEqual(parameters["discardedOrientationList"], "3 7")
+
+
+class ConnectomistOutliersPrescreen(unittest.TestCase):
+    """ Test the outlying slices prescreen:
+    'pyconnectomist.preproc.outliers.prescreen_outliers'
+    """
+    def setUp(self):
+        """ Simulate a noisy single shell acquisition with a signal dropout
+        in one slice of volume 3 and in most slices of volume 7.
+        """
+        self.tmpdir = tempfile.mkdtemp()
+        self.raw_dwi_dir = os.path.join(self.tmpdir, "raw")
+        self.rough_mask_dir = os.path.join(self.tmpdir, "mask")
+        os.mkdir(self.raw_dwi_dir)
+        os.mkdir(self.rough_mask_dir)
+        state = numpy.random.RandomState(0)
+        bvecs = state.normal(size=(30, 3))
+        bvecs /= numpy.linalg.norm(bvecs, axis=1)[:, numpy.newaxis]
+        dw = 500. + state.normal(scale=5., size=(8, 8, 10, 30))
+        dw[..., 2, 3] *= 0.3
+        dw[..., 1:9, 7] *= 0.5
+        dwfile = save_gis(os.path.join(self.raw_dwi_dir, "dw.ima"),
+                          dw.astype(numpy.float32))
+        with open(dwfile + ".minf", "wt") as open_file:
+            open_file.write("attributes = {{'bvalues': {0}, "
+                            "'diffusion_gradient_orientations': {1}}}".format(
+                                [1000.] * 30, bvecs.tolist()))
+        save_gis(os.path.join(self.rough_mask_dir, "mask.ima"),
+                 numpy.ones((8, 8, 10), dtype=numpy.int16))
+        self.kwargs = {
+            "outdir": os.path.join(self.tmpdir, "outliers"),
+            "raw_dwi_dir": self.raw_dwi_dir,
+            "rough_mask_dir": self.rough_mask_dir,
+            "min_slice_voxels": 20
+        }
+
+    def tearDown(self):
+        """ Run after each test.
+        """
+        shutil.rmtree(self.tmpdir)
+
+    def test_badfileerror_raise(self):
+        """ A wrong input -> raise ConnectomistBadFileError.
+        """
+        # Test execution
+        os.remove(os.path.join(self.raw_dwi_dir, "dw.ima.minf"))
+        self.assertRaises(ConnectomistBadFileError, prescreen_outliers,
+                          **self.kwargs)
+
+    def test_rejection_raise(self):
+        """ Too many discarded volumes -> raise ConnectomistError.
+        """
+        # Test execution
+        self.assertRaises(ConnectomistError, prescreen_outliers,
+                          max_discarded_ratio=0.01, **self.kwargs)
+
+    def test_normal_execution(self):
+        """ Test the normal behaviour of the function.
+        """
+        # Test execution
+        report, discarded = prescreen_outliers(**self.kwargs)
+        self.assertEqual(report, os.path.join(self.kwargs["outdir"],
+                                              "outliers_prescreen.py"))
+        self.assertEqual(discarded, [7])
+        outliers = read_outliers(report)
+        self.assertTrue(2 in outliers[3])
+        self.assertEqual(outliers[7], list(range(1, 9)))
+
+    def test_connectomist_report(self):
+        """ Test the pre-screen report has the structure of the Connectomist
+        'outliers.py' report.
+        """
+        # Create a Connectomist report fixture
+        fixture = os.path.join(self.tmpdir, "outliers.py")
+        with open(fixture, "wt") as open_file:
+            open_file.write(
+                "outliers = {'axial': {3: [2], 7: [1, 2, 3]},\n"
+                "            'coronal': {},\n"
+                "            'sagittal': {}}\n")
+
+        # Test execution
+        report, _ = prescreen_outliers(**self.kwargs)
+        expected = parse_dict_file(fixture)
+        content = parse_dict_file(report)
+        self.assertEqual(sorted(content), sorted(expected))
+        self.assertEqual(sorted(content["outliers"]),
+                         sorted(expected["outliers"]))
+        self.assertEqual(read_outliers(fixture), {3: [2], 7: [1, 2, 3]})
+        self.assertEqual(read_outliers(report, axis="coronal"), {})
+        self.assertRaises(ValueError, read_outliers, report, axis="WRONG")
 
 
 if __name__ == "__main__":
@@ -17,7 +17,11 @@ fake return string.
 import unittest
 import sys
 import copy
+import os
+import shutil
+import tempfile
 import numpy
+import nibabel
 # COMPATIBILITY: since python 3.3 mock is included in unittest module
 python_version = sys.version_info
 if python_version[:2] <= (3, 3):
@@ -32,6 +36,7 @@ from pyconnectomist.exceptions import ConnectomistBadManufacturerNameError
 from pyconnectomist.exceptions import ConnectomistBadFileError
 from pyconnectomist.exceptions import ConnectomistError
 from pyconnectomist.preproc.qspace import data_import_and_qspace_sampling
+from pyconnectomist.preproc.qspace import gather_and_format_input_files
 
 
 class ConnectomistQspace(unittest.TestCase):
@@ -129,13 +134,13 @@ class ConnectomistQspace(unittest.TestCase):
                 "_connectomist_version_check")
     @mock.patch("pyconnectomist.preproc.qspace.ConnectomistWrapper."
                 "create_parameter_file")
-    @mock.patch("pyconnectomist.preproc.qspace.read_bvals_bvecs")
+    @mock.patch("pyconnectomist.preproc.qspace.GradientTable")
     @mock.patch("pyconnectomist.preproc.qspace.ptk_nifti_to_gis")
     @mock.patch("os.path")
     @mock.patch("shutil.copyfile")
     @mock.patch("os.mkdir")
     def test_normal_execution(self, mock_mkdir, mock_copyfile, mock_path,
-                              mock_conversion, mock_bvecs, mock_params,
+                              mock_conversion, mock_gtab, mock_params,
                               mock_version, mock_savetxt):
         """ Test the normal behaviour of the function.
         """
@@ -144,7 +149,9 @@ class ConnectomistQspace(unittest.TestCase):
         mock_path.isfile.side_effect = [True] * 8 + [False]
         mock_path.join.side_effect = lambda *x: x[0] + "/" + x[1]
         mock_conversion.side_effect = lambda *x: x[-1]
-        mock_bvecs.return_value = (self.bvals, self.bvecs, 1, 2)
+        mock_gtab.from_files.return_value = mock.Mock(
+            bvals=self.bvals, bvecs=self.bvecs, nb_shells=1, nb_nodiff=2,
+            b0_mask=(self.bvals <= 50), dw_mask=(self.bvals >= 100))
         mock_params.return_value = "/my/path/mock_parameters"
 
         # Test execution
@@ -168,8 +175,9 @@ class ConnectomistQspace(unittest.TestCase):
         self.assertTrue(expected_conversions == mock_conversion.call_args_list)
         self.assertTrue([
             mock.call([self.kwargs["outdir"] + "/" + "dwi.bval"],
-                      [self.kwargs["outdir"] + "/" + "dwi.bvec"])] ==
-            mock_bvecs.call_args_list)
+                      [self.kwargs["outdir"] + "/" + "dwi.bvec"],
+                      cachedir=None)] ==
+            mock_gtab.from_files.call_args_list)
         self.assertTrue(len(mock_params.call_args_list) == 1)
         expected_saves = [
             mock.call(self.kwargs["outdir"] + "/" + "dwi.bval", self.bvals),
@@ -177,5 +185,74 @@ class ConnectomistQspace(unittest.TestCase):
         self.assertTrue(expected_saves, mock_savetxt.call_args_list)
 
 
+class ConnectomistGatherInputs(unittest.TestCase):
+    """ Test the Connectomist input files formating:
+    'pyconnectomist.preproc.qspace.gather_and_format_input_files'
+    """
+    def setUp(self):
+        """ Create a fieldmap containing the magnitude and the phase.
+        """
+        self.tmpdir = tempfile.mkdtemp()
+        self.outdir = os.path.join(self.tmpdir, "outdir")
+        self.b0_maps = numpy.arange(4 * 5 * 6 * 2, dtype=numpy.int16).reshape(
+            4, 5, 6, 2)
+        self.affine = numpy.array([[-2., 0., 0., 10.], [0., 2., 0., -5.],
+                                   [0., 0., 3., 2.], [0., 0., 0., 1.]])
+        self.kwargs = {
+            "outdir": self.outdir,
+            "dwis": [os.path.join(self.tmpdir, "dwi.nii.gz")],
+            "bvals": [os.path.join(self.tmpdir, "dwi.bval")],
+            "bvecs": [os.path.join(self.tmpdir, "dwi.bvec")],
+            "b0_magnitude": os.path.join(self.tmpdir, "b0_maps.nii")
+        }
+        nibabel.Nifti1Image(self.b0_maps, self.affine).to_filename(
+            self.kwargs["b0_magnitude"])
+        for path in self.kwargs["dwis"] + self.kwargs["bvals"] + \
+                self.kwargs["bvecs"]:
+            with open(path, "wt") as open_file:
+                open_file.write("0")
+
+    def tearDown(self):
+        """ Run after each test.
+        """
+        shutil.rmtree(self.tmpdir)
+
+    @mock.patch("pyconnectomist.preproc.qspace.ptk_nifti_to_gis")
+    def test_fieldmap_split(self, mock_conversion):
+        """ Test the fieldmap splitting: each channel is converted as the
+        DWIs with the original affine and data type.
+        """
+        # Set the mocked functions returned values
+        channels = []
+
+        def conversion(nifti, gis):
+            if nifti.endswith(".nii"):
+                image = nibabel.load(nifti)
+                channels.append((numpy.asanyarray(image.dataobj),
+                                 image.affine, image.get_data_dtype()))
+            return gis
+        mock_conversion.side_effect = conversion
+
+        # Test execution
+        _, _, _, b0_magnitude, b0_phase = gather_and_format_input_files(
+            **self.kwargs)
+        self.assertEqual(b0_magnitude,
+                         os.path.join(self.outdir, "b0_magnitude.ima"))
+        self.assertEqual(b0_phase, os.path.join(self.outdir, "b0_phase.ima"))
+        self.assertEqual([
+            mock.call(os.path.join(self.outdir, "b0_magnitude.nii"),
+                      b0_magnitude),
+            mock.call(os.path.join(self.outdir, "b0_phase.nii"), b0_phase),
+            mock.call(self.kwargs["dwis"][0],
+                      os.path.join(self.outdir, "dwi.ima"))],
+            mock_conversion.call_args_list)
+        for index, (data, affine, dtype) in enumerate(channels):
+            self.assertTrue(numpy.all(data == self.b0_maps[..., index]))
+            self.assertTrue(numpy.allclose(affine, self.affine))
+            self.assertEqual(dtype, numpy.int16)
+        self.assertEqual(sorted(os.listdir(self.outdir)),
+                         ["dwi.bval", "dwi.bvec"])
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -29,6 +29,8 @@ else:
 
 # pyConnectomist import
 from pyconnectomist.preproc.susceptibility import susceptibility_correction
+from pyconnectomist.preproc.susceptibility import (
+    check_brainsuite_installation)
 from pyconnectomist.exceptions import ConnectomistBadManufacturerNameError
 from pyconnectomist.exceptions import ConnectomistBadFileError
 from pyconnectomist.exceptions import ConnectomistMissingParametersError
@@ -73,7 +75,7 @@ class ConnectomistMask(unittest.TestCase):
         """
         self.popen_patcher.stop()
 
-    @mock.patch("pyconnectomist.preproc.susceptibility.exec_file")
+    @mock.patch("pyconnectomist.preproc.susceptibility.parse_dict_file")
     @mock.patch("os.path")
     def test_manufacturermiss_raise(self, mock_path, mock_exec):
         """ No manufacturer -> raise ConnectomistBadFileError.
@@ -88,7 +90,7 @@ class ConnectomistMask(unittest.TestCase):
         self.assertRaises(ConnectomistBadFileError,
                           susceptibility_correction, **self.kwargs)
 
-    @mock.patch("pyconnectomist.preproc.susceptibility.exec_file")
+    @mock.patch("pyconnectomist.preproc.susceptibility.parse_dict_file")
     @mock.patch("os.path")
     def test_manufacturer_raise(self, mock_path, mock_exec):
         """ No manufacturer -> raise ConnectomistBadManufacturerNameError.
@@ -105,7 +107,7 @@ class ConnectomistMask(unittest.TestCase):
         self.assertRaises(ConnectomistBadManufacturerNameError,
                           susceptibility_correction, **self.kwargs)
 
-    @mock.patch("pyconnectomist.preproc.susceptibility.exec_file")
+    @mock.patch("pyconnectomist.preproc.susceptibility.parse_dict_file")
     @mock.patch("os.path")
     def test_params_raise(self, mock_path, mock_exec):
         """ Wrong parameters -> raise ConnectomistMissingParametersError.
@@ -126,7 +128,7 @@ class ConnectomistMask(unittest.TestCase):
                 "_connectomist_version_check")
     @mock.patch("pyconnectomist.preproc.susceptibility.ConnectomistWrapper."
                 "create_parameter_file")
-    @mock.patch("pyconnectomist.preproc.susceptibility.exec_file")
+    @mock.patch("pyconnectomist.preproc.susceptibility.parse_dict_file")
     @mock.patch("os.path")
     def test_normal_execution(self, mock_path, mock_exec, mock_params,
                               mock_version):
@@ -157,5 +159,26 @@ class ConnectomistMask(unittest.TestCase):
             mock_exec.call_args_list)
 
 
+class ConnectomistBrainSuiteCheck(unittest.TestCase):
+    """ Test the BrainSuite installation check:
+    'pyconnectomist.preproc.susceptibility.check_brainsuite_installation'
+    """
+    @mock.patch.dict("os.environ", {"PATH": "/my/path/mock_brainsuite"})
+    @mock.patch("pyconnectomist.preproc.susceptibility.subprocess."
+                "check_call")
+    def test_normal_execution(self, mock_call):
+        """ Test the commands are probed once per search path.
+        """
+        # Set the mocked functions returned values
+        mock_call.side_effect = [OSError("mock_missing"), 0, 0]
+
+        # Test execution
+        self.assertRaises(Exception, check_brainsuite_installation)
+        check_brainsuite_installation()
+        check_brainsuite_installation()
+        self.assertEqual([args[0][0] for args in mock_call.call_args_list],
+                         [["bfc"], ["bfc"], ["bdp.sh"]])
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -17,6 +17,7 @@ fake return string.
 import unittest
 import sys
 import os
+import copy
 # COMPATIBILITY: since python 3.3 mock is included in unittest module
 python_version = sys.version_info
 if python_version[:2] <= (3, 3):
@@ -72,6 +73,38 @@ class ConnectomistTractography(unittest.TestCase):
             "path_connectomist": "/my/path/mock_connectomist"
         }
 
+    @mock.patch("pyconnectomist.tractography.all_steps.tractography_mask")
+    @mock.patch("pyconnectomist.tractography.all_steps.dwi_local_modeling")
+    @mock.patch("os.mkdir")
+    def test_badshardedtracking_raise(self, mock_mkdir, mock_model,
+                                      mock_mask):
+        """ A sharded tractography in a format that can't be merged -> raise
+        ConnectomistError before any processing.
+        """
+        # Test execution
+        wrong_kwargs = copy.copy(self.kwargs)
+        wrong_kwargs["nb_tractography_shards"] = 2
+        self.assertRaises(ConnectomistError, complete_tractography,
+                          **wrong_kwargs)
+        wrong_kwargs["tracking_type"] = "streamline_probabilistic"
+        self.assertRaises(ConnectomistError, complete_tractography,
+                          **wrong_kwargs)
+        self.assertEqual(len(mock_mkdir.call_args_list), 0)
+        self.assertEqual(len(mock_model.call_args_list), 0)
+        self.assertEqual(len(mock_mask.call_args_list), 0)
+
+    @mock.patch("os.mkdir")
+    def test_nolabelingrecords_raise(self, mock_mkdir):
+        """ A labeling memory budget without recorded runs -> raise
+        ConnectomistError before any processing.
+        """
+        # Test execution
+        wrong_kwargs = copy.copy(self.kwargs)
+        wrong_kwargs["labeling_memory_budget"] = 1024
+        self.assertRaises(ConnectomistError, complete_tractography,
+                          **wrong_kwargs)
+        self.assertEqual(len(mock_mkdir.call_args_list), 0)
+
     @mock.patch("os.path")
     def test_badregistrationdir_raise(self, mock_path):
         """ A wrong registration dir -> raise ConnectomistError.
@@ -0,0 +1,131 @@
+##########################################################################
+# NSAp - Copyright (C) CEA, 2016
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+"""
+Test the connectome builder on a small bundle map and parcellation written in
+a temporary directory.
+"""
+
+# System import
+import unittest
+import os
+import shutil
+import tempfile
+import numpy
+import nibabel
+
+# pyConnectomist import
+from pyconnectomist.exceptions import ConnectomistBadFileError
+from pyconnectomist.exceptions import ConnectomistError
+from pyconnectomist.tractography.connectome import connectome
+from pyconnectomist.utils.bundletools import save_bundles
+from pyconnectomist.utils.filetools import save_gis
+
+
+class ConnectomistConnectome(unittest.TestCase):
+    """ Test the structural connectivity matrices builder:
+    'pyconnectomist.tractography.connectome.connectome'
+    """
+    def setUp(self):
+        """ Create a parcellation with 3 regions along the x axis and 4
+        fibers.
+        """
+        self.tmpdir = tempfile.mkdtemp()
+        labels = numpy.zeros((9, 3, 3), dtype=numpy.int16)
+        labels[:3] = 10
+        labels[3: 6] = 20
+        labels[6: 8] = 30
+        self.label_file = save_gis(os.path.join(self.tmpdir, "labels"),
+                                   labels, (2., 2., 2.))
+        scalars = numpy.ones((9, 3, 3), dtype=numpy.float32)
+        scalars[4:] = 3
+        self.scalar_file = os.path.join(self.tmpdir, "scalars.nii.gz")
+        nibabel.Nifti1Image(
+            scalars, numpy.diag([-2., -2., -2., 1.])).to_filename(
+                self.scalar_file)
+        self.scalars = scalars
+        points = numpy.array([
+            [0, 2, 2], [6, 2, 2], [12, 2, 2],   # 10 -> 30 (through 20)
+            [14, 2, 2], [2, 2, 2],              # 30 -> 10
+            [8, 2, 2], [10, 2, 2],              # 20 -> 20
+            [4, 2, 2], [16, 2, 2]],             # 10 -> background
+            dtype=numpy.float32)
+        self.bundlefile = save_bundles(
+            os.path.join(self.tmpdir, "fibers"), points,
+            numpy.array([0, 3, 5, 7, 9]))
+
+    def tearDown(self):
+        """ Run after each test.
+        """
+        shutil.rmtree(self.tmpdir)
+
+    def test_badfileerror_raise(self):
+        """ A wrong input -> raise ConnectomistBadFileError.
+        """
+        # Test execution
+        self.assertRaises(ConnectomistBadFileError, connectome,
+                          [self.bundlefile], "WRONG.nii.gz", self.tmpdir)
+
+    def test_normal_execution(self):
+        """ Test the normal behaviour of the function.
+        """
+        # Test execution: use one fiber chunks
+        labels_file, matrix_files = connectome(
+            [self.bundlefile], self.label_file, self.tmpdir,
+            scalar_file=self.scalar_file, chunk_size=1)
+        self.assertEqual(numpy.loadtxt(labels_file).tolist(), [10, 20, 30])
+        self.assertEqual(sorted(matrix_files.keys()),
+                         ["count", "mean_length", "mean_scalar"])
+        count = numpy.loadtxt(matrix_files["count"])
+        self.assertEqual(count.tolist(), [[0, 0, 2], [0, 1, 0], [2, 0, 0]])
+        length = numpy.loadtxt(matrix_files["mean_length"])
+        self.assertAlmostEqual(length[0, 2], 12)
+        self.assertAlmostEqual(length[2, 0], 12)
+        self.assertAlmostEqual(length[1, 1], 2)
+        scalar = numpy.loadtxt(matrix_files["mean_scalar"])
+        self.assertAlmostEqual(scalar[0, 2], (5. / 3 + 2) / 2)
+        self.assertAlmostEqual(scalar[1, 1], 3)
+
+    def test_obliqueerror_raise(self):
+        """ An oblique Nifti image -> raise ConnectomistError.
+        """
+        # Test execution
+        angle = numpy.pi / 6
+        affine = numpy.eye(4)
+        affine[:2, :2] = [[numpy.cos(angle), -numpy.sin(angle)],
+                          [numpy.sin(angle), numpy.cos(angle)]]
+        nibabel.Nifti1Image(self.scalars, affine).to_filename(
+            self.scalar_file)
+        self.assertRaises(ConnectomistError, connectome,
+                          [self.bundlefile], self.label_file, self.tmpdir,
+                          scalar_file=self.scalar_file)
+
+    def test_orientation(self):
+        """ Test that the Nifti images are mapped using their affine.
+        """
+        # Store the scalars in the RAS orientation with swapped x and y axes
+        ras_scalars = numpy.ascontiguousarray(
+            self.scalars[::-1, ::-1, ::-1].transpose(1, 0, 2))
+        affine = numpy.array([[0., 2., 0., -16.],
+                              [2., 0., 0., -4.],
+                              [0., 0., 2., -4.],
+                              [0., 0., 0., 1.]])
+        nibabel.Nifti1Image(ras_scalars, affine).to_filename(
+            self.scalar_file)
+
+        # Test execution
+        _, matrix_files = connectome(
+            [self.bundlefile], self.label_file, self.tmpdir,
+            scalar_file=self.scalar_file)
+        scalar = numpy.loadtxt(matrix_files["mean_scalar"])
+        self.assertAlmostEqual(scalar[0, 2], (5. / 3 + 2) / 2)
+        self.assertAlmostEqual(scalar[1, 1], 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,152 @@
+##########################################################################
+# NSAp - Copyright (C) CEA, 2016
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+"""
+Test the in-process tensor estimation on synthetic data written in a
+temporary directory.
+"""
+
+# System import
+import unittest
+import sys
+import os
+import shutil
+import tempfile
+import numpy
+import nibabel
+# COMPATIBILITY: since python 3.3 mock is included in unittest module
+python_version = sys.version_info
+if python_version[:2] <= (3, 3):
+    import mock
+else:
+    import unittest.mock as mock
+
+# pyConnectomist import
+from pyconnectomist.exceptions import ConnectomistBadFileError
+from pyconnectomist.exceptions import ConnectomistError
+from pyconnectomist.tractography.dti import dti_fit
+from pyconnectomist.utils.filetools import save_gis
+from pyconnectomist.utils.filetools import load_gis
+
+
+class ConnectomistDTIFit(unittest.TestCase):
+    """ Test the in-process tensor estimation:
+    'pyconnectomist.tractography.dti.dti_fit'
+    """
+    def setUp(self):
+        """ Simulate the signal of a tensor oriented along y.
+        """
+        self.tmpdir = tempfile.mkdtemp()
+        self.eddy_motion_dir = os.path.join(self.tmpdir, "eddy")
+        self.rough_mask_dir = os.path.join(self.tmpdir, "mask")
+        os.mkdir(self.eddy_motion_dir)
+        os.mkdir(self.rough_mask_dir)
+        bvecs = numpy.array([
+            [1, 0, 0], [0, 1, 0], [0, 0, 1], [1, 1, 0], [1, 0, 1],
+            [0, 1, 1], [1, -1, 0], [0, 1, -1]], dtype=float)
+        bvecs /= numpy.linalg.norm(bvecs, axis=1)[:, numpy.newaxis]
+        bvals = numpy.array([1000.] * 8)
+        tensor = numpy.diag([0.0003, 0.0017, 0.0003])
+        signals = 1000. * numpy.exp(
+            -bvals * numpy.einsum("ni,ij,nj->n", bvecs, tensor, bvecs))
+        shape = (3, 2, 2)
+        save_gis(os.path.join(self.eddy_motion_dir,
+                              "t2_wo_eddy_current_and_motion.ima"),
+                 numpy.ones(shape, dtype=numpy.float32) * 1000.,
+                 (2., 2., 2.))
+        dwifile = save_gis(
+            os.path.join(self.eddy_motion_dir,
+                         "dw_wo_eddy_current_and_motion.ima"),
+            numpy.ones(shape + (8, ), dtype=numpy.float32) * signals,
+            (2., 2., 2., 1.))
+        with open(dwifile + ".minf", "wt") as open_file:
+            open_file.write("attributes = {{'bvalues': {0}, "
+                            "'diffusion_gradient_orientations': {1}}}".format(
+                                bvals.tolist(), (bvecs * 2).tolist()))
+        mask = numpy.ones(shape, dtype=numpy.int16)
+        mask[0, 0, 0] = 0
+        save_gis(os.path.join(self.rough_mask_dir, "mask.ima"), mask)
+        self.kwargs = {
+            "outdir": os.path.join(self.tmpdir, "dtifit"),
+            "eddy_motion_dir": self.eddy_motion_dir,
+            "rough_mask_dir": self.rough_mask_dir
+        }
+
+    def tearDown(self):
+        """ Run after each test.
+        """
+        shutil.rmtree(self.tmpdir)
+
+    def test_badfileerror_raise(self):
+        """ A wrong input -> raise ConnectomistBadFileError.
+        """
+        # Test execution
+        os.remove(os.path.join(self.rough_mask_dir, "mask.ima"))
+        self.assertRaises(ConnectomistBadFileError, dti_fit, **self.kwargs)
+
+    def test_badestimator_raise(self):
+        """ A wrong estimator -> raise ConnectomistError.
+        """
+        # Test execution
+        self.assertRaises(ConnectomistError, dti_fit,
+                          dti_estimator="WRONG", **self.kwargs)
+
+    @mock.patch("pyconnectomist.tractography.dti.ptk_gis_to_nifti")
+    def test_normal_execution(self, mock_conversion):
+        """ Test the normal behaviour of the function.
+        """
+        # Set the mocked functions returned values: the GIS voxels are
+        # copied in the Nifti image
+        def convert(gis, nifti):
+            data, voxel_sizes = load_gis(gis)
+            nibabel.Nifti1Image(
+                numpy.array(data),
+                numpy.diag(list(voxel_sizes[:3]) + [1.])).to_filename(nifti)
+            return nifti
+        mock_conversion.side_effect = convert
+
+        # Test execution
+        expected_fa = 0.0014 / numpy.sqrt(
+            0.0003 ** 2 * 2 + 0.0017 ** 2)
+        for estimator in ("linear", "positive"):
+            scalars = dti_fit(dti_estimator=estimator, chunk_size=5,
+                              nb_processes=2, **self.kwargs)
+            self.assertEqual(sorted(scalars), [
+                "fa", "lambda_parallel", "lambda_transverse",
+                "mean_diffusivity", "v1"])
+            fa = nibabel.load(scalars["fa"]).get_fdata()
+            self.assertEqual(fa.shape, (3, 2, 2))
+            self.assertEqual(fa[0, 0, 0], 0)
+            self.assertTrue(numpy.allclose(fa.ravel()[1:], expected_fa,
+                                           atol=1e-5))
+            for name, value in (("mean_diffusivity", 0.00076667),
+                                ("lambda_parallel", 0.0017),
+                                ("lambda_transverse", 0.0003)):
+                data = nibabel.load(scalars[name]).get_fdata()
+                self.assertTrue(numpy.allclose(data[2, 1, 1], value,
+                                               atol=1e-7))
+            v1 = nibabel.load(scalars["v1"]).get_fdata()
+            self.assertEqual(v1.shape, (3, 2, 2, 3))
+            self.assertTrue(numpy.allclose(numpy.abs(v1[1, 0, 0]),
+                                           [0, 1, 0], atol=1e-5))
+            self.assertEqual(nibabel.load(scalars["fa"]).header.get_zooms(),
+                             (2., 2., 2.))
+            self.assertEqual(mock_conversion.call_args_list[-5:], [
+                mock.call(os.path.join(self.kwargs["outdir"],
+                                       "dti_{0}.ima".format(name)),
+                          scalars[name])
+                for name in ("fa", "mean_diffusivity", "lambda_parallel",
+                             "lambda_transverse", "v1")])
+            self.assertEqual(sorted(os.listdir(self.kwargs["outdir"])), [
+                "dti_fa.nii.gz", "dti_lambda_parallel.nii.gz",
+                "dti_lambda_transverse.nii.gz",
+                "dti_mean_diffusivity.nii.gz", "dti_v1.nii.gz"])
+
+
+if __name__ == "__main__":
+    unittest.main()
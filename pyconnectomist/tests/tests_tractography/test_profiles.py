@@ -0,0 +1,99 @@
+##########################################################################
+# NSAp - Copyright (C) CEA, 2016
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+"""
+Test the tract profiles on a small labeling directory written in a temporary
+directory.
+"""
+
+# System import
+import unittest
+import os
+import shutil
+import tempfile
+import numpy
+import nibabel
+
+# pyConnectomist import
+from pyconnectomist.exceptions import ConnectomistError
+from pyconnectomist.tractography.profiles import tract_profiles
+from pyconnectomist.tractography.profiles import trilinear_interpolation
+from pyconnectomist.utils.bundletools import save_bundles
+
+
+class ConnectomistTractProfiles(unittest.TestCase):
+    """ Test the along-tract scalar profiles:
+    'pyconnectomist.tractography.profiles.tract_profiles'
+    """
+    def setUp(self):
+        """ Create a scalar map increasing along x and a bundle with two
+        opposite fibers.
+        """
+        self.tmpdir = tempfile.mkdtemp()
+        scalars = numpy.zeros((11, 3, 3), dtype=numpy.float32)
+        scalars += numpy.arange(11)[:, numpy.newaxis, numpy.newaxis]
+        self.scalar_file = os.path.join(self.tmpdir, "fa.nii.gz")
+        nibabel.Nifti1Image(
+            scalars, numpy.diag([-2., -2., -2., 1.])).to_filename(
+                self.scalar_file)
+        region_dir = os.path.join(self.tmpdir, "bundleMapsReferential",
+                                  "Fornix")
+        os.makedirs(region_dir)
+        points = numpy.array([
+            [0, 2, 2], [20, 2, 2],
+            [20, 2, 2], [10, 2, 2], [0, 2, 2]], dtype=numpy.float32)
+        save_bundles(os.path.join(region_dir, "Fornix_Left"), points,
+                     numpy.array([0, 2, 5]))
+
+    def tearDown(self):
+        """ Run after each test.
+        """
+        shutil.rmtree(self.tmpdir)
+
+    def test_nobundle_raise(self):
+        """ No labeled bundle -> raise ConnectomistError.
+        """
+        # Test execution
+        self.assertRaises(ConnectomistError, tract_profiles,
+                          os.path.join(self.tmpdir, "WRONG"),
+                          {"fa": self.scalar_file})
+
+    def test_interpolation(self):
+        """ Test the trilinear interpolation.
+        """
+        # Test execution
+        volume = numpy.arange(8, dtype=float).reshape(2, 2, 2)
+        values = trilinear_interpolation(volume, (2., 2., 2.), numpy.array([
+            [1, 1, 1], [0, 0, 2], [10, 0, 0]]))
+        self.assertAlmostEqual(values[0], 3.5)
+        self.assertAlmostEqual(values[1], 1)
+        self.assertTrue(numpy.isnan(values[2]))
+
+    def test_normal_execution(self):
+        """ Test the normal behaviour of the function.
+        """
+        # Test execution
+        outfile = tract_profiles(self.tmpdir, {"fa": self.scalar_file},
+                                 nb_points=5, nb_threads=2)
+        self.assertEqual(outfile,
+                         os.path.join(self.tmpdir, "tract_profiles.tsv"))
+        with open(outfile, "rt") as open_file:
+            rows = [line.rstrip("\n").split("\t") for line in open_file]
+        self.assertEqual(rows[0],
+                         ["region", "bundle", "scalar", "point", "mean",
+                          "std"])
+        self.assertEqual(len(rows), 6)
+        self.assertEqual(rows[1][:4], ["Fornix", "Fornix_Left", "fa", "0"])
+        means = [float(row[4]) for row in rows[1:]]
+        stds = [float(row[5]) for row in rows[1:]]
+        self.assertTrue(numpy.allclose(means, [0, 2.5, 5, 7.5, 10]))
+        self.assertTrue(numpy.allclose(stds, 0))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,118 @@
+##########################################################################
+# NSAp - Copyright (C) CEA, 2016
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+"""
+Test the streamline index on a small bundle map written in a temporary
+directory.
+"""
+
+# System import
+import unittest
+import os
+import shutil
+import tempfile
+import numpy
+
+# pyConnectomist import
+from pyconnectomist.exceptions import ConnectomistBadFileError
+from pyconnectomist.tractography.streamline_index import StreamlineIndex
+from pyconnectomist.utils.bundletools import save_bundles
+from pyconnectomist.utils.filetools import save_gis
+
+
+class ConnectomistStreamlineIndex(unittest.TestCase):
+    """ Test the voxel to streamline inverted index:
+    'pyconnectomist.tractography.streamline_index.StreamlineIndex'
+    """
+    def setUp(self):
+        """ Create a mask and a bundle map with three fibers.
+        """
+        self.tmpdir = tempfile.mkdtemp()
+        self.mask_file = save_gis(
+            os.path.join(self.tmpdir, "tractography_mask.ima"),
+            numpy.ones((5, 4, 3), dtype=numpy.int16), (2., 2., 2.))
+        points = numpy.array([
+            [0, 0, 0], [2, 0, 0], [4, 0, 0],
+            [0, 0, 0], [0, 2, 0], [0, 4, 0], [0, 6, 0],
+            [8, 6, 4], [8, 4, 4]], dtype=numpy.float32)
+        self.bundlefile = save_bundles(
+            os.path.join(self.tmpdir, "fibers"), points,
+            numpy.array([0, 3, 7, 9]))
+
+    def tearDown(self):
+        """ Run after each test.
+        """
+        shutil.rmtree(self.tmpdir)
+
+    def roi(self, *voxels):
+        """ Create a ROI on the mask grid.
+        """
+        roi = numpy.zeros((5, 4, 3), dtype=bool)
+        for voxel in voxels:
+            roi[voxel] = True
+        return roi
+
+    def test_badfileerror_raise(self):
+        """ A wrong input -> raise ConnectomistBadFileError.
+        """
+        # Test execution
+        self.assertRaises(ConnectomistBadFileError,
+                          StreamlineIndex.from_bundles, self.bundlefile,
+                          os.path.join(self.tmpdir, "WRONG.ima"))
+
+    def test_normal_execution(self):
+        """ Test the normal behaviour of the function.
+        """
+        # Test execution
+        index = StreamlineIndex.from_bundles(self.bundlefile, self.mask_file,
+                                             chunk_size=2)
+        self.assertEqual(index.shape, (5, 4, 3))
+        self.assertEqual(index.nb_streamlines, 3)
+        self.assertEqual(len(index.indices), 9)
+        self.assertEqual(index.streamlines(self.roi((0, 0, 0))).tolist(),
+                         [0, 1])
+        self.assertEqual(index.streamlines(
+            self.roi((2, 0, 0), (4, 2, 2), (4, 3, 2))).tolist(), [0, 2])
+        self.assertEqual(index.query(
+            include=[self.roi((0, 0, 0))],
+            exclude=[self.roi((0, 3, 0))]).tolist(), [0])
+        self.assertEqual(index.query(exclude=[self.roi((1, 0, 0))]).tolist(),
+                         [1, 2])
+
+        # Check the index is saved next to the bundle map and reused
+        indexfile = os.path.join(self.tmpdir, "fibers_index.npz")
+        self.assertTrue(os.path.isfile(indexfile))
+        cached = StreamlineIndex.from_bundles(self.bundlefile, self.mask_file)
+        self.assertTrue(numpy.array_equal(cached.indptr, index.indptr))
+        self.assertTrue(numpy.array_equal(cached.indices, index.indices))
+
+    def test_segment_traversal(self):
+        """ Test that the voxels crossed between two fiber points are
+        indexed.
+        """
+        # Create two fibers with long segments
+        points = numpy.array([
+            [0, 0, 0], [8, 0, 0],
+            [0, 6, 4], [8, 0, 4]], dtype=numpy.float32)
+        bundlefile = save_bundles(
+            os.path.join(self.tmpdir, "long_fibers"), points,
+            numpy.array([0, 2, 4]))
+
+        # Test execution
+        index = StreamlineIndex.from_bundles(bundlefile, self.mask_file,
+                                             cache=False)
+        for x in range(5):
+            self.assertEqual(
+                index.streamlines(self.roi((x, 0, 0))).tolist(), [0])
+        for voxel in ((0, 3, 2), (1, 2, 2), (2, 2, 2), (3, 1, 2),
+                      (4, 0, 2)):
+            self.assertEqual(index.streamlines(self.roi(voxel)).tolist(), [1])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -18,6 +18,9 @@ import unittest
 import sys
 import os
 import copy
+import shutil
+import tempfile
+import numpy
 # COMPATIBILITY: since python 3.3 mock is included in unittest module
 python_version = sys.version_info
 if python_version[:2] <= (3, 3):
@@ -29,6 +32,13 @@ else:
 
 # pyConnectomist import
 from pyconnectomist.tractography.tractography import tractography
+from pyconnectomist.tractography.tractography import sharded_tractography
+from pyconnectomist.tractography.tractography import mask_slabs
+from pyconnectomist.utils.bundletools import save_bundles
+from pyconnectomist.utils.bundletools import load_bundles
+from pyconnectomist.utils.bundletools import bundle_names
+from pyconnectomist.utils.filetools import load_gis
+from pyconnectomist.utils.filetools import save_gis
 from pyconnectomist.exceptions import ConnectomistBadFileError
 from pyconnectomist.exceptions import ConnectomistError
 
@@ -159,5 +169,98 @@ class ConnectomistTractography(unittest.TestCase):
             mock_path.isfile.call_args_list)
 
 
+class ConnectomistShardedTractography(unittest.TestCase):
+    """ Test the Connectomist sharded tractography:
+    'pyconnectomist.tractography.tractography.sharded_tractography'
+    """
+    def setUp(self):
+        """ Define the function parameters and a tractography mask.
+        """
+        self.tmpdir = tempfile.mkdtemp()
+        self.mask_dir = os.path.join(self.tmpdir, "mask")
+        os.mkdir(self.mask_dir)
+        self.mask = numpy.zeros((4, 4, 10), dtype=numpy.int16)
+        self.mask[1:3, 1:3, 2:8] = 1
+        save_gis(os.path.join(self.mask_dir, "tractography_mask.ima"),
+                 self.mask, (2., 2., 2.))
+        self.kwargs = {
+            "outdir": os.path.join(self.tmpdir, "tractography"),
+            "subject_id": "Lola",
+            "mask_dir": self.mask_dir,
+            "model": "aqbi",
+            "model_dir": "/my/path/mock_modeldir",
+            "registration_dir": "/my/path/mock_registrationdir",
+            "nb_shards": 3,
+            "tracking_type": "streamline_probabilistic",
+            "bundlemap": "aimsbundlemap",
+            "voxel_sampler_point_count": 8,
+            "path_connectomist": "/my/path/mock_connectomist"
+        }
+
+    def tearDown(self):
+        """ Run after each test.
+        """
+        shutil.rmtree(self.tmpdir)
+
+    def test_bundlemaperror_raise(self):
+        """ A bundle format that can't be merged -> raise ConnectomistError.
+        """
+        # Test execution
+        wrong_kwargs = copy.copy(self.kwargs)
+        wrong_kwargs["bundlemap"] = "vtkbundlemap"
+        self.assertRaises(ConnectomistError, sharded_tractography,
+                          **wrong_kwargs)
+
+    def test_slabs(self):
+        """ Test the mask slabs are balanced and cover all the slices.
+        """
+        self.assertEqual(mask_slabs(self.mask, 3), [(0, 4), (4, 6), (6, 10)])
+        self.assertEqual(mask_slabs(self.mask, 1), [(0, 10)])
+        self.assertEqual(len(mask_slabs(self.mask, 20)), 6)
+        mask = numpy.zeros((4, 4, 10, 1), dtype=numpy.int16)
+        mask[:, :, 2] = 1
+        mask[0, 0, 9] = 1
+        self.assertEqual(mask_slabs(mask, 2), [(0, 9), (9, 10)])
+
+    @mock.patch("pyconnectomist.tractography.tractography.tractography")
+    def test_normal_execution(self, mock_tractography):
+        """ Test the normal behaviour of the function.
+        """
+        # Set the mocked functions returned values: each shard generates
+        # one fiber per mask voxel
+        def track(outdir, subject_id, mask_dir, *args, **kwargs):
+            mask, _ = load_gis(os.path.join(mask_dir, "tractography_mask.ima"))
+            points = numpy.argwhere(mask).astype(numpy.float32)
+            save_bundles(os.path.join(outdir, "aims_bundle_map"),
+                         numpy.repeat(points, 2, axis=0),
+                         numpy.arange(0, 2 * len(points) + 1, 2))
+            return outdir
+        mock_tractography.side_effect = track
+
+        # Test execution
+        outdir = sharded_tractography(**self.kwargs)
+        self.assertEqual(outdir, self.kwargs["outdir"])
+        self.assertEqual(
+            [call[0][0] for call in mock_tractography.call_args_list],
+            [os.path.join(outdir, "shard_{0}".format(index))
+             for index in range(3)])
+        self.assertEqual(
+            [call[1]["voxel_sampler_point_count"]
+             for call in mock_tractography.call_args_list], [8, 8, 8])
+        masks = [load_gis(os.path.join(call[0][2], "tractography_mask.ima"))
+                 for call in mock_tractography.call_args_list]
+        self.assertEqual(masks[0][1][:3], (2., 2., 2.))
+        self.assertEqual([mask.sum() for mask, _ in masks], [8, 8, 8])
+        numpy.testing.assert_array_equal(
+            sum(mask for mask, _ in masks), self.mask)
+        points, offsets, header = load_bundles(
+            os.path.join(outdir, "aims_bundle_map.bundles"))
+        self.assertEqual(header["curves_count"], 24)
+        self.assertEqual(bundle_names(header), [("255", 0, 24)])
+        slices = points[offsets[:-1], 2].reshape(3, 8)
+        self.assertEqual(slices.min(axis=1).tolist(), [2, 4, 6])
+        self.assertEqual(slices.max(axis=1).tolist(), [3, 5, 7])
+
+
 if __name__ == "__main__":
     unittest.main()
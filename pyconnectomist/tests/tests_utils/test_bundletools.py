@@ -0,0 +1,308 @@
+##########################################################################
+# NSAp - Copyright (C) CEA, 2016
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+"""
+Test the in-process bundle map conversions on small fixtures written in a
+temporary directory.
+"""
+
+# System import
+import unittest
+import os
+import shutil
+import struct
+import tempfile
+import numpy
+import nibabel
+
+# pyConnectomist import
+from pyconnectomist.exceptions import ConnectomistBadFileError
+from pyconnectomist.utils.bundletools import save_bundles
+from pyconnectomist.utils.bundletools import load_bundles
+from pyconnectomist.utils.bundletools import fiber_records
+from pyconnectomist.utils.bundletools import trk_buffer
+from pyconnectomist.utils.bundletools import bundle_names
+from pyconnectomist.utils.bundletools import merge_bundle_maps
+from pyconnectomist.utils.bundletools import resample_fibers
+from pyconnectomist.utils.bundletools import bundle_to_trk
+from pyconnectomist.utils.bundletools import load_trk
+from pyconnectomist.utils.bundletools import bundles_to_trx
+from pyconnectomist.utils.bundletools import load_trx
+from pyconnectomist.utils.bundletools import compress_fibers
+from pyconnectomist.utils.bundletools import compress_bundles
+from pyconnectomist.utils.bundletools import merge_bundles_to_trk
+from pyconnectomist.utils.bundletools import TRK_HEADER_DTYPE
+
+
+class ConnectomistBundles(unittest.TestCase):
+    """ Test the Connectomist bundle map IO:
+    'pyconnectomist.utils.bundletools.load_bundles'
+    """
+    def setUp(self):
+        """ Create a bundle map fixture.
+        """
+        self.tmpdir = tempfile.mkdtemp()
+        self.fibers = [
+            numpy.array([[0, 0, 0], [1, 0, 0], [2, 0, 0]],
+                        dtype=numpy.float32),
+            numpy.array([[0, 1, 0], [0, 2, 0]], dtype=numpy.float32),
+            numpy.array([[3, 3, 3], [4, 4, 4], [5, 5, 5], [6, 6, 6]],
+                        dtype=numpy.float32)]
+        self.points = numpy.concatenate(self.fibers)
+        self.offsets = numpy.cumsum([0] + [len(f) for f in self.fibers])
+        self.bundlefile = save_bundles(
+            os.path.join(self.tmpdir, "fibers"), self.points, self.offsets,
+            names=[("bundle1", 0), ("bundle2", 2)],
+            header={"resolutionX": 2., "resolutionY": 2., "resolutionZ": 2.5,
+                    "sizeX": 64, "sizeY": 64, "sizeZ": 40})
+
+    def tearDown(self):
+        """ Run after each test.
+        """
+        shutil.rmtree(self.tmpdir)
+
+    def reference_trk_data(self):
+        """ Pack the fibers record by record.
+        """
+        data = b""
+        for fiber in self.fibers:
+            data += struct.pack("<i", len(fiber))
+            data += struct.pack("<{0}f".format(fiber.size), *fiber.ravel())
+        return data
+
+    def test_badfileerror_raise(self):
+        """ A wrong input -> raise ConnectomistBadFileError.
+        """
+        self.assertRaises(ConnectomistBadFileError, bundle_to_trk,
+                          os.path.join(self.tmpdir, "WRONG.bundles"), "trk")
+        self.assertRaises(ConnectomistBadFileError, load_bundles,
+                          os.path.join(self.tmpdir, "WRONG.bundles"))
+
+    def test_load_bundles(self):
+        """ Test the bundle map loader.
+        """
+        points, offsets, header = load_bundles(self.bundlefile)
+        self.assertTrue(numpy.allclose(points, self.points))
+        self.assertEqual(offsets.tolist(), self.offsets.tolist())
+        self.assertEqual(header["curves_count"], 3)
+        self.assertEqual(bundle_names(header),
+                         [("bundle1", 0, 2), ("bundle2", 2, 3)])
+        datafile = self.bundlefile.replace(".bundles", ".bundlesdata")
+        with open(datafile, "rb") as open_file:
+            self.assertEqual(open_file.read(), self.reference_trk_data())
+
+    def test_fiber_records(self):
+        """ Test the record positions with per-fiber values.
+        """
+        raw = numpy.concatenate([
+            numpy.concatenate(([len(fiber)], fiber.ravel(), [7]))
+            for fiber in self.fibers]).astype(numpy.int32)
+        starts, counts = fiber_records(raw, 3, nb_properties=1)
+        self.assertEqual(starts.tolist(), [0, 11, 19])
+        self.assertEqual(counts.tolist(), [3, 2, 4])
+        self.assertRaises(ValueError, fiber_records, raw[:-1], 3, 1)
+        self.assertRaises(ValueError, fiber_records, raw, 2, 1)
+
+    def test_vectorized_fiber_records(self):
+        """ Test the records located in a single pass match the records read
+        one after the other, with denormal coordinates and empty fibers.
+        """
+        raw = trk_buffer(self.points, self.offsets,
+                         numpy.ones((3, 1), dtype=numpy.float32)).view("<i4")
+        starts, counts = fiber_records(raw, 3, nb_properties=1)
+        self.assertEqual(starts.tolist(), [0, 11, 19])
+        self.assertEqual(counts.tolist(), [3, 2, 4])
+        points = self.points.copy()
+        points[0, 1] = 1e-40
+        raw = trk_buffer(points, self.offsets).view("<i4")
+        starts, counts = fiber_records(raw, 3)
+        self.assertEqual(starts.tolist(), [0, 10, 17])
+        self.assertEqual(counts.tolist(), [3, 2, 4])
+        raw = trk_buffer(self.points, [0, 3, 3, 5, 9]).view("<i4")
+        starts, counts = fiber_records(raw, 4)
+        self.assertEqual(starts.tolist(), [0, 10, 11, 18])
+        self.assertEqual(counts.tolist(), [3, 0, 2, 4])
+
+    def test_truncated_raise(self):
+        """ A truncated binary file -> raise ConnectomistBadFileError.
+        """
+        datafile = self.bundlefile.replace(".bundles", ".bundlesdata")
+        with open(datafile, "rb") as open_file:
+            data = open_file.read()
+        with open(datafile, "wb") as open_file:
+            open_file.write(data[:-12])
+        self.assertRaises(ConnectomistBadFileError, load_bundles,
+                          self.bundlefile)
+
+    def test_merge_bundles(self):
+        """ Test the bundle maps merge: the fibers are grouped by bundle.
+        """
+        other = save_bundles(
+            os.path.join(self.tmpdir, "other"), self.points[:5],
+            self.offsets[:3], names=[("bundle2", 0), ("bundle3", 1)])
+        merged = merge_bundle_maps([self.bundlefile, other],
+                                   os.path.join(self.tmpdir, "merged"))
+        points, offsets, header = load_bundles(merged)
+        self.assertEqual(header["curves_count"], 5)
+        self.assertEqual(header["resolutionZ"], 2.5)
+        self.assertEqual(bundle_names(header), [
+            ("bundle1", 0, 2), ("bundle2", 2, 4), ("bundle3", 4, 5)])
+        self.assertEqual(numpy.diff(offsets).tolist(), [3, 2, 4, 3, 2])
+        self.assertTrue(numpy.allclose(points[-2:], self.fibers[1]))
+
+    def test_resample_fibers(self):
+        """ Test the fibers resampling at equal arc length.
+        """
+        fibers = resample_fibers(self.points, self.offsets, 3)
+        self.assertEqual(fibers.shape, (3, 3, 3))
+        self.assertTrue(numpy.allclose(fibers[0], self.fibers[0]))
+        self.assertTrue(numpy.allclose(fibers[1], [[0, 1, 0], [0, 1.5, 0],
+                                                   [0, 2, 0]]))
+        self.assertTrue(numpy.allclose(fibers[2, 1], [4.5, 4.5, 4.5]))
+        self.assertRaises(ValueError, resample_fibers, self.points,
+                          numpy.array([0, 0, 3]), 3)
+
+    def test_normal_execution(self):
+        """ Test the Trackvis conversion at the byte level.
+        """
+        trk = bundle_to_trk(self.bundlefile, os.path.join(self.tmpdir, "out"))
+        self.assertEqual(trk, os.path.join(self.tmpdir, "out.trk"))
+        with open(trk, "rb") as open_file:
+            data = open_file.read()
+        self.assertEqual(TRK_HEADER_DTYPE.itemsize, 1000)
+        self.assertEqual(data[1000:], self.reference_trk_data())
+        header = numpy.frombuffer(data[:1000], dtype=TRK_HEADER_DTYPE)
+        self.assertEqual(header["n_count"][0], 3)
+        self.assertEqual(header["dim"][0].tolist(), [64, 64, 40])
+        self.assertEqual(header["voxel_size"][0].tolist(), [2., 2., 2.5])
+
+        # Check the file can be read back
+        points, offsets, properties, _ = load_trk(trk)
+        self.assertTrue(numpy.allclose(points, self.points))
+        self.assertEqual(offsets.tolist(), self.offsets.tolist())
+        self.assertEqual(properties.shape, (3, 0))
+        if hasattr(nibabel, "streamlines"):
+            trkfile = nibabel.streamlines.load(trk)
+            self.assertEqual(len(trkfile.streamlines), 3)
+
+    def test_trx(self):
+        """ Test the TRX conversion: contiguous positions and groups.
+        """
+        # Groups from the bundle map header
+        trx = bundles_to_trx([self.bundlefile, self.bundlefile],
+                             os.path.join(self.tmpdir, "out"), chunk_size=2)
+        self.assertEqual(trx, os.path.join(self.tmpdir, "out.trx"))
+        points, offsets, groups, header = load_trx(trx)
+        self.assertTrue(isinstance(points, numpy.memmap))
+        lpi_to_ras = numpy.array([63 * 2., 63 * 2., 39 * 2.5]) - self.points
+        self.assertTrue(numpy.allclose(points[:9], lpi_to_ras))
+        self.assertTrue(numpy.allclose(points[9:], lpi_to_ras))
+        self.assertEqual(offsets.tolist(), [0, 3, 5, 9, 12, 14, 18])
+        self.assertEqual(groups["bundle1"].tolist(), [0, 1, 3, 4])
+        self.assertEqual(groups["bundle2"].tolist(), [2, 5])
+        self.assertEqual(header["DIMENSIONS"], [64, 64, 40])
+        self.assertEqual(header["VOXEL_TO_RASMM"][2], [0, 0, -2.5, 97.5])
+        self.assertEqual(header["NB_STREAMLINES"], 6)
+
+        # Half precision and a group per bundle map
+        trx = bundles_to_trx([self.bundlefile], trx, group_names=["all"],
+                             float16=True)
+        points, offsets, groups, header = load_trx(trx)
+        self.assertEqual(points.dtype, numpy.float16)
+        self.assertTrue(numpy.allclose(points, lpi_to_ras))
+        self.assertEqual(sorted(groups), ["all"])
+        self.assertEqual(groups["all"].tolist(), [0, 1, 2])
+        self.assertEqual(sorted(os.listdir(trx)), [
+            "groups", "header.json", "offsets.uint64",
+            "positions.3.float16"])
+
+    def test_trx_reference(self):
+        """ Test the TRX RAS+ world space round trip against a reference
+        Nifti image.
+        """
+        # Create a RAS reference image with swapped x and y axes on the
+        # (64, 64, 40) Connectomist grid: each voxel stores its Connectomist
+        # voxel indices
+        lpi_indices = numpy.indices((64, 64, 40)).transpose(1, 2, 3, 0)
+        data = lpi_indices[::-1, ::-1, ::-1].transpose(1, 0, 2, 3)
+        affine = numpy.array([[0., 2., 0., -60.],
+                              [2., 0., 0., -70.],
+                              [0., 0., 2.5, -40.],
+                              [0., 0., 0., 1.]])
+        reference = os.path.join(self.tmpdir, "reference.nii.gz")
+        nibabel.Nifti1Image(data.astype(numpy.int16), affine).to_filename(
+            reference)
+
+        # Test execution: the fiber points are at the voxel centers
+        voxel_sizes = numpy.array([2., 2., 2.5], dtype=numpy.float32)
+        bundlefile = save_bundles(
+            os.path.join(self.tmpdir, "centers"), self.points * voxel_sizes,
+            self.offsets)
+        trx = bundles_to_trx([bundlefile], os.path.join(self.tmpdir, "out"),
+                             reference=reference)
+        points, _, _, header = load_trx(trx)
+        self.assertEqual(header["DIMENSIONS"], [64, 64, 40])
+        self.assertTrue(numpy.allclose(header["VOXEL_TO_RASMM"], affine))
+
+        # Map the world coordinates to the reference voxels: the stored
+        # Connectomist indices are the fiber coordinates in voxels
+        voxels = nibabel.affines.apply_affine(
+            numpy.linalg.inv(header["VOXEL_TO_RASMM"]), points)
+        self.assertTrue(numpy.allclose(voxels, numpy.round(voxels)))
+        voxels = numpy.round(voxels).astype(int)
+        self.assertEqual(data[tuple(voxels.T)].tolist(),
+                         self.points.astype(int).tolist())
+
+    def test_compress_fibers(self):
+        """ Test the error bounded fiber compression.
+        """
+        points = numpy.array([
+            [0, 0, 0], [1, 0.1, 0], [2, 0, 0], [3, 1, 0], [4, 0, 0],
+            [0, 0, 0], [1, 0, 0], [2, 0, 0],
+            [5, 5, 5]], dtype=numpy.float32)
+        kept = compress_fibers(points, numpy.array([0, 5, 8, 9]), 0.5)
+        self.assertEqual(numpy.flatnonzero(kept).tolist(),
+                         [0, 2, 3, 4, 5, 7, 8])
+        kept = compress_fibers(points, numpy.array([0, 5, 8, 9]), 0.05)
+        self.assertEqual(numpy.flatnonzero(~kept).tolist(), [6])
+
+    def test_compress_bundles(self):
+        """ Test the quick look export: compression and subsampling.
+        """
+        trk = compress_bundles([self.bundlefile, self.bundlefile],
+                               os.path.join(self.tmpdir, "quicklook"),
+                               tolerance=0.1, chunk_size=2)
+        points, offsets, _, header = load_trk(trk)
+        self.assertEqual(numpy.diff(offsets).tolist(), [2, 2, 2] * 2)
+        self.assertTrue(numpy.allclose(points[:2], [[0, 0, 0], [2, 0, 0]]))
+        self.assertEqual(header["voxel_size"][0].tolist(), [2., 2., 2.5])
+        trk = compress_bundles([self.bundlefile, self.bundlefile], trk,
+                               max_fibers=4, seed=1, chunk_size=2)
+        points, offsets, _, _ = load_trk(trk)
+        self.assertEqual(len(offsets), 5)
+        self.assertEqual(len(points), 8)
+
+    def test_merge_bundles_to_trk(self):
+        """ Test the single Trackvis file export with bundle labels.
+        """
+        other = save_bundles(os.path.join(self.tmpdir, "other"),
+                             self.fibers[1], numpy.array([0, 2]))
+        trk = merge_bundles_to_trk([self.bundlefile, other],
+                                   os.path.join(self.tmpdir, "merged"),
+                                   chunk_size=2)
+        points, offsets, properties, header = load_trk(trk)
+        self.assertEqual(header["n_count"][0], 4)
+        self.assertEqual(header["property_name"][0, 0], b"bundle_label")
+        self.assertEqual(properties.ravel().tolist(), [0, 0, 0, 1])
+        self.assertEqual(numpy.diff(offsets).tolist(), [3, 2, 4, 2])
+        self.assertTrue(numpy.allclose(points[:9], self.points))
+        self.assertTrue(numpy.allclose(points[9:], self.fibers[1]))
+
+
+if __name__ == "__main__":
+    unittest.main()
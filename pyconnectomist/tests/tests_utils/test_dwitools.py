@@ -16,7 +16,11 @@ fake return string.
 # System import
 import unittest
 import sys
+import os
+import shutil
+import tempfile
 import numpy
+import nibabel
 # COMPATIBILITY: since python 3.3 mock is included in unittest module
 python_version = sys.version_info
 if python_version[:2] <= (3, 3):
@@ -28,6 +32,10 @@ else:
 
 # pyConnectomist module
 from pyconnectomist.utils.dwitools import read_bvals_bvecs
+from pyconnectomist.utils.dwitools import extract_dwi_shells
+from pyconnectomist.utils.dwitools import GradientTable
+from pyconnectomist.utils.dwitools import iter_nifti_volumes
+from pyconnectomist.exceptions import ConnectomistBadFileError
 
 
 class ConnectomistBvecsBvals(unittest.TestCase):
@@ -109,5 +117,193 @@ class ConnectomistBvecsBvals(unittest.TestCase):
         self.assertTrue(output_files[3] == 2)
 
 
+class ConnectomistGradientTable(unittest.TestCase):
+    """ Test the Connectomist gradient table:
+    'pyconnectomist.utils.dwitools.GradientTable'
+    """
+    def setUp(self):
+        """ Create the gradient files.
+        """
+        self.tmpdir = tempfile.mkdtemp()
+        self.bvals = numpy.array([0, 1000, 2000, 5, 1010, 2000, 990])
+        self.bvecs = numpy.random.uniform(-1, 1, size=(7, 3))
+        self.bvals_file = os.path.join(self.tmpdir, "dwi.bval")
+        self.bvecs_file = os.path.join(self.tmpdir, "dwi.bvec")
+        numpy.savetxt(self.bvals_file, self.bvals)
+        numpy.savetxt(self.bvecs_file, self.bvecs.T)
+
+    def tearDown(self):
+        """ Run after each test.
+        """
+        shutil.rmtree(self.tmpdir)
+
+    def test_badshell_raise(self):
+        """ A wrong shell -> raise ValueError.
+        """
+        # Test execution
+        gtab = GradientTable(self.bvals, self.bvecs)
+        self.assertRaises(ValueError, gtab.shell_indices, 3000)
+        self.assertRaises(ValueError, gtab.check, min_bval=1500)
+        gtab = GradientTable([0, 5, 0], numpy.zeros((3, 3)))
+        self.assertRaises(ValueError, gtab.check)
+
+    def test_thresholds(self):
+        """ Test the b0 and diffusion weighted thresholds: a b-value of 50
+        is a b0, a b-value in ]50, 100[ is neither a b0 nor kept as
+        diffusion weighted.
+        """
+        gtab = GradientTable([0, 50, 80, 1000], numpy.zeros((4, 3)))
+        self.assertEqual(gtab.b0_mask.tolist(), [True, True, False, False])
+        self.assertEqual(gtab.dw_mask.tolist(), [False, False, False, True])
+        self.assertEqual(gtab.b0_indices.tolist(), [0, 1])
+        self.assertEqual(gtab.shells.tolist(), [100, 1000])
+
+    def test_normal_execution(self):
+        """ Test the normal behaviour of the class.
+        """
+        # Test execution
+        gtab = GradientTable.from_files(self.bvals_file, self.bvecs_file,
+                                        cachedir=self.tmpdir)
+        self.assertTrue(numpy.allclose(gtab.bvecs, self.bvecs))
+        self.assertEqual(gtab.shells.tolist(), [1000, 2000])
+        self.assertEqual(gtab.shell_index.tolist(), [-1, 0, 1, -1, 0, 1, 0])
+        self.assertEqual(gtab.b0_indices.tolist(), [0, 3])
+        self.assertEqual(gtab.shell_indices(1000).tolist(), [1, 4, 6])
+        self.assertEqual(gtab.shell_indices(2000).tolist(), [2, 5])
+        self.assertEqual((gtab.nb_shells, gtab.nb_nodiff), (2, 2))
+
+        # The cached table is reused until the sources are modified
+        cachefile = GradientTable.cachefile(
+            self.tmpdir, [self.bvals_file, self.bvecs_file])
+        self.assertTrue(os.path.isfile(cachefile))
+        with mock.patch("numpy.loadtxt") as mock_loadtxt:
+            gtab = GradientTable.from_files(
+                self.bvals_file, self.bvecs_file, cachedir=self.tmpdir)
+            self.assertEqual(len(mock_loadtxt.call_args_list), 0)
+        self.assertTrue(numpy.allclose(gtab.bvals, self.bvals))
+        numpy.savetxt(self.bvals_file, self.bvals + 1000)
+        gtab = GradientTable.from_files(self.bvals_file, self.bvecs_file,
+                                        cachedir=self.tmpdir)
+        self.assertEqual(gtab.shells.tolist(), [1000, 2000, 3000])
+
+    def test_minf_execution(self):
+        """ Test the table built from a Connectomist '.minf' file.
+        """
+        # Test execution
+        minf = os.path.join(self.tmpdir, "dw.ima.minf")
+        with open(minf, "wt") as open_file:
+            open_file.write("attributes = {{'bvalues': {0}, "
+                            "'diffusion_gradient_orientations': {1}}}".format(
+                                [1000, 2000, 2000],
+                                [[2, 0, 0], [0, 0, 1], [0, 3, 4]]))
+        gtab = GradientTable.from_minf(minf, nodiff_first=True,
+                                       cachedir=self.tmpdir)
+        self.assertEqual(gtab.bvals.tolist(), [0, 1000, 2000, 2000])
+        self.assertTrue(numpy.allclose(
+            gtab.bvecs, [[0, 0, 0], [1, 0, 0], [0, 0, 1], [0, 0.6, 0.8]]))
+        cachefile = GradientTable.cachefile(self.tmpdir, [minf], key="True")
+        self.assertTrue(os.path.isfile(cachefile))
+        self.assertEqual(
+            sorted(os.listdir(self.tmpdir)),
+            sorted(["dw.ima.minf", "dwi.bval", "dwi.bvec",
+                    os.path.basename(cachefile)]))
+        gtab = GradientTable.from_minf(minf, cachedir=self.tmpdir)
+        self.assertEqual(gtab.bvals.tolist(), [1000, 2000, 2000])
+        with open(minf, "wt") as open_file:
+            open_file.write("attributes = {'bvalues': [1000]}")
+        self.assertRaises(ConnectomistBadFileError, GradientTable.from_minf,
+                          minf)
+
+
+class ConnectomistExtractShells(unittest.TestCase):
+    """ Test the Connectomist multi-shell serie split:
+    'pyconnectomist.utils.dwitools.extract_dwi_shells'
+    """
+    def setUp(self):
+        """ Create a small multi-shell serie.
+        """
+        self.tmpdir = tempfile.mkdtemp()
+        self.bvals = numpy.array([0, 1000, 2000, 5, 1010, 2000, 1000])
+        self.bvecs = numpy.random.uniform(-1, 1, size=(7, 3))
+        self.data = numpy.random.randint(
+            0, 1000, size=(4, 5, 6, 7)).astype(numpy.int16)
+        self.affine = numpy.diag([2., 2., 2.5, 1.])
+        self.dwi = os.path.join(self.tmpdir, "dwi.nii.gz")
+        self.bvals_file = os.path.join(self.tmpdir, "dwi.bval")
+        self.bvecs_file = os.path.join(self.tmpdir, "dwi.bvec")
+        nibabel.Nifti1Image(self.data, self.affine).to_filename(self.dwi)
+        numpy.savetxt(self.bvals_file, self.bvals)
+        numpy.savetxt(self.bvecs_file, self.bvecs.T)
+
+    def tearDown(self):
+        """ Run after each test.
+        """
+        shutil.rmtree(self.tmpdir)
+
+    @mock.patch("pyconnectomist.utils.dwitools.iter_nifti_volumes")
+    def test_normal_execution(self, mock_iter):
+        """ Test the normal behaviour of the function.
+        """
+        # Count the volumes read
+        reads = []
+
+        def counted_iter(*args, **kwargs):
+            for start, data in iter_nifti_volumes(*args, **kwargs):
+                reads.append(data.shape[3])
+                yield start, data
+        mock_iter.side_effect = counted_iter
+
+        # Test execution: the budget allows a single volume per chunk
+        nodiff_file, dwis = extract_dwi_shells(
+            self.dwi, self.bvals_file, self.bvecs_file, self.tmpdir,
+            nb_threads=2, memory_budget=0)
+        self.assertEqual(len(mock_iter.call_args_list), 2)
+        self.assertEqual(reads, [1] * (4 + 7))
+        b0 = numpy.round(self.data[..., [0, 3]].mean(axis=3))
+        nodiff = nibabel.load(nodiff_file)
+        self.assertEqual(nodiff.get_data_dtype(), numpy.int16)
+        self.assertTrue(numpy.allclose(nodiff.affine, self.affine))
+        self.assertTrue(numpy.all(numpy.asarray(nodiff.dataobj) == b0))
+        self.assertEqual(sorted(dwis.keys()), [1000, 2000])
+        for bval, indices in ((1000, [1, 4, 6]), (2000, [2, 5])):
+            shell = nibabel.load(dwis[bval]["dwi"])
+            self.assertEqual(shell.get_data_dtype(), numpy.int16)
+            data = numpy.asarray(shell.dataobj)
+            self.assertEqual(data.shape, (4, 5, 6, len(indices) + 1))
+            self.assertTrue(numpy.all(data[..., 0] == b0))
+            self.assertTrue(numpy.all(data[..., 1:] ==
+                                      self.data[..., indices]))
+            self.assertTrue(numpy.allclose(
+                numpy.loadtxt(dwis[bval]["bvals"]),
+                [0] + self.bvals[indices].tolist()))
+            self.assertTrue(numpy.allclose(
+                numpy.loadtxt(dwis[bval]["bvecs"])[1:],
+                self.bvecs[indices]))
+
+        # Test execution: the budget covers the fixed buffers (the float64
+        # accumulator, the mean b0 and one volume per worker) and three
+        # volumes per chunk
+        reads[:] = []
+        volume_size = 4 * 5 * 6
+        memory_budget = (volume_size * (8 + 2 * 3) + volume_size * 2 * 3) / (
+            1024. ** 2)
+        extract_dwi_shells(
+            self.dwi, self.bvals_file, self.bvecs_file, self.tmpdir,
+            nb_threads=2, memory_budget=memory_budget)
+        self.assertEqual(reads, [3, 1, 3, 3, 1])
+
+    def test_iter_nifti_volumes(self):
+        """ Test the chunks follow the volume order with the image scaling.
+        """
+        image = nibabel.Nifti1Image(self.data, self.affine)
+        image.header.set_slope_inter(2., 1.)
+        image.to_filename(self.dwi)
+        chunks = list(iter_nifti_volumes(self.dwi, 3))
+        self.assertEqual([start for start, _ in chunks], [0, 3, 6])
+        data = numpy.concatenate([data for _, data in chunks], axis=3)
+        self.assertTrue(numpy.allclose(data, self.data * 2. + 1.))
+        self.assertEqual(len(list(iter_nifti_volumes(self.dwi, 2, 3))), 2)
+
+
 if __name__ == "__main__":
     unittest.main()
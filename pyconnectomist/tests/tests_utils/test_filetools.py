@@ -15,7 +15,13 @@ fake return string.
 
 # System import
 import unittest
+import copy
 import sys
+import os
+import shutil
+import json
+import tempfile
+import numpy
 # COMPATIBILITY: since python 3.3 mock is included in unittest module
 python_version = sys.version_info
 if python_version[:2] <= (3, 3):
@@ -34,6 +40,9 @@ from pyconnectomist.utils.filetools import ptk_concatenate_volumes
 from pyconnectomist.utils.filetools import ptk_split_t2_and_diffusion
 from pyconnectomist.utils.filetools import ptk_bundle_to_trk
 from pyconnectomist.utils.filetools import exec_file
+from pyconnectomist.utils.filetools import parse_dict_file
+from pyconnectomist.utils.filetools import save_dict_file
+from pyconnectomist.utils.filetools import update_json_file
 
 
 class ConnectomistBundleToTrk(unittest.TestCase):
@@ -300,5 +309,131 @@ class ConnectomistExecFile(unittest.TestCase):
         self.assertEqual(exec_dict["NAME"], "pyConnectomist")
 
 
+class ConnectomistParseDictFile(unittest.TestCase):
+    """ Test the Connectomist function that parses a dictionary file:
+    'pyconnectomist.utils.filetools.parse_dict_file'
+    """
+    def setUp(self):
+        """ Create a '.minf' like file.
+        """
+        self.tmpdir = tempfile.mkdtemp()
+        self.minf = os.path.join(self.tmpdir, "dw.ima.minf")
+        self.write("attributes = {'bvalues': [1500, 1500], "
+                   "'diffusion_gradient_orientations': [[1, 0, 0], "
+                   "[0, 1, 0]], 'subject': 'Lola'}\n")
+
+    def tearDown(self):
+        """ Run after each test.
+        """
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, content):
+        """ Overwrite the '.minf' like file.
+        """
+        with open(self.minf, "wt") as open_file:
+            open_file.write(content)
+
+    def test_badfileerror_raise(self):
+        """ A wrong input -> raise ConnectomistBadFileError.
+        """
+        # Test execution
+        self.assertRaises(ConnectomistBadFileError, parse_dict_file,
+                          os.path.join(self.tmpdir, "WRONG.minf"))
+        self.write("import os\nattributes = {}\n")
+        self.assertRaises(ConnectomistBadFileError, parse_dict_file,
+                          self.minf)
+        self.write("attributes = {'key': os.getcwd()}\n")
+        self.assertRaises(ConnectomistBadFileError, parse_dict_file,
+                          self.minf)
+        self.write("attributes = {'diffusion_gradient_orientations': "
+                   "[[1, 0, 0], [0, 1]]}\n")
+        self.assertRaises(ConnectomistBadFileError, parse_dict_file,
+                          self.minf)
+
+    def test_normal_execution(self):
+        """ Test the normal behaviour of the function.
+        """
+        # Test execution
+        parsed_dict = parse_dict_file(self.minf)
+        attributes = parsed_dict["attributes"]
+        self.assertEqual(attributes["subject"], "Lola")
+        self.assertTrue(isinstance(attributes["bvalues"], numpy.ndarray))
+        self.assertEqual(attributes["diffusion_gradient_orientations"].shape,
+                         (2, 3))
+
+        # The cached content is shared and the arrays are read-only
+        self.assertTrue(parse_dict_file(self.minf) is parsed_dict)
+        self.assertFalse(attributes["bvalues"].flags.writeable)
+
+        # The cache is invalidated when the file changes
+        self.write("attributes = {'subject': 'Lola2'}\n")
+        self.assertEqual(
+            parse_dict_file(self.minf)["attributes"]["subject"], "Lola2")
+
+    def test_save_execution(self):
+        """ Test the written file is parsed back.
+        """
+        # Test execution
+        parsed_dict = copy.deepcopy(parse_dict_file(self.minf))
+        parsed_dict["attributes"]["bvalues"] = (
+            parsed_dict["attributes"]["bvalues"][1:])
+        save_dict_file(self.minf, parsed_dict)
+        attributes = parse_dict_file(self.minf)["attributes"]
+        self.assertEqual(attributes["subject"], "Lola")
+        self.assertEqual(attributes["bvalues"].tolist(), [1500])
+        self.assertEqual(attributes["diffusion_gradient_orientations"].shape,
+                         (2, 3))
+
+
+class ConnectomistUpdateJsonFile(unittest.TestCase):
+    """ Test the shared '.json' file update:
+    'pyconnectomist.utils.filetools.update_json_file'
+    """
+    def setUp(self):
+        """ Define a '.json' file path.
+        """
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "cache.json")
+
+    def tearDown(self):
+        """ Run after each test.
+        """
+        shutil.rmtree(self.tmpdir)
+
+    def test_normal_execution(self):
+        """ Test the updates are merged with the file content.
+        """
+        def update(key):
+            def _update(content):
+                content = content or {}
+                content[key] = len(content)
+                return content
+            return _update
+
+        self.assertEqual(update_json_file(self.path, update("a")), {"a": 0})
+        self.assertEqual(update_json_file(self.path, update("b")),
+                         {"a": 0, "b": 1})
+        with open(self.path, "rt") as open_file:
+            self.assertEqual(json.load(open_file), {"a": 0, "b": 1})
+        self.assertEqual(sorted(os.listdir(self.tmpdir)),
+                         ["cache.json", "cache.json.lock"])
+
+    def test_error_execution(self):
+        """ A failed update leaves the file untouched.
+        """
+        update_json_file(self.path, lambda content: {"a": 0})
+
+        def update(content):
+            raise ValueError("failed update")
+
+        self.assertRaises(ValueError, update_json_file, self.path, update)
+        self.assertRaises(TypeError, update_json_file, self.path,
+                          lambda content: {"a": object()})
+        with open(self.path, "rt") as open_file:
+            self.assertEqual(json.load(open_file), {"a": 0})
+        self.assertEqual(sorted(os.listdir(self.tmpdir)),
+                         ["cache.json", "cache.json.lock"])
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,123 @@
+##########################################################################
+# NSAp - Copyright (C) CEA, 2016
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+"""
+Test the Morphologist index on a small hierarchy written in a temporary
+directory.
+"""
+
+# System import
+import unittest
+import os
+import glob
+import json
+import shutil
+import tempfile
+
+# pyConnectomist import
+from pyconnectomist.utils.morphologist import MorphologistIndex
+
+
+class ConnectomistMorphologistIndex(unittest.TestCase):
+    """ Test the Morphologist index:
+    'pyconnectomist.utils.morphologist.MorphologistIndex'
+    """
+    def setUp(self):
+        """ Create a Morphologist hierarchy with two subjects.
+        """
+        self.tmpdir = tempfile.mkdtemp()
+        self.morphologist_dir = os.path.join(self.tmpdir, "morphologist")
+        for subject_id, names in (
+                ("jp", ["jp.nii.gz", "jp.APC", "registration"]),
+                ("sub", ["sub.nii", "sub.APC"])):
+            timepoint_dir = os.path.join(
+                self.morphologist_dir, subject_id, "t1mri", "V1")
+            os.makedirs(timepoint_dir)
+            for name in names:
+                open(os.path.join(timepoint_dir, name), "wt").close()
+        self.cachefile = os.path.join(self.tmpdir, "index.json")
+
+    def tearDown(self):
+        """ Run after each test.
+        """
+        shutil.rmtree(self.tmpdir)
+
+    def test_valueerror_raise(self):
+        """ A wrong item -> raise ValueError.
+        """
+        index = MorphologistIndex(self.morphologist_dir)
+        self.assertRaises(ValueError, index.find, "jp", "WRONG")
+
+    def test_normal_execution(self):
+        """ Test the index gives the same files as the 'glob' patterns.
+        """
+        index = MorphologistIndex(self.morphologist_dir,
+                                  cachefile=self.cachefile).scan()
+        self.assertEqual(sorted(index.subjects), ["jp", "sub"])
+        for subject_id in ("jp", "sub"):
+            t1mri_dir = os.path.join(self.morphologist_dir, subject_id,
+                                     "t1mri", "*")
+            for item, pattern in (
+                    ("t1", "{0}.nii*"), ("apc", "{0}.APC"),
+                    ("registration", "registration")):
+                self.assertEqual(
+                    index.find(subject_id, item), glob.glob(os.path.join(
+                        t1mri_dir, pattern.format(subject_id))))
+        self.assertEqual(index.find("WRONG", "t1"), [])
+        self.assertTrue(os.path.isfile(self.cachefile))
+
+    def test_cache(self):
+        """ Test the cache reuse and invalidation.
+        """
+        MorphologistIndex(self.morphologist_dir,
+                          cachefile=self.cachefile).scan()
+        with open(self.cachefile, "rt") as open_file:
+            cache = json.load(open_file)
+
+        # The cached entries are reused as is
+        apcfile = os.path.join(self.morphologist_dir, "jp", "t1mri", "V1",
+                               "jp.APC")
+        cache["subjects"]["jp"]["apc"] = ["CACHED"]
+        with open(self.cachefile, "wt") as open_file:
+            json.dump(cache, open_file)
+        index = MorphologistIndex(self.morphologist_dir,
+                                  cachefile=self.cachefile)
+        self.assertEqual(index.find("jp", "apc"), ["CACHED"])
+
+        # A modified directory invalidates the subject entry
+        os.remove(apcfile)
+        timepoint_dir = os.path.dirname(apcfile)
+        mtime = cache["subjects"]["jp"]["mtimes"][timepoint_dir]
+        os.utime(timepoint_dir, (mtime + 10, mtime + 10))
+        index = MorphologistIndex(self.morphologist_dir,
+                                  cachefile=self.cachefile).scan(["jp"])
+        self.assertEqual(index.find("jp", "apc"), [])
+        self.assertEqual(len(index.find("sub", "t1")), 1)
+        with open(self.cachefile, "rt") as open_file:
+            self.assertEqual(json.load(open_file)["subjects"]["jp"]["apc"],
+                             [])
+
+    def test_concurrent_save(self):
+        """ Test concurrent indexes merge their entries in the cache.
+        """
+        first = MorphologistIndex(self.morphologist_dir,
+                                  cachefile=self.cachefile)
+        second = MorphologistIndex(self.morphologist_dir,
+                                   cachefile=self.cachefile)
+        first.scan(["jp"])
+        second.scan(["sub"])
+        with open(self.cachefile, "rt") as open_file:
+            cache = json.load(open_file)
+        self.assertEqual(sorted(cache["subjects"]), ["jp", "sub"])
+        self.assertEqual(sorted(second.subjects), ["jp", "sub"])
+        self.assertEqual(sorted(os.listdir(self.tmpdir)), [
+            "index.json", "index.json.lock", "morphologist"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,101 @@
+##########################################################################
+# NSAp - Copyright (C) CEA, 2016
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+"""
+Test the Nifti header cache on small images written in a temporary
+directory.
+"""
+
+# System import
+import unittest
+import sys
+import os
+import shutil
+import tempfile
+import numpy
+import nibabel
+# COMPATIBILITY: since python 3.3 mock is included in unittest module
+python_version = sys.version_info
+if python_version[:2] <= (3, 3):
+    import mock
+else:
+    import unittest.mock as mock
+
+# pyConnectomist import
+from pyconnectomist.utils.niftitools import NiftiHeaderCache
+
+
+class ConnectomistNiftiHeaderCache(unittest.TestCase):
+    """ Test the Nifti header cache:
+    'pyconnectomist.utils.niftitools.NiftiHeaderCache'
+    """
+    def setUp(self):
+        """ Create a Nifti image.
+        """
+        self.tmpdir = tempfile.mkdtemp()
+        self.image = os.path.join(self.tmpdir, "t1.nii.gz")
+        affine = numpy.diag([2., 2., 2.5, 1.])
+        nibabel.Nifti1Image(numpy.zeros((5, 6, 7), dtype=numpy.int16),
+                            affine).to_filename(self.image)
+        self.cachefile = os.path.join(self.tmpdir, NiftiHeaderCache.cachename)
+
+    def tearDown(self):
+        """ Run after each test.
+        """
+        shutil.rmtree(self.tmpdir)
+
+    def test_normal_execution(self):
+        """ Test the header metadata and the cache reuse.
+        """
+        metadata = NiftiHeaderCache(self.cachefile).get(self.image)
+        self.assertEqual(metadata["shape"], (5, 6, 7))
+        self.assertEqual(metadata["zooms"], (2., 2., 2.5))
+        self.assertEqual(metadata["dtype"], "int16")
+        self.assertTrue(numpy.allclose(metadata["affine"][:3, :3],
+                                       numpy.diag([2., 2., 2.5])))
+        self.assertEqual(metadata["size"], os.path.getsize(self.image))
+        self.assertTrue(os.path.isfile(self.cachefile))
+
+        # The header is not parsed again
+        with mock.patch("nibabel.load") as mock_load:
+            cached = NiftiHeaderCache(self.cachefile).get(self.image)
+            self.assertEqual(len(mock_load.call_args_list), 0)
+        self.assertEqual(cached["shape"], metadata["shape"])
+
+    def test_invalidation(self):
+        """ A modified image is parsed again.
+        """
+        cache = NiftiHeaderCache(self.cachefile)
+        cache.get(self.image)
+        nibabel.Nifti1Image(numpy.zeros((3, 3, 3, 2), dtype=numpy.float32),
+                            numpy.eye(4)).to_filename(self.image)
+        mtime = os.path.getmtime(self.image) + 10
+        os.utime(self.image, (mtime, mtime))
+        metadata = NiftiHeaderCache(self.cachefile).get(self.image)
+        self.assertEqual(metadata["shape"], (3, 3, 3, 2))
+        self.assertEqual(metadata["dtype"], "float32")
+
+    def test_concurrent_save(self):
+        """ Test concurrent caches merge their entries.
+        """
+        other = os.path.join(self.tmpdir, "t2.nii.gz")
+        nibabel.Nifti1Image(numpy.zeros((3, 3, 3), dtype=numpy.int16),
+                            numpy.eye(4)).to_filename(other)
+        first = NiftiHeaderCache(self.cachefile)
+        second = NiftiHeaderCache(self.cachefile)
+        first.get(self.image)
+        second.get(other)
+        with mock.patch("nibabel.load") as mock_load:
+            cache = NiftiHeaderCache(self.cachefile)
+            self.assertEqual(cache.get(self.image)["shape"], (5, 6, 7))
+            self.assertEqual(cache.get(other)["shape"], (3, 3, 3))
+            self.assertEqual(len(mock_load.call_args_list), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,92 @@
+##########################################################################
+# NSAp - Copyright (C) CEA, 2016
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+"""
+Test the parallel tools, the cgroup quota files are written in a temporary
+directory.
+"""
+
+# System import
+import unittest
+import sys
+import os
+import shutil
+import tempfile
+# COMPATIBILITY: since python 3.3 mock is included in unittest module
+python_version = sys.version_info
+if python_version[:2] <= (3, 3):
+    import mock
+else:
+    import unittest.mock as mock
+
+# pyConnectomist import
+from pyconnectomist.utils import paralleltools
+from pyconnectomist.utils.paralleltools import available_cpu_count
+from pyconnectomist.utils.paralleltools import parallel_map
+
+
+class ConnectomistAvailableCpuCount(unittest.TestCase):
+    """ Test the available CPUs count:
+    'pyconnectomist.utils.paralleltools.available_cpu_count'
+    """
+    def setUp(self):
+        """ Define cgroup quota files in a temporary directory.
+        """
+        self.tmpdir = tempfile.mkdtemp()
+        self.cpu_max = os.path.join(self.tmpdir, "cpu.max")
+        self.cfs_files = (os.path.join(self.tmpdir, "cpu.cfs_quota_us"),
+                          os.path.join(self.tmpdir, "cpu.cfs_period_us"))
+        self.patchers = [
+            mock.patch.object(paralleltools, "CGROUP_CPU_MAX", self.cpu_max),
+            mock.patch.object(paralleltools, "CGROUP_CFS_FILES",
+                              self.cfs_files),
+            mock.patch.object(paralleltools.os, "sched_getaffinity",
+                              return_value=set(range(8)), create=True)]
+        for patcher in self.patchers:
+            patcher.start()
+
+    def tearDown(self):
+        """ Run after each test.
+        """
+        for patcher in self.patchers:
+            patcher.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, path, content):
+        """ Write a cgroup quota file.
+        """
+        with open(path, "wt") as open_file:
+            open_file.write(content)
+
+    def test_normal_execution(self):
+        """ Test the affinity and the cgroup v2 and v1 quotas.
+        """
+        # Test execution
+        self.assertEqual(available_cpu_count(), 8)
+        self.write(self.cfs_files[0], "150000\n")
+        self.write(self.cfs_files[1], "100000\n")
+        self.assertEqual(available_cpu_count(), 2)
+        self.write(self.cfs_files[0], "-1\n")
+        self.assertEqual(available_cpu_count(), 8)
+        self.write(self.cpu_max, "max 100000\n")
+        self.assertEqual(available_cpu_count(), 8)
+        self.write(self.cpu_max, "300000 100000\n")
+        self.assertEqual(available_cpu_count(), 3)
+        self.write(self.cpu_max, "20000 100000\n")
+        self.assertEqual(available_cpu_count(), 1)
+
+    def test_parallel_map(self):
+        """ Test the results are returned in the iterable order.
+        """
+        # Test execution
+        self.assertEqual(parallel_map(abs, [-1, -2, -3], nb_workers=None),
+                         [1, 2, 3])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,124 @@
+##########################################################################
+# NSAp - Copyright (C) CEA, 2016
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+"""
+Test the pre-flight validation on small fixtures written in a temporary
+directory.
+"""
+
+# System import
+import unittest
+import os
+import shutil
+import tempfile
+import numpy
+import nibabel
+
+# pyConnectomist import
+from pyconnectomist.exceptions import ConnectomistError
+from pyconnectomist.utils.preflight import preflight
+from pyconnectomist.utils.preflight import check_diffusion_inputs
+from pyconnectomist.utils.preflight import check_fieldmap_inputs
+from pyconnectomist.utils.preflight import TRACTOGRAPHY_PREPROC_STEPS
+
+
+class ConnectomistPreflight(unittest.TestCase):
+    """ Test the pre-flight validation:
+    'pyconnectomist.utils.preflight.preflight'
+    """
+    def setUp(self):
+        """ Create a diffusion sequence, a fieldmap and a Morphologist
+        subject.
+        """
+        self.tmpdir = tempfile.mkdtemp()
+        self.dwi = self.image("dwi.nii.gz", (4, 4, 3, 4))
+        self.bval = os.path.join(self.tmpdir, "dwi.bval")
+        self.bvec = os.path.join(self.tmpdir, "dwi.bvec")
+        numpy.savetxt(self.bval, [0, 1000, 1000, 1000], newline=" ")
+        numpy.savetxt(self.bvec, [[0, 1, 0, 0], [0, 0, 1, 0], [0, 0, 0, 1]])
+        self.magnitude = self.image("magnitude.nii.gz", (4, 4, 3))
+        self.phase = self.image("phase.nii.gz", (4, 4, 3))
+        self.morphologist_dir = os.path.join(self.tmpdir, "morphologist")
+        t1mri_dir = os.path.join(self.morphologist_dir, "jp", "t1mri", "V1")
+        os.makedirs(os.path.join(t1mri_dir, "registration"))
+        self.image(os.path.join(t1mri_dir, "jp.nii.gz"), (5, 5, 5))
+        for name in ("jp.APC", os.path.join(
+                "registration", "RawT1-jp_V1_TO_Talairach-ACPC.trm")):
+            open(os.path.join(t1mri_dir, name), "wt").close()
+        self.preproc_dir = os.path.join(self.tmpdir, "preproc")
+        for name in TRACTOGRAPHY_PREPROC_STEPS:
+            os.makedirs(os.path.join(self.preproc_dir, name))
+        self.kwargs = {
+            "subject_id": "jp",
+            "morphologist_dir": self.morphologist_dir,
+            "dwis": [self.dwi],
+            "bvals": [self.bval],
+            "bvecs": [self.bvec],
+            "manufacturer": "Siemens",
+            "b0_magnitude": self.magnitude,
+            "b0_phase": self.phase,
+            "dwi_preproc_dir": self.preproc_dir}
+
+    def tearDown(self):
+        """ Run after each test.
+        """
+        shutil.rmtree(self.tmpdir)
+
+    def image(self, name, shape):
+        """ Write a Nifti image.
+        """
+        path = os.path.join(self.tmpdir, name)
+        nibabel.Nifti1Image(numpy.zeros(shape, dtype=numpy.int16),
+                            numpy.eye(4)).to_filename(path)
+        return path
+
+    def test_normal_execution(self):
+        """ Test valid inputs.
+        """
+        self.assertEqual(preflight(**self.kwargs), [])
+
+    def test_diffusion_problems(self):
+        """ Test the detection of the diffusion inputs problems.
+        """
+        numpy.savetxt(self.bvec, [[0, 2, 0, 0], [0, 0, 1, 0], [0, 0, 0, 1]])
+        problems = check_diffusion_inputs([self.dwi], [self.bval],
+                                          [self.bvec])
+        self.assertEqual(len(problems), 1)
+        self.assertTrue("volumes [1]" in problems[0])
+        numpy.savetxt(self.bval, [0, 1000, 1000], newline=" ")
+        numpy.savetxt(self.bvec, [[0, 1, 0], [0, 0, 1], [0, 0, 0]])
+        problems = check_diffusion_inputs([self.dwi], [self.bval],
+                                          [self.bvec])
+        self.assertEqual(len(problems), 2)
+        self.assertTrue("contains 4 volumes" in problems[-1])
+
+    def test_fieldmap_problems(self):
+        """ Test the detection of the fieldmap problems.
+        """
+        phase = self.image("phase.nii.gz", (4, 4, 2))
+        problems = check_fieldmap_inputs(self.magnitude, phase)
+        self.assertEqual(len(problems), 1)
+        self.assertEqual(len(check_fieldmap_inputs(self.magnitude)), 1)
+        b0_maps = self.image("b0_maps.nii.gz", (4, 4, 3, 2))
+        self.assertEqual(check_fieldmap_inputs(b0_maps), [])
+
+    def test_all_problems_raise(self):
+        """ All the problems are reported at once -> raise ConnectomistError.
+        """
+        os.remove(os.path.join(self.morphologist_dir, "jp", "t1mri", "V1",
+                               "jp.APC"))
+        shutil.rmtree(os.path.join(self.preproc_dir,
+                                   TRACTOGRAPHY_PREPROC_STEPS[0]))
+        self.kwargs["manufacturer"] = "WRONG"
+        self.assertRaises(ConnectomistError, preflight, **self.kwargs)
+        problems = preflight(raise_error=False, **self.kwargs)
+        self.assertEqual(len(problems), 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,202 @@
+##########################################################################
+# NSAp - Copyright (C) CEA, 2016
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+"""
+Test the transformation reader and the motion metrics on small fixtures
+written in a temporary directory.
+"""
+
+# System import
+import unittest
+import os
+import json
+import shutil
+import tempfile
+import warnings
+import numpy
+
+# pyConnectomist import
+from pyconnectomist.exceptions import ConnectomistBadFileError
+from pyconnectomist.utils.regtools import read_trms
+from pyconnectomist.utils.regtools import natural_sort
+from pyconnectomist.utils.regtools import motion_metrics
+from pyconnectomist.utils.regtools import save_motion_metrics
+from pyconnectomist.utils.regtools import affine_parameters
+from pyconnectomist.utils.regtools import parameters_affine
+from pyconnectomist.utils.regtools import warm_start_registration
+from pyconnectomist.utils.regtools import apply_registration_preset
+from pyconnectomist.utils.regtools import MOTION_COLUMNS
+
+
+class ConnectomistMotionMetrics(unittest.TestCase):
+    """ Test the motion metrics:
+    'pyconnectomist.utils.regtools.motion_metrics'
+    """
+    def setUp(self):
+        """ Create three volume transformations: identity, a translation and
+        a rotation around z.
+        """
+        self.tmpdir = tempfile.mkdtemp()
+        angle = numpy.radians(10.)
+        rotation = numpy.array([
+            [numpy.cos(angle), -numpy.sin(angle), 0],
+            [numpy.sin(angle), numpy.cos(angle), 0],
+            [0, 0, 1]])
+        self.transforms = [
+            (numpy.zeros(3), numpy.eye(3)),
+            (numpy.array([1., 2., 2.]), numpy.eye(3)),
+            (numpy.array([1., 2., 2.]), rotation)]
+        self.trms = []
+        for index, (translation, linear) in enumerate(self.transforms):
+            path = os.path.join(self.tmpdir, "dw{0}.trm".format(index * 5))
+            numpy.savetxt(path, numpy.concatenate(([translation], linear)))
+            self.trms.append(path)
+
+    def tearDown(self):
+        """ Run after each test.
+        """
+        shutil.rmtree(self.tmpdir)
+
+    def test_badfileerror_raise(self):
+        """ A wrong input -> raise ConnectomistBadFileError.
+        """
+        # Test execution
+        with open(self.trms[0], "wt") as open_file:
+            open_file.write("1 2 3")
+        self.assertRaises(ConnectomistBadFileError, read_trms, self.trms)
+
+    def test_normal_execution(self):
+        """ Test the normal behaviour of the function.
+        """
+        # Test execution
+        self.assertEqual(natural_sort(self.trms[::-1]), self.trms)
+        affines = read_trms(self.trms)
+        self.assertEqual(affines.shape, (3, 4, 4))
+        self.assertTrue(numpy.allclose(affines[2, :3, :3],
+                                       self.transforms[2][1]))
+        self.assertTrue(numpy.allclose(affines[1, :3, 3], [1, 2, 2]))
+        bvecs = numpy.array([[1, 0, 0], [0, 0, 1], [1, 0, 0]])
+        metrics = motion_metrics(affines, bvecs)
+        self.assertTrue(numpy.allclose(metrics["absolute_translation"],
+                                       [0, 3, 3]))
+        self.assertTrue(numpy.allclose(metrics["absolute_rotation"],
+                                       [0, 0, 10]))
+        self.assertTrue(numpy.allclose(metrics["rotation_z"], [0, 0, 10]))
+        self.assertTrue(numpy.allclose(metrics["relative_translation"],
+                                       [0, 3, 0]))
+        self.assertTrue(numpy.allclose(metrics["relative_rotation"],
+                                       [0, 0, 10]))
+        self.assertTrue(numpy.allclose(
+            metrics["framewise_displacement"],
+            [0, 5, 50 * numpy.radians(10.)]))
+        self.assertTrue(numpy.allclose(metrics["gradient_rotation"],
+                                       [0, 0, 10]))
+
+        # Check the saved table and summary
+        tsvfile, jsonfile = save_motion_metrics(
+            metrics, os.path.join(self.tmpdir, "motion.tsv"),
+            os.path.join(self.tmpdir, "motion.json"))
+        with open(tsvfile, "rt") as open_file:
+            lines = open_file.read().splitlines()
+        self.assertEqual(lines[0].split("\t"), MOTION_COLUMNS)
+        self.assertEqual(len(lines), 4)
+        with open(jsonfile, "rt") as open_file:
+            summary = json.load(open_file)
+        self.assertEqual(summary["nb_volumes"], 3)
+        self.assertAlmostEqual(summary["max_absolute_translation"], 3)
+
+    def test_warm_start(self):
+        """ Test the registration parameters seeded from a transformation.
+        """
+        # Decompose a rotation, scaling and shearing
+        affine = numpy.eye(4)
+        affine[:3, :3] = numpy.dot(self.transforms[2][1], [
+            [2., 0.2, 0.], [0., 1., 0.], [0., 0., 0.5]])
+        affine[:3, 3] = [1, 2, 3]
+        parameters = affine_parameters(affine)
+        self.assertAlmostEqual(parameters["RotationZ"], 10)
+        self.assertAlmostEqual(parameters["RotationX"], 0)
+        self.assertAlmostEqual(parameters["ScalingX"], 2)
+        self.assertAlmostEqual(parameters["ScalingZ"], 0.5)
+        self.assertAlmostEqual(parameters["ShearingXY"], 0.1)
+        self.assertAlmostEqual(parameters["TranslationZ"], 3)
+        self.assertTrue(numpy.allclose(parameters_affine(parameters), affine))
+        angles = {"RotationX": 20, "RotationY": -30, "RotationZ": 40}
+        rotated = dict(parameters, **angles)
+        for name, value in affine_parameters(
+                parameters_affine(rotated)).items():
+            self.assertAlmostEqual(value, rotated[name])
+
+        # Seed the registration parameters
+        registration_parameters = {
+            "maximumIterationCount": 1000,
+            "initializeCoefficientsUsingCenterOfGravity": True}
+        for name in parameters:
+            registration_parameters["initialParameters" + name] = 0
+            registration_parameters["optimizerParameters" + name] = 10
+        seeded = warm_start_registration(registration_parameters,
+                                         self.trms[2], search_scale=0.5,
+                                         iteration_count=200)
+        self.assertAlmostEqual(seeded["initialParametersRotationZ"], 10)
+        self.assertAlmostEqual(seeded["initialParametersTranslationY"], 2)
+        self.assertAlmostEqual(seeded["initialParametersScalingY"], 1)
+        self.assertEqual(seeded["optimizerParametersRotationX"], 5)
+        self.assertEqual(seeded["maximumIterationCount"], 200)
+        self.assertFalse(seeded["initializeCoefficientsUsingCenterOfGravity"])
+        self.assertEqual(registration_parameters["maximumIterationCount"],
+                         1000)
+
+        # By default the search ranges and iterations are reduced, they can
+        # be kept
+        seeded = warm_start_registration(registration_parameters,
+                                         self.trms[2])
+        self.assertAlmostEqual(seeded["optimizerParametersRotationX"], 2)
+        self.assertEqual(seeded["maximumIterationCount"], 200)
+        seeded = warm_start_registration(registration_parameters,
+                                         self.trms[2], search_scale=1,
+                                         iteration_count=None)
+        self.assertAlmostEqual(seeded["initialParametersRotationZ"], 10)
+        self.assertEqual(seeded["optimizerParametersRotationX"], 10)
+        self.assertEqual(seeded["maximumIterationCount"], 1000)
+
+        # A reflection or a missing parameter: no warm start
+        with open(self.trms[2], "wt") as open_file:
+            open_file.write("0 0 0\n-1 0 0\n0 1 0\n0 0 1\n")
+        with warnings.catch_warnings(record=True) as records:
+            warnings.simplefilter("always")
+            self.assertTrue(warm_start_registration(
+                registration_parameters, self.trms[2]) is
+                registration_parameters)
+            del registration_parameters["optimizerParametersShearingYZ"]
+            self.assertTrue(warm_start_registration(
+                registration_parameters, self.trms[0]) is
+                registration_parameters)
+        self.assertEqual(len(records), 2)
+
+    def test_registration_presets(self):
+        """ Test the registration presets.
+        """
+        parameters = {"levelCount": 32, "maximumIterationCount": 1000,
+                      "stepSize": 0.1, "subSamplingMaximumSizes": "64 256",
+                      "optimizerParametersRotationX": 5}
+        self.assertTrue(apply_registration_preset(parameters) is parameters)
+        self.assertRaises(ValueError, apply_registration_preset, parameters,
+                          "WRONG")
+        fast = apply_registration_preset(parameters, "fast")
+        self.assertEqual(fast["subSamplingMaximumSizes"], "64")
+        self.assertEqual(fast["maximumIterationCount"], 250)
+        self.assertEqual(fast["optimizerParametersRotationX"], 5)
+        self.assertFalse("maximumTolerance" in fast)
+        accurate = apply_registration_preset(parameters, "accurate")
+        self.assertEqual(accurate["subSamplingMaximumSizes"], "64 256")
+        self.assertEqual(accurate["levelCount"], 64)
+        self.assertEqual(parameters["levelCount"], 32)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -21,8 +21,16 @@ from .model import export_scalars_to_nifti
 from .mask import tractography_mask
 from .mask import export_mask_to_nifti
 from .tractography import tractography
+from .tractography import sharded_tractography
 from pyconnectomist.clustering.labeling import export_bundles_to_trk
+from pyconnectomist.clustering.labeling import export_bundles_to_trx
+from pyconnectomist.clustering.labeling import export_merged_bundles_to_trk
+from pyconnectomist.clustering.labeling import export_quicklook_bundles
+from pyconnectomist.utils.bundletools import compress_bundles
+from pyconnectomist.utils.bundletools import bundles_to_trx
 from pyconnectomist.clustering.labeling import fast_bundle_labeling
+from pyconnectomist.clustering.labeling import fit_labeling_memory_model
+from pyconnectomist.clustering.labeling import sharded_fast_bundle_labeling
 from pyconnectomist.preproc.all_steps import STEPS as PREPROC_STEPS
 
 
@@ -64,6 +72,17 @@ def complete_tractography(
         output_orientation_count=500,
         rgbscale=1.0,
         model_only=False,
+        nb_threads=1,
+        nb_tractography_shards=1,
+        nb_labeling_shards=1,
+        labeling_memory_budget=None,
+        labeling_memory_records=None,
+        merge_bundles=False,
+        export_trx=False,
+        trx_float16=False,
+        quicklook_tolerance=None,
+        quicklook_max_fibers=None,
+        morphologist_index=None,
         path_connectomist=DEFAULT_CONNECTOMIST_PATH):
     """ Function that runs all preprocessing tabs from Connectomist.
 
@@ -89,7 +108,12 @@ def complete_tractography(
 
     10 - Export tractography mask.
 
-    11 - Export bundels.
+    11 - Export bundels, optionally gathered in a single
+    '<outdir>/bundles.trk' file, and optionally the tractography and the
+    labeled bundles in TRX format: '<outdir>/tractography.trx' and
+    '<outdir>/bundles.trx'. Optionally export compressed quick look
+    versions of the tractography and the labeled bundles:
+    '<outdir>/tractography_quicklook.trk' and '<outdir>/quicklook'.
 
     Parameters
     ----------
@@ -160,6 +184,40 @@ def complete_tractography(
         the t1 map.
     model_only: bool (optional, default False)
         if True estimate only the diffusion model, skip steps 6, 7, 8, 10 ,11.
+    nb_threads: int (optional, default 1)
+        the number of threads used to export the labeled bundles.
+    nb_tractography_shards: int (optional, default 1)
+        if greater than 1, split the tractography mask in slabs tracked in
+        parallel.
+    nb_labeling_shards: int (optional, default 1)
+        if greater than 1, split the fibers to be labeled in shards run in
+        parallel.
+    labeling_memory_budget: int (optional, default None)
+        the memory in MB available for the labeling, shared between the
+        labeling shards: if specified, the number of fibers labeled at once
+        is derived from this value, otherwise 50000 fibers are labeled at
+        once.
+    labeling_memory_records: list of str (optional, default None)
+        the 'fiber_chunking.json' files of recorded labeling runs used to
+        fit the labeling memory model, mandatory with a
+        'labeling_memory_budget'.
+    merge_bundles: bool (optional, default False)
+        if True also export all the labeled bundles in a single Trackvis
+        file with a per-fiber bundle label.
+    export_trx: bool (optional, default False)
+        if True also export the tractography and the labeled bundles as
+        memory mappable TRX tractograms.
+    trx_float16: bool (optional, default False)
+        if True store the TRX fiber positions in half precision.
+    quicklook_tolerance: float (optional, default None)
+        if specified, export quick look tractograms where the fibers are
+        compressed with this maximum error in mm.
+    quicklook_max_fibers: int (optional, default None)
+        if specified, the maximum number of fibers randomly kept in each
+        quick look tractogram.
+    morphologist_index: MorphologistIndex (optional, default None)
+        an index of the Morphologist files shared by the steps, used instead
+        of listing the Morphologist directory.
     path_connectomist: str (optional)
         path to the Connectomist executable.
 
@@ -173,6 +231,21 @@ def complete_tractography(
     bundles: list of str
         the labeled fiber bundles.
     """
+    # Check input parameters: fail before computing the model and the mask
+    if (not model_only and nb_tractography_shards > 1 and
+            bundlemap != "aimsbundlemap"):
+        raise ConnectomistError(
+            "Only the 'aimsbundlemap' format can be merged, not "
+            "'{0}'.".format(bundlemap))
+    labeling_memory_model = None
+    if labeling_memory_budget is not None:
+        if not labeling_memory_records:
+            raise ConnectomistError(
+                "Recorded labeling runs are required to fit the memory model "
+                "used with a labeling memory budget.")
+        labeling_memory_model = fit_labeling_memory_model(
+            labeling_memory_records)
+
     # Step 1 - Create the tractography output directory if not existing
     if not os.path.isdir(outdir):
         os.mkdir(outdir)
@@ -229,12 +302,18 @@ def complete_tractography(
             morphologist_dir=morphologist_dir,
             add_cerebelum=add_cerebelum,
             add_commissures=add_commissures,
+            morphologist_index=morphologist_index,
             path_connectomist=path_connectomist)
 
     # Step 7 - The tractography algorithm
     if not model_only:
         tractography_dir = os.path.join(outdir, STEPS[2].format(tracking_type))
-        tractography(
+        tractography_kwargs = {}
+        tractography_func = tractography
+        if nb_tractography_shards > 1:
+            tractography_kwargs["nb_shards"] = nb_tractography_shards
+            tractography_func = sharded_tractography
+        tractography_func(
             tractography_dir,
             subject_id,
             mask_dir,
@@ -251,7 +330,8 @@ def complete_tractography(
             gibbs_temperature=gibbs_temperature,
             storing_increment=storing_increment,
             output_orientation_count=output_orientation_count,
-            path_connectomist=path_connectomist)
+            path_connectomist=path_connectomist,
+            **tractography_kwargs)
 
     # Step 8 - Fast bundle labeling
     if not model_only:
@@ -260,7 +340,15 @@ def complete_tractography(
             os.path.join(tractography_dir, "*.bundlesdata"))
         paths_bundle_map = [item.replace(".bundlesdata", ".bundles")
                             for item in paths_bundle_map]
-        fast_bundle_labeling(
+        labeling_kwargs = {}
+        labeling_func = fast_bundle_labeling
+        if nb_labeling_shards > 1:
+            labeling_kwargs["nb_shards"] = nb_labeling_shards
+            labeling_func = sharded_fast_bundle_labeling
+        if labeling_memory_budget is not None:
+            labeling_kwargs["memory_budget"] = labeling_memory_budget
+            labeling_kwargs["memory_model"] = labeling_memory_model
+        labeling_func(
             labeling_dir,
             registered_dwi_dir,
             morphologist_dir,
@@ -272,7 +360,9 @@ def complete_tractography(
             nb_fibers_to_process_at_once=50000,
             resample_fibers=True,
             remove_temporary_files=True,
-            path_connectomist=path_connectomist)
+            morphologist_index=morphologist_index,
+            path_connectomist=path_connectomist,
+            **labeling_kwargs)
 
     # Step 9 - Export diffusion scalars
     scalars = export_scalars_to_nifti(model_dir, model, outdir)
@@ -285,6 +375,24 @@ def complete_tractography(
     # Step 11 - Export bundels
     bundles = None
     if not model_only:
-        bundles = export_bundles_to_trk(labeling_dir, outdir)
+        bundles = export_bundles_to_trk(labeling_dir, outdir,
+                                        nb_threads=nb_threads)
+        if merge_bundles:
+            export_merged_bundles_to_trk(labeling_dir, outdir)
+        if export_trx:
+            bundles_to_trx(paths_bundle_map,
+                           os.path.join(outdir, "tractography.trx"),
+                           reference=mask, float16=trx_float16)
+            export_bundles_to_trx(labeling_dir, outdir, reference=mask,
+                                  float16=trx_float16)
+        if quicklook_tolerance is not None:
+            compress_bundles(
+                paths_bundle_map,
+                os.path.join(outdir, "tractography_quicklook.trk"),
+                tolerance=quicklook_tolerance,
+                max_fibers=quicklook_max_fibers)
+            export_quicklook_bundles(
+                labeling_dir, outdir, tolerance=quicklook_tolerance,
+                max_fibers=quicklook_max_fibers, nb_threads=nb_threads)
 
     return scalars, mask, bundles
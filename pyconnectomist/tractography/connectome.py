@@ -0,0 +1,246 @@
+##########################################################################
+# NSAp - Copyright (C) CEA, 2016
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html for details.
+##########################################################################
+
+"""
+Build structural connectivity matrices from the Connectomist tractography
+bundle maps and a parcellation.
+"""
+
+# System import
+import os
+import numpy
+import nibabel
+
+# pyConnectomist import
+from pyconnectomist.exceptions import ConnectomistBadFileError
+from pyconnectomist.exceptions import ConnectomistError
+from pyconnectomist.utils.filetools import load_gis
+from pyconnectomist.utils.bundletools import iter_bundles
+from pyconnectomist.utils.bundletools import fiber_lengths
+from pyconnectomist.utils.regtools import connectomist_orientation
+
+
+def load_volume(path):
+    """ Load a Nifti or GIS volume in the Connectomist voxel order.
+
+    Connectomist images are stored in the LPI orientation, the first voxel
+    being at the origin of the Connectomist space. A Nifti image is
+    reoriented to this voxel order using its affine: the image must then be
+    defined on the Connectomist image grid, as the images exported from
+    Connectomist, and an oblique image is rejected.
+
+    Parameters
+    ----------
+    path: str
+        path to the '.nii', '.nii.gz' or '.ima' image.
+
+    Returns
+    -------
+    data: array (X, Y, Z)
+        the image voxels in the Connectomist voxel order.
+    voxel_sizes: 3-uplet
+        the voxel sizes in mm.
+    """
+    if not os.path.isfile(path):
+        raise ConnectomistBadFileError(path)
+    if path.endswith(".ima"):
+        data, voxel_sizes = load_gis(path)
+    else:
+        image = nibabel.load(path)
+        data = numpy.asanyarray(image.dataobj)
+        voxel_sizes = image.header.get_zooms()[:3]
+        to_connectomist = connectomist_orientation(image.affine)
+        if to_connectomist is None:
+            raise ConnectomistError(
+                "'{0}' is an oblique image: it is not defined on the "
+                "Connectomist image grid.".format(path))
+        data = nibabel.orientations.apply_orientation(data, to_connectomist)
+        voxel_sizes = [voxel_sizes[int(axis)]
+                       for axis in numpy.argsort(to_connectomist[:, 0])]
+    if data.ndim == 4 and data.shape[3] == 1:
+        data = data[..., 0]
+    if data.ndim != 3:
+        raise ConnectomistBadFileError(path)
+
+    return data, tuple(voxel_sizes[:3])
+
+
+def voxel_lookup(points, volume, voxel_sizes, fill_value=0):
+    """ Get the volume values at some points with a nearest neighbour
+    interpolation.
+
+    Parameters
+    ----------
+    points: array (N, 3)
+        the points coordinates in mm in the Connectomist space, ie. the voxel
+        center indices scaled by the voxel sizes.
+    volume: array (X, Y, Z)
+        the image voxels in the Connectomist voxel order.
+    voxel_sizes: 3-uplet
+        the voxel sizes in mm.
+    fill_value: number (optional, default 0)
+        the value returned for points outside the volume.
+
+    Returns
+    -------
+    values: array (N, )
+        the volume values.
+    """
+    indices = numpy.round(
+        numpy.asarray(points) / numpy.asarray(voxel_sizes)).astype(int)
+    inside = numpy.all((indices >= 0) & (indices < volume.shape), axis=1)
+    values = numpy.empty((len(indices), ), dtype=volume.dtype)
+    values.fill(fill_value)
+    values[inside] = volume[tuple(indices[inside].T)]
+
+    return values
+
+
+def compute_connectome(bundlefiles, label_file, scalar_file=None,
+                       chunk_size=100000):
+    """ Compute the structural connectivity matrices.
+
+    The fiber endpoints are mapped to the parcellation labels with a
+    vectorized voxel lookup, the bundle maps being processed by chunks of
+    fibers. The fibers with an endpoint outside a labeled region are
+    discarded.
+
+    The parcellation and the optional scalar map must be defined on the
+    tractography voxel grid (for instance an image in the Connectomist
+    diffusion space): a Nifti image is reoriented in the Connectomist voxel
+    order using its affine, then the fiber coordinates in mm are converted
+    in voxel indices using the image voxel sizes.
+
+    Parameters
+    ----------
+    bundlefiles: list of str
+        path to the '.bundles' header files.
+    label_file: str
+        path to the parcellation, a Nifti or GIS image where 0 is the
+        background.
+    scalar_file: str (optional, default None)
+        path to a Nifti or GIS scalar map averaged along the fibers.
+    chunk_size: int (optional, default 100000)
+        the number of fibers processed at once.
+
+    Returns
+    -------
+    labels: array (N, )
+        the parcellation labels associated to the matrices rows/columns.
+    matrices: dict
+        the symmetric (N, N) 'count', 'mean_length' and, if a scalar map is
+        specified, 'mean_scalar' connectivity matrices.
+    """
+    # Load the parcellation
+    label_data, voxel_sizes = load_volume(label_file)
+    labels = numpy.unique(label_data)
+    labels = labels[labels != 0]
+    nb_labels = len(labels)
+    scalar_data = None
+    if scalar_file is not None:
+        scalar_data, scalar_voxel_sizes = load_volume(scalar_file)
+
+    # Accumulate the fiber counts, lengths and scalars for each edge
+    count = numpy.zeros((nb_labels * nb_labels, ), dtype=numpy.float64)
+    length = numpy.zeros((nb_labels * nb_labels, ), dtype=numpy.float64)
+    scalar = numpy.zeros((nb_labels * nb_labels, ), dtype=numpy.float64)
+    for bundlefile in bundlefiles:
+        for points, offsets in iter_bundles(bundlefile, chunk_size):
+
+            # Map the endpoints to the labels: the empty fibers are
+            # discarded
+            if len(points) == 0:
+                continue
+            counts = numpy.diff(offsets)
+            valid = counts > 0
+            ends = numpy.concatenate((offsets[:-1], offsets[1:] - 1))
+            ends[numpy.concatenate((~valid, ~valid))] = 0
+            end_labels = voxel_lookup(points[ends], label_data, voxel_sizes)
+            end_indices = numpy.searchsorted(labels, end_labels)
+            end_indices[end_labels == 0] = -1
+            end_indices = end_indices.reshape(2, -1)
+            valid &= numpy.all(end_indices >= 0, axis=0)
+            first = numpy.min(end_indices[:, valid], axis=0)
+            second = numpy.max(end_indices[:, valid], axis=0)
+            edges = first * nb_labels + second
+
+            # Accumulate the edge statistics
+            count += numpy.bincount(edges, minlength=nb_labels * nb_labels)
+            length += numpy.bincount(
+                edges, weights=fiber_lengths(points, offsets)[valid],
+                minlength=nb_labels * nb_labels)
+            if scalar_data is not None:
+                point_scalars = voxel_lookup(
+                    points, scalar_data, scalar_voxel_sizes).astype(float)
+                fiber_ids = numpy.repeat(numpy.arange(len(counts)), counts)
+                fiber_scalars = numpy.bincount(
+                    fiber_ids, weights=point_scalars, minlength=len(counts))
+                fiber_scalars[counts > 0] /= counts[counts > 0]
+                scalar += numpy.bincount(
+                    edges, weights=fiber_scalars[valid],
+                    minlength=nb_labels * nb_labels)
+
+    # Build the symmetric matrices
+    matrices = {}
+    connected = count > 0
+    for name, values in (("count", count), ("mean_length", length),
+                         ("mean_scalar", scalar)):
+        if name == "mean_scalar" and scalar_data is None:
+            continue
+        if name != "count":
+            values[connected] /= count[connected]
+        matrix = values.reshape(nb_labels, nb_labels)
+        matrix = matrix + numpy.triu(matrix, 1).T
+        matrices[name] = matrix
+
+    return labels, matrices
+
+
+def connectome(bundlefiles, label_file, outdir, scalar_file=None,
+               chunk_size=100000):
+    """ Compute and save the structural connectivity matrices.
+
+    Parameters
+    ----------
+    bundlefiles: list of str
+        path to the '.bundles' header files.
+    label_file: str
+        path to the parcellation, a Nifti or GIS image where 0 is the
+        background.
+    outdir: str
+        path to the destination folder.
+    scalar_file: str (optional, default None)
+        path to a Nifti or GIS scalar map averaged along the fibers.
+    chunk_size: int (optional, default 100000)
+        the number of fibers processed at once.
+
+    Returns
+    -------
+    labels_file: str
+        path to the parcellation labels associated to the matrices
+        rows/columns.
+    matrix_files: dict
+        path to the 'count', 'mean_length' and optionally 'mean_scalar'
+        connectivity matrices.
+    """
+    # Compute the matrices
+    labels, matrices = compute_connectome(
+        bundlefiles, label_file, scalar_file=scalar_file,
+        chunk_size=chunk_size)
+
+    # Save the result
+    if not os.path.isdir(outdir):
+        os.mkdir(outdir)
+    labels_file = os.path.join(outdir, "connectome_labels.txt")
+    numpy.savetxt(labels_file, labels, fmt="%d")
+    matrix_files = {}
+    for name, matrix in matrices.items():
+        matrix_files[name] = os.path.join(
+            outdir, "connectome_{0}.txt".format(name))
+        numpy.savetxt(matrix_files[name], matrix)
+
+    return labels_file, matrix_files
@@ -0,0 +1,264 @@
+##########################################################################
+# NSAp - Copyright (C) CEA, 2016
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html for details.
+##########################################################################
+
+"""
+In-process second order tensor estimation from the Connectomist eddy current
+and motion corrected diffusion data.
+"""
+
+# System import
+import os
+import numpy
+
+# pyConnectomist import
+from pyconnectomist.exceptions import ConnectomistBadFileError
+from pyconnectomist.exceptions import ConnectomistError
+from pyconnectomist.utils.filetools import load_gis
+from pyconnectomist.utils.filetools import parse_dict_file
+from pyconnectomist.utils.filetools import save_gis
+from pyconnectomist.utils.filetools import ptk_gis_to_nifti
+from pyconnectomist.utils.paralleltools import parallel_map
+from .model import DTI_ESTIMATOR_MAP
+
+# The smallest diffusivity in mm2/s kept by the 'positive' estimator
+MIN_DIFFUSIVITY = 1e-9
+
+# The smallest signal used in the log-linear fit
+MIN_SIGNAL = 1e-3
+
+
+def design_matrix(bvals, bvecs):
+    """ Create the log-linear tensor model design matrix.
+
+    The log signal is modeled as 'ln(S0) - b g^T D g': the unknowns are the
+    (Dxx, Dyy, Dzz, Dxy, Dxz, Dyz) tensor coefficients and ln(S0).
+
+    Parameters
+    ----------
+    bvals: array (N, )
+        the diffusion b-values in s/mm2.
+    bvecs: array (N, 3)
+        the unit diffusion gradient orientations.
+
+    Returns
+    -------
+    design: array (N, 7)
+        the design matrix.
+    """
+    bvals = numpy.asarray(bvals, dtype=numpy.float64)
+    bvecs = numpy.asarray(bvecs, dtype=numpy.float64)
+    x, y, z = bvecs.T
+    design = numpy.stack((
+        x * x, y * y, z * z, 2 * x * y, 2 * x * z, 2 * y * z), axis=1)
+    design *= -bvals[:, numpy.newaxis]
+
+    return numpy.concatenate((design, numpy.ones((len(bvals), 1))), axis=1)
+
+
+def fit_tensors(signals, design, dti_estimator="linear"):
+    """ Fit the tensor model on a batch of voxels.
+
+    The 'linear' estimator solves the ordinary least squares problem on the
+    log signal. The 'positive' estimator solves the weighted least squares
+    problem, the weights being the squared signals predicted by the ordinary
+    fit, then clips the eigenvalues to 'MIN_DIFFUSIVITY' so that the tensors
+    are positive definite: this is not a constrained fit, the clipped
+    tensors are not the best positive definite tensors fitting the signal.
+
+    Parameters
+    ----------
+    signals: array (V, N)
+        the diffusion signals of V voxels.
+    design: array (N, 7)
+        the log-linear design matrix.
+    dti_estimator: str (optional, default 'linear')
+        the tensor fitting method: 'linear' or 'positive'.
+
+    Returns
+    -------
+    evals: array (V, 3)
+        the tensor eigenvalues in decreasing order.
+    evecs: array (V, 3, 3)
+        the associated eigenvectors stored in columns.
+    """
+    # Ordinary least squares on the log signal
+    log_signals = numpy.log(numpy.maximum(
+        numpy.asarray(signals, dtype=numpy.float64), MIN_SIGNAL))
+    params = numpy.dot(log_signals, numpy.linalg.pinv(design).T)
+
+    # Weighted least squares: solve all the voxel normal equations at once
+    if dti_estimator == "positive":
+        weights = numpy.exp(2 * numpy.dot(params, design.T))
+        normal = numpy.einsum("vn,ni,nj->vij", weights, design, design)
+        rhs = numpy.einsum("vn,ni,vn->vi", weights, design, log_signals)
+        solvable = numpy.abs(numpy.linalg.det(normal)) > 0
+        params[solvable] = numpy.linalg.solve(
+            normal[solvable], rhs[solvable][..., numpy.newaxis])[..., 0]
+
+    # Diagonalize the tensors
+    tensors = params[:, [0, 3, 4, 3, 1, 5, 4, 5, 2]].reshape(-1, 3, 3)
+    evals, evecs = numpy.linalg.eigh(tensors)
+    evals = evals[:, ::-1]
+    evecs = evecs[:, :, ::-1]
+    if dti_estimator == "positive":
+        evals = numpy.maximum(evals, MIN_DIFFUSIVITY)
+
+    return evals, evecs
+
+
+def tensor_scalars(evals, evecs):
+    """ Compute the tensor scalar maps.
+
+    Parameters
+    ----------
+    evals: array (V, 3)
+        the tensor eigenvalues in decreasing order.
+    evecs: array (V, 3, 3)
+        the associated eigenvectors stored in columns.
+
+    Returns
+    -------
+    scalars: dict
+        the 'fa', 'mean_diffusivity', 'lambda_parallel' (axial diffusivity),
+        'lambda_transverse' (radial diffusivity) (V, ) arrays and the 'v1'
+        (V, 3) principal direction array.
+    """
+    mean = evals.mean(axis=1)
+    norms = numpy.sqrt(numpy.sum(evals ** 2, axis=1))
+    fa = numpy.zeros_like(mean)
+    numpy.divide(
+        numpy.sqrt(1.5 * numpy.sum((evals - mean[:, numpy.newaxis]) ** 2,
+                                   axis=1)),
+        norms, out=fa, where=norms > 0)
+
+    return {
+        "fa": fa,
+        "mean_diffusivity": mean,
+        "lambda_parallel": evals[:, 0],
+        "lambda_transverse": evals[:, 1:].mean(axis=1),
+        "v1": evecs[:, :, 0]}
+
+
+def dti_fit(
+        outdir,
+        eddy_motion_dir,
+        rough_mask_dir,
+        dti_estimator="linear",
+        chunk_size=10000,
+        nb_processes=1):
+    """ Estimate the second order tensor model in-process and export the
+    tensor scalar maps in Nifti format.
+
+    The masked voxels are fitted by chunks dispatched on a pool of processes.
+    The maps are written in the GIS format, then converted in Nifti format
+    with the Connectomist converter as the Connectomist model scalars, so
+    that both exports share the same orientation and affine.
+
+    Parameters
+    ----------
+    outdir: str
+        path to directory where to output:
+        <outdir>/dti_<name>.nii.gz
+    eddy_motion_dir: str
+        path to Connectomist eddy motion correction directory.
+    rough_mask_dir: str
+        path to Connectomist rough mask directory.
+    dti_estimator: str (optional default 'linear')
+        the second order tensor fitting method: 'linear' or 'positive'.
+        The second method is a weighted least squares fit followed by an
+        eigenvalue clipping that generates positive definite tensors.
+    chunk_size: int (optional, default 10000)
+        the number of voxels fitted at once.
+    nb_processes: int (optional, default 1)
+        the number of chunks fitted in parallel.
+
+    Returns
+    -------
+    scalars: dict
+        the 'fa', 'mean_diffusivity', 'lambda_parallel', 'lambda_transverse'
+        and 'v1' Nifti images.
+    """
+    # Get Connectomist eddy current and motion correction result files
+    # and check existance
+    t2file = os.path.join(eddy_motion_dir, "t2_wo_eddy_current_and_motion.ima")
+    dwifile = os.path.join(eddy_motion_dir,
+                           "dw_wo_eddy_current_and_motion.ima")
+    maskfile = os.path.join(rough_mask_dir, "mask.ima")
+    for fpath in (t2file, dwifile, dwifile + ".minf", maskfile):
+        if not os.path.isfile(fpath):
+            raise ConnectomistBadFileError(fpath)
+
+    # Check input parameters
+    if dti_estimator not in DTI_ESTIMATOR_MAP:
+        raise ConnectomistError(
+            "'{0}' dti estimator not supported (must be in {1}).".format(
+                dti_estimator, DTI_ESTIMATOR_MAP.keys()))
+
+    # Build the design matrix: the T2 volume is the b=0 volume
+    attributes = parse_dict_file(dwifile + ".minf").get("attributes", {})
+    for key in ("bvalues", "diffusion_gradient_orientations"):
+        if key not in attributes:
+            raise ConnectomistBadFileError(dwifile + ".minf")
+    bvecs = numpy.array(attributes["diffusion_gradient_orientations"],
+                        dtype=float)
+    norms = numpy.linalg.norm(bvecs, axis=1)
+    bvecs[norms > 0] /= norms[norms > 0, numpy.newaxis]
+    design = design_matrix(
+        numpy.concatenate(([0], attributes["bvalues"])),
+        numpy.concatenate(([[0, 0, 0]], bvecs)))
+
+    # Load the data
+    t2, voxel_sizes = load_gis(t2file)
+    dwi, _ = load_gis(dwifile)
+    mask, _ = load_gis(maskfile)
+    if dwi.ndim == 3:
+        dwi = dwi[..., numpy.newaxis]
+    if (t2.shape != mask.shape or dwi.shape[:3] != mask.shape or
+            dwi.shape[3] != len(design) - 1):
+        raise ConnectomistError(
+            "The eddy current and motion corrected data do not match the "
+            "rough mask or the diffusion gradients.")
+
+    # Fit the masked voxels by chunks
+    voxels = numpy.argwhere(mask > 0)
+    chunks = [
+        (numpy.concatenate((
+            t2[tuple(coords.T)][:, numpy.newaxis],
+            dwi[tuple(coords.T)]), axis=1), design, dti_estimator)
+        for coords in (voxels[start: start + chunk_size]
+                       for start in range(0, len(voxels), chunk_size))]
+    results = parallel_map(_fit_tensors, chunks, nb_workers=nb_processes,
+                           use_processes=True)
+
+    # Save the result
+    if not os.path.isdir(outdir):
+        os.mkdir(outdir)
+    scalars = {}
+    for name in ("fa", "mean_diffusivity", "lambda_parallel",
+                 "lambda_transverse", "v1"):
+        shape = mask.shape + ((3, ) if name == "v1" else ())
+        data = numpy.zeros(shape, dtype=numpy.float32)
+        if len(results) > 0:
+            data[tuple(voxels.T)] = numpy.concatenate(
+                [result[name] for result in results])
+        gis_file = save_gis(
+            os.path.join(outdir, "dti_{0}.ima".format(name)), data,
+            tuple(voxel_sizes[:3]))
+        scalars[name] = ptk_gis_to_nifti(
+            gis_file, os.path.join(outdir, "dti_{0}.nii.gz".format(name)))
+        for path in (gis_file, gis_file[:-4] + ".dim"):
+            os.remove(path)
+
+    return scalars
+
+
+def _fit_tensors(chunk):
+    """ Fit the tensors and compute the scalars of a chunk described by a
+    (signals, design, dti_estimator) 3-uplet.
+    """
+    signals, design, dti_estimator = chunk
+    return tensor_scalars(*fit_tensors(signals, design, dti_estimator))
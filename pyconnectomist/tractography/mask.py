@@ -33,6 +33,7 @@ def tractography_mask(
         morphologist_dir,
         add_cerebelum=False,
         add_commissures=True,
+        morphologist_index=None,
         path_connectomist=DEFAULT_CONNECTOMIST_PATH):
     """ Tractography mask computation.
 
@@ -50,6 +51,9 @@ def tractography_mask(
         if True add the cerebelum to the tractography mask.
     add_commissures: bool (optional, default False)
         if True add the commissures to the tractography mask.
+    morphologist_index: MorphologistIndex (optional, default None)
+        an index of the Morphologist files used instead of listing the
+        Morphologist directory.
     path_connectomist: str (optional)
         path to the Connectomist executable.
 
@@ -62,7 +66,10 @@ def tractography_mask(
     apcpattern = os.path.join(
         morphologist_dir, subject_id, "t1mri", "*",
         "{0}.APC".format(subject_id))
-    apcfiles = glob.glob(apcpattern)
+    if morphologist_index is not None:
+        apcfiles = morphologist_index.find(subject_id, "apc")
+    else:
+        apcfiles = glob.glob(apcpattern)
     if len(apcfiles) != 1 or not os.path.isfile(apcfiles[0]):
         raise ConnectomistBadFileError(apcpattern)
     apcfile = apcfiles[0]
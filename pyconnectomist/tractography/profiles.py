@@ -0,0 +1,226 @@
+##########################################################################
+# NSAp - Copyright (C) CEA, 2016
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html for details.
+##########################################################################
+
+"""
+Sample the diffusion scalar maps along the bundles labeled by Connectomist.
+"""
+
+# System import
+import os
+import glob
+import numpy
+
+# pyConnectomist import
+from pyconnectomist.exceptions import ConnectomistError
+from pyconnectomist.utils.bundletools import iter_bundles
+from pyconnectomist.utils.bundletools import resample_fibers
+from pyconnectomist.utils.paralleltools import parallel_map
+from .connectome import load_volume
+
+
+def trilinear_interpolation(volume, voxel_sizes, points):
+    """ Interpolate a volume at some points.
+
+    Parameters
+    ----------
+    volume: array (X, Y, Z)
+        the image voxels.
+    voxel_sizes: 3-uplet
+        the voxel sizes in mm.
+    points: array (N, 3)
+        the points coordinates in mm in the Connectomist space, ie. the voxel
+        indices scaled by the voxel sizes.
+
+    Returns
+    -------
+    values: array (N, )
+        the interpolated values, NaN outside the volume.
+    """
+    # Get the voxel coordinates, the points on the border are interpolated
+    # with the nearest inner voxels
+    coords = numpy.asarray(points, dtype=numpy.float64) / voxel_sizes
+    shape = numpy.asarray(volume.shape)
+    inside = numpy.all((coords >= -0.5) & (coords <= shape - 0.5), axis=1)
+    coords = numpy.clip(coords, 0, shape - 1)
+    lower = numpy.minimum(numpy.floor(coords).astype(int),
+                          numpy.maximum(shape - 2, 0))
+    upper = numpy.minimum(lower + 1, shape - 1)
+    weights = coords - lower
+
+    # Accumulate the 8 corner contributions
+    values = numpy.zeros((len(coords), ), dtype=numpy.float64)
+    for corner in range(8):
+        use_upper = [(corner >> axis) & 1 for axis in range(3)]
+        indices = tuple(
+            upper[:, axis] if use_upper[axis] else lower[:, axis]
+            for axis in range(3))
+        corner_weights = numpy.prod([
+            weights[:, axis] if use_upper[axis] else 1 - weights[:, axis]
+            for axis in range(3)], axis=0)
+        values += corner_weights * volume[indices]
+    values[~inside] = numpy.nan
+
+    return values
+
+
+def align_fibers(fibers, reference):
+    """ Flip the fibers so that they all run in the reference direction.
+
+    Parameters
+    ----------
+    fibers: array (F, K, 3)
+        the resampled fibers.
+    reference: array (K, 3)
+        the reference resampled fiber.
+
+    Returns
+    -------
+    aligned: array (F, K, 3)
+        the aligned fibers.
+    """
+    direct = numpy.sum((fibers - reference) ** 2, axis=(1, 2))
+    flipped = numpy.sum((fibers[:, ::-1] - reference) ** 2, axis=(1, 2))
+    aligned = fibers.copy()
+    to_flip = flipped < direct
+    aligned[to_flip] = fibers[to_flip, ::-1]
+
+    return aligned
+
+
+def bundle_profiles(bundlefile, scalars, nb_points=20, chunk_size=10000):
+    """ Compute the mean and standard deviation profiles of scalar maps
+    along a bundle.
+
+    Each fiber is resampled on 'nb_points' points, oriented like the first
+    fiber of the bundle, and the scalar maps are trilinearly interpolated
+    at all the points of a chunk of fibers at once.
+
+    Parameters
+    ----------
+    bundlefile: str
+        path to the '.bundles' header file.
+    scalars: dict
+        the scalar maps as (data, voxel_sizes) 2-uplets, defined on the
+        tractography voxel grid.
+    nb_points: int (optional, default 20)
+        the number of points of the profiles.
+    chunk_size: int (optional, default 10000)
+        the number of fibers processed at once.
+
+    Returns
+    -------
+    profiles: dict
+        for each scalar map, the mean and standard deviation profiles as
+        (nb_points, ) arrays, NaN where no fiber sample is available.
+    """
+    # Accumulate the scalar sums and squared sums at each profile point
+    sums = dict((name, numpy.zeros((nb_points, ))) for name in scalars)
+    squares = dict((name, numpy.zeros((nb_points, ))) for name in scalars)
+    counts = dict((name, numpy.zeros((nb_points, ))) for name in scalars)
+    reference = None
+    for points, offsets in iter_bundles(bundlefile, chunk_size):
+        valid = numpy.diff(offsets) > 0
+        offsets = numpy.concatenate((offsets[:1], offsets[1:][valid]))
+        fibers = resample_fibers(points, offsets, nb_points)
+        if len(fibers) == 0:
+            continue
+        if reference is None:
+            reference = fibers[0]
+        fibers = align_fibers(fibers, reference)
+        for name, (data, voxel_sizes) in scalars.items():
+            values = trilinear_interpolation(
+                data, voxel_sizes, fibers.reshape(-1, 3))
+            values = values.reshape(-1, nb_points)
+            sampled = ~numpy.isnan(values)
+            values[~sampled] = 0
+            sums[name] += values.sum(axis=0)
+            squares[name] += (values ** 2).sum(axis=0)
+            counts[name] += sampled.sum(axis=0)
+
+    # Compute the profiles
+    profiles = {}
+    for name in scalars:
+        mean = numpy.empty((nb_points, ))
+        std = numpy.empty((nb_points, ))
+        mean.fill(numpy.nan)
+        std.fill(numpy.nan)
+        sampled = counts[name] > 0
+        mean[sampled] = sums[name][sampled] / counts[name][sampled]
+        variance = squares[name][sampled] / counts[name][sampled]
+        variance -= mean[sampled] ** 2
+        std[sampled] = numpy.sqrt(numpy.maximum(variance, 0))
+        profiles[name] = (mean, std)
+
+    return profiles
+
+
+def tract_profiles(labeling_dir, scalar_files, outfile=None, nb_points=20,
+                   chunk_size=10000, nb_threads=1):
+    """ Compute the scalar profiles of each bundle labeled by Connectomist
+    and write them in a tab separated table, one row per bundle, scalar and
+    profile point.
+
+    Parameters
+    ----------
+    labeling_dir: str
+        path to the Connectomist 'Labeling' directory.
+    scalar_files: dict
+        the scalar map names and paths to the Nifti or GIS images, as
+        returned by 'export_scalars_to_nifti'.
+    outfile: str (optional, default None)
+        path to the output table. By default the table is written in
+        '<labeling_dir>/tract_profiles.tsv'.
+    nb_points: int (optional, default 20)
+        the number of points of the profiles.
+    chunk_size: int (optional, default 10000)
+        the number of fibers processed at once.
+    nb_threads: int (optional, default 1)
+        the number of bundles processed in parallel.
+
+    Returns
+    -------
+    outfile: str
+        path to the tract profiles table.
+    """
+    # Get the labeled bundles
+    bundlefiles = sorted(glob.glob(os.path.join(
+        labeling_dir, "bundleMapsReferential", "*", "*.bundles")))
+    if len(bundlefiles) == 0:
+        raise ConnectomistError(
+            "No labeled bundle found in '{0}'.".format(labeling_dir))
+
+    # Load the scalar maps once and compute the profiles
+    scalars = dict((name, load_volume(path))
+                   for name, path in scalar_files.items())
+    all_profiles = parallel_map(
+        _bundle_profiles,
+        [(path, scalars, nb_points, chunk_size) for path in bundlefiles],
+        nb_workers=nb_threads)
+
+    # Write the table
+    if outfile is None:
+        outfile = os.path.join(labeling_dir, "tract_profiles.tsv")
+    with open(outfile, "wt") as open_file:
+        open_file.write("region\tbundle\tscalar\tpoint\tmean\tstd\n")
+        for path, profiles in zip(bundlefiles, all_profiles):
+            region = os.path.basename(os.path.dirname(path))
+            bundle = os.path.basename(path).split(".")[0]
+            for name in sorted(profiles):
+                mean, std = profiles[name]
+                for index in range(nb_points):
+                    open_file.write("{0}\t{1}\t{2}\t{3}\t{4}\t{5}\n".format(
+                        region, bundle, name, index, mean[index],
+                        std[index]))
+
+    return outfile
+
+
+def _bundle_profiles(args):
+    """ Compute the profiles of a bundle described by a (bundlefile,
+    scalars, nb_points, chunk_size) 4-uplet.
+    """
+    return bundle_profiles(*args)
@@ -0,0 +1,290 @@
+##########################################################################
+# NSAp - Copyright (C) CEA, 2016
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html for details.
+##########################################################################
+
+"""
+Voxel to streamline inverted index used to answer the ROI queries on a
+Connectomist bundle map without scanning the fibers again.
+"""
+
+# System import
+import os
+import numpy
+
+# pyConnectomist import
+from pyconnectomist.exceptions import ConnectomistBadFileError
+from pyconnectomist.utils.bundletools import read_bundles_header
+from pyconnectomist.utils.bundletools import iter_bundles
+from .connectome import load_volume
+
+
+class StreamlineIndex(object):
+    """ Map each voxel of the tractography grid to the IDs of the
+    streamlines crossing it.
+
+    The index is stored in a compressed sparse row layout: the streamline
+    IDs crossing the voxel of flat index 'v' are
+    'indices[indptr[v]: indptr[v + 1]]', sorted in increasing order.
+    A streamline crosses a voxel if one of its points lies in this voxel,
+    each fiber segment being supersampled with a step below half a voxel
+    so that the voxels crossed between two fiber points are indexed (a
+    voxel whose corner only is clipped by a segment may still be missed).
+    """
+    suffix = "_index.npz"
+
+    def __init__(self, indptr, indices, shape, voxel_sizes, nb_streamlines):
+        """ Initialize the StreamlineIndex class.
+
+        Parameters
+        ----------
+        indptr: array (X * Y * Z + 1, )
+            the offsets of each voxel streamline IDs.
+        indices: array (N, )
+            the streamline IDs of all the voxels.
+        shape: 3-uplet
+            the tractography grid shape.
+        voxel_sizes: 3-uplet
+            the tractography grid voxel sizes in mm.
+        nb_streamlines: int
+            the number of streamlines in the bundle map.
+        """
+        self.indptr = numpy.asarray(indptr, dtype=numpy.int64)
+        self.indices = numpy.asarray(indices, dtype=numpy.int64)
+        self.shape = tuple(int(size) for size in shape)
+        self.voxel_sizes = tuple(float(size) for size in voxel_sizes)
+        self.nb_streamlines = int(nb_streamlines)
+        if len(self.indptr) != numpy.prod(self.shape) + 1:
+            raise ValueError("The index offsets do not match the grid "
+                             "shape '{0}'.".format(self.shape))
+
+    @classmethod
+    def from_bundles(cls, bundlefile, mask_file, chunk_size=100000,
+                     cache=True):
+        """ Create the index of a Connectomist bundle map.
+
+        When caching is enabled the index is stored next to the bundle map
+        in a '<bundlemap>_index.npz' file and reused as long as the bundle
+        map and the mask are not modified.
+
+        Parameters
+        ----------
+        bundlefile: str
+            path to the '.bundles' header file.
+        mask_file: str
+            path to the tractography mask, a Nifti or GIS image defining the
+            index grid.
+        chunk_size: int (optional, default 100000)
+            the number of fibers processed at once.
+        cache: bool (optional, default True)
+            if True, store and reuse the index.
+
+        Returns
+        -------
+        index: StreamlineIndex
+            the streamline index.
+        """
+        # Check the cache: the sources are identified by their path,
+        # modification time and size
+        header, datafile = read_bundles_header(bundlefile)
+        if not os.path.isfile(mask_file):
+            raise ConnectomistBadFileError(mask_file)
+        cachefile = cls.indexname(bundlefile)
+        sources = numpy.array([
+            "{0}:{1}:{2}".format(os.path.abspath(path),
+                                 os.path.getmtime(path),
+                                 os.path.getsize(path))
+            for path in (bundlefile, datafile, mask_file)])
+        if cache and os.path.isfile(cachefile):
+            index = cls.load(cachefile)
+            if numpy.array_equal(index.sources, sources):
+                return index
+
+        # Get the (voxel, streamline) pairs of each chunk: the pairs are
+        # unique and sorted by voxel then by streamline
+        mask, voxel_sizes = load_volume(mask_file)
+        shape = numpy.asarray(mask.shape)
+        nb_streamlines = int(header["curves_count"])
+        voxels = []
+        streamlines = []
+        first = 0
+        for points, offsets in iter_bundles(bundlefile, chunk_size):
+            nb_fibers = len(offsets) - 1
+            fiber_ids = numpy.repeat(
+                numpy.arange(first, first + nb_fibers), numpy.diff(offsets))
+            first += nb_fibers
+            coords, fiber_ids = supersample_segments(
+                points / numpy.asarray(voxel_sizes), fiber_ids)
+            coords = numpy.round(coords).astype(numpy.int64)
+            inside = numpy.all((coords >= 0) & (coords < shape), axis=1)
+            flat = numpy.ravel_multi_index(tuple(coords[inside].T), mask.shape)
+            pairs = numpy.unique(flat * nb_streamlines + fiber_ids[inside])
+            voxels.append(pairs // nb_streamlines)
+            streamlines.append(pairs % nb_streamlines)
+
+        # Merge the chunks: a stable sort keeps the streamline IDs sorted
+        # within each voxel
+        voxels = numpy.concatenate(voxels or [numpy.zeros((0, ), int)])
+        streamlines = numpy.concatenate(
+            streamlines or [numpy.zeros((0, ), int)])
+        order = numpy.argsort(voxels, kind="mergesort")
+        indptr = numpy.zeros((mask.size + 1, ), dtype=numpy.int64)
+        numpy.cumsum(numpy.bincount(voxels, minlength=mask.size),
+                     out=indptr[1:])
+        index = cls(indptr, streamlines[order], mask.shape, voxel_sizes,
+                    nb_streamlines)
+        index.sources = sources
+        if cache:
+            index.save(cachefile)
+
+        return index
+
+    @classmethod
+    def indexname(cls, bundlefile):
+        """ Get the index file associated to a bundle map.
+
+        Parameters
+        ----------
+        bundlefile: str
+            path to the '.bundles' header file.
+
+        Returns
+        -------
+        indexfile: str
+            path to the '.npz' index file.
+        """
+        return os.path.splitext(bundlefile)[0] + cls.suffix
+
+    def save(self, indexfile):
+        """ Save the index in a '.npz' file.
+
+        Parameters
+        ----------
+        indexfile: str
+            path to the '.npz' index file.
+        """
+        numpy.savez(
+            indexfile, indptr=self.indptr, indices=self.indices,
+            shape=self.shape, voxel_sizes=self.voxel_sizes,
+            nb_streamlines=self.nb_streamlines,
+            sources=getattr(self, "sources", numpy.array([], dtype=str)))
+
+    @classmethod
+    def load(cls, indexfile):
+        """ Load an index saved in a '.npz' file.
+
+        Parameters
+        ----------
+        indexfile: str
+            path to the '.npz' index file.
+
+        Returns
+        -------
+        index: StreamlineIndex
+            the streamline index.
+        """
+        if not os.path.isfile(indexfile):
+            raise ConnectomistBadFileError(indexfile)
+        with numpy.load(indexfile) as archive:
+            index = cls(archive["indptr"], archive["indices"],
+                        archive["shape"], archive["voxel_sizes"],
+                        archive["nb_streamlines"])
+            index.sources = archive["sources"]
+        return index
+
+    def streamlines(self, roi):
+        """ Get the streamlines crossing a ROI.
+
+        Parameters
+        ----------
+        roi: array (X, Y, Z) or str
+            the ROI on the tractography grid or the path to a Nifti or GIS
+            image: the non zero voxels belong to the ROI.
+
+        Returns
+        -------
+        streamline_ids: array (M, )
+            the sorted IDs of the streamlines crossing the ROI.
+        """
+        # Get the ROI voxels
+        if not isinstance(roi, numpy.ndarray):
+            roi, _ = load_volume(roi)
+        if roi.shape != self.shape:
+            raise ValueError("The ROI shape '{0}' does not match the index "
+                             "grid '{1}'.".format(roi.shape, self.shape))
+        voxels = numpy.flatnonzero(roi)
+
+        # Gather the voxels streamline IDs
+        starts = self.indptr[voxels]
+        counts = self.indptr[voxels + 1] - starts
+        positions = numpy.arange(counts.sum()) - numpy.repeat(
+            numpy.cumsum(counts) - counts - starts, counts)
+
+        return numpy.unique(self.indices[positions])
+
+    def query(self, include=None, exclude=None):
+        """ Select the streamlines crossing all the inclusion ROIs and none of
+        the exclusion ROIs.
+
+        Parameters
+        ----------
+        include: list of array or str (optional, default None)
+            the inclusion ROIs. If not specified, all the streamlines are
+            included.
+        exclude: list of array or str (optional, default None)
+            the exclusion ROIs.
+
+        Returns
+        -------
+        streamline_ids: array (M, )
+            the sorted IDs of the selected streamlines.
+        """
+        selected = numpy.ones((self.nb_streamlines, ), dtype=bool)
+        for roi in include or []:
+            crossing = numpy.zeros((self.nb_streamlines, ), dtype=bool)
+            crossing[self.streamlines(roi)] = True
+            selected &= crossing
+        for roi in exclude or []:
+            selected[self.streamlines(roi)] = False
+
+        return numpy.flatnonzero(selected)
+
+
+def supersample_segments(coords, fiber_ids, max_step=0.5):
+    """ Supersample the fiber segments.
+
+    Parameters
+    ----------
+    coords: array (N, 3)
+        the fiber points coordinates in voxels.
+    fiber_ids: array (N, )
+        the fiber ID of each point, the points of a fiber being consecutive.
+    max_step: float (optional, default 0.5)
+        the sampling step upper bound in voxels along each axis.
+
+    Returns
+    -------
+    samples: array (M, 3)
+        the fiber points followed by the points sampled on the segments.
+    sample_ids: array (M, )
+        the fiber ID of each sample.
+    """
+    # Get the segments joining two points of the same fiber and the number
+    # of steps needed to sample them
+    starts = numpy.flatnonzero(fiber_ids[1:] == fiber_ids[:-1])
+    deltas = coords[starts + 1] - coords[starts]
+    nb_steps = (numpy.floor(numpy.abs(deltas).max(axis=1) / max_step) +
+                1).astype(numpy.int64)
+
+    # Sample the segments: the last point of each segment is already a
+    # fiber point
+    segments = numpy.repeat(numpy.arange(len(starts)), nb_steps)
+    steps = numpy.arange(nb_steps.sum()) - numpy.repeat(
+        numpy.cumsum(nb_steps) - nb_steps, nb_steps)
+    samples = coords[starts[segments]] + deltas[segments] * (
+        steps / nb_steps[segments].astype(float))[:, numpy.newaxis]
+
+    return (numpy.concatenate((coords, samples)),
+            numpy.concatenate((fiber_ids, fiber_ids[starts[segments]])))
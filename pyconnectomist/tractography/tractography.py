@@ -11,12 +11,19 @@ Wrapper to Connectomist's 'Tractography' tab.
 
 # System import
 import os
+import glob
+import shutil
+import numpy
 
 # pyConnectomist import
 from pyconnectomist import DEFAULT_CONNECTOMIST_PATH
 from pyconnectomist.exceptions import ConnectomistBadFileError
 from pyconnectomist.exceptions import ConnectomistError
 from pyconnectomist.wrappers import ConnectomistWrapper
+from pyconnectomist.utils.filetools import load_gis
+from pyconnectomist.utils.filetools import save_gis
+from pyconnectomist.utils.bundletools import merge_bundle_maps
+from pyconnectomist.utils.paralleltools import parallel_map
 
 # Map bundle format to index used by Connectomist
 BUNDLE_MAP = {
@@ -175,3 +182,143 @@ def tractography(
     connprocess(algorithm, parameter_file, outdir)
 
     return outdir
+
+
+def sharded_tractography(
+        outdir,
+        subject_id,
+        mask_dir,
+        model,
+        model_dir,
+        registration_dir,
+        nb_shards=2,
+        bundlemap="aimsbundlemap",
+        **kwargs):
+    """ Tractography split in independent spatial shards.
+
+    The tractography mask is partitioned in disjoint slabs along the slice
+    axis, balanced by their number of mask voxels. Each shard gets a
+    'shard_<i>' sub-directory with its own 'mask/tractography_mask.ima' and
+    is tracked in its own Connectomist call with the same ODF inputs: the
+    shards seed disjoint voxels, so they cannot track the same fiber. The
+    shards are run in parallel and the resulting bundle maps are merged in
+    the output directory following the slab order.
+
+    The mask also constrains the fiber propagation: the fibers are stopped
+    at the boundaries of their slab.
+
+    Parameters
+    ----------
+    outdir: str
+        path to Connectomist output work directory.
+    subject_id: str
+        the subject code in study.
+    mask_dir: str
+        the path to the Connectomist tractography mask directory.
+    model: str
+        the name of the estimated model: 'dot', 'sd', 'sdt', 'aqbi',
+        'sa-qbi', 'dti'.
+    model_dir: str
+        the path to the Connectomist model directory.
+    registration_dir str
+        the path to the Connectomist registration directory.
+    nb_shards: int (optional, default 2)
+        the number of shards, limited by the number of mask slices.
+    bundlemap: str (optional, default 'aimsbundlemap')
+        the bundle format: only 'aimsbundlemap' can be merged.
+    kwargs: dict
+        the other 'tractography' parameters.
+
+    Returns
+    -------
+    outdir: str
+        path to Connectomist's output directory.
+    """
+    # Check input parameters
+    if bundlemap != "aimsbundlemap":
+        raise ConnectomistError(
+            "Only the 'aimsbundlemap' format can be merged, not "
+            "'{0}'.".format(bundlemap))
+    maskfile = os.path.join(mask_dir, "tractography_mask.ima")
+    if not os.path.isfile(maskfile):
+        raise ConnectomistBadFileError(maskfile)
+
+    # Split the mask in slabs
+    data, voxel_sizes = load_gis(maskfile)
+    slabs = mask_slabs(data, nb_shards)
+    if not os.path.isdir(outdir):
+        os.mkdir(outdir)
+    shards = []
+    for index, (start, stop) in enumerate(slabs):
+        shard_dir = os.path.join(outdir, "shard_{0}".format(index))
+        shard_mask_dir = os.path.join(shard_dir, "mask")
+        for dirpath in (shard_dir, shard_mask_dir):
+            if not os.path.isdir(dirpath):
+                os.mkdir(dirpath)
+        shard_data = numpy.zeros_like(data)
+        shard_data[:, :, start:stop] = data[:, :, start:stop]
+        shard_maskfile = save_gis(
+            os.path.join(shard_mask_dir, "tractography_mask.ima"),
+            shard_data, voxel_sizes)
+        if os.path.isfile(maskfile + ".minf"):
+            shutil.copy(maskfile + ".minf", shard_maskfile + ".minf")
+        shard_kwargs = dict(kwargs)
+        shard_kwargs["bundlemap"] = bundlemap
+        shards.append(((shard_dir, subject_id, shard_mask_dir, model,
+                        model_dir, registration_dir), shard_kwargs))
+
+    # Track each shard in its own Connectomist call
+    shard_dirs = parallel_map(_tractography, shards, nb_workers=len(shards))
+
+    # Merge the shard bundle maps
+    for path in sorted(glob.glob(os.path.join(shard_dirs[0], "*.bundles"))):
+        basename = os.path.basename(path)
+        merge_bundle_maps(
+            [os.path.join(shard_dir, basename) for shard_dir in shard_dirs],
+            os.path.join(outdir, basename))
+
+    return outdir
+
+
+def mask_slabs(data, nb_shards):
+    """ Partition a mask in slabs along the slice axis balanced by their
+    number of mask voxels.
+
+    Parameters
+    ----------
+    data: array (X, Y, Z) or (X, Y, Z, 1)
+        the mask voxels.
+    nb_shards: int
+        the number of slabs, limited by the number of slices with mask
+        voxels.
+
+    Returns
+    -------
+    slabs: list of 2-uplet
+        the first and last (excluded) slice of each slab, covering all the
+        slices.
+    """
+    counts = (data.reshape(data.shape[:3] + (-1, )) != 0).sum(axis=(0, 1, 3))
+    nonempty = numpy.flatnonzero(counts)
+    nb_shards = max(1, min(nb_shards, len(nonempty)))
+
+    # Count the slices with mask voxels in the first slabs: at least one
+    # such slice per slab
+    cumulated = numpy.cumsum(counts[nonempty])
+    targets = cumulated[-1] * numpy.arange(1, nb_shards) / float(nb_shards)
+    nb_slices = numpy.searchsorted(cumulated, targets) + 1
+    for index in range(nb_shards - 1):
+        if index > 0:
+            nb_slices[index] = max(nb_slices[index], nb_slices[index - 1] + 1)
+        nb_slices[index] = min(max(nb_slices[index], index + 1),
+                               len(nonempty) - nb_shards + index + 1)
+    bounds = [0] + nonempty[nb_slices].tolist() + [data.shape[2]]
+
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def _tractography(shard):
+    """ Run the tractography of a shard.
+    """
+    args, kwargs = shard
+    return tractography(*args, **kwargs)
@@ -0,0 +1,1135 @@
+##########################################################################
+# NSAp - Copyright (C) CEA, 2016
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html for details.
+##########################################################################
+
+"""
+Utility functions to read the Connectomist bundle maps and convert them in
+other tractogram formats.
+
+A Connectomist bundle map is composed of a '.bundles' text header that
+defines a Python dict and of a '.bundlesdata' binary file where each fiber
+is stored as an int32 number of points followed by the float32 (x, y, z)
+coordinates in mm of each point.
+"""
+
+# System import
+import os
+import json
+import shutil
+import numpy
+import nibabel
+
+# pyConnectomist import
+from pyconnectomist.exceptions import ConnectomistBadFileError
+from pyconnectomist.utils.filetools import parse_dict_file
+from pyconnectomist.utils.regtools import connectomist_to_rasmm
+
+# Map the Connectomist byte order to the numpy convention
+BYTE_ORDER = {
+    "DCBA": "<",
+    "ABCD": ">"
+}
+
+# Trackvis version 2 header description
+TRK_HEADER_DTYPE = numpy.dtype([
+    ("id_string", "S6"),
+    ("dim", "<i2", 3),
+    ("voxel_size", "<f4", 3),
+    ("origin", "<f4", 3),
+    ("n_scalars", "<i2"),
+    ("scalar_name", "S20", 10),
+    ("n_properties", "<i2"),
+    ("property_name", "S20", 10),
+    ("vox_to_ras", "<f4", (4, 4)),
+    ("reserved", "S444"),
+    ("voxel_order", "S4"),
+    ("pad2", "S4"),
+    ("image_orientation_patient", "<f4", 6),
+    ("pad1", "S2"),
+    ("invert_x", "u1"),
+    ("invert_y", "u1"),
+    ("invert_z", "u1"),
+    ("swap_xy", "u1"),
+    ("swap_yz", "u1"),
+    ("swap_zx", "u1"),
+    ("n_count", "<i4"),
+    ("version", "<i4"),
+    ("hdr_size", "<i4")])
+
+# The smallest float32 normal number viewed as int32: the fiber point counts
+# are located in a buffer as the values lower than this bound
+MAX_POINT_COUNT = 2 ** 23
+
+# TRX positions data types
+TRX_DTYPES = {
+    "float16": "<f2",
+    "float32": "<f4"
+}
+
+
+def read_bundles_header(bundlefile):
+    """ Read a Connectomist bundle map header.
+
+    Parameters
+    ----------
+    bundlefile: str
+        path to the '.bundles' header file.
+
+    Returns
+    -------
+    header: dict
+        the bundle map attributes.
+    datafile: str
+        path to the associated '.bundlesdata' binary file.
+    """
+    # Check input existence
+    if not os.path.isfile(bundlefile):
+        raise ConnectomistBadFileError(bundlefile)
+
+    # The header is a text file that defines a python dict
+    header = parse_dict_file(bundlefile).get("attributes", {})
+    if "curves_count" not in header:
+        raise ConnectomistBadFileError(bundlefile)
+
+    # Get the associated binary file
+    datafile = os.path.splitext(bundlefile)[0] + ".bundlesdata"
+    if not os.path.isfile(datafile):
+        raise ConnectomistBadFileError(datafile)
+
+    return header, datafile
+
+
+def fiber_records(raw, nb_fibers, nb_properties=0):
+    """ Locate the fiber records in a '.bundlesdata' or Trackvis buffer.
+
+    The number of points of a fiber gives the position of the next record.
+    The records are first located in a single pass over the buffer: a
+    float32 coordinate or property viewed as int32 is either null or out of
+    the [1, 2**23[ range, unless it is a denormal number, so the values in
+    this range are the point counts. The positions are then checked to
+    follow each other; otherwise, for instance with empty fibers, the
+    counts are read one after the other.
+
+    Parameters
+    ----------
+    raw: array (M, )
+        the fiber records viewed as int32.
+    nb_fibers: int
+        the number of fibers stored in the buffer.
+    nb_properties: int (optional, default 0)
+        the number of per-fiber values stored after the fiber points.
+
+    Returns
+    -------
+    starts: array (nb_fibers, )
+        the int32 position of each fiber record.
+    counts: array (nb_fibers, )
+        the number of points of each fiber.
+    """
+    # Fast path: all the fibers have the same number of points (this is the
+    # case for resampled fibers)
+    size = len(raw)
+    if nb_fibers > 0 and size > 0:
+        count = int(raw[0])
+        stride = 1 + 3 * count + nb_properties
+        if (count > 0 and size == stride * nb_fibers and
+                numpy.all(raw[::stride] == count)):
+            starts = numpy.arange(nb_fibers, dtype=numpy.int64) * stride
+            counts = numpy.empty(nb_fibers, dtype=numpy.int64)
+            counts.fill(count)
+            return starts, counts
+
+    # Vectorized path: the point counts are the only values in [1, 2**23[
+    starts = numpy.flatnonzero((raw >= 1) & (raw < MAX_POINT_COUNT))
+    if len(starts) == nb_fibers:
+        counts = raw[starts].astype(numpy.int64)
+        stops = starts + 1 + 3 * counts + nb_properties
+        if (nb_fibers > 0 and starts[0] == 0 and stops[-1] == size and
+                numpy.array_equal(starts[1:], stops[:-1])):
+            return starts, counts
+
+    # Generic case: read the counts, then compute the record positions
+    counts = numpy.empty(nb_fibers, dtype=numpy.int64)
+    item = raw.item
+    position = 0
+    for index in range(nb_fibers):
+        if position >= size:
+            raise ValueError("Truncated bundle map: {0} fibers expected, {1} "
+                             "found.".format(nb_fibers, index))
+        count = item(position)
+        counts[index] = count
+        position += 1 + 3 * count + nb_properties
+    starts = numpy.zeros(nb_fibers + 1, dtype=numpy.int64)
+    numpy.cumsum(1 + 3 * counts + nb_properties, out=starts[1:])
+    if starts[-1] != size:
+        raise ValueError("Corrupted bundle map: unexpected data size.")
+    starts = starts[:-1]
+
+    return starts, counts
+
+
+def load_bundles(bundlefile):
+    """ Load a Connectomist bundle map.
+
+    The binary data are memory mapped and the fiber points are gathered in
+    one contiguous array using a single masked copy.
+
+    Parameters
+    ----------
+    bundlefile: str
+        path to the '.bundles' header file.
+
+    Returns
+    -------
+    points: array (P, 3)
+        the float32 fiber points coordinates in mm.
+    offsets: array (F + 1, )
+        the fibers are stored in points[offsets[i]: offsets[i + 1]].
+    header: dict
+        the bundle map attributes.
+    """
+    # Read the header
+    header, datafile = read_bundles_header(bundlefile)
+    nb_fibers = int(header["curves_count"])
+    byte_order = BYTE_ORDER[header.get("byte_order", "DCBA")]
+
+    # Memory map the binary data and locate the fibers
+    if os.path.getsize(datafile) == 0:
+        raw = numpy.zeros((0, ), dtype=byte_order + "i4")
+    else:
+        raw = numpy.memmap(datafile, dtype=byte_order + "i4", mode="r")
+    try:
+        starts, counts = fiber_records(raw, nb_fibers)
+    except ValueError:
+        raise ConnectomistBadFileError(datafile)
+    offsets = numpy.zeros((nb_fibers + 1, ), dtype=numpy.int64)
+    numpy.cumsum(counts, out=offsets[1:])
+
+    # Gather the points: skip the int32 number of points of each record
+    mask = numpy.ones(raw.shape, dtype=bool)
+    mask[starts] = False
+    points = raw.view(byte_order + "f4")[mask].astype(numpy.float32)
+    points.shape = (-1, 3)
+
+    return points, offsets, header
+
+
+def iter_bundles(bundlefile, chunk_size=100000):
+    """ Iterate over the fibers of a Connectomist bundle map by chunks.
+
+    Only the current chunk points are read from the memory mapped binary
+    data, so that the memory usage does not depend on the bundle map size.
+
+    Parameters
+    ----------
+    bundlefile: str
+        path to the '.bundles' header file.
+    chunk_size: int (optional, default 100000)
+        the number of fibers in each chunk.
+
+    Returns
+    -------
+    chunks: generator of 2-uplet
+        for each chunk, the fiber points (P, 3) and offsets (F + 1, ).
+    """
+    # Read the header and locate the fibers
+    header, datafile = read_bundles_header(bundlefile)
+    nb_fibers = int(header["curves_count"])
+    byte_order = BYTE_ORDER[header.get("byte_order", "DCBA")]
+    if nb_fibers == 0 or os.path.getsize(datafile) == 0:
+        return
+    raw = numpy.memmap(datafile, dtype=byte_order + "i4", mode="r")
+    try:
+        starts, counts = fiber_records(raw, nb_fibers)
+    except ValueError:
+        raise ConnectomistBadFileError(datafile)
+
+    # Gather the points of each chunk
+    for first in range(0, nb_fibers, chunk_size):
+        last = min(first + chunk_size, nb_fibers)
+        stop = starts[last] if last < nb_fibers else len(raw)
+        chunk = raw[starts[first]: stop]
+        mask = numpy.ones(chunk.shape, dtype=bool)
+        mask[starts[first: last] - starts[first]] = False
+        points = chunk.view(byte_order + "f4")[mask].astype(numpy.float32)
+        points.shape = (-1, 3)
+        offsets = numpy.zeros((last - first + 1, ), dtype=numpy.int64)
+        numpy.cumsum(counts[first: last], out=offsets[1:])
+        yield points, offsets
+
+
+def save_bundles(bundlefile, points, offsets, names=None, header=None):
+    """ Save fibers as a Connectomist bundle map.
+
+    Parameters
+    ----------
+    bundlefile: str
+        path to the output '.bundles' header file.
+    points: array (P, 3)
+        the fiber points coordinates in mm.
+    offsets: array (F + 1, )
+        the fibers are stored in points[offsets[i]: offsets[i + 1]].
+    names: list of 2-uplet (optional, default None)
+        the bundle names with the associated first fiber index.
+    header: dict (optional, default None)
+        extra bundle map attributes, typically the input bundle map header.
+
+    Returns
+    -------
+    bundlefile: str
+        path to the output '.bundles' header file.
+    """
+    # Add extension if there is none
+    if not bundlefile.endswith(".bundles"):
+        bundlefile += ".bundles"
+    datafile = os.path.splitext(bundlefile)[0] + ".bundlesdata"
+
+    # Write the header
+    save_bundles_header(bundlefile, len(offsets) - 1, names=names,
+                        header=header)
+
+    # Write the fibers: same record layout as the Trackvis files without
+    # properties
+    buffer = trk_buffer(numpy.asarray(points, dtype=numpy.float32), offsets)
+    with open(datafile, "wb") as open_file:
+        open_file.write(buffer.tobytes())
+
+    return bundlefile
+
+
+def save_bundles_header(bundlefile, nb_fibers, names=None, header=None):
+    """ Save the '.bundles' header of a Connectomist bundle map.
+
+    The '.bundlesdata' binary file can then be written incrementally with
+    the 'trk_buffer' records of the fibers.
+
+    Parameters
+    ----------
+    bundlefile: str
+        path to the output '.bundles' header file.
+    nb_fibers: int
+        the number of fibers in the bundle map.
+    names: list of 2-uplet (optional, default None)
+        the bundle names with the associated first fiber index.
+    header: dict (optional, default None)
+        extra bundle map attributes, typically the input bundle map header.
+
+    Returns
+    -------
+    bundlefile: str
+        path to the output '.bundles' header file.
+    """
+    attributes = dict(header or {})
+    if names is None:
+        names = [("255", 0)]
+    attributes.update({
+        "binary": 1,
+        "bundles": [item for name in names for item in name],
+        "byte_order": "DCBA",
+        "curves_count": nb_fibers,
+        "data_file_name": "*.bundlesdata",
+        "format": "bundles_1.0",
+        "io_mode": "binary",
+        "item_count": 1,
+        "space_dimension": 3})
+    with open(bundlefile, "wt") as open_file:
+        open_file.write("attributes = {\n")
+        for key in sorted(attributes):
+            open_file.write("    {0!r} : {1!r},\n".format(
+                key, attributes[key]))
+        open_file.write("  }\n")
+
+    return bundlefile
+
+
+def bundle_names(header):
+    """ Get the bundle names and their fiber ranges from a bundle map header.
+
+    Parameters
+    ----------
+    header: dict
+        the bundle map attributes.
+
+    Returns
+    -------
+    names: list of 3-uplet
+        the bundle names with the associated first and last (excluded) fiber
+        indices.
+    """
+    nb_fibers = int(header["curves_count"])
+    description = header.get("bundles", [])
+    names = description[::2]
+    starts = [int(item) for item in description[1::2]]
+    stops = starts[1:] + [nb_fibers]
+
+    return list(zip(names, starts, stops))
+
+
+def fiber_lengths(points, offsets):
+    """ Compute the length of each fiber.
+
+    Parameters
+    ----------
+    points: array (P, 3)
+        the fiber points coordinates in mm.
+    offsets: array (F + 1, )
+        the fibers are stored in points[offsets[i]: offsets[i + 1]].
+
+    Returns
+    -------
+    lengths: array (F, )
+        the fiber lengths in mm.
+    """
+    # Compute all the segment lengths, then discard the segments that join
+    # two consecutive fibers
+    nb_fibers = len(offsets) - 1
+    counts = numpy.diff(offsets)
+    fiber_ids = numpy.repeat(numpy.arange(nb_fibers), counts)
+    segments = numpy.sqrt(numpy.sum(
+        numpy.diff(numpy.asarray(points, dtype=numpy.float64), axis=0) ** 2,
+        axis=1))
+    inner = (fiber_ids[1:] == fiber_ids[:-1])
+
+    return numpy.bincount(fiber_ids[1:][inner], weights=segments[inner],
+                          minlength=nb_fibers)
+
+
+def resample_fibers(points, offsets, nb_points):
+    """ Resample each fiber on points equally spaced along its length.
+
+    Parameters
+    ----------
+    points: array (P, 3)
+        the fiber points coordinates in mm.
+    offsets: array (F + 1, )
+        the fibers are stored in points[offsets[i]: offsets[i + 1]].
+    nb_points: int
+        the number of points of the resampled fibers, at least 2.
+
+    Returns
+    -------
+    resampled: array (F, nb_points, 3)
+        the resampled fibers.
+    """
+    # Compute the curvilinear abscissa of each point: the fibers are laid
+    # end to end, separated by a gap larger than any fiber, so that a
+    # single sorted search locates all the resampled points
+    points = numpy.asarray(points, dtype=numpy.float64)
+    nb_fibers = len(offsets) - 1
+    counts = numpy.diff(offsets)
+    if nb_fibers == 0:
+        return numpy.zeros((0, nb_points, 3), dtype=numpy.float64)
+    if numpy.any(counts == 0):
+        raise ValueError("Empty fibers can't be resampled.")
+    fiber_ids = numpy.repeat(numpy.arange(nb_fibers), counts)
+    segments = numpy.zeros((len(points), ), dtype=numpy.float64)
+    segments[1:] = numpy.sqrt(numpy.sum(numpy.diff(points, axis=0) ** 2,
+                                        axis=1))
+    segments[offsets[:-1]] = 0
+    abscissa = numpy.cumsum(segments)
+    abscissa -= numpy.repeat(abscissa[offsets[:-1]], counts)
+    lengths = abscissa[offsets[1:] - 1]
+    gap = lengths.max() + 1.
+    keys = abscissa + fiber_ids * gap
+
+    # Locate the resampled points in the fiber segments
+    ratios = numpy.linspace(0., 1., nb_points)
+    targets = (lengths[:, numpy.newaxis] * ratios +
+               (numpy.arange(nb_fibers) * gap)[:, numpy.newaxis]).ravel()
+    starts = numpy.searchsorted(keys, targets, side="right") - 1
+    first = numpy.repeat(offsets[:-1], nb_points)
+    last = numpy.repeat(numpy.maximum(offsets[1:] - 2, offsets[:-1]),
+                        nb_points)
+    starts = numpy.clip(starts, first, last)
+    stops = numpy.minimum(starts + 1, numpy.repeat(offsets[1:] - 1,
+                                                   nb_points))
+
+    # Linear interpolation
+    span = keys[stops] - keys[starts]
+    weights = numpy.zeros_like(span)
+    numpy.divide(targets - keys[starts], span, out=weights, where=span > 0)
+    weights = numpy.clip(weights, 0., 1.)[:, numpy.newaxis]
+    resampled = (1. - weights) * points[starts] + weights * points[stops]
+
+    return resampled.reshape(nb_fibers, nb_points, 3)
+
+
+def compress_fibers(points, offsets, tolerance):
+    """ Compress the fibers with an error bounded simplification.
+
+    The Douglas-Peucker algorithm is applied to all the fibers at once: at
+    each pass, the points of every segment joining two kept points are
+    compared to the segment, and the farthest point is kept if its distance
+    is larger than the tolerance. The fiber endpoints are always kept.
+
+    Parameters
+    ----------
+    points: array (P, 3)
+        the fiber points coordinates in mm.
+    offsets: array (F + 1, )
+        the fibers are stored in points[offsets[i]: offsets[i + 1]].
+    tolerance: float
+        the maximum distance in mm between a removed point and the
+        compressed fiber.
+
+    Returns
+    -------
+    kept: array (P, )
+        the mask of the points kept in the compressed fibers.
+    """
+    # Keep the fiber endpoints
+    points = numpy.asarray(points, dtype=numpy.float64)
+    kept = numpy.zeros((len(points), ), dtype=bool)
+    counts = numpy.diff(offsets)
+    kept[offsets[:-1][counts > 0]] = True
+    kept[offsets[1:][counts > 0] - 1] = True
+
+    # Split the segments until all the points are close enough
+    while True:
+        kept_indices = numpy.flatnonzero(kept)
+        segment_ids = numpy.cumsum(kept) - 1
+        inner = numpy.flatnonzero(~kept)
+        if len(inner) == 0:
+            break
+        segment_ids = segment_ids[inner]
+        starts = points[kept_indices[segment_ids]]
+        stops = points[kept_indices[segment_ids + 1]]
+
+        # Compute the distances to the segments
+        directions = stops - starts
+        norms = numpy.sum(directions ** 2, axis=1)
+        ratios = numpy.zeros((len(inner), ), dtype=numpy.float64)
+        numpy.divide(numpy.sum((points[inner] - starts) * directions, axis=1),
+                     norms, out=ratios, where=norms > 0)
+        ratios = numpy.clip(ratios, 0., 1.)[:, numpy.newaxis]
+        distances = numpy.sqrt(numpy.sum(
+            (points[inner] - starts - ratios * directions) ** 2, axis=1))
+
+        # Keep the farthest point of each segment above the tolerance
+        farthest = numpy.zeros((len(kept_indices), ), dtype=numpy.float64)
+        numpy.maximum.at(farthest, segment_ids, distances)
+        candidates = numpy.flatnonzero(
+            (distances > tolerance) & (distances == farthest[segment_ids]))
+        if len(candidates) == 0:
+            break
+        _, first = numpy.unique(segment_ids[candidates], return_index=True)
+        kept[inner[candidates[first]]] = True
+
+    return kept
+
+
+def select_fibers(points, offsets, fiber_ids=None, point_mask=None):
+    """ Select some fibers and some of their points.
+
+    Parameters
+    ----------
+    points: array (P, 3)
+        the fiber points coordinates.
+    offsets: array (F + 1, )
+        the fibers are stored in points[offsets[i]: offsets[i + 1]].
+    fiber_ids: array (N, ) (optional, default None)
+        the sorted indices of the selected fibers, by default all the fibers.
+    point_mask: array (P, ) (optional, default None)
+        the mask of the selected points, by default all the points.
+
+    Returns
+    -------
+    points: array (Q, 3)
+        the selected points.
+    offsets: array (N + 1, )
+        the selected fibers offsets.
+    """
+    counts = numpy.diff(offsets)
+    if point_mask is None:
+        point_mask = numpy.ones((len(points), ), dtype=bool)
+    if fiber_ids is not None:
+        selected = numpy.zeros((len(counts), ), dtype=bool)
+        selected[fiber_ids] = True
+        point_mask = point_mask & numpy.repeat(selected, counts)
+    fiber_counts = numpy.bincount(
+        numpy.repeat(numpy.arange(len(counts)), counts)[point_mask],
+        minlength=len(counts))
+    if fiber_ids is not None:
+        fiber_counts = fiber_counts[fiber_ids]
+    new_offsets = numpy.zeros((len(fiber_counts) + 1, ), dtype=numpy.int64)
+    numpy.cumsum(fiber_counts, out=new_offsets[1:])
+
+    return points[point_mask], new_offsets
+
+
+def merge_bundle_maps(bundlefiles, bundlefile):
+    """ Merge Connectomist bundle maps.
+
+    The fibers of each bundle are gathered following the input bundle maps
+    order, so that the merged fiber ordering does not depend on the way the
+    input bundle maps have been generated.
+
+    Parameters
+    ----------
+    bundlefiles: list of str
+        path to the '.bundles' header files to be merged.
+    bundlefile: str
+        path to the output '.bundles' header file.
+
+    Returns
+    -------
+    bundlefile: str
+        path to the output '.bundles' header file.
+    """
+    # Gather the fibers of each bundle
+    fibers = {}
+    order = []
+    header = None
+    for path in bundlefiles:
+        points, offsets, attributes = load_bundles(path)
+        if header is None:
+            header = attributes
+        for name, start, stop in bundle_names(attributes):
+            if name not in fibers:
+                fibers[name] = []
+                order.append(name)
+            fibers[name].append((points[offsets[start]: offsets[stop]],
+                                 numpy.diff(offsets[start: stop + 1])))
+
+    # Concatenate the bundles
+    names = []
+    all_points = []
+    all_counts = []
+    nb_fibers = 0
+    for name in order:
+        names.append((name, nb_fibers))
+        for points, counts in fibers[name]:
+            all_points.append(points)
+            all_counts.append(counts)
+            nb_fibers += len(counts)
+    if len(all_points) == 0:
+        all_points = [numpy.zeros((0, 3), dtype=numpy.float32)]
+    offsets = numpy.zeros((nb_fibers + 1, ), dtype=numpy.int64)
+    if nb_fibers > 0:
+        numpy.cumsum(numpy.concatenate(all_counts), out=offsets[1:])
+
+    return save_bundles(bundlefile, numpy.concatenate(all_points), offsets,
+                        names=names or None, header=header)
+
+
+def trk_header(nb_fibers, dimensions=(0, 0, 0), voxel_sizes=(1., 1., 1.),
+               voxel_order="LPI", property_names=None):
+    """ Create a Trackvis header.
+
+    Parameters
+    ----------
+    nb_fibers: int
+        the number of fibers.
+    dimensions: 3-uplet (optional)
+        the reference image dimensions.
+    voxel_sizes: 3-uplet (optional)
+        the reference image voxel sizes.
+    voxel_order: str (optional, default 'LPI')
+        the reference image orientation: Connectomist data are stored in the
+        LPI orientation.
+    property_names: list of str (optional, default None)
+        the names of the per-fiber properties.
+
+    Returns
+    -------
+    header: array
+        the Trackvis header as a numpy structured array.
+    """
+    property_names = property_names or []
+    if len(property_names) > 10:
+        raise ValueError("Trackvis supports at most 10 fiber properties.")
+    header = numpy.zeros((1, ), dtype=TRK_HEADER_DTYPE)
+    header["id_string"] = b"TRACK"
+    header["dim"] = dimensions
+    header["voxel_size"] = voxel_sizes
+    header["n_properties"] = len(property_names)
+    for index, name in enumerate(property_names):
+        header["property_name"][0, index] = name.encode("ascii")[:20]
+    header["vox_to_ras"] = numpy.diag(list(voxel_sizes) + [1.])
+    header["voxel_order"] = voxel_order.encode("ascii")
+    header["n_count"] = nb_fibers
+    header["version"] = 2
+    header["hdr_size"] = TRK_HEADER_DTYPE.itemsize
+
+    return header
+
+
+def trk_buffer(points, offsets, properties=None):
+    """ Pack fibers in a Trackvis data buffer.
+
+    Parameters
+    ----------
+    points: array (P, 3)
+        the fiber points coordinates.
+    offsets: array (F + 1, )
+        the fibers are stored in points[offsets[i]: offsets[i + 1]].
+    properties: array (F, N) (optional, default None)
+        the per-fiber properties.
+
+    Returns
+    -------
+    buffer: array (F + 3 * P + F * N, )
+        the float32 Trackvis data buffer.
+    """
+    # Insert the point counts and the properties in the flat points in a
+    # single pass: the values inserted at the same position keep their
+    # order, so the properties of a fiber come before the next count
+    nb_fibers = len(offsets) - 1
+    offsets = numpy.asarray(offsets, dtype=numpy.int64)
+    counts = numpy.diff(offsets).astype("<i4")
+    if properties is None:
+        properties = numpy.zeros((nb_fibers, 0), dtype=numpy.float32)
+    nb_properties = properties.shape[1]
+    positions = numpy.empty((nb_fibers, 1 + nb_properties),
+                            dtype=numpy.int64)
+    positions[:, 0] = 3 * offsets[:-1]
+    positions[:, 1:] = 3 * offsets[1:, numpy.newaxis]
+    values = numpy.empty((nb_fibers, 1 + nb_properties), dtype="<f4")
+    values[:, 0] = counts.view("<f4")
+    values[:, 1:] = properties
+    buffer = numpy.insert(
+        numpy.asarray(points, dtype="<f4").ravel(), positions.ravel(),
+        values.ravel())
+
+    return buffer
+
+
+def save_trk(trk, points, offsets, dimensions=(0, 0, 0),
+             voxel_sizes=(1., 1., 1.), properties=None, property_names=None):
+    """ Save fibers in a Trackvis file.
+
+    Parameters
+    ----------
+    trk: str
+        path to the output Trackvis file.
+    points: array (P, 3)
+        the fiber points coordinates.
+    offsets: array (F + 1, )
+        the fibers are stored in points[offsets[i]: offsets[i + 1]].
+    dimensions: 3-uplet (optional)
+        the reference image dimensions.
+    voxel_sizes: 3-uplet (optional)
+        the reference image voxel sizes.
+    properties: array (F, N) (optional, default None)
+        the per-fiber properties.
+    property_names: list of str (optional, default None)
+        the names of the per-fiber properties.
+
+    Returns
+    -------
+    trk: str
+        path to the output Trackvis file.
+    """
+    header = trk_header(len(offsets) - 1, dimensions, voxel_sizes,
+                        property_names=property_names)
+    buffer = trk_buffer(points, offsets, properties)
+    with open(trk, "wb") as open_file:
+        open_file.write(header.tobytes())
+        open_file.write(buffer.tobytes())
+
+    return trk
+
+
+def load_trk(trk):
+    """ Load a Trackvis file without scalars.
+
+    Parameters
+    ----------
+    trk: str
+        path to the Trackvis file.
+
+    Returns
+    -------
+    points: array (P, 3)
+        the fiber points coordinates.
+    offsets: array (F + 1, )
+        the fibers are stored in points[offsets[i]: offsets[i + 1]].
+    properties: array (F, N)
+        the per-fiber properties.
+    header: array
+        the Trackvis header as a numpy structured array.
+    """
+    # Check input existence
+    if not os.path.isfile(trk):
+        raise ConnectomistBadFileError(trk)
+
+    # Load the header
+    header = numpy.fromfile(trk, dtype=TRK_HEADER_DTYPE, count=1)
+    if len(header) != 1 or header["id_string"][0] != b"TRACK":
+        raise ConnectomistBadFileError(trk)
+    if header["n_scalars"][0] != 0:
+        raise ValueError("Trackvis scalars are not supported.")
+    nb_fibers = int(header["n_count"][0])
+    nb_properties = int(header["n_properties"][0])
+
+    # Locate each fiber record
+    raw = numpy.fromfile(trk, dtype="<i4")[TRK_HEADER_DTYPE.itemsize // 4:]
+    try:
+        starts, counts = fiber_records(raw, nb_fibers, nb_properties)
+    except ValueError:
+        raise ConnectomistBadFileError(trk)
+
+    # Unpack the buffer
+    offsets = numpy.zeros((nb_fibers + 1, ), dtype=numpy.int64)
+    numpy.cumsum(counts, out=offsets[1:])
+    floats = raw.view("<f4")
+    properties = numpy.empty((nb_fibers, nb_properties), dtype=numpy.float32)
+    mask = numpy.ones(raw.shape, dtype=bool)
+    mask[starts] = False
+    for index in range(nb_properties):
+        positions = starts + 1 + 3 * counts + index
+        properties[:, index] = floats[positions]
+        mask[positions] = False
+    points = floats[mask].reshape(-1, 3)
+
+    return points, offsets, properties, header
+
+
+def bundle_to_trk(bundle, trk):
+    """ Convert a Connectomist bundle map in Trackvis format.
+
+    The conversion is performed in-process: the fiber coordinates are copied
+    unchanged, the header and the fiber data are written in two bulk writes.
+
+    Parameters
+    ----------
+    bundle: str
+        path to the input Connectomist Bundles file to be converted.
+    trk: str
+        path to the output Trackvis file.
+
+    Returns
+    -------
+    trk: str
+        path to the output Trackvis file.
+    """
+    # Check input existence
+    if not os.path.isfile(bundle):
+        raise ConnectomistBadFileError(bundle)
+
+    # Add extension if there is none
+    if not trk.endswith(".trk"):
+        trk += ".trk"
+
+    # Load the fibers and save them in Trackvis format
+    points, offsets, header = load_bundles(bundle)
+    dimensions = [int(header.get("size" + axis, 0)) for axis in "XYZ"]
+    voxel_sizes = [float(header.get("resolution" + axis, 1.))
+                   for axis in "XYZ"]
+    save_trk(trk, points, offsets, dimensions, voxel_sizes)
+
+    return trk
+
+
+def merge_bundles_to_trk(bundlefiles, trk, chunk_size=100000):
+    """ Gather Connectomist bundle maps in a single Trackvis file where a
+    'bundle_label' property stores the index of the bundle map of each
+    fiber.
+
+    The output file is preallocated and memory mapped, then filled chunk by
+    chunk, so that the fibers are never loaded all at once.
+
+    Parameters
+    ----------
+    bundlefiles: list of str
+        path to the input '.bundles' header files.
+    trk: str
+        path to the output Trackvis file.
+    chunk_size: int (optional, default 100000)
+        the number of fibers processed at once.
+
+    Returns
+    -------
+    trk: str
+        path to the output Trackvis file.
+    """
+    # Check the inputs and count the fibers and the points
+    if len(bundlefiles) == 0:
+        raise ValueError("At least one bundle map is expected.")
+    if not trk.endswith(".trk"):
+        trk += ".trk"
+    headers = []
+    nb_fibers = 0
+    nb_values = 0
+    for bundlefile in bundlefiles:
+        header, datafile = read_bundles_header(bundlefile)
+        headers.append(header)
+        nb_fibers += int(header["curves_count"])
+        nb_values += os.path.getsize(datafile) // 4 + int(
+            header["curves_count"])
+
+    # Preallocate the output file and write the header
+    dimensions = [int(headers[0].get("size" + axis, 0)) for axis in "XYZ"]
+    voxel_sizes = [float(headers[0].get("resolution" + axis, 1.))
+                   for axis in "XYZ"]
+    header = trk_header(nb_fibers, dimensions, voxel_sizes,
+                        property_names=["bundle_label"])
+    with open(trk, "wb") as open_file:
+        open_file.write(header.tobytes())
+        open_file.truncate(TRK_HEADER_DTYPE.itemsize + 4 * nb_values)
+    if nb_values == 0:
+        return trk
+
+    # Fill the fibers chunk by chunk
+    buffer = numpy.memmap(trk, dtype="<f4", mode="r+",
+                          offset=TRK_HEADER_DTYPE.itemsize)
+    position = 0
+    for label, bundlefile in enumerate(bundlefiles):
+        for points, offsets in iter_bundles(bundlefile, chunk_size):
+            properties = numpy.empty((len(offsets) - 1, 1),
+                                     dtype=numpy.float32)
+            properties.fill(label)
+            chunk = trk_buffer(points, offsets, properties)
+            buffer[position: position + len(chunk)] = chunk
+            position += len(chunk)
+    buffer.flush()
+    del buffer
+
+    return trk
+
+
+def compress_bundles(bundlefiles, trk, tolerance=0.5, max_fibers=None,
+                     seed=0, chunk_size=100000):
+    """ Export a light version of Connectomist bundle maps in Trackvis
+    format for quick looks.
+
+    The fibers are compressed with an error bounded simplification and
+    optionally randomly subsampled, chunk by chunk.
+
+    Parameters
+    ----------
+    bundlefiles: list of str
+        path to the input '.bundles' header files, concatenated in the
+        output.
+    trk: str
+        path to the output Trackvis file.
+    tolerance: float (optional, default 0.5)
+        the maximum distance in mm between a removed point and the
+        compressed fiber.
+    max_fibers: int (optional, default None)
+        if specified, the maximum number of fibers randomly kept.
+    seed: int (optional, default 0)
+        the seed of the fibers random subsampling.
+    chunk_size: int (optional, default 100000)
+        the number of fibers processed at once.
+
+    Returns
+    -------
+    trk: str
+        path to the output Trackvis file.
+    """
+    # Check the inputs
+    if len(bundlefiles) == 0:
+        raise ValueError("At least one bundle map is expected.")
+    headers = [read_bundles_header(path)[0] for path in bundlefiles]
+    if not trk.endswith(".trk"):
+        trk += ".trk"
+
+    # Draw the kept fibers
+    nb_fibers = sum(int(header["curves_count"]) for header in headers)
+    fiber_ids = None
+    if max_fibers is not None and max_fibers < nb_fibers:
+        fiber_ids = numpy.sort(numpy.random.RandomState(seed).choice(
+            nb_fibers, max_fibers, replace=False))
+
+    # Compress the fibers
+    all_points = []
+    all_counts = []
+    first = 0
+    for bundlefile in bundlefiles:
+        for points, offsets in iter_bundles(bundlefile, chunk_size):
+            chunk_ids = None
+            last = first + len(offsets) - 1
+            if fiber_ids is not None:
+                chunk_ids = fiber_ids[(fiber_ids >= first) &
+                                      (fiber_ids < last)] - first
+            first = last
+            points, offsets = select_fibers(
+                points, offsets, chunk_ids,
+                compress_fibers(points, offsets, tolerance))
+            all_points.append(points)
+            all_counts.append(numpy.diff(offsets))
+
+    # Save the result
+    points = numpy.concatenate(
+        all_points or [numpy.zeros((0, 3), dtype=numpy.float32)])
+    counts = numpy.concatenate(
+        all_counts or [numpy.zeros((0, ), dtype=numpy.int64)])
+    offsets = numpy.zeros((len(counts) + 1, ), dtype=numpy.int64)
+    numpy.cumsum(counts, out=offsets[1:])
+    dimensions = [int(headers[0].get("size" + axis, 0)) for axis in "XYZ"]
+    voxel_sizes = [float(headers[0].get("resolution" + axis, 1.))
+                   for axis in "XYZ"]
+    save_trk(trk, points, offsets, dimensions, voxel_sizes)
+
+    return trk
+
+
+def bundles_to_trx(bundlefiles, trx, reference=None, group_names=None,
+                   float16=False, chunk_size=100000):
+    """ Convert Connectomist bundle maps in a TRX tractogram.
+
+    The tractogram is written as an uncompressed TRX directory: the points
+    coordinates are stored in a contiguous 'positions.3.<dtype>' file and
+    the first point index of each fiber in an 'offsets.uint64' file, so that
+    the data can be memory mapped without any parsing. The fibers are
+    streamed by chunks, and each group is stored in a 'groups/<name>.uint32'
+    file listing its fiber indices. The Connectomist LPI coordinates in mm
+    are converted in the RAS+ world space of the reference image, whose
+    affine and shape are stored in the 'VOXEL_TO_RASMM' and 'DIMENSIONS'
+    header entries.
+
+    Parameters
+    ----------
+    bundlefiles: list of str
+        path to the input '.bundles' header files, concatenated in the
+        tractogram.
+    trx: str
+        path to the output TRX directory: an existing directory is replaced.
+    reference: str (optional, default None)
+        path to a Nifti image defined on the Connectomist diffusion grid,
+        for instance an exported diffusion scalar map. By default the
+        reference is the bundle map grid stored in the LPI orientation, the
+        world origin being the center of its last voxel.
+    group_names: list of str (optional, default None)
+        the group name of each bundle map fibers. By default the groups are
+        the bundles defined in the bundle map headers.
+    float16: bool (optional, default False)
+        if True store the positions in half precision.
+    chunk_size: int (optional, default 100000)
+        the number of fibers processed at once.
+
+    Returns
+    -------
+    trx: str
+        path to the output TRX directory.
+    """
+    # Check the inputs
+    if len(bundlefiles) == 0:
+        raise ValueError("At least one bundle map is expected.")
+    if group_names is not None and len(group_names) != len(bundlefiles):
+        raise ValueError("One group name per bundle map is expected.")
+    headers = [read_bundles_header(path)[0] for path in bundlefiles]
+
+    # Get the Connectomist to RAS+ mm transformation
+    if reference is not None:
+        if not os.path.isfile(reference):
+            raise ConnectomistBadFileError(reference)
+        image = nibabel.load(reference)
+        affine = image.affine
+        dimensions = [int(size) for size in image.shape[:3]]
+    else:
+        voxel_sizes = [float(headers[0].get("resolution" + axis, 1.))
+                       for axis in "XYZ"]
+        dimensions = [int(headers[0].get("size" + axis, 0))
+                      for axis in "XYZ"]
+        affine = numpy.diag([-size for size in voxel_sizes] + [1.])
+        affine[:3, 3] = [(size - 1) * voxel_size
+                         for size, voxel_size in zip(dimensions, voxel_sizes)]
+    to_rasmm = connectomist_to_rasmm(affine, dimensions)
+
+    # Create the destination directory
+    if not trx.endswith(".trx"):
+        trx += ".trx"
+    if os.path.isdir(trx):
+        shutil.rmtree(trx)
+    os.makedirs(os.path.join(trx, "groups"))
+
+    # Stream the fibers and locate the groups
+    dtype = TRX_DTYPES["float16" if float16 else "float32"]
+    positions = os.path.join(trx, "positions.3.{0}".format(
+        "float16" if float16 else "float32"))
+    groups = {}
+    nb_fibers = 0
+    nb_points = 0
+    with open(positions, "wb") as positions_file, \
+            open(os.path.join(trx, "offsets.uint64"), "wb") as offsets_file:
+        for index, (bundlefile, header) in enumerate(
+                zip(bundlefiles, headers)):
+            first = nb_fibers
+            for points, offsets in iter_bundles(bundlefile, chunk_size):
+                points = numpy.dot(points, to_rasmm[:3, :3].T)
+                points += to_rasmm[:3, 3]
+                positions_file.write(points.astype(dtype).tobytes())
+                offsets_file.write(
+                    (offsets[:-1] + nb_points).astype("<u8").tobytes())
+                nb_fibers += len(offsets) - 1
+                nb_points += len(points)
+            if group_names is not None:
+                bundles = [(group_names[index], 0, nb_fibers - first)]
+            else:
+                bundles = bundle_names(header)
+            for name, start, stop in bundles:
+                groups.setdefault(name, []).append(
+                    numpy.arange(first + start, first + stop))
+
+    # Write the groups and the header
+    for name, indices in groups.items():
+        numpy.concatenate(indices).astype("<u4").tofile(
+            os.path.join(trx, "groups", "{0}.uint32".format(name)))
+    header = {
+        "DIMENSIONS": dimensions,
+        "VOXEL_TO_RASMM": numpy.asarray(affine, dtype=float).tolist(),
+        "NB_STREAMLINES": nb_fibers,
+        "NB_VERTICES": nb_points}
+    with open(os.path.join(trx, "header.json"), "wt") as open_file:
+        json.dump(header, open_file, indent=4)
+
+    return trx
+
+
+def load_trx(trx):
+    """ Load an uncompressed TRX tractogram by memory mapping its arrays.
+
+    Parameters
+    ----------
+    trx: str
+        path to the TRX directory.
+
+    Returns
+    -------
+    points: array (P, 3)
+        the memory mapped fiber points coordinates.
+    offsets: array (F + 1, )
+        the fibers are stored in points[offsets[i]: offsets[i + 1]].
+    groups: dict
+        the fiber indices of each group.
+    header: dict
+        the TRX header.
+    """
+    # Load the header
+    headerfile = os.path.join(trx, "header.json")
+    if not os.path.isfile(headerfile):
+        raise ConnectomistBadFileError(trx)
+    with open(headerfile, "rt") as open_file:
+        header = json.load(open_file)
+
+    # Map the positions and offsets
+    points = numpy.zeros((0, 3), dtype=numpy.float32)
+    offsets = numpy.zeros((0, ), dtype=numpy.int64)
+    for name, dtype in TRX_DTYPES.items():
+        path = os.path.join(trx, "positions.3.{0}".format(name))
+        if os.path.isfile(path) and header["NB_VERTICES"] > 0:
+            points = numpy.memmap(path, dtype=dtype, mode="r").reshape(-1, 3)
+    path = os.path.join(trx, "offsets.uint64")
+    if os.path.isfile(path) and header["NB_STREAMLINES"] > 0:
+        offsets = numpy.memmap(path, dtype="<u8", mode="r")
+    if (len(points) != header["NB_VERTICES"] or
+            len(offsets) != header["NB_STREAMLINES"]):
+        raise ConnectomistBadFileError(trx)
+    offsets = numpy.concatenate((offsets, [len(points)])).astype(
+        numpy.int64)
+
+    # Load the groups
+    groups = {}
+    groupdir = os.path.join(trx, "groups")
+    if os.path.isdir(groupdir):
+        for basename in sorted(os.listdir(groupdir)):
+            name = basename.rsplit(".", 1)[0]
+            groups[name] = numpy.fromfile(
+                os.path.join(groupdir, basename), dtype="<u4")
+
+    return points, offsets, groups, header
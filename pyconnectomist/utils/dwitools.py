@@ -15,13 +15,29 @@ Utility Python functions to load diffusion metadata.
 import numpy
 import math
 import os
+import hashlib
+import tempfile
 import numpy as np
 import nibabel
+from nibabel.openers import Opener
+from nibabel.volumeutils import apply_read_scaling
 
+# pyConnectomist import
+from pyconnectomist.exceptions import ConnectomistBadFileError
+from pyconnectomist.utils.filetools import parse_dict_file
+from pyconnectomist.utils.paralleltools import parallel_map
 
-def extract_dwi_shells(dwi_nii_path, bvals_path, bvecs_path, outdir):
+
+def extract_dwi_shells(dwi_nii_path, bvals_path, bvecs_path, outdir,
+                       nb_threads=1, memory_budget=1024, cachedir=None):
     """ Convert a multi-shell serie to multiple single shell series.
 
+    The volumes are read in order from a single open file, chunk by chunk,
+    so that a compressed serie is decompressed sequentially: a first pass
+    that stops after the last b0 volume computes the mean b0, then a
+    second pass dispatches each chunk to the shell files, which are written
+    in place volume by volume with the input data type.
+
     Parameters
     ----------
     dwi_nii_path: str
@@ -32,6 +48,14 @@ def extract_dwi_shells(dwi_nii_path, bvals_path, bvecs_path, outdir):
         path to the diffusion b-vectors file.
     outdir: str
         path to the destination folder.
+    nb_threads: int (optional, default 1)
+        the number of shell files written in parallel.
+    memory_budget: int (optional, default 1024)
+        the maximum size in MB of the volume buffers: the chunk size is
+        derived from this value, at least one volume being read at once.
+    cachedir: str (optional, default None)
+        a subject level folder where the gradient table is cached and shared
+        with the other steps, by default the table is not cached.
 
     Returns
     -------
@@ -43,64 +67,486 @@ def extract_dwi_shells(dwi_nii_path, bvals_path, bvecs_path, outdir):
     """
     # Load input data
     dwi = nibabel.load(dwi_nii_path)
-    dwi_array = dwi.get_data()
-    real_bvals, real_bvecs, nb_shells, nb_nodiff = read_bvals_bvecs(
-        bvals_path, bvecs_path, min_bval=100.)
-
-    # Detect shell indices
-    bvals = real_bvals.copy()
-    bvecs = real_bvecs.copy()
-    b0_indices = numpy.where(bvals < 50)[0].tolist()
-    bvals[b0_indices] = 0
-    bvals = [int(round(bval, -2)) for bval in bvals]
-    bvals_set = set(bvals) - {0}
+    gtab = GradientTable.from_files(bvals_path, bvecs_path, cachedir=cachedir)
+    gtab.check(min_bval=100.)
+    if gtab.nb_nodiff == 0:
+        raise ValueError("No b0 volume in '{0}'.".format(bvals_path))
+    bvals_set = gtab.shells.tolist()
+
+    # Size the buffers: the float64 b0 accumulator, the mean b0 and one
+    # volume per worker are always allocated, then each volume of a chunk
+    # costs its raw bytes plus its scaled copy if a scaling is applied
+    raw_dtype = dwi.get_data_dtype()
+    dtype = apply_read_scaling(
+        numpy.zeros((1, ), dtype=raw_dtype), dwi.dataobj.slope,
+        dwi.dataobj.inter).dtype
+    nb_workers = max(1, min(nb_threads, len(bvals_set)))
+    volume_size = int(numpy.prod(dwi.shape[:3]))
+    volume_nbytes = volume_size * dtype.itemsize
+    chunk_nbytes = volume_size * raw_dtype.itemsize
+    if _is_scaled(dwi.dataobj.slope, dwi.dataobj.inter):
+        chunk_nbytes += volume_nbytes
+    fixed_nbytes = volume_size * 8 + (1 + nb_workers) * volume_nbytes
+    chunk_size = max(
+        1, int(memory_budget * 1024 ** 2 - fixed_nbytes) // chunk_nbytes)
 
     # Create mean b0 image
-    b0 = numpy.mean(dwi_array[..., b0_indices], axis=3)
-    im = nibabel.Nifti1Image(b0, affine=dwi.get_affine())
+    b0 = numpy.zeros(dwi.shape[:3], dtype=numpy.float64)
+    for start, data in iter_nifti_volumes(
+            dwi_nii_path, chunk_size, stop=gtab.b0_indices.max() + 1):
+        mask = gtab.b0_mask[start: start + data.shape[3]]
+        for index in numpy.flatnonzero(mask):
+            b0 += data[..., index]
+    b0 /= gtab.nb_nodiff
+    if numpy.issubdtype(dtype, numpy.integer):
+        b0 = numpy.round(b0)
+    b0 = b0.astype(dtype)
     nodiff_file = os.path.join(outdir, "nodiff.nii.gz")
-    nibabel.save(im, nodiff_file)
-    b0.shape += (1, )
+    write_nifti_volumes(nodiff_file, [b0], dwi.shape[:3], dtype, dwi.affine)
 
-    # Create dwi for each shell
+    # Create the bvecs/bvals of each shell
     dwis = {}
-    bvals = numpy.asarray(bvals)
     for bval in bvals_set:
-
-        # Get shell indices
         bval_outdir = os.path.join(outdir, str(bval))
         if not os.path.isdir(bval_outdir):
             os.mkdir(bval_outdir)
-        shell_indices = numpy.where(bvals == bval)[0].tolist()
-
-        # Create single shell dwi
-        shell_dwi = dwi_array[..., shell_indices]
-        shell_dwi = numpy.concatenate((b0, shell_dwi), axis=3)
-        im = nibabel.Nifti1Image(shell_dwi, affine=dwi.get_affine())
-        dwi_file = os.path.join(bval_outdir, "dwi.nii.gz")
-        nibabel.save(im, dwi_file)
-
-        # Create associated bvecs/bvals
-        shell_bvecs = real_bvecs[shell_indices]
+        shell_indices = gtab.shell_indices(bval).tolist()
+        shell_bvecs = gtab.bvecs[shell_indices]
         shell_bvecs = numpy.concatenate((numpy.zeros((1, 3)), shell_bvecs),
                                         axis=0)
         bvecs_file = os.path.join(bval_outdir, "bvecs")
         numpy.savetxt(bvecs_file, shell_bvecs)
-        shell_bvals = real_bvals[shell_indices]
+        shell_bvals = gtab.bvals[shell_indices]
         shell_bvals = numpy.concatenate((numpy.zeros((1, )), shell_bvals))
         bvals_file = os.path.join(bval_outdir, "bvals")
         numpy.savetxt(bvals_file, shell_bvals)
-
-        # Update output structure
         dwis[bval] = {
             "bvals": bvals_file,
             "bvecs": bvecs_file,
-            "dwi": dwi_file
+            "dwi": os.path.join(bval_outdir, "dwi.nii.gz")
         }
 
+    # Stream the single shell dwis: each file starts with the mean b0 and
+    # the shell volumes are written in place, without gathering them
+    fileobjs = []
+    try:
+        for bval in bvals_set:
+            fileobjs.append(Opener(dwis[bval]["dwi"], "wb"))
+            nifti_header(
+                dwi.shape[:3] + (len(gtab.shell_indices(bval)) + 1, ),
+                dtype, dwi.affine).write_to(fileobjs[-1])
+            _write_volume(fileobjs[-1], b0)
+        for start, data in iter_nifti_volumes(dwi_nii_path, chunk_size):
+            shell_index = gtab.shell_index[start: start + data.shape[3]]
+            parallel_map(_write_volumes, [
+                (fileobj, data, numpy.flatnonzero(shell_index == index))
+                for index, fileobj in enumerate(fileobjs)],
+                nb_workers=nb_workers)
+    finally:
+        for fileobj in fileobjs:
+            fileobj.close()
+
     return nodiff_file, dwis
 
 
+def _is_scaled(slope, inter):
+    """ Check if a Nifti scaling changes the stored values.
+    """
+    return not (slope in (None, 1) and inter in (None, 0))
+
+
+def _write_volumes(volumes):
+    """ Append some volumes of a chunk to an open Nifti file.
+    """
+    fileobj, data, indices = volumes
+    for index in indices:
+        _write_volume(fileobj, data[..., index])
+
+
+def _write_volume(fileobj, volume):
+    """ Append a volume to an open Nifti file: a Fortran ordered volume is
+    written without copy.
+    """
+    fileobj.write(memoryview(volume.ravel(order="F")))
+
+
+def iter_nifti_volumes(path, chunk_size, stop=None):
+    """ Read the volumes of a Nifti image in order, chunk by chunk.
+
+    The voxels are read sequentially from a single open file: a compressed
+    image is decompressed once whatever the number of chunks.
+
+    Parameters
+    ----------
+    path: str
+        path to the '.nii' or '.nii.gz' image.
+    chunk_size: int
+        the maximum number of volumes in a chunk.
+    stop: int (optional, default None)
+        the index of the volume where the reading stops, by default all the
+        volumes are read.
+
+    Returns
+    -------
+    chunks: generator of 2-uplet
+        the index of the first volume of each chunk and the chunk voxels
+        as an array (X, Y, Z, N) with the scaling of the image applied.
+    """
+    # Get the data location and type
+    image = nibabel.load(path)
+    shape = tuple(image.shape[:3])
+    nb_volumes = image.shape[3] if len(image.shape) > 3 else 1
+    if stop is None or stop > nb_volumes:
+        stop = nb_volumes
+    dtype = image.get_data_dtype()
+    volume_nbytes = int(numpy.prod(shape)) * dtype.itemsize
+
+    # Read the volumes: in Fortran order each volume is contiguous
+    with Opener(image.dataobj.file_like, "rb") as fileobj:
+        fileobj.seek(image.dataobj.offset)
+        for start in range(0, stop, chunk_size):
+            count = min(chunk_size, stop - start)
+            buffer = fileobj.read(count * volume_nbytes)
+            if len(buffer) != count * volume_nbytes:
+                raise ValueError("Truncated Nifti image '{0}'.".format(path))
+            data = numpy.frombuffer(buffer, dtype=dtype).reshape(
+                shape + (count, ), order="F")
+            yield start, apply_read_scaling(
+                data, image.dataobj.slope, image.dataobj.inter)
+
+
+def write_nifti_volumes(path, volumes, shape, dtype, affine):
+    """ Write a Nifti image incrementally.
+
+    Parameters
+    ----------
+    path: str
+        path to the output '.nii' or '.nii.gz' file.
+    volumes: iterable of array
+        the image data split along the last axis: each item is written
+        as soon as it is available.
+    shape: uplet
+        the image shape.
+    dtype: numpy.dtype
+        the image data type.
+    affine: array (4, 4)
+        the image affine transformation.
+
+    Returns
+    -------
+    path: str
+        path to the output Nifti image.
+    """
+    # Stream the data in Fortran order
+    nb_items = 0
+    with Opener(path, "wb") as fileobj:
+        nifti_header(shape, dtype, affine).write_to(fileobj)
+        for data in volumes:
+            data = numpy.asarray(data, dtype=dtype)
+            nb_items += data.size
+            fileobj.write(data.tobytes(order="F"))
+    if nb_items != numpy.prod(shape):
+        raise ValueError("Unexpected number of voxels written in "
+                         "'{0}'.".format(path))
+
+    return path
+
+
+def nifti_header(shape, dtype, affine):
+    """ Build the header of a new Nifti image as nibabel would do.
+
+    Parameters
+    ----------
+    shape: uplet
+        the image shape.
+    dtype: numpy.dtype
+        the image data type.
+    affine: array (4, 4)
+        the image affine transformation.
+
+    Returns
+    -------
+    header: Nifti1Header
+        the image header: the voxels start right after the header.
+    """
+    header = nibabel.Nifti1Header()
+    header.set_data_shape(shape)
+    header.set_data_dtype(dtype)
+    header.set_sform(affine, code="aligned")
+    header.set_qform(affine, code="unknown")
+    header["vox_offset"] = 352
+    return header
+
+
+class GradientTable(object):
+    """ A diffusion gradient table.
+
+    The b-values and b-vectors are stored as contiguous arrays with a
+    precomputed volume to shell index, so that the shells are inferred only
+    once per subject. A b-value lower or equal to 'b0_threshold' is
+    considered as a no diffusion weighted volume, the other b-values are
+    rounded to the hundred to define the shells. As in Connectomist, the
+    volumes kept as diffusion weighted after the T2 merge are those with a
+    b-value greater or equal to 'dw_threshold'.
+    """
+    cachename = "gradient_table_{0}.npz"
+
+    def __init__(self, bvals, bvecs, b0_threshold=50., dw_threshold=100.):
+        """ Initialize the GradientTable class.
+
+        Parameters
+        ----------
+        bvals: array (N, )
+            the diffusion b-values.
+        bvecs: array (N, 3) or (3, N)
+            the diffusion b-vectors.
+        b0_threshold: float (optional, default 50)
+            the b-value up to which a volume is not diffusion weighted.
+        dw_threshold: float (optional, default 100)
+            the b-value from which a volume is kept as diffusion weighted.
+        """
+        # Check consistency between bvals and associated bvecs
+        bvals = numpy.asarray(bvals, dtype=float)
+        bvecs = numpy.asarray(bvecs, dtype=float)
+        if bvecs.ndim != 2:
+            raise ValueError("b-vectors should be a two dimensional array.")
+        if bvals.ndim != 1:
+            raise ValueError("b-values should be a one dimensional array.")
+        if bvecs.shape[1] > bvecs.shape[0]:
+            bvecs = bvecs.T
+        if bvals.shape[0] != bvecs.shape[0]:
+            raise ValueError("b-values and b-vectors shapes do not "
+                             "correspond.")
+        self.bvals = numpy.ascontiguousarray(bvals)
+        self.bvecs = numpy.ascontiguousarray(bvecs)
+        self.b0_threshold = b0_threshold
+        self.dw_threshold = dw_threshold
+
+        # Build the volume to shell index: -1 for the no diffusion volumes
+        self.b0_mask = self.bvals <= b0_threshold
+        self.dw_mask = self.bvals >= dw_threshold
+        rounded = numpy.round(self.bvals, -2).astype(int)
+        self.shells = numpy.array(
+            sorted(set(rounded[~self.b0_mask].tolist())), dtype=int)
+        self.shell_index = numpy.searchsorted(self.shells, rounded)
+        self.shell_index[self.b0_mask] = -1
+        order = numpy.argsort(self.shell_index, kind="mergesort")
+        counts = numpy.bincount(self.shell_index + 1,
+                                minlength=len(self.shells) + 1)
+        bounds = numpy.cumsum(counts)
+        self._order = order
+        self._slices = [slice(start, stop) for start, stop in zip(
+            bounds[:-1], bounds[1:])]
+        self.b0_indices = order[:bounds[0]]
+
+    @property
+    def nb_shells(self):
+        """ The number of shells.
+        """
+        return len(self.shells)
+
+    @property
+    def nb_nodiff(self):
+        """ The number of no diffusion weighted volumes.
+        """
+        return len(self.b0_indices)
+
+    def shell_indices(self, bval):
+        """ Get the volume indices of a shell.
+
+        Parameters
+        ----------
+        bval: int
+            the shell rounded b-value.
+
+        Returns
+        -------
+        indices: array (M, )
+            the sorted indices of the shell volumes.
+        """
+        index = numpy.searchsorted(self.shells, bval)
+        if index >= len(self.shells) or self.shells[index] != bval:
+            raise ValueError("Unknown shell '{0}'.".format(bval))
+        return self._order[self._slices[index]]
+
+    def check(self, min_bval=200.):
+        """ Check that diffusion weighted volumes are defined and that no
+        small b-value has been used.
+
+        Parameters
+        ----------
+        min_bval: float, optional
+            if a shell under this threshold is detected raise an ValueError.
+        """
+        if self.nb_shells == 0:
+            raise ValueError("No diffusion weighted shell detected.")
+        if self.shells[0] < min_bval:
+            raise ValueError("Small b-values detected (<{0}).".format(
+                min_bval))
+
+    def to_files(self, bval, bvec):
+        """ Write the table as '.bval' and '.bvec' files.
+
+        Parameters
+        ----------
+        bval: str
+            path to the output b-values file.
+        bvec: str
+            path to the output b-vectors file, stored as a (3, N) array.
+        """
+        numpy.savetxt(bval, self.bvals, newline=" ", fmt="%d")
+        numpy.savetxt(bvec, self.bvecs.T, fmt="%.10f")
+
+    @classmethod
+    def from_files(cls, bvals_path, bvecs_path, cachedir=None):
+        """ Create a gradient table from '.bval' and '.bvec' files.
+
+        When a cache directory is specified, the table is stored in a
+        '.npz' file and reused as long as the source files are not modified.
+
+        Parameters
+        ----------
+        bvals_path: str or list of str
+            path to the diffusion b-values file(s).
+        bvecs_path: str or list of str
+            path to the diffusion b-vectors file(s).
+        cachedir: str (optional, default None)
+            a folder where the table is cached.
+
+        Returns
+        -------
+        gtab: GradientTable
+            the gradient table.
+        """
+        # Format input path
+        if not isinstance(bvals_path, list):
+            bvals_path = [bvals_path]
+        if not isinstance(bvecs_path, list):
+            bvecs_path = [bvecs_path]
+
+        # Read .bval & .bvecs files
+        def read_files():
+            bvals = None
+            bvecs = None
+            for bvalfile, bvecfile in zip(bvals_path, bvecs_path):
+                if bvals is None:
+                    bvals = np.loadtxt(bvalfile)
+                else:
+                    bvals = np.concatenate((bvals, np.loadtxt(bvalfile)))
+                if bvecs is None:
+                    bvecs = np.loadtxt(bvecfile)
+                else:
+                    axis = bvecs.shape.index(max(bvecs.shape))
+                    bvecs = np.concatenate((bvecs, np.loadtxt(bvecfile)),
+                                           axis=axis)
+            return cls(bvals, bvecs)
+
+        return cls._cached(bvals_path + bvecs_path, read_files, cachedir)
+
+    @classmethod
+    def from_minf(cls, path_minf, nodiff_first=False, cachedir=None):
+        """ Create a gradient table from the 'bvalues' and
+        'diffusion_gradient_orientations' attributes of a Connectomist
+        diffusion '.minf' file.
+
+        The orientations are normalized. When a cache directory is
+        specified, the table is stored in a '.npz' file and reused as long
+        as the source file is not modified.
+
+        Parameters
+        ----------
+        path_minf: str
+            path to the diffusion '.ima.minf' file.
+        nodiff_first: bool (optional, default False)
+            if True, insert a no diffusion volume first, for the T2 volume
+            merged with the diffusion weighted volumes.
+        cachedir: str (optional, default None)
+            a folder where the table is cached.
+
+        Returns
+        -------
+        gtab: GradientTable
+            the gradient table.
+        """
+        def read_minf():
+            attributes = parse_dict_file(path_minf).get("attributes", {})
+            for key in ("bvalues", "diffusion_gradient_orientations"):
+                if key not in attributes:
+                    raise ConnectomistBadFileError(path_minf)
+            bvals = numpy.asarray(attributes["bvalues"], dtype=float)
+            bvecs = numpy.asarray(
+                attributes["diffusion_gradient_orientations"], dtype=float)
+            norms = numpy.linalg.norm(bvecs, axis=1)
+            bvecs = bvecs / numpy.where(norms > 0, norms, 1)[:, numpy.newaxis]
+            if nodiff_first:
+                bvals = numpy.concatenate(([0], bvals))
+                bvecs = numpy.concatenate(([[0, 0, 0]], bvecs))
+            return cls(bvals, bvecs)
+
+        return cls._cached([path_minf], read_minf, cachedir,
+                           key=str(nodiff_first))
+
+    @classmethod
+    def cachefile(cls, cachedir, paths, key=""):
+        """ Get the path of the cached table built from source files.
+
+        Parameters
+        ----------
+        cachedir: str
+            a folder where the tables are cached.
+        paths: list of str
+            the source files of the table.
+        key: str (optional, default '')
+            an extra key that identifies how the table is built.
+
+        Returns
+        -------
+        cachefile: str
+            path to the '.npz' cache file.
+        """
+        digest = hashlib.md5("\n".join(
+            [os.path.abspath(path) for path in paths] + [key]).encode(
+                "utf-8")).hexdigest()
+        return os.path.join(cachedir, cls.cachename.format(digest[:16]))
+
+    @classmethod
+    def _cached(cls, paths, build, cachedir, key=""):
+        """ Build a table or load it from the cache: the sources are
+        identified by their path, modification time and size, and the cache
+        is replaced atomically so that a concurrent reader never sees a
+        partial file.
+        """
+        if cachedir is None:
+            return build()
+
+        # Check the cache
+        cachefile = cls.cachefile(cachedir, paths, key=key)
+        sources = numpy.array([
+            "{0}:{1}:{2}".format(os.path.abspath(path),
+                                 os.path.getmtime(path),
+                                 os.path.getsize(path))
+            for path in paths])
+        if os.path.isfile(cachefile):
+            with numpy.load(cachefile) as cache:
+                if numpy.array_equal(cache["sources"], sources):
+                    return cls(cache["bvals"], cache["bvecs"])
+
+        # Update the cache
+        gtab = build()
+        fd, tmpfile = tempfile.mkstemp(
+            prefix=os.path.basename(cachefile) + ".", dir=cachedir)
+        try:
+            with os.fdopen(fd, "wb") as open_file:
+                numpy.savez(open_file, bvals=gtab.bvals, bvecs=gtab.bvecs,
+                            sources=sources)
+            os.rename(tmpfile, cachefile)
+        finally:
+            if os.path.isfile(tmpfile):
+                os.remove(tmpfile)
+
+        return gtab
+
+
 def read_bvals_bvecs(bvals_path, bvecs_path, min_bval=200.):
     """ Read b-values and associated b-vectors.
 
@@ -129,46 +575,7 @@ def read_bvals_bvecs(bvals_path, bvecs_path, min_bval=200.):
     ValueError: if the b-values or the corresponding b-vectors have not
         matching sizes this exception is raised.
     """
-    # Format input path
-    if not isinstance(bvals_path, list):
-        bvals_path = [bvals_path]
-    if not isinstance(bvecs_path, list):
-        bvecs_path = [bvecs_path]
-
-    # Read .bval & .bvecs files
-    bvals = None
-    bvecs = None
-    for bvalfile, bvecfile in zip(bvals_path, bvecs_path):
-        if bvals is None:
-            bvals = np.loadtxt(bvalfile)
-        else:
-            bvals = np.concatenate((bvals, np.loadtxt(bvalfile)))
-        if bvecs is None:
-            bvecs = np.loadtxt(bvecfile)
-        else:
-            axis = bvecs.shape.index(max(bvecs.shape))
-            bvecs = np.concatenate((bvecs, np.loadtxt(bvecfile)), axis=axis)
-
-    # Check consistency between bvals and associated bvecs
-    if bvecs.ndim != 2:
-        raise ValueError("b-vectors file should be saved as a two dimensional "
-                         "array: '{0}'.".format(bvecs_path))
-    if bvals.ndim != 1:
-        raise ValueError("b-values file should be saved as a one dimensional "
-                         "array: '{0}'.".format(bvals_path))
-    if bvecs.shape[1] > bvecs.shape[0]:
-        bvecs = bvecs.T
-    if bvals.shape[0] != bvecs.shape[0]:
-        raise ValueError("b-values and b-vectors shapes do not correspond.")
-
-    # Infer nb of T2 and nb of shells.
-    nb_nodiff = np.sum(bvals <= 50)  # nb of volumes where bvalue<50
-    b0_set = set(bvals[bvals <= 50])
-    bvals_set = set(bvals) - b0_set    # set of non-zero bvalues
-    bvals_set = set([int(round(bval, -2)) for bval in list(bvals_set)])
-    nb_shells = len(bvals_set)
-    if min(bvals_set) < min_bval:
-        raise ValueError("Small b-values detected (<{0}) in '{1}'.".format(
-            min_bval, bvals_path))
-
-    return bvals, bvecs, nb_shells, nb_nodiff
+    gtab = GradientTable.from_files(bvals_path, bvecs_path)
+    gtab.check(min_bval=min_bval)
+
+    return gtab.bvals, gtab.bvecs, gtab.nb_shells, gtab.nb_nodiff
@@ -12,13 +12,37 @@ split, concatenate data files.
 
 # System import
 import os
+import ast
 import gzip
+import json
+import fcntl
 import shutil
+import tempfile
+import numpy
 
 # Clindmri import
 from pyconnectomist.exceptions import ConnectomistBadFileError
 from pyconnectomist.wrappers import PtkWrapper
 
+# Map numpy data types to GIS data types
+GIS_TYPES = {
+    "uint8": "U8",
+    "int8": "S8",
+    "uint16": "U16",
+    "int16": "S16",
+    "uint32": "U32",
+    "int32": "S32",
+    "float32": "FLOAT",
+    "float64": "DOUBLE"
+}
+
+# Attributes returned as numpy arrays by 'parse_dict_file'
+ARRAY_ATTRIBUTES = ("bvalues", "diffusion_gradient_orientations")
+
+# In-process cache of the parsed dict files: map a path to its
+# modification time, its size and its content
+_DICT_FILE_CACHE = {}
+
 
 def exec_file(path):
     """ Execute a text file that defines a Python dict.
@@ -40,6 +64,161 @@ def exec_file(path):
     return exec_dict
 
 
+def parse_dict_file(path):
+    """ Parse a text file that defines Python dicts, like the Connectomist
+    '.minf' or 'acquisition_parameters.py' files.
+
+    Contrary to 'exec_file' the file content is never executed: only
+    assignments of literal values are accepted. The parsed content is cached
+    in-process and invalidated when the file modification time or size
+    change. The 'bvalues' and 'diffusion_gradient_orientations' attributes
+    are returned as read-only numpy arrays.
+
+    The cached content is returned without copy: callers must not modify
+    it and should work on a 'copy.deepcopy' of the returned dict instead.
+
+    Parameters
+    ----------
+    path: str
+        the path to a text file containing Python dicts.
+
+    Returns
+    -------
+    parsed_dict: dict
+        the file content as a Python dictionary, shared with the cache.
+
+    Raises
+    ------
+    ConnectomistBadFileError: If the file is missing, contains other
+        statements than literal assignments or diffusion attributes that
+        can't be converted to arrays.
+    """
+    # Check the cache
+    if not os.path.isfile(path):
+        raise ConnectomistBadFileError(path)
+    key = os.path.abspath(path)
+    stat = os.stat(key)
+    cached = _DICT_FILE_CACHE.get(key)
+    if cached is not None and cached[:2] == (stat.st_mtime, stat.st_size):
+        return cached[2]
+
+    # Parse the file: only keep literal assignments
+    with open(path, "r") as open_file:
+        source = open_file.read()
+    parsed_dict = {}
+    try:
+        tree = ast.parse(source, filename=path)
+        for node in tree.body:
+            if isinstance(node, ast.Expr):
+                if not isinstance(ast.literal_eval(node.value), str):
+                    raise ValueError("Unsupported expression.")
+                continue
+            if not isinstance(node, ast.Assign):
+                raise ValueError("Unsupported statement.")
+            value = ast.literal_eval(node.value)
+            for target in node.targets:
+                if not isinstance(target, ast.Name):
+                    raise ValueError("Unsupported assignment.")
+                parsed_dict[target.id] = value
+
+        # Convert the diffusion attributes
+        for content in parsed_dict.values():
+            if not isinstance(content, dict):
+                continue
+            for name in ARRAY_ATTRIBUTES:
+                if name in content:
+                    content[name] = numpy.array(content[name], dtype=float)
+                    content[name].flags.writeable = False
+    except (SyntaxError, ValueError, TypeError):
+        raise ConnectomistBadFileError(path)
+
+    # Update the cache
+    _DICT_FILE_CACHE[key] = (stat.st_mtime, stat.st_size, parsed_dict)
+
+    return parsed_dict
+
+
+def save_dict_file(path, parsed_dict):
+    """ Write Python dicts in a text file that can be read back with
+    'parse_dict_file', like the Connectomist '.minf' files.
+
+    Parameters
+    ----------
+    path: str
+        the path to the output text file.
+    parsed_dict: dict
+        the file content: map each variable name to a dict of literal
+        values or numpy arrays.
+
+    Returns
+    -------
+    path: str
+        the generated text file.
+    """
+    # Convert the numpy arrays and scalars to literal values
+    def _literal(value):
+        if isinstance(value, dict):
+            return dict((key, _literal(item)) for key, item in value.items())
+        if isinstance(value, (list, tuple)):
+            return type(value)(_literal(item) for item in value)
+        if isinstance(value, (numpy.ndarray, numpy.generic)):
+            return value.tolist()
+        return value
+
+    # Write the assignments and invalidate the cache
+    with open(path, "wt") as open_file:
+        for name in sorted(parsed_dict):
+            open_file.write("{0} = {1!r}\n".format(
+                name, _literal(parsed_dict[name])))
+    _DICT_FILE_CACHE.pop(os.path.abspath(path), None)
+
+    return path
+
+
+def update_json_file(path, update):
+    """ Update a '.json' file shared by concurrent jobs.
+
+    The file is locked through a '<path>.lock' file, re-read and updated,
+    then written in a temporary file of the same directory that is renamed:
+    concurrent jobs never lose each other updates nor read a partial file.
+
+    Parameters
+    ----------
+    path: str
+        path to the '.json' file.
+    update: callable
+        called with the current file content, None if the file does not
+        exist, and returning the new content.
+
+    Returns
+    -------
+    content: object
+        the written content.
+    """
+    dirpath = os.path.dirname(os.path.abspath(path))
+    with open(path + ".lock", "a") as lock_file:
+        fcntl.lockf(lock_file, fcntl.LOCK_EX)
+        try:
+            content = None
+            if os.path.isfile(path):
+                with open(path, "rt") as open_file:
+                    content = json.load(open_file)
+            content = update(content)
+            fd, tmpfile = tempfile.mkstemp(
+                prefix=os.path.basename(path) + ".", dir=dirpath)
+            try:
+                with os.fdopen(fd, "wt") as open_file:
+                    json.dump(content, open_file, sort_keys=True, indent=4)
+                os.rename(tmpfile, path)
+            finally:
+                if os.path.isfile(tmpfile):
+                    os.remove(tmpfile)
+        finally:
+            fcntl.lockf(lock_file, fcntl.LOCK_UN)
+
+    return content
+
+
 def ptk_bundle_to_trk(bundle, trk):
     """ Function that wraps the PtkDwiBundleOperator command line tool from
     Connectomist.
@@ -152,6 +331,109 @@ def gz_compress(file_to_compress, clean=True):
     return gz_file
 
 
+def save_gis(gis, data, voxel_sizes=None):
+    """ Write an array in the GIS format without any conversion.
+
+    A GIS image is composed of a '.dim' text header and of a '.ima' raw
+    binary file where the first axis varies fastest. The array is written
+    with its own data type in little endian byte order, so that the voxels
+    can be streamed from a lazily sliced image.
+
+    Parameters
+    ----------
+    gis: str
+        path to the output '.ima' file.
+    data: array (X, Y, Z) or (X, Y, Z, T)
+        the image voxels.
+    voxel_sizes: 3-uplet or 4-uplet (optional, default None)
+        the voxel sizes, if None use unit voxels.
+
+    Returns
+    -------
+    gis: str
+        path to the generated Gis file.
+    """
+    # Check the data type
+    data = numpy.asarray(data)
+    if data.dtype == bool:
+        data = data.astype(numpy.uint8)
+    if data.dtype.name not in GIS_TYPES:
+        raise ValueError("Unsupported GIS data type '{0}'.".format(
+            data.dtype))
+    if data.ndim not in (3, 4):
+        raise ValueError("A 3D or 4D array is expected.")
+
+    # Add extension if there is none
+    if not gis.endswith(".ima"):
+        gis += ".ima"
+
+    # Write the header
+    shape = list(data.shape) + [1] * (4 - data.ndim)
+    sizes = list(voxel_sizes or []) + [1.] * (4 - len(voxel_sizes or []))
+    with open(gis[:-4] + ".dim", "wt") as open_file:
+        open_file.write("{0}\n".format(" ".join([str(x) for x in shape])))
+        open_file.write("-type {0}\n".format(GIS_TYPES[data.dtype.name]))
+        open_file.write("-dx {0} -dy {1} -dz {2} -dt {3}\n".format(
+            *sizes[:4]))
+        open_file.write("-bo DCBA\n")
+        open_file.write("-om binar\n")
+
+    # Write the voxels: the first axis varies fastest
+    data.T.astype(data.dtype.newbyteorder("<"), copy=False).tofile(gis)
+
+    return gis
+
+
+def load_gis(gis):
+    """ Load a GIS image: the voxels are memory mapped.
+
+    Parameters
+    ----------
+    gis: str
+        path to the '.ima' file.
+
+    Returns
+    -------
+    data: array (X, Y, Z) or (X, Y, Z, T)
+        the image voxels, the fourth dimension is removed for 3D images.
+    voxel_sizes: 4-uplet
+        the voxel sizes.
+    """
+    # Check input existence
+    dim = gis[:-4] + ".dim"
+    for path in (gis, dim):
+        if not os.path.isfile(path):
+            raise ConnectomistBadFileError(path)
+
+    # Read the header: the first line contains the image shape, the other
+    # lines '-key value' items
+    with open(dim, "rt") as open_file:
+        lines = open_file.read().split("\n")
+    try:
+        shape = [int(item) for item in lines[0].split()]
+        shape += [1] * (4 - len(shape))
+        tokens = " ".join(lines[1:]).split()
+        header = dict(zip(tokens[::2], tokens[1::2]))
+        types = dict((value, key) for key, value in GIS_TYPES.items())
+        dtype = numpy.dtype(types[header["-type"]])
+        voxel_sizes = tuple(
+            float(header.get(key, 1.)) for key in ("-dx", "-dy", "-dz", "-dt"))
+    except (ValueError, KeyError):
+        raise ConnectomistBadFileError(dim)
+    if header.get("-bo", "DCBA") == "ABCD":
+        dtype = dtype.newbyteorder(">")
+    else:
+        dtype = dtype.newbyteorder("<")
+
+    # Memory map the voxels: the first axis varies fastest
+    data = numpy.memmap(gis, dtype=dtype, mode="r", shape=tuple(shape[::-1]))
+    data = data.T
+    if shape[3] == 1:
+        data = data[..., 0]
+
+    return data, voxel_sizes
+
+
 def ptk_gis_to_nifti(gis, nifti):
     """ Function that wraps the PtkGis2NiftiConverter command line tool from
     Connectomist.
@@ -0,0 +1,195 @@
+##########################################################################
+# NSAp - Copyright (C) CEA, 2016
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html for details.
+##########################################################################
+
+"""
+An index of the Morphologist result files shared by the processing steps.
+
+The Morphologist hierarchy is '<morphologist_dir>/<subject>/t1mri/
+<timepoint>/' where the T1 image '<subject>.nii[.gz]', the commissure
+coordinates '<subject>.APC' and the 'registration' directory are stored.
+"""
+
+# System import
+import os
+import json
+
+# pyConnectomist import
+from pyconnectomist.utils.filetools import update_json_file
+
+# The indexed items and the associated file names
+MORPHOLOGIST_ITEMS = {
+    "t1": ("{0}.nii.gz", "{0}.nii"),
+    "apc": ("{0}.APC", ),
+    "registration": ("registration", )
+}
+
+
+class MorphologistIndex(object):
+    """ An index of the Morphologist result files.
+
+    Each subject hierarchy is listed once and the resolved paths are
+    reused by all the steps. The index can be cached on disk: a subject
+    entry is reused as long as the modification times of its directories
+    have not changed.
+    """
+    def __init__(self, morphologist_dir, cachefile=None):
+        """ Initialize the MorphologistIndex class.
+
+        Parameters
+        ----------
+        morphologist_dir: str
+            path to the Morphologist processings.
+        cachefile: str (optional, default None)
+            a '.json' file where the index is cached.
+        """
+        self.morphologist_dir = os.path.abspath(morphologist_dir)
+        self.cachefile = cachefile
+        self.subjects = {}
+        self._validated = set()
+        self._updated = set()
+
+        # Load the cache: the entries are validated when accessed
+        if cachefile is not None and os.path.isfile(cachefile):
+            with open(cachefile, "rt") as open_file:
+                cache = json.load(open_file)
+            if cache.get("morphologist_dir") == self.morphologist_dir:
+                self.subjects = cache.get("subjects", {})
+
+    def scan(self, subject_ids=None):
+        """ Index subjects and update the cache.
+
+        Parameters
+        ----------
+        subject_ids: list of str (optional, default None)
+            the subjects to be indexed, by default all the subjects of the
+            Morphologist directory.
+
+        Returns
+        -------
+        index: MorphologistIndex
+            the updated index.
+        """
+        if subject_ids is None:
+            subject_ids = sorted(os.listdir(self.morphologist_dir))
+        for subject_id in subject_ids:
+            self._subject(subject_id)
+        self.save()
+
+        return self
+
+    def find(self, subject_id, item):
+        """ Find the Morphologist files of a subject.
+
+        The files are returned in the same order as the corresponding
+        'glob' patterns would have returned them.
+
+        Parameters
+        ----------
+        subject_id: str
+            the subject identifier.
+        item: str
+            the requested item: 't1', 'apc' or 'registration'.
+
+        Returns
+        -------
+        paths: list of str
+            the matching paths.
+        """
+        if item not in MORPHOLOGIST_ITEMS:
+            raise ValueError("Unknown Morphologist item '{0}'.".format(item))
+        return list(self._subject(subject_id)[item])
+
+    def save(self):
+        """ Merge the updated entries in the cache.
+
+        The cache is shared by concurrent jobs: see 'update_json_file'.
+        """
+        if self.cachefile is None or len(self._updated) == 0:
+            return
+
+        def merge(cache):
+            subjects = {}
+            if (cache is not None and
+                    cache.get("morphologist_dir") == self.morphologist_dir):
+                subjects = cache.get("subjects", {})
+            for subject_id in self._updated:
+                subjects[subject_id] = self.subjects[subject_id]
+            return {"morphologist_dir": self.morphologist_dir,
+                    "subjects": subjects}
+
+        cache = update_json_file(self.cachefile, merge)
+        for subject_id, entry in cache["subjects"].items():
+            if subject_id not in self._validated:
+                self.subjects[subject_id] = entry
+        self._updated.clear()
+
+    def _subject(self, subject_id):
+        """ Get a subject entry, listing its hierarchy if the entry is missing
+        or outdated.
+        """
+        entry = self.subjects.get(subject_id)
+        if subject_id not in self._validated:
+            if entry is None or not self._is_valid(entry):
+                entry = self._scan_subject(subject_id)
+                self.subjects[subject_id] = entry
+                self._updated.add(subject_id)
+            self._validated.add(subject_id)
+        return entry
+
+    def _scan_subject(self, subject_id):
+        """ List a subject hierarchy.
+        """
+        subject_dir = os.path.join(self.morphologist_dir, subject_id)
+        t1mri_dir = os.path.join(subject_dir, "t1mri")
+        entry = {"mtimes": {}}
+        matches = dict((item, [[] for _ in names])
+                       for item, names in MORPHOLOGIST_ITEMS.items())
+        for dirpath in (subject_dir, t1mri_dir):
+            entry["mtimes"][dirpath] = _mtime(dirpath)
+        for timepoint in sorted(_listdir(t1mri_dir) or []):
+            timepoint_dir = os.path.join(t1mri_dir, timepoint)
+            mtime = _mtime(timepoint_dir)
+            names = _listdir(timepoint_dir)
+            if names is None:
+                continue
+            entry["mtimes"][timepoint_dir] = mtime
+            names = set(names)
+            for item, patterns in MORPHOLOGIST_ITEMS.items():
+                for index, pattern in enumerate(patterns):
+                    name = pattern.format(subject_id)
+                    if name in names:
+                        matches[item][index].append(
+                            os.path.join(timepoint_dir, name))
+        for item, paths in matches.items():
+            entry[item] = sum(paths, [])
+        return entry
+
+    def _is_valid(self, entry):
+        """ Check that the subject directories have not been modified.
+        """
+        for dirpath, mtime in entry["mtimes"].items():
+            if _mtime(dirpath) != mtime:
+                return False
+        return True
+
+
+def _listdir(dirpath):
+    """ List a directory, None if it is not a directory.
+    """
+    try:
+        return os.listdir(dirpath)
+    except OSError:
+        return None
+
+
+def _mtime(dirpath):
+    """ The directory modification time, None if it does not exist.
+    """
+    try:
+        return os.path.getmtime(dirpath)
+    except OSError:
+        return None
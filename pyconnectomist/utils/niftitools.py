@@ -0,0 +1,105 @@
+##########################################################################
+# NSAp - Copyright (C) CEA, 2016
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html for details.
+##########################################################################
+
+"""
+A cache of the Nifti header metadata shared by the processing steps.
+"""
+
+# System import
+import os
+import json
+import numpy
+import nibabel
+
+# pyConnectomist import
+from pyconnectomist.utils.filetools import update_json_file
+
+
+class NiftiHeaderCache(object):
+    """ A cache of the Nifti header metadata.
+
+    The shape, voxel sizes, data type and affine of each image are parsed
+    once and stored in a '.json' file with the image size and modification
+    time: an entry is reused as long as the image is not modified.
+    """
+    cachename = "nifti_headers.json"
+
+    def __init__(self, cachefile=None):
+        """ Initialize the NiftiHeaderCache class.
+
+        Parameters
+        ----------
+        cachefile: str (optional, default None)
+            a '.json' file where the metadata are cached, by default the
+            metadata are only kept in memory.
+        """
+        self.cachefile = cachefile
+        self.headers = {}
+        self._updated = set()
+        if cachefile is not None and os.path.isfile(cachefile):
+            with open(cachefile, "rt") as open_file:
+                self.headers = json.load(open_file)
+
+    def get(self, path):
+        """ Get the header metadata of a Nifti image.
+
+        Parameters
+        ----------
+        path: str
+            path to the Nifti image.
+
+        Returns
+        -------
+        metadata: dict
+            the image 'shape' and 'zooms' tuples, 'dtype' name, (4, 4)
+            'affine' array, file 'size' and modification time 'mtime'.
+        """
+        # Check the cache: the image is identified by its path, size and
+        # modification time
+        key = os.path.abspath(path)
+        size = os.path.getsize(path)
+        mtime = os.path.getmtime(path)
+        entry = self.headers.get(key)
+        if entry is None or entry["size"] != size or entry["mtime"] != mtime:
+
+            # Parse the header
+            image = nibabel.load(path)
+            entry = {
+                "shape": [int(dim) for dim in image.shape],
+                "zooms": [float(zoom) for zoom in image.header.get_zooms()],
+                "dtype": str(image.header.get_data_dtype()),
+                "affine": image.affine.tolist(),
+                "size": size,
+                "mtime": mtime}
+            self.headers[key] = entry
+            self._updated.add(key)
+            self.save()
+
+        return {
+            "shape": tuple(entry["shape"]),
+            "zooms": tuple(entry["zooms"]),
+            "dtype": entry["dtype"],
+            "affine": numpy.array(entry["affine"]),
+            "size": entry["size"],
+            "mtime": entry["mtime"]}
+
+    def save(self):
+        """ Merge the updated entries in the cache.
+
+        The cache is shared by concurrent steps: see 'update_json_file'.
+        """
+        if self.cachefile is None or len(self._updated) == 0:
+            return
+
+        def merge(headers):
+            headers = headers or {}
+            for key in self._updated:
+                headers[key] = self.headers[key]
+            return headers
+
+        self.headers = update_json_file(self.cachefile, merge)
+        self._updated.clear()
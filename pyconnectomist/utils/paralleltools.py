@@ -0,0 +1,111 @@
+##########################################################################
+# NSAp - Copyright (C) CEA, 2016
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html for details.
+##########################################################################
+
+"""
+Utility functions to dispatch independent jobs on a pool of workers.
+"""
+
+# System import
+import os
+import math
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+# The cgroup v2 and v1 CPU quota files
+CGROUP_CPU_MAX = "/sys/fs/cgroup/cpu.max"
+CGROUP_CFS_FILES = ("/sys/fs/cgroup/cpu/cpu.cfs_quota_us",
+                    "/sys/fs/cgroup/cpu/cpu.cfs_period_us")
+
+
+def available_cpu_count():
+    """ Count the CPUs the current process can use.
+
+    The count is limited by the process CPU affinity and by the cgroup CPU
+    quota (a container or a batch scheduler allocation), when defined.
+
+    Returns
+    -------
+    nb_cpus: int
+        the number of available CPUs, at least 1.
+    """
+    # The CPUs the process is allowed to run on
+    if hasattr(os, "sched_getaffinity"):
+        nb_cpus = len(os.sched_getaffinity(0))
+    else:
+        nb_cpus = multiprocessing.cpu_count()
+
+    # The cgroup CPU quota
+    quota = _cgroup_cpu_quota()
+    if quota is not None:
+        nb_cpus = min(nb_cpus, int(math.ceil(quota)))
+
+    return max(1, nb_cpus)
+
+
+def _cgroup_cpu_quota():
+    """ The cgroup CPU quota as a number of CPUs, None if unlimited or
+    undefined.
+    """
+    try:
+        if os.path.isfile(CGROUP_CPU_MAX):
+            with open(CGROUP_CPU_MAX, "rt") as open_file:
+                quota, period = open_file.read().split()[:2]
+        else:
+            values = []
+            for path in CGROUP_CFS_FILES:
+                with open(path, "rt") as open_file:
+                    values.append(open_file.read().strip())
+            quota, period = values
+        if quota == "max" or int(quota) <= 0 or int(period) <= 0:
+            return None
+        return float(quota) / float(period)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def parallel_map(func, iterable, nb_workers=1, use_processes=False):
+    """ Apply a function to each element of an iterable using a pool of
+    workers.
+
+    Parameters
+    ----------
+    func: callable
+        the function to be applied: must be defined at the module level
+        if 'use_processes' is True.
+    iterable: iterable
+        the function arguments.
+    nb_workers: int (optional, default 1)
+        the number of workers, if 1 the jobs are executed sequentially in the
+        current thread. If None use all the CPUs available to the process.
+    use_processes: bool (optional, default False)
+        if True use a pool of processes instead of a pool of threads.
+
+    Returns
+    -------
+    results: list
+        the function results in the iterable order.
+    """
+    # Sequential execution
+    iterable = list(iterable)
+    if nb_workers is None:
+        nb_workers = available_cpu_count()
+    nb_workers = min(nb_workers, len(iterable))
+    if nb_workers <= 1:
+        return [func(item) for item in iterable]
+
+    # Parallel execution
+    if use_processes:
+        pool = multiprocessing.Pool(nb_workers)
+    else:
+        pool = ThreadPool(nb_workers)
+    try:
+        results = pool.map(func, iterable)
+    finally:
+        pool.close()
+        pool.join()
+
+    return results
@@ -0,0 +1,385 @@
+##########################################################################
+# NSAp - Copyright (C) CEA, 2016
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html for details.
+##########################################################################
+
+"""
+Pre-flight validation of the preprocessing and tractography inputs.
+
+All the checks are performed in one pass and only read the Nifti headers and
+the gradient text files, so that a bad input is reported before any
+Connectomist step is launched. Each 'check_*' function returns the list of
+detected problems.
+"""
+
+# System import
+import os
+import glob
+import numpy
+import nibabel
+
+# pyConnectomist import
+from pyconnectomist.exceptions import ConnectomistError
+from pyconnectomist.manufacturers import MANUFACTURERS
+from pyconnectomist.utils.dwitools import GradientTable
+from pyconnectomist.preproc.all_steps import STEPS as PREPROC_STEPS
+
+# The tolerated deviation of the diffusion b-vectors norm from one
+BVEC_NORM_TOLERANCE = 0.1
+
+# The acquisition axes
+AXES = ("x", "y", "z")
+
+# The Connectomist preprocessing folders needed by the tractography
+TRACTOGRAPHY_PREPROC_STEPS = [PREPROC_STEPS[index] for index in (1, 2, 5)]
+
+
+def load_header(path, problems):
+    """ Load a Nifti image without reading its voxel data.
+
+    Parameters
+    ----------
+    path: str
+        path to the Nifti image.
+    problems: list of str
+        the detected problems, updated inplace.
+
+    Returns
+    -------
+    image: nibabel image
+        the proxy image or None if the file can't be loaded.
+    """
+    if not os.path.isfile(path):
+        problems.append("Missing file '{0}'.".format(path))
+        return None
+    try:
+        return nibabel.load(path)
+    except Exception as error:
+        problems.append("Can't read the header of '{0}': {1}".format(
+            path, error))
+        return None
+
+
+def check_diffusion_inputs(dwis, bvals, bvecs):
+    """ Check the diffusion sequences and their gradient files.
+
+    Parameters
+    ----------
+    dwis: list of str
+        path to the Nifti diffusion sequences.
+    bvals: list of str
+        path to the associated b-values files.
+    bvecs: list of str
+        path to the associated b-vectors files.
+
+    Returns
+    -------
+    problems: list of str
+        the detected problems.
+    """
+    problems = []
+    if len(dwis) == 0:
+        problems.append("No diffusion sequence specified.")
+    if len(bvals) != len(dwis) or len(bvecs) != len(dwis):
+        problems.append(
+            "{0} diffusion sequences, {1} b-values and {2} b-vectors files "
+            "specified.".format(len(dwis), len(bvals), len(bvecs)))
+        return problems
+
+    # Go through all sequences
+    spatial_shapes = set()
+    for dwi, bval, bvec in zip(dwis, bvals, bvecs):
+
+        # Check the gradients
+        gtab = None
+        for path in (bval, bvec):
+            if not os.path.isfile(path):
+                problems.append("Missing file '{0}'.".format(path))
+        if os.path.isfile(bval) and os.path.isfile(bvec):
+            try:
+                gtab = GradientTable(numpy.loadtxt(bval, ndmin=1),
+                                     numpy.loadtxt(bvec, ndmin=2))
+            except ValueError as error:
+                problems.append("Invalid gradients '{0}' and '{1}': "
+                                "{2}".format(bval, bvec, error))
+        if gtab is not None:
+            if gtab.bvecs.shape[1] != 3:
+                problems.append("'{0}' does not contain 3 components "
+                                "b-vectors.".format(bvec))
+            if (gtab.bvals < 0).any():
+                problems.append("Negative b-values in '{0}'.".format(bval))
+            norms = numpy.linalg.norm(gtab.bvecs, axis=1)
+            invalid = numpy.flatnonzero(
+                (numpy.abs(norms - 1) > BVEC_NORM_TOLERANCE) &
+                ((norms > 0) | ~gtab.b0_mask))
+            if len(invalid) > 0:
+                problems.append(
+                    "Non unit b-vectors in '{0}' at volumes {1}.".format(
+                        bvec, invalid.tolist()))
+
+        # Check the diffusion sequence header
+        image = load_header(dwi, problems)
+        if image is None:
+            continue
+        if len(image.shape) != 4:
+            problems.append("'{0}' is not a 4D image.".format(dwi))
+            continue
+        spatial_shapes.add(tuple(image.shape[:3]))
+        if gtab is not None and image.shape[3] != len(gtab.bvals):
+            problems.append(
+                "'{0}' contains {1} volumes but {2} gradients are "
+                "specified.".format(dwi, image.shape[3], len(gtab.bvals)))
+    if len(spatial_shapes) > 1:
+        problems.append("The diffusion sequences have different "
+                        "shapes: {0}.".format(sorted(spatial_shapes)))
+
+    return problems
+
+
+def check_fieldmap_inputs(b0_magnitude, b0_phase=None):
+    """ Check the B0 fieldmap images.
+
+    Parameters
+    ----------
+    b0_magnitude: str
+        path to the B0 magnitude map, that also contains the phase when no
+        phase map is specified.
+    b0_phase: str (optional, default None)
+        path to the B0 phase map.
+
+    Returns
+    -------
+    problems: list of str
+        the detected problems.
+    """
+    problems = []
+    magnitude = load_header(b0_magnitude, problems)
+    phase = None
+    if b0_phase is not None:
+        phase = load_header(b0_phase, problems)
+    if magnitude is None:
+        return problems
+
+    # Magnitude and phase in the same file: 2 volumes expected
+    if phase is None and b0_phase is None:
+        if len(magnitude.shape) != 4 or magnitude.shape[3] != 2:
+            problems.append(
+                "'{0}' should contain the magnitude and phase volumes when "
+                "no phase map is specified, got shape {1}.".format(
+                    b0_magnitude, magnitude.shape))
+    elif phase is not None:
+        if magnitude.shape[:3] != phase.shape[:3]:
+            problems.append(
+                "The B0 magnitude {0} and phase {1} maps have different "
+                "shapes.".format(magnitude.shape, phase.shape))
+        for image, path in ((magnitude, b0_magnitude), (phase, b0_phase)):
+            if len(image.shape) not in (3, 4) or (
+                    len(image.shape) == 4 and image.shape[3] != 1):
+                problems.append("'{0}' is not a 3D image.".format(path))
+
+    return problems
+
+
+def check_acquisition_parameters(manufacturer, phase_axis="y",
+                                 slice_axis="z"):
+    """ Check the acquisition parameters.
+
+    Parameters
+    ----------
+    manufacturer: str
+        the name of the manufacturer.
+    phase_axis: str (optional, default 'y')
+        the acquistion phase axis 'x', 'y' or 'z'.
+    slice_axis: str (optional, default 'z')
+        the acquistion slice axis 'x', 'y' or 'z'.
+
+    Returns
+    -------
+    problems: list of str
+        the detected problems.
+    """
+    problems = []
+    if manufacturer not in MANUFACTURERS:
+        problems.append(
+            "Incorrect manufacturer name: '{0}', should be in {1}.".format(
+                manufacturer, sorted(MANUFACTURERS)))
+    for axis in (phase_axis, slice_axis):
+        if axis not in AXES:
+            problems.append("Invalid axis '{0}'.".format(axis))
+    if phase_axis == slice_axis:
+        problems.append("The phase and slice axes are both '{0}'.".format(
+            phase_axis))
+
+    return problems
+
+
+def check_morphologist_inputs(morphologist_dir, subject_id, t1=True,
+                              registration=False, morphologist_index=None):
+    """ Check the Morphologist result files.
+
+    Parameters
+    ----------
+    morphologist_dir: str
+        path to the Morphologist processings.
+    subject_id: str
+        the subject identifier.
+    t1: bool (optional, default True)
+        if True check the T1 image used by the registration and brain mask
+        steps.
+    registration: bool (optional, default False)
+        if True check the Talairach transformation used by the bundle
+        labeling.
+    morphologist_index: MorphologistIndex (optional, default None)
+        an index of the Morphologist files used instead of listing the
+        Morphologist directory.
+
+    Returns
+    -------
+    problems: list of str
+        the detected problems.
+    """
+    problems = []
+    if morphologist_dir is None or not os.path.isdir(morphologist_dir):
+        problems.append("Missing Morphologist directory '{0}'.".format(
+            morphologist_dir))
+        return problems
+
+    # The commissure coordinates and the T1 image
+    t1mri_dir = os.path.join(morphologist_dir, subject_id, "t1mri", "*")
+    apcpattern = os.path.join(t1mri_dir, "{0}.APC".format(subject_id))
+    if len(_find(morphologist_index, subject_id, "apc",
+                 [apcpattern])) != 1:
+        problems.append("Expect one file matching '{0}'.".format(apcpattern))
+    if t1:
+        t1patterns = [os.path.join(t1mri_dir, subject_id + ext)
+                      for ext in (".nii.gz", ".nii")]
+        t1files = _find(morphologist_index, subject_id, "t1", t1patterns)
+        if len(t1files) != 1:
+            problems.append("Expect one file matching {0}.".format(
+                t1patterns))
+        else:
+            image = load_header(t1files[0], problems)
+            if image is not None and len(image.shape) != 3:
+                problems.append("'{0}' is not a 3D image.".format(
+                    t1files[0]))
+
+    # The Talairach transformation
+    if registration:
+        regpattern = os.path.join(t1mri_dir, "registration")
+        regdirs = _find(morphologist_index, subject_id, "registration",
+                        [regpattern])
+        if len(regdirs) != 1:
+            problems.append("Expect one folder matching '{0}'.".format(
+                regpattern))
+        else:
+            timepoint = regdirs[0].split(os.sep)[-2]
+            t1total = os.path.join(
+                regdirs[0], "RawT1-{0}_{1}_TO_Talairach-ACPC.trm".format(
+                    subject_id, timepoint))
+            if not os.path.isfile(t1total):
+                problems.append("Missing file '{0}'.".format(t1total))
+
+    return problems
+
+
+def preflight(
+        subject_id,
+        morphologist_dir,
+        dwis=None,
+        bvals=None,
+        bvecs=None,
+        manufacturer=None,
+        b0_magnitude=None,
+        b0_phase=None,
+        phase_axis="y",
+        slice_axis="z",
+        dwi_preproc_dir=None,
+        morphologist_index=None,
+        raise_error=True):
+    """ Check in one pass all the inputs of the preprocessing and/or the
+    tractography.
+
+    The preprocessing inputs are checked when the diffusion sequences are
+    specified, the tractography inputs when the preprocessing directory
+    is specified.
+
+    Parameters
+    ----------
+    subject_id: str
+        the subject identifier.
+    morphologist_dir: str
+        path to the Morphologist processings.
+    dwis, bvals, bvecs: list of str (optional, default None)
+        path to the Nifti diffusion sequences and their gradient files.
+    manufacturer: str (optional, default None)
+        the name of the manufacturer.
+    b0_magnitude: str (optional, default None)
+        path to the B0 magnitude map.
+    b0_phase: str (optional, default None)
+        path to the B0 phase map.
+    phase_axis: str (optional, default 'y')
+        the acquistion phase axis 'x', 'y' or 'z'.
+    slice_axis: str (optional, default 'z')
+        the acquistion slice axis 'x', 'y' or 'z'.
+    dwi_preproc_dir: str (optional, default None)
+        path to the Connectomist preprocessings used by the tractography.
+    morphologist_index: MorphologistIndex (optional, default None)
+        an index of the Morphologist files used instead of listing the
+        Morphologist directory.
+    raise_error: bool (optional, default True)
+        if True raise a ConnectomistError listing all the detected
+        problems.
+
+    Returns
+    -------
+    problems: list of str
+        the detected problems.
+    """
+    problems = []
+
+    # Preprocessing inputs
+    if dwis is not None:
+        problems.extend(check_diffusion_inputs(dwis, bvals or [],
+                                               bvecs or []))
+        problems.extend(check_acquisition_parameters(
+            manufacturer, phase_axis, slice_axis))
+        if b0_magnitude is not None:
+            problems.extend(check_fieldmap_inputs(b0_magnitude, b0_phase))
+        elif b0_phase is not None:
+            problems.append("A B0 phase map is specified without a "
+                            "magnitude map.")
+
+    # Tractography inputs
+    if dwi_preproc_dir is not None:
+        for name in TRACTOGRAPHY_PREPROC_STEPS:
+            step_dir = os.path.join(dwi_preproc_dir, name)
+            if not os.path.isdir(step_dir):
+                problems.append(
+                    "In '{0}' can't detect Connectomist folder "
+                    "'{1}'.".format(dwi_preproc_dir, name))
+
+    # Morphologist inputs
+    problems.extend(check_morphologist_inputs(
+        morphologist_dir, subject_id, t1=(dwis is not None),
+        registration=(dwi_preproc_dir is not None),
+        morphologist_index=morphologist_index))
+
+    if raise_error and len(problems) > 0:
+        raise ConnectomistError(
+            "Pre-flight check failed for subject '{0}':\n- {1}".format(
+                subject_id, "\n- ".join(problems)))
+
+    return problems
+
+
+def _find(morphologist_index, subject_id, item, patterns):
+    """ Find Morphologist files from the index or from 'glob' patterns.
+    """
+    if morphologist_index is not None:
+        return morphologist_index.find(subject_id, item)
+    paths = []
+    for pattern in patterns:
+        paths.extend(glob.glob(pattern))
+    return paths
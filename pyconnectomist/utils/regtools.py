@@ -0,0 +1,534 @@
+##########################################################################
+# NSAp - Copyright (C) CEA, 2016
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html for details.
+##########################################################################
+
+"""
+Utility functions to read the AIMS/Connectomist '.trm' transformations,
+derive motion quality control metrics from them, seed registrations and
+map the Connectomist space to the Nifti world space.
+
+A '.trm' file stores an affine transformation as four lines: the
+translation, then the three rows of the linear part.
+"""
+
+# System import
+import os
+import re
+import json
+import warnings
+import numpy
+import nibabel
+
+# pyConnectomist import
+from pyconnectomist.exceptions import ConnectomistBadFileError
+
+# Orientation of the Connectomist voxel and mm spaces
+CONNECTOMIST_AXCODES = ("L", "P", "I")
+
+# The head radius in mm used to convert the rotations in displacements
+HEAD_RADIUS = 50.
+
+# The warm start optimizer search range scale and maximum iteration count
+WARM_START_SEARCH_SCALE = 0.2
+WARM_START_ITERATION_COUNT = 200
+
+# The registration presets overriding the Connectomist registration
+# parameter blocks: 'subSamplingLevelCount' is the number of kept
+# subsampling levels, starting from the coarsest one (None keeps them all)
+REGISTRATION_PRESETS = {
+    "fast": {
+        "levelCount": 16,
+        "maximumIterationCount": 250,
+        "stepSize": 0.2,
+        "stoppingCriterionError": 0.05,
+        "maximumTolerance": 0.05,
+        "subSamplingLevelCount": 1},
+    "balanced": {
+        "levelCount": 32,
+        "maximumIterationCount": 1000,
+        "stepSize": 0.1,
+        "stoppingCriterionError": 0.01,
+        "maximumTolerance": 0.01,
+        "subSamplingLevelCount": None},
+    "accurate": {
+        "levelCount": 64,
+        "maximumIterationCount": 2000,
+        "stepSize": 0.05,
+        "stoppingCriterionError": 0.001,
+        "maximumTolerance": 0.001,
+        "subSamplingLevelCount": None}
+}
+
+# The motion table columns
+MOTION_COLUMNS = [
+    "volume", "translation_x", "translation_y", "translation_z",
+    "rotation_x", "rotation_y", "rotation_z", "absolute_translation",
+    "absolute_rotation", "relative_translation", "relative_rotation",
+    "framewise_displacement", "gradient_rotation"]
+
+
+def read_trms(paths):
+    """ Read '.trm' transformations.
+
+    Parameters
+    ----------
+    paths: list of str
+        path to the '.trm' files.
+
+    Returns
+    -------
+    affines: array (N, 4, 4)
+        the affine transformations.
+    """
+    # Gather all the values and parse them at once
+    tokens = []
+    for path in paths:
+        if not os.path.isfile(path):
+            raise ConnectomistBadFileError(path)
+        with open(path, "rt") as open_file:
+            values = open_file.read().split()
+        if len(values) != 12:
+            raise ConnectomistBadFileError(path)
+        tokens.extend(values)
+    try:
+        values = numpy.array(tokens, dtype=numpy.float64).reshape(-1, 12)
+    except ValueError:
+        raise ConnectomistBadFileError(paths[0])
+
+    # Build the affine matrices
+    affines = numpy.zeros((len(values), 4, 4), dtype=numpy.float64)
+    affines[:, :3, :3] = values[:, 3:].reshape(-1, 3, 3)
+    affines[:, :3, 3] = values[:, :3]
+    affines[:, 3, 3] = 1
+
+    return affines
+
+
+def natural_sort(paths):
+    """ Sort paths by taking into account their numbers, so that 'trm10'
+    comes after 'trm9'.
+
+    Parameters
+    ----------
+    paths: list of str
+        the paths to be sorted.
+
+    Returns
+    -------
+    paths: list of str
+        the sorted paths.
+    """
+    return sorted(paths, key=lambda path: [
+        int(item) if item.isdigit() else item
+        for item in re.split(r"(\d+)", path)])
+
+
+def rotation_matrices(affines):
+    """ Extract the closest rotation of each affine linear part.
+
+    Parameters
+    ----------
+    affines: array (N, 4, 4)
+        the affine transformations.
+
+    Returns
+    -------
+    rotations: array (N, 3, 3)
+        the rotation matrices obtained by polar decomposition.
+    """
+    left, _, right = numpy.linalg.svd(affines[:, :3, :3])
+    rotations = numpy.matmul(left, right)
+    flipped = numpy.linalg.det(rotations) < 0
+    left[flipped, :, 2] *= -1
+    rotations[flipped] = numpy.matmul(left[flipped], right[flipped])
+
+    return rotations
+
+
+def rotation_angles(rotations):
+    """ Compute the angle of rotations.
+
+    Parameters
+    ----------
+    rotations: array (N, 3, 3)
+        the rotation matrices.
+
+    Returns
+    -------
+    angles: array (N, )
+        the rotation angles in radians.
+    """
+    cosines = (numpy.trace(rotations, axis1=1, axis2=2) - 1) / 2
+
+    return numpy.arccos(numpy.clip(cosines, -1, 1))
+
+
+def euler_angles(rotations):
+    """ Decompose rotations as successive rotations around the x, y and z
+    axes: R = Rz Ry Rx.
+
+    Parameters
+    ----------
+    rotations: array (N, 3, 3)
+        the rotation matrices.
+
+    Returns
+    -------
+    angles: array (N, 3)
+        the rotation angles around the x, y and z axes in radians.
+    """
+    return numpy.stack((
+        numpy.arctan2(rotations[:, 2, 1], rotations[:, 2, 2]),
+        numpy.arcsin(numpy.clip(-rotations[:, 2, 0], -1, 1)),
+        numpy.arctan2(rotations[:, 1, 0], rotations[:, 0, 0])), axis=1)
+
+
+def motion_metrics(affines, bvecs=None, radius=HEAD_RADIUS):
+    """ Compute the motion quality control metrics of a series of volume
+    transformations.
+
+    The framewise displacement is the sum of the absolute translation and
+    rotation (converted to a displacement on a sphere of radius 'radius')
+    parameter differences between consecutive volumes.
+
+    Parameters
+    ----------
+    affines: array (N, 4, 4)
+        the volume transformations.
+    bvecs: array (N, 3) (optional, default None)
+        the corrected diffusion gradient orientations, used to compute the
+        gradient rotation angles.
+    radius: float (optional, default 50)
+        the head radius in mm.
+
+    Returns
+    -------
+    metrics: dict
+        the (N, ) metrics named as in 'MOTION_COLUMNS', the translations in
+        mm and the rotations in degrees.
+    """
+    # Absolute motion
+    rotations = rotation_matrices(affines)
+    translations = affines[:, :3, 3]
+    eulers = euler_angles(rotations)
+    metrics = {
+        "volume": numpy.arange(len(affines)),
+        "absolute_translation": numpy.linalg.norm(translations, axis=1),
+        "absolute_rotation": numpy.degrees(rotation_angles(rotations))}
+    for index, axis in enumerate("xyz"):
+        metrics["translation_" + axis] = translations[:, index]
+        metrics["rotation_" + axis] = numpy.degrees(eulers[:, index])
+
+    # Relative motion: the first volume does not move
+    metrics["relative_translation"] = numpy.zeros((len(affines), ))
+    metrics["relative_rotation"] = numpy.zeros((len(affines), ))
+    metrics["framewise_displacement"] = numpy.zeros((len(affines), ))
+    if len(affines) > 1:
+        metrics["relative_translation"][1:] = numpy.linalg.norm(
+            numpy.diff(translations, axis=0), axis=1)
+        metrics["relative_rotation"][1:] = numpy.degrees(rotation_angles(
+            numpy.matmul(rotations[1:],
+                         numpy.transpose(rotations[:-1], (0, 2, 1)))))
+        metrics["framewise_displacement"][1:] = (
+            numpy.abs(numpy.diff(translations, axis=0)).sum(axis=1) +
+            radius * numpy.abs(numpy.diff(eulers, axis=0)).sum(axis=1))
+
+    # Gradient rotation: angle between the corrected and original
+    # orientations
+    metrics["gradient_rotation"] = numpy.zeros((len(affines), ))
+    if bvecs is not None:
+        bvecs = numpy.asarray(bvecs, dtype=numpy.float64)
+        norms = numpy.linalg.norm(bvecs, axis=1)
+        valid = norms > 0
+        bvecs = bvecs[valid] / norms[valid, numpy.newaxis]
+        originals = numpy.einsum("nji,nj->ni", rotations[valid], bvecs)
+        cosines = numpy.sum(originals * bvecs, axis=1)
+        metrics["gradient_rotation"][valid] = numpy.degrees(
+            numpy.arccos(numpy.clip(cosines, -1, 1)))
+
+    return metrics
+
+
+def save_motion_metrics(metrics, tsvfile, jsonfile):
+    """ Save the motion metrics table and their summary.
+
+    Parameters
+    ----------
+    metrics: dict
+        the motion metrics as returned by 'motion_metrics'.
+    tsvfile: str
+        path to the tab separated metrics table.
+    jsonfile: str
+        path to the summary scalars.
+
+    Returns
+    -------
+    tsvfile, jsonfile: str
+        path to the metrics table and summary.
+    """
+    # Save the table
+    table = numpy.stack([metrics[name] for name in MOTION_COLUMNS], axis=1)
+    numpy.savetxt(tsvfile, table, delimiter="\t", comments="",
+                  header="\t".join(MOTION_COLUMNS),
+                  fmt=["%d"] + ["%.6f"] * (len(MOTION_COLUMNS) - 1))
+
+    # Save the summary
+    summary = {"nb_volumes": len(metrics["volume"])}
+    for name in ("absolute_translation", "absolute_rotation",
+                 "relative_translation", "relative_rotation",
+                 "framewise_displacement", "gradient_rotation"):
+        values = metrics[name]
+        summary["mean_" + name] = float(values.mean()) if len(values) else 0.
+        summary["max_" + name] = float(values.max()) if len(values) else 0.
+    with open(jsonfile, "wt") as open_file:
+        json.dump(summary, open_file, sort_keys=True, indent=4)
+
+    return tsvfile, jsonfile
+
+
+def connectomist_orientation(affine, tolerance=1e-3):
+    """ Get the transformation from a Nifti voxel order to the Connectomist
+    LPI voxel order.
+
+    Parameters
+    ----------
+    affine: array (4, 4)
+        the Nifti image affine transformation.
+    tolerance: float (optional, default 1e-3)
+        the tolerance on the image axes alignment.
+
+    Returns
+    -------
+    to_connectomist: array (3, 2)
+        the nibabel orientation transformation, None if the image axes are
+        not aligned with the world axes.
+    """
+    axes = numpy.asarray(affine, dtype=float)[:3, :3]
+    axes = axes / numpy.linalg.norm(axes, axis=0)
+    if not numpy.allclose(numpy.abs(axes).max(axis=0), 1, atol=tolerance):
+        return None
+
+    return nibabel.orientations.ornt_transform(
+        nibabel.orientations.io_orientation(affine),
+        nibabel.orientations.axcodes2ornt(CONNECTOMIST_AXCODES))
+
+
+def connectomist_to_rasmm(affine, shape):
+    """ Compute the transformation from the Connectomist mm space to the
+    world RAS+ mm space of a Nifti image defined on the Connectomist grid.
+
+    The Connectomist coordinates are the LPI voxel indices scaled by the
+    voxel sizes: the voxel indices are reoriented in the Nifti voxel order,
+    flipping an axis over the image extent, then mapped with the Nifti
+    affine.
+
+    Parameters
+    ----------
+    affine: array (4, 4)
+        the Nifti image affine transformation.
+    shape: 3-uplet
+        the Nifti image shape.
+
+    Returns
+    -------
+    to_rasmm: array (4, 4)
+        the Connectomist mm to RAS+ mm transformation.
+    """
+    # Check the image is not oblique
+    affine = numpy.asarray(affine, dtype=numpy.float64)
+    to_connectomist = connectomist_orientation(affine)
+    if to_connectomist is None:
+        raise ValueError("An oblique image is not defined on the "
+                         "Connectomist grid.")
+
+    # Build the Connectomist mm to Nifti voxel transformation
+    voxel_sizes = numpy.linalg.norm(affine[:3, :3], axis=0)
+    to_voxel = numpy.eye(4)
+    to_voxel[:3, :3] = 0
+    for axis, (target, flip) in enumerate(
+            nibabel.orientations.ornt_transform(
+                nibabel.orientations.axcodes2ornt(CONNECTOMIST_AXCODES),
+                nibabel.orientations.io_orientation(affine))):
+        target = int(target)
+        to_voxel[target, axis] = flip / voxel_sizes[target]
+        if flip < 0:
+            to_voxel[target, 3] = shape[target] - 1
+
+    return numpy.dot(affine, to_voxel)
+
+
+def affine_parameters(affine):
+    """ Decompose an affine transformation in registration parameters.
+
+    The linear part is factorized as 'R K' where R is a rotation (R = Rz Ry
+    Rx) and K an upper triangular matrix holding the scalings on its
+    diagonal and the shearings above it.
+
+    Parameters
+    ----------
+    affine: array (4, 4)
+        the affine transformation.
+
+    Returns
+    -------
+    parameters: dict
+        the 'TranslationX/Y/Z' in mm, 'RotationX/Y/Z' in degrees,
+        'ScalingX/Y/Z' and 'ShearingXY/XZ/YZ' parameters.
+    """
+    # Factorize the linear part with positive scalings
+    rotation, upper = numpy.linalg.qr(affine[:3, :3])
+    signs = numpy.sign(numpy.diag(upper))
+    signs[signs == 0] = 1
+    rotation = rotation * signs
+    upper = upper * signs[:, numpy.newaxis]
+
+    # Gather the parameters
+    angles = numpy.degrees(euler_angles(rotation[numpy.newaxis])[0])
+    parameters = {
+        "ShearingXY": upper[0, 1] / upper[0, 0],
+        "ShearingXZ": upper[0, 2] / upper[0, 0],
+        "ShearingYZ": upper[1, 2] / upper[1, 1]}
+    for index, axis in enumerate("XYZ"):
+        parameters["Translation" + axis] = affine[index, 3]
+        parameters["Rotation" + axis] = angles[index]
+        parameters["Scaling" + axis] = upper[index, index]
+
+    return dict((name, float(value)) for name, value in parameters.items())
+
+
+def parameters_affine(parameters):
+    """ Compose an affine transformation from registration parameters: the
+    inverse of 'affine_parameters'.
+
+    Parameters
+    ----------
+    parameters: dict
+        the 'TranslationX/Y/Z' in mm, 'RotationX/Y/Z' in degrees,
+        'ScalingX/Y/Z' and 'ShearingXY/XZ/YZ' parameters.
+
+    Returns
+    -------
+    affine: array (4, 4)
+        the affine transformation.
+    """
+    angles = numpy.radians([parameters["Rotation" + axis] for axis in "XYZ"])
+    cosines, sines = numpy.cos(angles), numpy.sin(angles)
+    rotations = []
+    for index, (cosine, sine) in enumerate(zip(cosines, sines)):
+        axes = [axis for axis in range(3) if axis != index]
+        rotation = numpy.eye(3)
+        rotation[numpy.ix_(axes, axes)] = [[cosine, -sine], [sine, cosine]]
+        if index == 1:
+            rotation = rotation.T
+        rotations.append(rotation)
+    scalings = [parameters["Scaling" + axis] for axis in "XYZ"]
+    upper = numpy.diag(scalings)
+    upper[0, 1] = parameters["ShearingXY"] * scalings[0]
+    upper[0, 2] = parameters["ShearingXZ"] * scalings[0]
+    upper[1, 2] = parameters["ShearingYZ"] * scalings[1]
+    affine = numpy.eye(4)
+    affine[:3, :3] = numpy.dot(
+        numpy.dot(numpy.dot(rotations[2], rotations[1]), rotations[0]), upper)
+    affine[:3, 3] = [parameters["Translation" + axis] for axis in "XYZ"]
+
+    return affine
+
+
+def apply_registration_preset(parameters, preset=None):
+    """ Override Connectomist registration parameters with a preset.
+
+    Parameters
+    ----------
+    parameters: dict
+        the Connectomist registration parameters.
+    preset: str (optional, default None)
+        the registration preset: 'fast', 'balanced' or 'accurate'. If None
+        the parameters are not modified.
+
+    Returns
+    -------
+    parameters: dict
+        the updated registration parameters.
+    """
+    if preset is None:
+        return parameters
+    if preset not in REGISTRATION_PRESETS:
+        raise ValueError("Unsupported registration preset '{0}' (must be in "
+                         "{1}).".format(preset, sorted(REGISTRATION_PRESETS)))
+    parameters = dict(parameters)
+    for name, value in REGISTRATION_PRESETS[preset].items():
+        if name == "subSamplingLevelCount":
+            if value is not None:
+                sizes = str(parameters["subSamplingMaximumSizes"]).split()
+                parameters["subSamplingMaximumSizes"] = " ".join(
+                    sizes[:value])
+        elif name in parameters:
+            parameters[name] = value
+
+    return parameters
+
+
+def warm_start_registration(
+        parameters,
+        trmfile,
+        search_scale=WARM_START_SEARCH_SCALE,
+        iteration_count=WARM_START_ITERATION_COUNT):
+    """ Seed Connectomist registration parameters from a prior
+    transformation.
+
+    The initial parameters are set from the prior transformation, the
+    optimizer search ranges are scaled down and the maximum number of
+    iterations is reduced, since the registration starts close to the
+    solution. The decomposition follows the 'affine_parameters' convention:
+    the parameters are returned unchanged, with a warning, if the
+    transformation cannot be decomposed exactly (a reflection) or if the
+    registration parameters miss an initial parameter.
+
+    Parameters
+    ----------
+    parameters: dict
+        the Connectomist registration parameters.
+    trmfile: str
+        path to the prior '.trm' transformation, computed by the same
+        registration on a previous run or an earlier timepoint.
+    search_scale: float (optional, default 0.2)
+        the factor applied to the optimizer search ranges, 1 to keep them.
+    iteration_count: int (optional, default 200)
+        the maximum number of iterations, None to keep it.
+
+    Returns
+    -------
+    parameters: dict
+        the seeded registration parameters.
+    """
+    # Check the transformation decomposition and the registration
+    # parametrization
+    affine = read_trms([trmfile])[0]
+    initial_parameters = affine_parameters(affine)
+    if not numpy.allclose(parameters_affine(initial_parameters), affine,
+                          atol=1e-4):
+        warnings.warn("The '{0}' transformation cannot be decomposed in "
+                      "registration parameters, no warm start.".format(
+                          trmfile))
+        return parameters
+    for name in initial_parameters:
+        for prefix in ("initialParameters", "optimizerParameters"):
+            if prefix + name not in parameters:
+                warnings.warn("No '{0}' registration parameter, no warm "
+                              "start.".format(prefix + name))
+                return parameters
+
+    # Seed the registration
+    parameters = dict(parameters)
+    for name, value in initial_parameters.items():
+        parameters["initialParameters" + name] = value
+        parameters["optimizerParameters" + name] *= search_scale
+    parameters["initializeCoefficientsUsingCenterOfGravity"] = False
+    if iteration_count is not None:
+        parameters["maximumIterationCount"] = min(
+            parameters["maximumIterationCount"], iteration_count)
+
+    return parameters
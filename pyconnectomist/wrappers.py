@@ -15,6 +15,7 @@ import re
 import warnings
 import time
 import subprocess
+import threading
 import json
 
 # Clindmri import
@@ -60,7 +61,8 @@ class ConnectomistWrapper(object):
         if self.exitcode != 0:
             raise ConnectomistConfigurationError(self.path_connectomist)
 
-    def __call__(self, algorithm, parameter_file, outdir):
+    def __call__(self, algorithm, parameter_file, outdir,
+                 track_memory=False):
         """ Run the Connectomist 'algorithm' (tab in UI).
 
         Parameters
@@ -72,6 +74,10 @@ class ConnectomistWrapper(object):
             file to set the connectomist tab input parameters.
         outdir: str
             path to directory where the algorithm outputs.
+        track_memory: bool (optional, default False)
+            if True, store in the 'peak_memory' attribute the peak resident
+            memory in KB of this call (the Connectomist process and the
+            processes it waited for).
 
         Raises
         ------
@@ -86,7 +92,11 @@ class ConnectomistWrapper(object):
             env=self.environment,
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE)
-        self.stdout, self.stderr = process.communicate()
+        if track_memory:
+            self.stdout, self.stderr, self.peak_memory = _wait_with_usage(
+                process)
+        else:
+            self.stdout, self.stderr = process.communicate()
         self.exitcode = process.returncode
         if self.exitcode != 0:
             error_message = ["STDOUT", "----", self.stdout, "STDERR", "----",
@@ -208,3 +218,46 @@ class PtkWrapper(object):
                              self.stderr]
             error_message = "\n".join(error_message)
             raise ConnectomistRuntimeError("PTK", self.cmd, error_message)
+
+
+def _wait_with_usage(process):
+    """ Wait for a process and get its own resource usage.
+
+    'communicate' reaps the process without returning its resource usage,
+    and the RUSAGE_CHILDREN usage of the current process is the maximum over
+    all the children ever waited for: the pipes are drained in threads and
+    the process is reaped with 'wait4'.
+
+    Parameters
+    ----------
+    process: subprocess.Popen
+        a process started with piped stdout and stderr.
+
+    Returns
+    -------
+    stdout, stderr: str
+        the process outputs.
+    peak_memory: int
+        the peak resident memory of the process and of its waited children
+        in KB.
+    """
+    outputs = {}
+
+    def read(name):
+        stream = getattr(process, name)
+        outputs[name] = stream.read()
+        stream.close()
+
+    threads = [threading.Thread(target=read, args=(name, ))
+               for name in ("stdout", "stderr")]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    _, status, usage = os.wait4(process.pid, 0)
+    if os.WIFSIGNALED(status):
+        process.returncode = -os.WTERMSIG(status)
+    else:
+        process.returncode = os.WEXITSTATUS(status)
+
+    return outputs["stdout"], outputs["stderr"], usage.ru_maxrss